@@ -0,0 +1,128 @@
+# answer_cache.py (v1.1 - Cache de Respostas para Perguntas Repetidas)
+import re
+import time
+import hashlib
+import logging
+import unicodedata
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ANSWER_TTL_SECONDS = 60 * 60
+DEFAULT_MAX_ANSWERS = 1000
+ANSWER_KEY_PREFIX = "resposta:"
+
+def normalize_question(question: str) -> str:
+    """Minúsculas, sem acentos, pontuação e espaços extras: 'Vocês aceitam Unimed?' == 'voces aceitam unimed'."""
+    text = unicodedata.normalize("NFKD", question.lower())
+    text = "".join(char for char in text if not unicodedata.combining(char))
+    return " ".join(re.sub(r"[^\w\s]", " ", text).split())
+
+def answer_cache_key(knowledge_version: Optional[float], block_key: str, scheduling_state: Optional[str], first_turn: bool,
+                     question: str, tenant_id: str = "default") -> str:
+    """
+    Chave = clínica + versão da base + bloco do RAG + estado do agendamento + se é a primeira mensagem da conversa
+    (na primeira a Margot se apresenta; nas seguintes, não) + hash da pergunta normalizada (o mesmo bloco responde
+    perguntas diferentes: 'aceitam unimed?' e 'aceitam bradesco?'). Com a versão na chave, alterar a base invalida tudo.
+    """
+    version = f"{knowledge_version:.6f}" if knowledge_version else "0"
+    question_hash = hashlib.sha1(normalize_question(question).encode("utf-8")).hexdigest()[:16]
+    return f"{tenant_id}|{version}|{block_key}|{scheduling_state or '-'}|{'primeira' if first_turn else 'seguinte'}|{question_hash}"
+
+class AnswerCache(ABC):
+    """Interface comum; métricas de acerto contadas por processo."""
+    def __init__(self, ttl_seconds: int = DEFAULT_ANSWER_TTL_SECONDS):
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+
+    async def get(self, key: str) -> Optional[str]:
+        answer = await self._get(key)
+        if answer is None: self.misses += 1
+        else: self.hits += 1
+        return answer
+
+    async def set(self, key: str, answer: str):
+        await self._set(key, answer)
+        self.stores += 1
+
+    @abstractmethod
+    async def _get(self, key: str) -> Optional[str]: ...
+
+    @abstractmethod
+    async def _set(self, key: str, answer: str): ...
+
+    def metrics(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "backend": type(self).__name__,
+            "hits": self.hits,
+            "misses": self.misses,
+            "stores": self.stores,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "ttl_seconds": self.ttl_seconds,
+        }
+
+class InMemoryAnswerCache(AnswerCache):
+    """LRU limitado a max_entries, com expiração por TTL (verificada na leitura)."""
+    def __init__(self, ttl_seconds: int = DEFAULT_ANSWER_TTL_SECONDS, max_entries: int = DEFAULT_MAX_ANSWERS):
+        super().__init__(ttl_seconds)
+        self.max_entries = max_entries
+        self.entries: "OrderedDict[str, Tuple[float, str]]" = OrderedDict() # chave -> (expira_em, resposta)
+        self.evictions = 0
+
+    async def _get(self, key: str) -> Optional[str]:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expires_at, answer = entry
+        if expires_at <= time.monotonic():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return answer
+
+    async def _set(self, key: str, answer: str):
+        self.entries[key] = (time.monotonic() + self.ttl_seconds, answer)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def metrics(self) -> Dict[str, Any]:
+        metrics = super().metrics()
+        metrics.update({"entries": len(self.entries), "max_entries": self.max_entries, "evictions": self.evictions})
+        return metrics
+
+class RedisAnswerCache(AnswerCache):
+    """
+    Cache compartilhado entre workers no Redis ('resposta:{chave}' com TTL nativo).
+    Usa o cliente/pool do armazenamento de sessões. Falhas do Redis viram miss (a resposta é gerada normalmente).
+    """
+    def __init__(self, redis_client, ttl_seconds: int = DEFAULT_ANSWER_TTL_SECONDS):
+        super().__init__(ttl_seconds)
+        self.redis = redis_client
+        self.errors = 0
+
+    async def _get(self, key: str) -> Optional[str]:
+        try:
+            return await self.redis.get(f"{ANSWER_KEY_PREFIX}{key}")
+        except Exception as e_redis_get:
+            self.errors += 1
+            logger.error(f"Erro ao ler cache de respostas no Redis: {e_redis_get}")
+            return None
+
+    async def _set(self, key: str, answer: str):
+        try:
+            await self.redis.set(f"{ANSWER_KEY_PREFIX}{key}", answer, ex=self.ttl_seconds)
+        except Exception as e_redis_set:
+            self.errors += 1
+            logger.error(f"Erro ao gravar cache de respostas no Redis: {e_redis_set}")
+
+    def metrics(self) -> Dict[str, Any]:
+        metrics = super().metrics()
+        metrics["errors"] = self.errors
+        return metrics
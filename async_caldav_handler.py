@@ -0,0 +1,603 @@
+# async_caldav_handler.py (v1.1 - Cliente CalDAV Assíncrono com Pool HTTP + Motor de Disponibilidade em Bitmap)
+import asyncio
+import logging
+import datetime
+import time
+import xml.etree.ElementTree as ET
+from xml.sax.saxutils import escape
+from typing import List, Optional, Tuple, Dict, Any, Sequence, Callable, Set
+from urllib.parse import quote
+
+import httpx
+import pytz
+import vobject
+from caldav.lib.error import NotFoundError
+
+from caldav_handler import (
+    DEFAULT_TIMEZONE, BusyIntervals, CalendarBusyIndex, IndexedOccurrence, INDEX_HORIZON_MONTHS,
+    vevent_busy_interval, vevent_block_conflict, vevent_occurrence, slot_search_range, find_free_slots,
+    build_appointment_vcal, format_start_ptbr, BUSY_FETCH_CHUNK_DAYS, BUSY_SEARCH_MARGIN,
+)
+from dateutil.relativedelta import relativedelta
+from availability_engine import AvailabilityCache, WorkingHours
+from slot_preferences import SlotPreferences
+
+logger = logging.getLogger(__name__)
+
+DAV_NS = "DAV:"
+CALDAV_NS = "urn:ietf:params:xml:ns:caldav"
+CS_NS = "http://calendarserver.org/ns/"
+DEFAULT_MAX_CONNECTIONS = 20
+DEFAULT_TIMEOUT_SECONDS = 15.0
+
+def _tag(ns: str, name: str) -> str:
+    return f"{{{ns}}}{name}"
+
+def _utc_stamp(dt: datetime.datetime) -> str:
+    return dt.astimezone(pytz.utc).strftime('%Y%m%dT%H%M%SZ')
+
+class AsyncCalendarObject:
+    """Recurso de calendário devolvido pelo cliente assíncrono (href, etag e dados iCalendar)."""
+    def __init__(self, url: str, etag: Optional[str] = None, data: Optional[str] = None):
+        self.url = url
+        self.etag = etag
+        self.data = data
+        self._instance = None
+
+    @property
+    def instance(self):
+        """VCALENDAR parseado (vobject), como em caldav.Event.instance."""
+        if self._instance is None and self.data:
+            self._instance = vobject.readOne(self.data)
+        return self._instance
+
+    @property
+    def vevents(self) -> list:
+        return self.instance.contents.get('vevent', []) if self.instance else []
+
+class AsyncCaldavHandler:
+    """
+    (v1.1) Variante assíncrona do CaldavHandler sobre httpx.AsyncClient (pool com keep-alive).
+    - Primitivas: search, save_event, delete, event_by_url, event_by_uid.
+    - Mesma API de alto nível do CaldavHandler (slots, busca por nome, agendar, cancelar),
+      com as mesmas regras e o mesmo índice local de ocupação (CTag / sync-token).
+    - Slots calculados no bitmap de ocupação (availability_engine), reconstruído só quando o índice muda.
+    - Visão materializada dos próximos slots: start_slot_refresh() revalida o índice (CTag) e aquece o bitmap em
+      background; dentro de busy_max_age_seconds as buscas dos pacientes usam o índice sem ida ao servidor.
+      Agendar/cancelar atualizam o índice na hora (write-through), então a visão já reflete as próprias reservas.
+    - Nenhuma chamada bloqueia o event loop: vários pacientes são atendidos em paralelo no mesmo worker.
+    Uso: await handler.connect() na inicialização e await handler.aclose() no desligamento.
+    """
+    def __init__(self, url: str, username: str, password: str, calendar_name: str,
+                 use_busy_index: bool = True, max_connections: int = DEFAULT_MAX_CONNECTIONS,
+                 timeout_seconds: float = DEFAULT_TIMEOUT_SECONDS, busy_max_age_seconds: float = 0.0,
+                 timezone: str = DEFAULT_TIMEZONE):
+        self.url = url
+        self.username = username
+        self.password = password
+        self.calendar_name = calendar_name
+        self.timezone = timezone # Da clínica: slots, agendamentos e índice calculados neste fuso
+        self.calendar_url: Optional[str] = None
+        self.use_busy_index = use_busy_index
+        self.busy_index = CalendarBusyIndex()
+        self.availability_cache = AvailabilityCache() # Bitmap de ocupação reaproveitado até o índice mudar
+        self.busy_max_age_seconds = busy_max_age_seconds # 0: toda busca revalida o índice no servidor (CTag)
+        self._busy_verified_at: Optional[float] = None
+        self._slot_refresher: Optional[asyncio.Task] = None
+        self.slot_refreshes = 0
+        self.slot_refresh_failures = 0
+        self.busy_fresh_hits = 0 # Buscas atendidas pela visão local, sem ida ao servidor
+        self.unreadable_resources = 0 # Recursos sem horário legível na última janela de ocupação
+        self.remote_block_checks = 0 # Blocos confirmados no servidor por causa deles
+        self._index_lock = asyncio.Lock()
+        self._booking_lock = asyncio.Lock() # Um por calendário: serializa checagem de conflito + gravação
+        self.client = httpx.AsyncClient(
+            auth=httpx.BasicAuth(username, password),
+            headers={"User-Agent": "MargotClinicBot/1.0"},
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+            timeout=httpx.Timeout(timeout_seconds),
+            follow_redirects=True,
+        )
+
+    async def connect(self):
+        """Descobre a URL do calendário (principal -> calendar-home-set -> displayname)."""
+        try:
+            principal_url = await self._propfind_href(self.url, _tag(DAV_NS, "current-user-principal")) or self.url
+            home_url = await self._propfind_href(principal_url, _tag(CALDAV_NS, "calendar-home-set")) or principal_url
+            body = (
+                '<?xml version="1.0" encoding="utf-8"?>'
+                '<D:propfind xmlns:D="DAV:"><D:prop><D:displayname/><D:resourcetype/></D:prop></D:propfind>'
+            )
+            root = await self._request_xml("PROPFIND", home_url, body, depth="1")
+            calendar_names = []
+            for response in root.iter(_tag(DAV_NS, "response")):
+                prop = response.find(f".//{_tag(DAV_NS, 'prop')}")
+                if prop is None or prop.find(f".//{_tag(CALDAV_NS, 'calendar')}") is None: continue
+                name = prop.findtext(_tag(DAV_NS, "displayname"))
+                calendar_names.append(name)
+                if name == self.calendar_name:
+                    self.calendar_url = self._absolute(home_url, response.findtext(_tag(DAV_NS, "href")))
+            if not self.calendar_url:
+                logger.error(f"Calendário '{self.calendar_name}' não encontrado. Disponíveis: {calendar_names}")
+                raise ValueError(f"Calendário '{self.calendar_name}' não encontrado.")
+            self.busy_index.loaded = False
+            logger.info(f"Conectado CalDAV (async): Calendário '{self.calendar_name}' OK.")
+        except Exception as e:
+            logger.error(f"Falha conexão/seleção CalDAV (async): {e}", exc_info=True); self.calendar_url = None
+            raise ConnectionError(f"Não foi possível conectar/encontrar calendário CalDAV: {e}")
+
+    async def aclose(self):
+        if self._slot_refresher:
+            self._slot_refresher.cancel()
+            try: await self._slot_refresher
+            except asyncio.CancelledError: pass
+            self._slot_refresher = None
+        await self.client.aclose()
+
+    def _get_tz(self) -> pytz.timezone:
+        try: return pytz.timezone(self.timezone)
+        except pytz.UnknownTimeZoneError: logger.error(f"Timezone '{self.timezone}' desconhecido! Usando UTC."); return pytz.utc
+
+    async def _is_connected(self) -> bool:
+        if self.calendar_url:
+            return True
+        try: await self.connect(); return True
+        except ConnectionError: logger.error("Falha ao reconectar ao CalDAV (async)."); return False
+
+    # --- HTTP / XML ---
+    def _absolute(self, base: str, href: Optional[str]) -> Optional[str]:
+        return str(httpx.URL(base).join(href)) if href else None
+
+    async def _request(self, method: str, url: str, body: Optional[str] = None, depth: Optional[str] = None,
+                       headers: Optional[Dict[str, str]] = None) -> httpx.Response:
+        req_headers = dict(headers or {})
+        if depth is not None: req_headers["Depth"] = depth
+        if body is not None and "Content-Type" not in req_headers:
+            req_headers["Content-Type"] = 'application/xml; charset="utf-8"'
+        response = await self.client.request(method, url, content=body.encode('utf-8') if body else None, headers=req_headers)
+        if response.status_code == 404:
+            raise NotFoundError(f"{method} {url}: 404")
+        response.raise_for_status()
+        return response
+
+    async def _request_xml(self, method: str, url: str, body: str, depth: str = "0") -> ET.Element:
+        response = await self._request(method, url, body, depth=depth)
+        return ET.fromstring(response.content)
+
+    async def _propfind_href(self, url: str, prop_tag: str) -> Optional[str]:
+        ns, name = prop_tag[1:].split("}")
+        body = (
+            '<?xml version="1.0" encoding="utf-8"?>'
+            f'<D:propfind xmlns:D="DAV:" xmlns:X="{ns}"><D:prop><X:{name}/></D:prop></D:propfind>'
+        )
+        root = await self._request_xml("PROPFIND", url, body)
+        prop = root.find(f".//{prop_tag}")
+        href = prop.findtext(_tag(DAV_NS, "href")) if prop is not None else None
+        return self._absolute(url, href.strip()) if href else None
+
+    def _parse_objects(self, root: ET.Element) -> Tuple[List[AsyncCalendarObject], List[str]]:
+        """Multistatus -> (objetos com dados, hrefs removidos/404)."""
+        objects, missing = [], []
+        for response in root.iter(_tag(DAV_NS, "response")):
+            href = self._absolute(self.calendar_url, (response.findtext(_tag(DAV_NS, "href")) or "").strip())
+            status = response.findtext(_tag(DAV_NS, "status")) or ""
+            if " 404" in status:
+                missing.append(href); continue
+            prop = response.find(f".//{_tag(DAV_NS, 'prop')}")
+            if prop is None: continue
+            objects.append(AsyncCalendarObject(
+                href, prop.findtext(_tag(DAV_NS, "getetag")), prop.findtext(_tag(CALDAV_NS, "calendar-data"))
+            ))
+        return objects, missing
+
+    # --- Primitivas CalDAV ---
+    async def search(self, start: datetime.datetime, end: datetime.datetime, expand: bool = True) -> List[AsyncCalendarObject]:
+        """REPORT calendar-query por VEVENTs no intervalo (expand=True pede expansão de recorrências ao servidor)."""
+        expand_xml = f'<C:expand start="{_utc_stamp(start)}" end="{_utc_stamp(end)}"/>' if expand else ''
+        body = (
+            '<?xml version="1.0" encoding="utf-8"?>'
+            '<C:calendar-query xmlns:D="DAV:" xmlns:C="urn:ietf:params:xml:ns:caldav">'
+            f'<D:prop><D:getetag/><C:calendar-data>{expand_xml}</C:calendar-data></D:prop>'
+            '<C:filter><C:comp-filter name="VCALENDAR"><C:comp-filter name="VEVENT">'
+            f'<C:time-range start="{_utc_stamp(start)}" end="{_utc_stamp(end)}"/>'
+            '</C:comp-filter></C:comp-filter></C:filter></C:calendar-query>'
+        )
+        objects, _ = self._parse_objects(await self._request_xml("REPORT", self.calendar_url, body, depth="1"))
+        return objects
+
+    async def save_event(self, vcal_string: str, uid: str) -> AsyncCalendarObject:
+        """PUT de um novo recurso (If-None-Match: * evita sobrescrever)."""
+        url = self._absolute(self.calendar_url, quote(f"{uid}.ics"))
+        response = await self._request("PUT", url, vcal_string, headers={
+            "Content-Type": "text/calendar; charset=utf-8", "If-None-Match": "*"
+        })
+        return AsyncCalendarObject(url, response.headers.get("ETag"), vcal_string)
+
+    async def delete(self, url: str):
+        await self._request("DELETE", url)
+
+    async def event_by_url(self, url: str) -> AsyncCalendarObject:
+        response = await self._request("GET", url)
+        return AsyncCalendarObject(url, response.headers.get("ETag"), response.text)
+
+    async def event_by_uid(self, uid: str) -> AsyncCalendarObject:
+        if uid in self.busy_index.uid_map:
+            return await self.event_by_url(self.busy_index.resources[self.busy_index.uid_map[uid]]["href"])
+        body = (
+            '<?xml version="1.0" encoding="utf-8"?>'
+            '<C:calendar-query xmlns:D="DAV:" xmlns:C="urn:ietf:params:xml:ns:caldav">'
+            '<D:prop><D:getetag/><C:calendar-data/></D:prop>'
+            '<C:filter><C:comp-filter name="VCALENDAR"><C:comp-filter name="VEVENT">'
+            f'<C:prop-filter name="UID"><C:text-match collation="i;octet">{escape(uid)}</C:text-match></C:prop-filter>'
+            '</C:comp-filter></C:comp-filter></C:filter></C:calendar-query>'
+        )
+        objects, _ = self._parse_objects(await self._request_xml("REPORT", self.calendar_url, body, depth="1"))
+        if not objects:
+            raise NotFoundError(f"UID {uid}")
+        return objects[0]
+
+    async def _search_events_chunked(self, range_start: datetime.datetime, range_end: datetime.datetime) -> List[AsyncCalendarObject]:
+        """Mesma divisão em blocos do CaldavHandler, com os REPORTs disparados em paralelo."""
+        chunk = datetime.timedelta(days=BUSY_FETCH_CHUNK_DAYS)
+        ranges = []; chunk_start = range_start
+        while chunk_start < range_end:
+            chunk_end = min(chunk_start + chunk, range_end)
+            ranges.append((chunk_start, chunk_end)); chunk_start = chunk_end
+        results = await asyncio.gather(*(self.search(s, e) for s, e in ranges))
+        return [obj for chunk_objects in results for obj in chunk_objects]
+
+    # --- Índice local de ocupação (mesma lógica do CaldavHandler) ---
+    async def _get_collection_tags(self) -> Tuple[Optional[str], Optional[str]]:
+        body = (
+            '<?xml version="1.0" encoding="utf-8"?>'
+            f'<D:propfind xmlns:D="DAV:" xmlns:CS="{CS_NS}"><D:prop><CS:getctag/><D:sync-token/></D:prop></D:propfind>'
+        )
+        root = await self._request_xml("PROPFIND", self.calendar_url, body)
+        ctag = root.findtext(f".//{_tag(CS_NS, 'getctag')}")
+        sync_token = root.findtext(f".//{_tag(DAV_NS, 'sync-token')}")
+        return (ctag or None), (sync_token or None)
+
+    async def _refresh_busy_index(self, range_start: datetime.datetime, range_end: datetime.datetime) -> bool:
+        if not self.use_busy_index or not self.calendar_url:
+            return False
+        async with self._index_lock:
+            index = self.busy_index
+            try:
+                if not index.covers(range_start, range_end):
+                    await self._load_busy_index(range_start, range_end)
+                    return index.covers(range_start, range_end)
+                ctag, _ = await self._get_collection_tags()
+                if ctag is not None and ctag == index.ctag:
+                    logger.debug("Índice de ocupação (async): CTag inalterado.")
+                    return True
+                if index.sync_token:
+                    try:
+                        await self._sync_busy_index()
+                        index.ctag = ctag
+                        return True
+                    except Exception as e_sync:
+                        logger.warning(f"Sync incremental (async) falhou ({e_sync}). Recarregando índice completo.")
+                await self._load_busy_index(range_start, range_end)
+                return index.covers(range_start, range_end)
+            except Exception as e_index:
+                logger.error(f"Erro ao atualizar índice de ocupação (async): {e_index}", exc_info=True)
+                index.loaded = False
+                return False
+
+    async def _load_busy_index(self, range_start: datetime.datetime, range_end: datetime.datetime):
+        tz = self._get_tz()
+        today = tz.localize(datetime.datetime.combine(datetime.datetime.now(tz).date(), datetime.time.min))
+        window_start = min(today, range_start) - datetime.timedelta(days=1)
+        window_end = max(today + relativedelta(months=INDEX_HORIZON_MONTHS, days=2), range_end)
+        index = self.busy_index
+        index.reset(window_start, window_end)
+        ctag, sync_token = await self._get_collection_tags()
+        grouped: Dict[str, Dict[str, Any]] = {}
+        for obj in await self._search_events_chunked(window_start, window_end):
+            entry = grouped.setdefault(obj.url, {"uid": None, "occurrences": [], "unreadable": False})
+            try:
+                for vevent in obj.vevents:
+                    uid_obj = getattr(vevent, 'uid', None)
+                    if uid_obj and not entry["uid"]: entry["uid"] = uid_obj.value
+                    entry["occurrences"].append(vevent_occurrence(vevent, tz))
+            except Exception as e_event: # Ilegível: fica à parte; os blocos livres passam pela checagem remota
+                logger.warning(f"Erro ao indexar evento {obj.url}: {e_event}. Recurso marcado como ilegível.")
+                entry["unreadable"] = True
+        for url, entry in grouped.items():
+            index.set_resource(url, url, entry["uid"], entry["occurrences"], entry["unreadable"])
+        index.ctag = ctag; index.sync_token = sync_token
+        index.rebuild(); index.loaded = True
+        logger.info(f"Índice de ocupação (async) carregado: {len(index.resources)} recursos, {len(index.busy)} intervalos.")
+
+    async def _sync_busy_index(self):
+        """sync-collection + calendar-multiget (com expand) só dos recursos alterados."""
+        index = self.busy_index
+        body = (
+            '<?xml version="1.0" encoding="utf-8"?>'
+            f'<D:sync-collection xmlns:D="DAV:"><D:sync-token>{escape(index.sync_token)}</D:sync-token>'
+            '<D:sync-level>1</D:sync-level><D:prop><D:getetag/></D:prop></D:sync-collection>'
+        )
+        root = await self._request_xml("REPORT", self.calendar_url, body, depth="1")
+        changed, deleted = self._parse_objects(root)
+        for url in deleted:
+            index.remove_resource(url)
+        if changed:
+            hrefs = "".join(f"<D:href>{httpx.URL(obj.url).raw_path.decode()}</D:href>" for obj in changed)
+            multiget = (
+                '<?xml version="1.0" encoding="utf-8"?>'
+                '<C:calendar-multiget xmlns:D="DAV:" xmlns:C="urn:ietf:params:xml:ns:caldav">'
+                f'<D:prop><D:getetag/><C:calendar-data><C:expand start="{_utc_stamp(index.window_start)}" end="{_utc_stamp(index.window_end)}"/></C:calendar-data></D:prop>'
+                f'{hrefs}</C:calendar-multiget>'
+            )
+            objects, missing = self._parse_objects(await self._request_xml("REPORT", self.calendar_url, multiget, depth="1"))
+            tz = self._get_tz()
+            for obj in objects:
+                try:
+                    vevents = obj.vevents
+                    uid_obj = getattr(vevents[0], 'uid', None) if vevents else None
+                    index.set_resource(obj.url, obj.url, uid_obj.value if uid_obj else None, [vevent_occurrence(v, tz) for v in vevents])
+                except Exception as e_event:
+                    logger.warning(f"Erro ao indexar evento {obj.url}: {e_event}. Recurso marcado como ilegível.")
+                    index.set_resource(obj.url, obj.url, None, [], unreadable=True)
+            for url in missing:
+                index.remove_resource(url)
+        index.sync_token = root.findtext(_tag(DAV_NS, "sync-token")) or index.sync_token
+        index.rebuild()
+        logger.info(f"Índice de ocupação (async) sincronizado: {len(changed)} alterado(s), {len(deleted)} removido(s).")
+
+    def _busy_index_fresh(self, range_start: datetime.datetime, range_end: datetime.datetime) -> bool:
+        return (self.busy_max_age_seconds > 0 and self._busy_verified_at is not None
+                and time.monotonic() - self._busy_verified_at < self.busy_max_age_seconds
+                and self.busy_index.covers(range_start, range_end))
+
+    async def _get_busy_intervals(self, range_start: datetime.datetime, range_end: datetime.datetime) -> Optional[BusyIntervals]:
+        if self._busy_index_fresh(range_start, range_end):
+            self.busy_fresh_hits += 1
+            return self.busy_index.busy
+        if await self._refresh_busy_index(range_start, range_end):
+            self._busy_verified_at = time.monotonic()
+            return self.busy_index.busy
+        tz = self._get_tz()
+        try:
+            objects = await self._search_events_chunked(range_start, range_end)
+        except Exception as e_caldav:
+            logger.error(f"Erro ao buscar janela de ocupação (async): {e_caldav}", exc_info=True)
+            return None
+        intervals = []; unreadable = 0
+        for obj in objects:
+            try:
+                intervals.extend(iv for iv in (vevent_busy_interval(v, tz) for v in obj.vevents) if iv)
+            except Exception as e_event: # Recurso ilegível: os blocos livres passam pela checagem remota
+                logger.warning(f"Erro ao ler evento para janela de ocupação: {e_event}. Recurso marcado como ilegível.")
+                unreadable += 1
+        return BusyIntervals(intervals, unreadable)
+
+    async def _is_block_busy_remote(self, block_start_dt: datetime.datetime, block_end_dt: datetime.datetime, tz) -> bool:
+        """Checagem por bloco do CaldavHandler (um REPORT com a mesma margem); erro na busca ou no evento conta como ocupado."""
+        try:
+            for obj in await self.search(block_start_dt - BUSY_SEARCH_MARGIN, block_end_dt + BUSY_SEARCH_MARGIN):
+                for vevent in obj.vevents:
+                    conflict = vevent_block_conflict(vevent, block_start_dt, block_end_dt, tz)
+                    if conflict:
+                        logger.info(f"    * Bloco OCUPADO por: {conflict}")
+                        return True
+        except Exception as e_caldav:
+            logger.error(f"    * Erro buscar conflitos (async): {e_caldav}", exc_info=True)
+            return True
+        return False
+
+    async def _confirm_slots(self, search: Callable[[Set[datetime.datetime]], List[datetime.datetime]],
+                             block_duration_minutes: int, tz) -> List[datetime.datetime]:
+        """Mesma confirmação do CaldavHandler, com os REPORTs dos blocos pendentes em paralelo."""
+        block_duration = datetime.timedelta(minutes=block_duration_minutes)
+        rejected: Set[datetime.datetime] = set(); confirmed: Set[datetime.datetime] = set()
+        while True:
+            slots = search(rejected)
+            pending = [slot for slot in slots if slot not in confirmed]
+            if not pending:
+                return slots
+            self.remote_block_checks += len(pending)
+            busy = await asyncio.gather(*(self._is_block_busy_remote(slot, slot + block_duration, tz) for slot in pending))
+            for slot, is_busy in zip(pending, busy):
+                (rejected if is_busy else confirmed).add(slot)
+
+    # --- Visão materializada dos próximos slots ---
+    async def _slot_refresh_loop(self, interval_seconds: float, search_kwargs: Callable[[], Dict[str, Any]]):
+        while True:
+            try:
+                self._busy_verified_at = None # Força a revalidação (CTag / sync) antes de recalcular
+                await self.find_available_slots(start_search_dt=datetime.datetime.now(self._get_tz()), **search_kwargs())
+                self.slot_refreshes += 1
+            except Exception as e_refresh:
+                self.slot_refresh_failures += 1
+                logger.error(f"Erro ao atualizar a visão de slots em background: {e_refresh}", exc_info=True)
+            await asyncio.sleep(interval_seconds)
+
+    def start_slot_refresh(self, interval_seconds: float, search_kwargs: Callable[[], Dict[str, Any]]):
+        """
+        Revalida o índice e recalcula o bitmap a cada interval_seconds (chamar com o event loop rodando).
+        search_kwargs() devolve os parâmetros padrão de find_available_slots (regras atuais da clínica).
+        """
+        if self._slot_refresher is None or self._slot_refresher.done():
+            self._slot_refresher = asyncio.get_running_loop().create_task(self._slot_refresh_loop(interval_seconds, search_kwargs))
+
+    def metrics(self) -> Dict[str, Any]:
+        return {
+            "slot_refreshes": self.slot_refreshes,
+            "slot_refresh_failures": self.slot_refresh_failures,
+            "busy_fresh_hits": self.busy_fresh_hits,
+            "busy_verified_seconds_ago": round(time.monotonic() - self._busy_verified_at, 1) if self._busy_verified_at else None,
+            "availability_builds": self.availability_cache.builds,
+            "unreadable_resources": self.unreadable_resources,
+            "remote_block_checks": self.remote_block_checks,
+        }
+
+    # --- API de alto nível (espelha o CaldavHandler) ---
+    async def find_available_slots(self,
+                                   start_search_dt: datetime.datetime, num_slots_to_find: int = 5,
+                                   consultation_duration_minutes: int = 45, block_duration_minutes: int = 60,
+                                   preferred_days: List[int] = [0, 1], valid_start_hours: List[int] = [14, 15, 16, 17],
+                                   working_hours: Optional[WorkingHours] = None, holidays: Sequence[datetime.date] = (),
+                                   resume_after: Optional[datetime.datetime] = None, preferences: Optional[SlotPreferences] = None,
+                                   excluded_intervals: Sequence[Tuple[datetime.datetime, datetime.datetime]] = ()
+                                  ) -> List[datetime.datetime]:
+        if not await self._is_connected(): logger.error("find_available_slots: Não conectado."); return []
+        tz = self._get_tz()
+        start_search_dt = start_search_dt.astimezone(tz) if start_search_dt.tzinfo else tz.localize(start_search_dt)
+        logger.info(f"Iniciando busca (async) por {num_slots_to_find} slots (blocos {block_duration_minutes}min) a partir de {start_search_dt.isoformat()}.")
+        busy_intervals = await self._get_busy_intervals(*slot_search_range(start_search_dt, block_duration_minutes, tz))
+        if busy_intervals is None:
+            logger.error("find_available_slots: janela de ocupação indisponível. Nenhum slot retornado.")
+            return []
+        self.unreadable_resources = busy_intervals.unreadable
+        search = lambda rejected_starts: find_free_slots(
+            start_search_dt, num_slots_to_find, block_duration_minutes, preferred_days, valid_start_hours, tz, busy_intervals,
+            self.availability_cache, working_hours, holidays, resume_after, preferences, excluded_intervals, rejected_starts)
+        return await self._confirm_slots(search, block_duration_minutes, tz) if busy_intervals.unreadable else search(())
+
+    async def find_appointments_by_details(self,
+                                           patient_name: str, start_range: datetime.datetime, end_range: datetime.datetime
+                                          ) -> List[Dict[str, Any]]:
+        if not await self._is_connected():
+            logger.error("find_appointments: Não conectado.")
+            return []
+        tz = self._get_tz()
+        start_range = start_range.astimezone(tz) if start_range.tzinfo else tz.localize(start_range)
+        end_range = end_range.astimezone(tz) if end_range.tzinfo else tz.localize(end_range)
+        logger.info(f"Buscando agendamentos (async) para '{patient_name}' entre {start_range.isoformat()} e {end_range.isoformat()}")
+        name_lower = patient_name.lower()
+        if await self._refresh_busy_index(start_range, end_range):
+            candidates = list(self.busy_index.occurrences_between(start_range, end_range))
+        else:
+            candidates = []
+            try:
+                for obj in await self.search(start_range, end_range):
+                    for vevent in obj.vevents:
+                        try: candidates.append((obj.url, vevent_occurrence(vevent, tz)))
+                        except Exception as e_event: logger.warning(f"Erro processando evento {obj.url}: {e_event}")
+            except Exception as e_search:
+                logger.error(f"Erro durante search (async): {e_search}", exc_info=True)
+        found_appointments = [
+            {"summary": occ.summary, "start": occ.start, "end": occ.end, "id": href}
+            for href, occ in candidates
+            if occ.summary is not None and occ.has_end and name_lower in occ.summary.lower()
+        ]
+        logger.info(f"Busca por '{patient_name}' (async) finalizada. {len(found_appointments)} eventos encontrados.")
+        found_appointments.sort(key=lambda x: x['start'])
+        return found_appointments
+
+    async def book_appointment(self,
+                               start_time: datetime.datetime, end_time: datetime.datetime,
+                               patient_name: str, patient_contact: Optional[str] = None,
+                               patient_email: Optional[str] = None,
+                               indication_source: Optional[str] = None, procedure_interest: Optional[str] = None
+                              ) -> Tuple[bool, str]:
+        if not await self._is_connected(): logger.error("book_appointment: Não conectado."); return False, "Sem conexão com calendário."
+        if not start_time or not end_time:
+            logger.error("Horário de início ou fim inválido para agendamento.")
+            return False, "Horário de agendamento inválido. Não foi possível registrar o compromisso."
+        tz = self._get_tz()
+        start_time = start_time.astimezone(tz) if start_time.tzinfo else tz.localize(start_time)
+        end_time = end_time.astimezone(tz) if end_time.tzinfo else tz.localize(end_time)
+        async with self._booking_lock: # Checagem final + PUT atômicos: duas confirmações do mesmo horário não gravam ambas
+            conflict_check_start = start_time - datetime.timedelta(seconds=1)
+            conflict_check_end = end_time + datetime.timedelta(seconds=1)
+            try:
+                summaries = []; remote_check = True
+                if await self._refresh_busy_index(conflict_check_start, conflict_check_end):
+                    conflict = self.busy_index.extents.find_overlap(conflict_check_start, conflict_check_end)
+                    summaries = [conflict[2]] if conflict else []
+                    remote_check = not summaries and self.busy_index.unreadable > 0 # Recursos ilegíveis: confirma no servidor
+                if remote_check:
+                    events_found = await self.search(conflict_check_start, conflict_check_end, expand=False)
+                    summaries = [getattr(v, 'summary', None).value if hasattr(v, 'summary') else "N/A" for e in events_found for v in e.vevents]
+                if summaries:
+                    logger.warning(f"Falha agendamento {patient_name}: Conflito final detectado ({len(summaries)}): {'; '.join(summaries)}.")
+                    return False, "Desculpe, este horário foi preenchido enquanto confirmávamos. Tente outro."
+            except Exception as e_conflict:
+                logger.error(f"Erro verificando conflito final (async): {e_conflict}", exc_info=True); return False, "Erro ao verificar disponibilidade final."
+
+            vcal_string, event_uid, summary = build_appointment_vcal(
+                start_time, end_time, tz, patient_name, patient_contact, patient_email, indication_source, procedure_interest
+            )
+            try:
+                logger.info(f"Tentando salvar agendamento (async PUT) para '{patient_name}' UID: {event_uid}")
+                new_event = await self.save_event(vcal_string, event_uid)
+                logger.info(f"Agendamento (async) CRIADO com sucesso. Ref: {new_event.url}")
+                if self.use_busy_index and self.busy_index.loaded:
+                    occurrence = IndexedOccurrence(start_time, end_time, summary, True, (start_time, end_time, summary))
+                    self.busy_index.set_resource(new_event.url, new_event.url, event_uid, [occurrence])
+                    self.busy_index.rebuild()
+                dt_f = format_start_ptbr(start_time, '%A, %d de %B às %H:%M', '%d/%m/%Y %H:%M')
+                return True, f"Agendamento confirmado para {patient_name} em {dt_f}."
+            except Exception as e_caldav_save:
+                logger.error(f"Erro CRÍTICO ao salvar evento (async) UID {event_uid}: {e_caldav_save}", exc_info=True)
+                return False, "Erro técnico ao registrar agendamento. Equipe notificada."
+
+    async def cancel_appointment(self, event_identifier: str) -> Tuple[bool, str]:
+        if not await self._is_connected():
+            logger.error("cancel_appointment: Não conectado.")
+            return False, "Sem conexão com calendário."
+        if not event_identifier:
+            logger.error("Cancelamento sem ID.")
+            return False, "Não identificamos qual agendamento cancelar."
+        logger.info(f"Tentando cancelar evento (async) ID: {event_identifier}")
+        try:
+            if "http" in event_identifier:
+                event_to_delete = await self.event_by_url(event_identifier)
+            else:
+                event_to_delete = await self.event_by_uid(event_identifier)
+        except NotFoundError:
+            logger.warning(f"Evento ID '{event_identifier}' não encontrado para cancelar.")
+            return False, "Agendamento não encontrado."
+        except Exception as e_find:
+            logger.error(f"Erro ao buscar evento ID '{event_identifier}': {e_find}", exc_info=True)
+            return False, "Erro ao localizar agendamento."
+        vevents = event_to_delete.vevents
+        if not vevents or not getattr(vevents[0], 'dtstart', None) or not getattr(vevents[0], 'dtend', None):
+            logger.warning("Evento sem dtstart ou dtend. Cancelamento interrompido por segurança.")
+            return False, "Erro ao localizar informações completas do agendamento para cancelamento."
+        summary = "Agendamento"; start_str = ""
+        try: # Pega detalhes ANTES de deletar
+            vevent = vevents[0]
+            summary = getattr(vevent, 'summary').value if hasattr(vevent, 'summary') else "Agendamento"
+            st_naive = vevent.dtstart.value
+            if isinstance(st_naive, datetime.datetime):
+                tz = self._get_tz()
+                start_time = st_naive.astimezone(tz) if st_naive.tzinfo else tz.localize(st_naive)
+                start_str = f" de {format_start_ptbr(start_time, '%A, %d/%m às %H:%M', '%d/%m %H:%M')}"
+        except Exception as e_details:
+            logger.warning(f"Erro lendo detalhes evento {event_identifier}: {e_details}")
+        try:
+            await self.delete(event_to_delete.url)
+        except Exception as e_delete:
+            logger.error(f"Erro ao DELETAR evento ID '{event_identifier}': {e_delete}", exc_info=True)
+            return False, "Erro ao remover agendamento."
+        if self.use_busy_index and self.busy_index.loaded:
+            self.busy_index.remove_resource(event_to_delete.url)
+            self.busy_index.rebuild()
+        logger.info(f"Evento '{summary}' (ID: {event_identifier}) cancelado.")
+        return True, f"{summary}{start_str} foi cancelado com sucesso."
+
+    async def reagendar_appointment(self, old_event_id: str,
+                                    start_time: datetime.datetime, end_time: datetime.datetime,
+                                    patient_name: str, patient_contact: Optional[str] = None,
+                                    indication_source: Optional[str] = None, procedure_interest: Optional[str] = None
+                                   ) -> Tuple[bool, str]:
+        if not await self._is_connected():
+            logger.error("reagendar_appointment: Não conectado.")
+            return False, "Sem conexão com calendário."
+        if not start_time or not end_time:
+            logger.error("Horário de início ou fim inválido para reagendamento.")
+            return False, "Horário de reagendamento inválido. Não foi possível atualizar o compromisso."
+        cancel_ok, cancel_msg = await self.cancel_appointment(old_event_id)
+        if not cancel_ok:
+            return False, f"Não foi possível cancelar o compromisso anterior: {cancel_msg}"
+        book_ok, book_msg = await self.book_appointment(
+            start_time, end_time, patient_name, patient_contact,
+            indication_source=indication_source, procedure_interest=procedure_interest
+        )
+        if book_ok:
+            return True, "Compromisso reagendado com sucesso."
+        else:
+            return False, f"Erro ao reagendar: {book_msg}"
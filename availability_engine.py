@@ -0,0 +1,189 @@
+# availability_engine.py (v1.0 - Motor de Disponibilidade com Bitmaps de Ocupação)
+import datetime
+import logging
+import math
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+try:
+    import numpy as np
+except ImportError: # Sem numpy os handlers CalDAV voltam à varredura dia a dia (select_free_slots)
+    np = None
+
+logger = logging.getLogger(__name__)
+
+RESOLUTION_MINUTES = 5 # Granularidade do bitmap (durações/inícios múltiplos disso são exatos)
+MINUTES_PER_DAY = 24 * 60
+DEFAULT_STEP_MINUTES = 60 # Inícios alinhados à hora cheia (mesmo comportamento da busca antiga)
+MAX_MATERIALIZED_PAGES = 512 # Páginas de next_slots guardadas por bitmap (descartadas junto com ele)
+MAX_CACHED_GRIDS = 8 # Bitmaps mantidos pelo AvailabilityCache (um por duração/expediente em uso)
+
+WorkingHours = Dict[int, List[Tuple[int, int]]] # dia da semana (0=segunda) -> [(minuto_inicio, minuto_fim)]
+
+def is_available() -> bool:
+    return np is not None
+
+def working_hours_from_rules(preferred_days: Iterable[int], valid_start_hours: Iterable[int], block_duration_minutes: int) -> WorkingHours:
+    """
+    Converte os parâmetros antigos (dias preferidos + horas de início) em janelas de expediente: cada hora de início
+    abre [hora, hora + bloco). Com inícios de hora em hora, o resultado é idêntico ao da varredura antiga.
+    """
+    windows: List[Tuple[int, int]] = []
+    for hour in sorted(set(valid_start_hours)):
+        start, end = hour * 60, min(hour * 60 + block_duration_minutes, MINUTES_PER_DAY)
+        if windows and start <= windows[-1][1]: windows[-1] = (windows[-1][0], max(windows[-1][1], end))
+        else: windows.append((start, end))
+    return {day: list(windows) for day in set(preferred_days)}
+
+def parse_working_hours(raw: Dict[str, Sequence[Sequence[str]]]) -> WorkingHours:
+    """{"0": [["08:00", "12:00"], ["14:00", "18:00"]], ...} (chave = dia da semana) -> WorkingHours. ValueError se inválido."""
+    def to_minutes(text: str) -> int:
+        hours, minutes = str(text).split(":")
+        return int(hours) * 60 + int(minutes)
+    working_hours: WorkingHours = {}
+    for day, windows in raw.items():
+        parsed = [(to_minutes(start), to_minutes(end)) for start, end in windows]
+        if any(not 0 <= start < end <= MINUTES_PER_DAY for start, end in parsed):
+            raise ValueError(f"Janela de expediente inválida para o dia {day}: {windows}")
+        working_hours[int(day)] = sorted(parsed)
+    return working_hours
+
+class OccupancyGrid:
+    """
+    Agenda do horizonte como bitmap (dias x fatias de RESOLUTION_MINUTES): 1 = livre (dentro do expediente, fora de
+    feriados e sem evento). Os inícios viáveis para uma duração saem de uma soma acumulada (janela deslizante
+    vetorizada) e ficam em cache por (duração, passo); next_slots() é só um searchsorted nesse vetor.
+    Intervalos ocupados são arredondados para fora (início para baixo, fim para cima): blocos alinhados à grade
+    têm o mesmo resultado da checagem de sobreposição intervalo a intervalo.
+    """
+    def __init__(self, origin: datetime.date, tz, free, resolution_minutes: int = RESOLUTION_MINUTES):
+        self.origin = origin
+        self.tz = tz
+        self.resolution_minutes = resolution_minutes
+        self.free = free # np.ndarray (dias, fatias_por_dia) bool
+        self.days, self.slots_per_day = free.shape
+        self._flat_free = free.reshape(-1)
+        self._starts_cache: Dict[Tuple[int, int], "np.ndarray"] = {}
+        self._datetimes: Dict[int, datetime.datetime] = {} # tz.localize é o passo mais caro de next_slots
+        self._pages: Dict[tuple, List[datetime.datetime]] = {} # Visão materializada: mesma consulta na mesma fatia = mesma página
+
+    @classmethod
+    def build(cls, origin: datetime.date, days: int, tz, working_hours: WorkingHours,
+              busy_intervals: Iterable[Tuple[datetime.datetime, datetime.datetime]],
+              holidays: Iterable[datetime.date] = (), resolution_minutes: int = RESOLUTION_MINUTES) -> "OccupancyGrid":
+        if MINUTES_PER_DAY % resolution_minutes:
+            raise ValueError(f"Resolução de {resolution_minutes} min não divide o dia.")
+        slots_per_day = MINUTES_PER_DAY // resolution_minutes
+        templates = np.zeros((7, slots_per_day), dtype=bool) # Expediente de cada dia da semana
+        for weekday, windows in working_hours.items():
+            for start, end in windows:
+                templates[weekday, -(-start // resolution_minutes):end // resolution_minutes] = True
+        first_weekday = origin.weekday()
+        free = templates[(np.arange(days) + first_weekday) % 7] # Gather: uma linha por dia do horizonte
+        for holiday in holidays:
+            offset = (holiday - origin).days
+            if 0 <= offset < days: free[offset] = False
+
+        total = days * slots_per_day
+        delta = np.zeros(total + 1, dtype=np.int32) # +1 no início e -1 no fim de cada intervalo; cumsum > 0 = ocupado
+        starts, ends = [], []
+        for busy_start, busy_end in busy_intervals:
+            start_index = math.floor(cls._minute_offset(busy_start, origin, tz) / resolution_minutes)
+            end_index = math.ceil(cls._minute_offset(busy_end, origin, tz) / resolution_minutes)
+            if end_index <= 0 or start_index >= total or end_index <= start_index: continue
+            starts.append(max(start_index, 0)); ends.append(min(end_index, total))
+        if starts:
+            np.add.at(delta, np.asarray(starts), 1)
+            np.add.at(delta, np.asarray(ends), -1)
+            free &= ~(np.cumsum(delta[:-1]) > 0).reshape(days, slots_per_day)
+        return cls(origin, tz, free, resolution_minutes)
+
+    @staticmethod
+    def _minute_offset(moment: datetime.datetime, origin: datetime.date, tz) -> float:
+        """Minutos (hora local, de relógio) desde a meia-noite de origin."""
+        local = moment.astimezone(tz) if moment.tzinfo else tz.localize(moment)
+        return (local.replace(tzinfo=None) - datetime.datetime.combine(origin, datetime.time.min)).total_seconds() / 60
+
+    def feasible_starts(self, duration_minutes: int, step_minutes: int = DEFAULT_STEP_MINUTES) -> "np.ndarray":
+        """Índices (achatados) das fatias onde cabe um bloco de duration_minutes começando alinhado a step_minutes."""
+        key = (duration_minutes, step_minutes)
+        cached = self._starts_cache.get(key)
+        if cached is not None:
+            return cached
+        width = -(-duration_minutes // self.resolution_minutes)
+        cumulative = np.concatenate(([0], np.cumsum(self._flat_free, dtype=np.int32)))
+        window_free = cumulative[width:] - cumulative[:-width] == width # Janela deslizante: todas as fatias livres
+        step = max(step_minutes // self.resolution_minutes, 1)
+        aligned = (np.arange(window_free.size) % self.slots_per_day) % step == 0
+        starts = np.flatnonzero(window_free & aligned)
+        self._starts_cache[key] = starts
+        return starts
+
+    def next_slots(self, after: datetime.datetime, count: int, duration_minutes: int,
+                   step_minutes: int = DEFAULT_STEP_MINUTES, weekdays: Optional[Iterable[int]] = None,
+                   start_window: Optional[Tuple[int, int]] = None, before: Optional[datetime.datetime] = None) -> List[datetime.datetime]:
+        """
+        Próximos 'count' inícios livres (>= after) para blocos de duration_minutes. Restrições do paciente são máscaras
+        sobre o vetor em cache (sem reconstruir o bitmap): weekdays, start_window [minuto_de, minuto_até) do início
+        e before (inícios < before).
+        """
+        after_index = max(math.ceil(self._minute_offset(after, self.origin, self.tz) / self.resolution_minutes), 0)
+        before_index = math.ceil(self._minute_offset(before, self.origin, self.tz) / self.resolution_minutes) if before is not None else None
+        weekdays = tuple(sorted(set(weekdays))) if weekdays is not None else None
+        page_key = (after_index, before_index, count, duration_minutes, step_minutes, weekdays, start_window)
+        page = self._pages.get(page_key)
+        if page is not None:
+            return list(page)
+        starts = self.feasible_starts(duration_minutes, step_minutes)
+        candidates = starts[int(np.searchsorted(starts, after_index)):]
+        if before_index is not None:
+            candidates = candidates[:int(np.searchsorted(candidates, before_index))]
+        if weekdays is not None or start_window is not None:
+            mask = np.ones(candidates.size, dtype=bool)
+            if weekdays is not None:
+                mask &= np.isin((candidates // self.slots_per_day + self.origin.weekday()) % 7, list(weekdays))
+            if start_window is not None:
+                minute_of_day = (candidates % self.slots_per_day) * self.resolution_minutes
+                mask &= (minute_of_day >= start_window[0]) & (minute_of_day < start_window[1])
+            candidates = candidates[mask]
+        page = [self._to_datetime(int(index)) for index in candidates[:count]]
+        if len(self._pages) >= MAX_MATERIALIZED_PAGES: self._pages.clear()
+        self._pages[page_key] = page
+        return list(page)
+
+    def _to_datetime(self, flat_index: int) -> datetime.datetime:
+        cached = self._datetimes.get(flat_index)
+        if cached is not None:
+            return cached
+        day, slot = divmod(flat_index, self.slots_per_day)
+        minutes = slot * self.resolution_minutes
+        wall_clock = datetime.datetime.combine(self.origin + datetime.timedelta(days=day), datetime.time(minutes // 60, minutes % 60))
+        moment = self._datetimes[flat_index] = self.tz.localize(wall_clock)
+        return moment
+
+class AvailabilityCache:
+    """
+    Bitmaps construídos (LRU de até max_grids), um por horizonte + regras (o expediente muda com a duração do bloco),
+    reaproveitados enquanto a ocupação for a mesma (mesmo objeto BusyIntervals do índice local). O índice troca o
+    objeto a cada mudança na agenda; buscas com durações diferentes não se despejam.
+    """
+    def __init__(self, resolution_minutes: int = RESOLUTION_MINUTES, max_grids: int = MAX_CACHED_GRIDS):
+        self.resolution_minutes = resolution_minutes
+        self.max_grids = max_grids
+        self._grids: "OrderedDict[tuple, Tuple[object, OccupancyGrid]]" = OrderedDict() # chave -> (busy_source, bitmap)
+        self.builds = 0
+
+    def grid(self, busy_source, busy_intervals: Iterable[Tuple[datetime.datetime, datetime.datetime]],
+             origin: datetime.date, days: int, tz, working_hours: WorkingHours, holidays: Iterable[datetime.date] = ()) -> OccupancyGrid:
+        holidays = tuple(sorted(set(holidays)))
+        key = (origin, days, str(tz), tuple(sorted((day, tuple(windows)) for day, windows in working_hours.items())), holidays)
+        cached = self._grids.get(key)
+        if cached is not None and cached[0] is busy_source:
+            self._grids.move_to_end(key)
+            return cached[1]
+        grid = OccupancyGrid.build(origin, days, tz, working_hours, busy_intervals, holidays, self.resolution_minutes)
+        self._grids[key] = (busy_source, grid); self._grids.move_to_end(key)
+        while len(self._grids) > self.max_grids:
+            self._grids.popitem(last=False)
+        self.builds += 1
+        return grid
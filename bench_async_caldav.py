@@ -0,0 +1,166 @@
+# bench_async_caldav.py - Benchmark de carga: CaldavHandler (síncrono) x AsyncCaldavHandler
+# Sobe um servidor CalDAV mínimo local (com latência artificial) e simula N pacientes pedindo horários
+# ao mesmo tempo. O modo síncrono reproduz o webhook antigo (chamadas em série no event loop);
+# o modo assíncrono dispara as N buscas em paralelo no mesmo loop.
+# Uso: python bench_async_caldav.py --senders 20 --latency 0.15
+import re
+import time
+import asyncio
+import logging
+import argparse
+import datetime
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytz
+
+from caldav_handler import CaldavHandler, DEFAULT_TIMEZONE
+from async_caldav_handler import AsyncCaldavHandler
+
+logger = logging.getLogger(__name__)
+
+CALENDAR_PATH = "/dav/cal/agenda/"
+CALENDAR_NAME = "Agenda"
+
+def _multistatus(responses: str) -> bytes:
+    return (
+        '<?xml version="1.0" encoding="utf-8"?>'
+        '<D:multistatus xmlns:D="DAV:" xmlns:C="urn:ietf:params:xml:ns:caldav" xmlns:CS="http://calendarserver.org/ns/">'
+        f'{responses}</D:multistatus>'
+    ).encode('utf-8')
+
+def _response(href: str, props: str) -> str:
+    return f'<D:response><D:href>{href}</D:href><D:propstat><D:prop>{props}</D:prop><D:status>HTTP/1.1 200 OK</D:status></D:propstat></D:response>'
+
+class FakeCalendarStore:
+    """Calendário em memória com alguns eventos ocupando blocos de segunda/terça à tarde."""
+    def __init__(self, weeks: int = 8):
+        self.lock = threading.Lock()
+        self.events = {} # href -> (inicio UTC, fim UTC, ics)
+        self.ctag = 1
+        tz = pytz.timezone(DEFAULT_TIMEZONE)
+        today = datetime.datetime.now(tz).date()
+        for day in range(weeks * 7):
+            date = today + datetime.timedelta(days=day)
+            if date.weekday() not in (0, 1): continue
+            for hour in (14, 16):
+                start = tz.localize(datetime.datetime.combine(date, datetime.time(hour)))
+                self.add(f"bench-{date.isoformat()}-{hour}", start, start + datetime.timedelta(minutes=45))
+
+    def add(self, uid: str, start: datetime.datetime, end: datetime.datetime):
+        fmt = lambda dt: dt.astimezone(pytz.utc).strftime('%Y%m%dT%H%M%SZ')
+        ics = (
+            "BEGIN:VCALENDAR\r\nVERSION:2.0\r\nPRODID:-//Bench//EN\r\nBEGIN:VEVENT\r\n"
+            f"UID:{uid}\r\nDTSTAMP:{fmt(start)}\r\nDTSTART:{fmt(start)}\r\nDTEND:{fmt(end)}\r\n"
+            f"SUMMARY:Paciente {uid}\r\nEND:VEVENT\r\nEND:VCALENDAR\r\n"
+        )
+        self.events[f"{CALENDAR_PATH}{uid}.ics"] = (start.astimezone(pytz.utc), end.astimezone(pytz.utc), ics)
+
+    def between(self, start: datetime.datetime, end: datetime.datetime):
+        with self.lock:
+            return [(href, ics) for href, (st, en, ics) in self.events.items() if st < end and en > start]
+
+def make_handler(store: FakeCalendarStore, latency: float):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def _reply(self, status: int, body: bytes = b"", content_type: str = 'application/xml; charset="utf-8"'):
+            time.sleep(latency)
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _body(self) -> str:
+            length = int(self.headers.get("Content-Length") or 0)
+            return self.rfile.read(length).decode('utf-8') if length else ""
+
+        def do_PROPFIND(self):
+            self._body()
+            path = self.path.split("?")[0]
+            if path.rstrip("/") == CALENDAR_PATH.rstrip("/"):
+                props = (
+                    f'<D:displayname>{CALENDAR_NAME}</D:displayname><D:resourcetype><D:collection/><C:calendar/></D:resourcetype>'
+                    f'<CS:getctag>{store.ctag}</CS:getctag>'
+                    '<C:supported-calendar-component-set><C:comp name="VEVENT"/></C:supported-calendar-component-set>'
+                )
+                return self._reply(207, _multistatus(_response(CALENDAR_PATH, props)))
+            if path.startswith("/dav/cal") and self.headers.get("Depth") == "1":
+                home = _response("/dav/cal/", '<D:resourcetype><D:collection/></D:resourcetype>')
+                calendar = _response(CALENDAR_PATH, f'<D:displayname>{CALENDAR_NAME}</D:displayname><D:resourcetype><D:collection/><C:calendar/></D:resourcetype>')
+                return self._reply(207, _multistatus(home + calendar))
+            props = (
+                '<D:current-user-principal><D:href>/dav/principal/</D:href></D:current-user-principal>'
+                '<C:calendar-home-set><D:href>/dav/cal/</D:href></C:calendar-home-set>'
+                '<D:resourcetype><D:collection/></D:resourcetype>'
+            )
+            return self._reply(207, _multistatus(_response(path, props)))
+
+        def do_REPORT(self):
+            body = self._body()
+            match = re.search(r'time-range start="(\w+)" end="(\w+)"', body)
+            if not match:
+                return self._reply(207, _multistatus(""))
+            parse = lambda s: pytz.utc.localize(datetime.datetime.strptime(s, '%Y%m%dT%H%M%SZ'))
+            events = store.between(parse(match.group(1)), parse(match.group(2)))
+            responses = "".join(
+                _response(href, f'<D:getetag>"1"</D:getetag><C:calendar-data>{ics}</C:calendar-data>') for href, ics in events
+            )
+            return self._reply(207, _multistatus(responses))
+
+        def do_OPTIONS(self):
+            time.sleep(latency)
+            self.send_response(200)
+            self.send_header("DAV", "1, 2, calendar-access")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+    return Handler
+
+def run_sync(url: str, senders: int, start_dt: datetime.datetime) -> float:
+    handler = CaldavHandler(url, "bench", "bench", CALENDAR_NAME, use_busy_index=False)
+    began = time.perf_counter()
+    for _ in range(senders):
+        handler.find_available_slots(start_search_dt=start_dt)
+    return time.perf_counter() - began
+
+async def run_async(url: str, senders: int, start_dt: datetime.datetime) -> float:
+    handler = AsyncCaldavHandler(url, "bench", "bench", CALENDAR_NAME, use_busy_index=False)
+    await handler.connect()
+    try:
+        began = time.perf_counter()
+        results = await asyncio.gather(*(handler.find_available_slots(start_search_dt=start_dt) for _ in range(senders)))
+        elapsed = time.perf_counter() - began
+        logger.info(f"Async: {sum(len(r) for r in results)} slots retornados no total.")
+        return elapsed
+    finally:
+        await handler.aclose()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--senders", type=int, default=20, help="Pacientes simultâneos")
+    parser.add_argument("--latency", type=float, default=0.1, help="Latência artificial por requisição (s)")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
+    logger.setLevel(logging.INFO)
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(FakeCalendarStore(), args.latency))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}/dav/"
+    start_dt = datetime.datetime.now(pytz.timezone(DEFAULT_TIMEZONE))
+    try:
+        sync_elapsed = run_sync(url, args.senders, start_dt)
+        async_elapsed = asyncio.run(run_async(url, args.senders, start_dt))
+    finally:
+        server.shutdown()
+    print(f"{args.senders} pacientes, latência {args.latency * 1000:.0f} ms por requisição")
+    print(f"  Síncrono (em série, bloqueando o loop): {sync_elapsed:.2f} s ({sync_elapsed / args.senders * 1000:.0f} ms/paciente)")
+    print(f"  Assíncrono (pool httpx, em paralelo):   {async_elapsed:.2f} s ({async_elapsed / args.senders * 1000:.0f} ms/paciente)")
+    print(f"  Ganho de vazão: {sync_elapsed / async_elapsed:.1f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+# bm25_index.py (v1.0 - Índice Invertido BM25 para a Base de Conhecimento)
+import re
+import math
+import heapq
+import unicodedata
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+BM25_K1 = 1.5
+BM25_B = 0.75
+MIN_TOKEN_LENGTH = 2
+
+# Palavras muito frequentes em PT-BR que não ajudam a ranquear (já sem acento)
+STOPWORDS_PT = frozenset("""
+a o e as os de da do das dos em no na nos nas um uma uns umas para pra por pelo pela pelos pelas com sem
+que se ou ao aos ate como mais mas muito muita ja eu voce voces ele ela eles elas me te lhe meu minha seu sua
+isso esse essa este esta aqui ali qual quais quando onde tem ter sao ser foi era estou esta estao fazer faz
+sobre entre tambem so nao sim ola oi bom boa dia tarde noite obrigado obrigada gostaria queria quero saber
+""".split())
+
+_TOKEN_RE = re.compile(r'\w+')
+
+def fold_text(text: str) -> str:
+    """Minúsculas sem acentos ('Lipoaspiração' -> 'lipoaspiracao')."""
+    decomposed = unicodedata.normalize('NFKD', text.lower())
+    return "".join(char for char in decomposed if not unicodedata.combining(char))
+
+def tokenize(text: str) -> List[str]:
+    return [token for token in _TOKEN_RE.findall(fold_text(text))
+            if len(token) >= MIN_TOKEN_LENGTH and token not in STOPWORDS_PT]
+
+class KnowledgeChunk(NamedTuple):
+    chunk_id: str # Ex: 'procedure:rinoplastia', 'faq:3', 'clinic:address'
+    kind: str # 'procedure', 'faq', 'clinic', 'doctor', 'consultation', 'policy', ...
+    title: str
+    content: str # Bloco já formatado para o RAG
+
+class SearchHit(NamedTuple):
+    score: float
+    matched_terms: int # Termos distintos da query presentes no chunk
+    chunk: KnowledgeChunk
+
+class BM25Index:
+    """
+    Índice invertido (termo -> [(doc, tf)]) com pontuação BM25 (Okapi).
+    Construído uma vez no carregamento da base; a busca só visita as listas dos termos da query.
+    """
+    def __init__(self, k1: float = BM25_K1, b: float = BM25_B):
+        self.k1 = k1
+        self.b = b
+        self.chunks: List[KnowledgeChunk] = []
+        self._postings: Dict[str, List[Tuple[int, int]]] = {}
+        self._doc_lengths: List[int] = []
+        self._idf: Dict[str, float] = {}
+        self._avg_doc_length = 0.0
+
+    def __len__(self) -> int:
+        return len(self.chunks)
+
+    def add(self, chunk: KnowledgeChunk, index_text: Optional[str] = None):
+        """Adiciona um chunk. index_text permite indexar mais texto (sinônimos, título) do que o conteúdo exibido."""
+        doc_id = len(self.chunks)
+        tokens = tokenize(index_text if index_text is not None else f"{chunk.title}\n{chunk.content}")
+        self.chunks.append(chunk)
+        self._doc_lengths.append(len(tokens))
+        term_counts: Dict[str, int] = {}
+        for token in tokens:
+            term_counts[token] = term_counts.get(token, 0) + 1
+        for term, count in term_counts.items():
+            self._postings.setdefault(term, []).append((doc_id, count))
+
+    def finalize(self):
+        """Calcula IDF e comprimento médio (chamar após o último add)."""
+        total_docs = len(self.chunks)
+        self._avg_doc_length = (sum(self._doc_lengths) / total_docs) if total_docs else 0.0
+        self._idf = {
+            term: math.log(1 + (total_docs - len(postings) + 0.5) / (len(postings) + 0.5))
+            for term, postings in self._postings.items()
+        }
+
+    def search(self, query: str, k: int = 3, kinds: Optional[Tuple[str, ...]] = None) -> List[SearchHit]:
+        """Top-k chunks por BM25 (opcionalmente filtrando por tipo)."""
+        query_terms = set(tokenize(query))
+        if not query_terms or not self.chunks:
+            return []
+        scores: Dict[int, float] = {}
+        matched: Dict[int, int] = {}
+        for term in query_terms:
+            postings = self._postings.get(term)
+            if not postings: continue
+            idf = self._idf[term]
+            for doc_id, tf in postings:
+                norm = self.k1 * (1 - self.b + self.b * self._doc_lengths[doc_id] / self._avg_doc_length)
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (self.k1 + 1) / (tf + norm)
+                matched[doc_id] = matched.get(doc_id, 0) + 1
+        if kinds:
+            scores = {doc_id: score for doc_id, score in scores.items() if self.chunks[doc_id].kind in kinds}
+        best = heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+        return [SearchHit(score, matched[doc_id], self.chunks[doc_id]) for doc_id, score in best]
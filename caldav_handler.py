@@ -1,37 +1,410 @@
-# caldav_handler.py (v1.4 - Revert Save Method, Strict VCALENDAR format)
+# caldav_handler.py (v1.7 - Índice Local de Ocupação com Sync Incremental + Motor de Disponibilidade em Bitmap)
 import logging
 import datetime
+import bisect
+import threading
 import pytz
-from typing import List, Optional, Tuple, Dict, Any
+from typing import List, Optional, Tuple, Dict, Any, NamedTuple, ClassVar, Callable, Sequence, Collection, Set
 import caldav
 from caldav.elements import dav, cdav
+from caldav.elements.base import BaseElement
 from caldav.lib.error import NotFoundError
 from dateutil.relativedelta import relativedelta
 from dateutil.parser import parse as dateutil_parse
 import uuid
 import textwrap # Para formatar linhas longas no VCALENDAR
+import availability_engine
+from slot_preferences import SlotPreferences
+from availability_engine import AvailabilityCache, WorkingHours, working_hours_from_rules
 
 logger = logging.getLogger(__name__)
 
 DEFAULT_TIMEZONE = 'America/Sao_Paulo'
 DEFAULT_SEARCH_MONTHS = 2
+BUSY_FETCH_CHUNK_DAYS = 31 # Tamanho máximo de cada REPORT ao baixar a janela de ocupação
+BUSY_SEARCH_MARGIN = datetime.timedelta(minutes=1) # Mesma margem usada na busca por bloco
+INDEX_HORIZON_MONTHS = 6 # Janela mantida no índice local (cobre a busca de agendamentos de 6 meses)
+
+def vevent_busy_interval(vevent, tz) -> Optional[Tuple[datetime.datetime, datetime.datetime, str]]:
+    """
+    Converte um VEVENT (vobject) em (inicio, fim, resumo) para checagem local.
+    Replica a checagem por bloco: eventos de dia inteiro (date) não ocupam; eventos sem
+    DTEND ocupam qualquer bloco que o servidor retornaria (início/fim com margem).
+    Sem DTSTART levanta ValueError: o evento não tem posição na agenda e quem chama o separa como ilegível
+    (os blocos livres passam pela checagem remota por bloco, como antes).
+    """
+    dtstart_obj = getattr(vevent, 'dtstart', None)
+    if not dtstart_obj:
+        raise ValueError("Evento sem DTSTART")
+    summary_obj = getattr(vevent, 'summary', None)
+    summary = summary_obj.value if summary_obj else "[Sem Título]"
+    start_val = dtstart_obj.value
+    dtend_obj = getattr(vevent, 'dtend', None)
+    if not dtend_obj:
+        if not isinstance(start_val, datetime.datetime):
+            start_val = datetime.datetime.combine(start_val, datetime.time.min)
+        start_val = start_val.astimezone(tz) if start_val.tzinfo else tz.localize(start_val)
+        duration_obj = getattr(vevent, 'duration', None)
+        end_val = start_val + duration_obj.value if duration_obj else start_val
+        return start_val - BUSY_SEARCH_MARGIN, end_val + BUSY_SEARCH_MARGIN, "[Evento sem horário definido]"
+    end_val = dtend_obj.value
+    if not isinstance(start_val, datetime.datetime) or not isinstance(end_val, datetime.datetime):
+        return None
+    start_val = start_val.astimezone(tz) if start_val.tzinfo else tz.localize(start_val)
+    end_val = end_val.astimezone(tz) if end_val.tzinfo else tz.localize(end_val)
+    return start_val, end_val, summary
+
+def vevent_block_conflict(vevent, block_start_dt: datetime.datetime, block_end_dt: datetime.datetime, tz) -> Optional[str]:
+    """Checagem por bloco de um VEVENT devolvido pelo servidor: resumo se ocupa o bloco, None se não. Sem DTSTART/DTEND ocupa por segurança."""
+    dtstart_obj = getattr(vevent, 'dtstart', None)
+    dtend_obj = getattr(vevent, 'dtend', None)
+    summary = getattr(vevent, 'summary', None)
+    if not (dtstart_obj and dtend_obj):
+        return "[Evento sem horário definido]"
+    start_val = dtstart_obj.value
+    end_val = dtend_obj.value
+    if isinstance(start_val, datetime.datetime) and isinstance(end_val, datetime.datetime):
+        start_val = start_val.astimezone(tz) if start_val.tzinfo else tz.localize(start_val)
+        end_val = end_val.astimezone(tz) if end_val.tzinfo else tz.localize(end_val)
+        # Se houver sobreposição real
+        if block_start_dt < end_val and block_end_dt > start_val:
+            return summary.value if summary else "[Sem Título]"
+    return None
+
+class BusyIntervals:
+    """
+    Intervalos ocupados ordenados por início. find_overlap é O(log n): usa bisect nos inícios
+    e o índice do maior fim acumulado para saber se algum intervalo anterior cruza o bloco.
+    """
+    def __init__(self, intervals: List[Tuple[datetime.datetime, datetime.datetime, str]], unreadable: int = 0):
+        self._intervals = sorted(intervals, key=lambda iv: iv[0])
+        self.unreadable = unreadable # Recursos sem horário legível: blocos livres aqui ainda precisam da checagem remota
+        self._starts = [iv[0] for iv in self._intervals]
+        self._max_end_idx: List[int] = []
+        best = -1
+        for i, interval in enumerate(self._intervals):
+            if best < 0 or interval[1] > self._intervals[best][1]: best = i
+            self._max_end_idx.append(best)
+
+    def __len__(self) -> int:
+        return len(self._intervals)
+
+    @property
+    def intervals(self) -> List[Tuple[datetime.datetime, datetime.datetime, str]]:
+        return self._intervals
+
+    def find_overlap(self, start: datetime.datetime, end: datetime.datetime) -> Optional[Tuple[datetime.datetime, datetime.datetime, str]]:
+        """Retorna um intervalo que sobrepõe [start, end) ou None."""
+        pos = bisect.bisect_left(self._starts, end) # Intervalos com início < end
+        if pos == 0:
+            return None
+        candidate = self._intervals[self._max_end_idx[pos - 1]]
+        return candidate if candidate[1] > start else None
+
+    def is_busy(self, start: datetime.datetime, end: datetime.datetime) -> bool:
+        conflict = self.find_overlap(start, end)
+        if conflict:
+            logger.info(f"    * Bloco OCUPADO por: {conflict[2]}")
+        return conflict is not None
+
+def slot_search_range(start_search_dt: datetime.datetime, block_duration_minutes: int, tz) -> Tuple[datetime.datetime, datetime.datetime]:
+    """Intervalo que cobre todos os blocos candidatos de select_free_slots (com a margem da busca por bloco)."""
+    search_limit_dt = start_search_dt + relativedelta(months=DEFAULT_SEARCH_MONTHS)
+    # O último bloco começa antes da meia-noite do dia limite
+    horizon_end = tz.localize(datetime.datetime.combine(search_limit_dt.date(), datetime.time.min)) + datetime.timedelta(minutes=block_duration_minutes)
+    return start_search_dt - BUSY_SEARCH_MARGIN, horizon_end + BUSY_SEARCH_MARGIN
+
+def select_free_slots(start_search_dt: datetime.datetime, num_slots_to_find: int, block_duration_minutes: int,
+                      preferred_days: List[int], valid_start_hours: List[int], tz,
+                      is_busy: Callable[[datetime.datetime, datetime.datetime], bool]) -> List[datetime.datetime]:
+    """Percorre dias/horas candidatos a partir de start_search_dt (já no tz) e devolve os blocos livres."""
+    available_slots: List[datetime.datetime] = []
+    current_check_date = start_search_dt.date()
+    block_duration = datetime.timedelta(minutes=block_duration_minutes)
+    search_limit_dt = start_search_dt + relativedelta(months=DEFAULT_SEARCH_MONTHS)
+    checked_days = 0; max_checked_days = 90
+    while len(available_slots) < num_slots_to_find and current_check_date < search_limit_dt.date() and checked_days < max_checked_days:
+        if current_check_date.weekday() not in preferred_days:
+            current_check_date += datetime.timedelta(days=1); checked_days += 1; continue
+        logger.debug(f"Verificando dia: {current_check_date.strftime('%Y-%m-%d')} (Dia Sem: {current_check_date.weekday()})")
+        for hour in valid_start_hours:
+            block_start_dt = tz.localize(datetime.datetime.combine(current_check_date, datetime.time(hour=hour)))
+            block_end_dt = block_start_dt + block_duration
+            if block_start_dt < start_search_dt: continue
+            logger.debug(f"  - Verificando bloco: {block_start_dt.strftime('%H:%M')} - {block_end_dt.strftime('%H:%M')}")
+            if is_busy(block_start_dt, block_end_dt):
+                logger.debug(f"    * Bloco ocupado. Ignorando: {block_start_dt.isoformat()}")
+                continue
+
+            available_slots.append(block_start_dt)
+            logger.info(f"    * Bloco VAGO. Adicionando slot: {block_start_dt.isoformat()}")
+        # Após verificar todos os horários do dia, verifica se já atingiu o número de slots desejados
+        if len(available_slots) >= num_slots_to_find:
+            break  # Essa verificação só é feita após avaliar todos os horários do dia
+        current_check_date += datetime.timedelta(days=1); checked_days += 1
+    if checked_days >= max_checked_days: logger.warning(f"Busca atingiu limite de {max_checked_days} dias.")
+    logger.info(f"Busca finalizada. Encontrados {len(available_slots)} slots.")
+    return available_slots
+
+def slot_horizon_days(start_search_dt: datetime.datetime) -> int:
+    """Dias avaliados pela busca de slots (mesmo limite de select_free_slots: DEFAULT_SEARCH_MONTHS, no máximo 90 dias)."""
+    search_limit_dt = start_search_dt + relativedelta(months=DEFAULT_SEARCH_MONTHS)
+    return min((search_limit_dt.date() - start_search_dt.date()).days, 90)
+
+def overlaps_held(block_start_dt: datetime.datetime, block_duration: datetime.timedelta,
+                  excluded_intervals: Sequence[Tuple[datetime.datetime, datetime.datetime]]) -> bool:
+    return any(held_start < block_start_dt + block_duration and block_start_dt < held_end for held_start, held_end in excluded_intervals)
+
+def scan_free_slots(search_from: datetime.datetime, num_slots_to_find: int, block_duration_minutes: int, tz,
+                    working_hours: WorkingHours, holidays: Sequence[datetime.date], preferences: Optional[SlotPreferences],
+                    excluded_intervals: Sequence[Tuple[datetime.datetime, datetime.datetime]],
+                    is_busy: Callable[[datetime.datetime, datetime.datetime], bool]) -> List[datetime.datetime]:
+    """
+    Varredura dia a dia (select_free_slots) com expediente, feriados, preferências e reservas alheias. is_busy só é
+    chamado para blocos que passam pelas regras (índice local ou, no fallback, um REPORT por bloco).
+    """
+    block_duration = datetime.timedelta(minutes=block_duration_minutes)
+    holiday_set = set(holidays)
+    def is_outside_hours_or_busy(block_start_dt: datetime.datetime, block_end_dt: datetime.datetime) -> bool:
+        start_minute = block_start_dt.hour * 60 + block_start_dt.minute
+        end_minute = start_minute + block_duration_minutes
+        inside = any(start <= start_minute and end_minute <= end for start, end in working_hours.get(block_start_dt.weekday(), []))
+        if preferences is not None and not preferences.accepts(block_start_dt): return True
+        if excluded_intervals and overlaps_held(block_start_dt, block_duration, excluded_intervals): return True
+        return block_start_dt.date() in holiday_set or not inside or is_busy(block_start_dt, block_end_dt)
+    candidate_hours = sorted({minute // 60 for windows in working_hours.values() for start, end in windows for minute in range(start, end, 60)})
+    return select_free_slots(search_from, num_slots_to_find, block_duration_minutes, sorted(working_hours), candidate_hours, tz, is_outside_hours_or_busy)
+
+def find_free_slots(start_search_dt: datetime.datetime, num_slots_to_find: int, block_duration_minutes: int,
+                    preferred_days: List[int], valid_start_hours: List[int], tz, busy_intervals: BusyIntervals,
+                    availability_cache: Optional[AvailabilityCache] = None, working_hours: Optional[WorkingHours] = None,
+                    holidays: Sequence[datetime.date] = (), resume_after: Optional[datetime.datetime] = None,
+                    preferences: Optional[SlotPreferences] = None,
+                    excluded_intervals: Sequence[Tuple[datetime.datetime, datetime.datetime]] = (),
+                    rejected_starts: Collection[datetime.datetime] = ()) -> List[datetime.datetime]:
+    """
+    Blocos livres a partir da ocupação local. Com numpy, usa o bitmap do availability_engine (em cache enquanto a agenda
+    não muda); sem numpy, a varredura dia a dia. working_hours (expediente por dia da semana) substitui dias/horas fixos.
+    resume_after (paginação): devolve só blocos a partir dele, com o horizonte ainda ancorado em start_search_dt (mesmo
+    bitmap em cache da primeira página; a varredura sem numpy recomeça no dia do cursor).
+    preferences (dias da semana, faixa de horário e de datas pedidas pelo paciente) filtram os blocos na própria busca.
+    excluded_intervals (reservas provisórias de outros pacientes) ficam fora do resultado sem mexer no bitmap em cache.
+    rejected_starts (inícios recusados pela checagem remota, ver _confirm_slots dos handlers) também saem, e a página é reposta.
+    """
+    block_duration = datetime.timedelta(minutes=block_duration_minutes)
+    def is_dropped(block_start_dt: datetime.datetime) -> bool:
+        return block_start_dt in rejected_starts or (bool(excluded_intervals) and overlaps_held(block_start_dt, block_duration, excluded_intervals))
+    if working_hours is None:
+        working_hours = working_hours_from_rules(preferred_days, valid_start_hours, block_duration_minutes)
+    search_from = max(start_search_dt, resume_after or start_search_dt)
+    search_before = None
+    if preferences is not None:
+        if preferences.earliest is not None:
+            search_from = max(search_from, tz.localize(datetime.datetime.combine(preferences.earliest, datetime.time.min)))
+        if preferences.latest is not None:
+            search_before = tz.localize(datetime.datetime.combine(preferences.latest + datetime.timedelta(days=1), datetime.time.min))
+    if availability_engine.is_available():
+        origin = start_search_dt.date()
+        intervals = ((start, end) for start, end, _ in busy_intervals.intervals) # Só é percorrido se o bitmap for reconstruído
+        if availability_cache is not None:
+            grid = availability_cache.grid(busy_intervals, intervals, origin, slot_horizon_days(start_search_dt), tz, working_hours, holidays)
+        else:
+            grid = availability_engine.OccupancyGrid.build(origin, slot_horizon_days(start_search_dt), tz, working_hours, intervals, holidays)
+        slots: List[datetime.datetime] = []
+        while len(slots) < num_slots_to_find: # Páginas extras só quando reservas alheias / checagem remota derrubam candidatos
+            wanted = num_slots_to_find - len(slots) + len(excluded_intervals) + len(rejected_starts)
+            page = grid.next_slots(search_from, wanted, block_duration_minutes, weekdays=preferences.weekdays if preferences else None,
+                                   start_window=preferences.start_window() if preferences else None, before=search_before)
+            slots.extend(slot for slot in page if not is_dropped(slot))
+            if len(page) < wanted: break
+            search_from = page[-1] + datetime.timedelta(minutes=1)
+        slots = slots[:num_slots_to_find]
+        logger.info(f"Busca (bitmap) finalizada. Encontrados {len(slots)} slots.")
+        return slots
+    slots = scan_free_slots(search_from, num_slots_to_find, block_duration_minutes, tz, working_hours, holidays, preferences, excluded_intervals,
+                            lambda block_start_dt, block_end_dt: block_start_dt in rejected_starts or busy_intervals.is_busy(block_start_dt, block_end_dt))
+    horizon_end = tz.localize(datetime.datetime.combine(start_search_dt.date() + datetime.timedelta(days=slot_horizon_days(start_search_dt)), datetime.time.min))
+    search_before = min(search_before, horizon_end) if search_before else horizon_end # Mesmo horizonte do bitmap (ancorado na origem)
+    return [slot for slot in slots if slot < search_before]
+
+def format_vcal_line(line: str) -> str:
+    """Formata uma linha VCALENDAR com quebra e indentação (RFC 5545)."""
+    # Garante que a linha termine com \r\n
+    # Quebra linhas longas (máximo 75 octets recomendado, incluindo CRLF)
+    folded_lines = textwrap.fill(line, width=73, subsequent_indent=' ', break_long_words=False, break_on_hyphens=False)
+    return folded_lines + "\r\n"
+
+def build_appointment_vcal(start_time: datetime.datetime, end_time: datetime.datetime, tz,
+                           patient_name: str, patient_contact: Optional[str] = None, patient_email: Optional[str] = None,
+                           indication_source: Optional[str] = None, procedure_interest: Optional[str] = None
+                          ) -> Tuple[str, str, str]:
+    """Monta o VCALENDAR da consulta. Retorna (vcal_string, uid, summary)."""
+    summary = f"Consulta - {patient_name}"
+    desc_parts = [f"Paciente: {patient_name}"]
+    if patient_contact: desc_parts.append(f"Contato: {patient_contact}")
+    if patient_email: desc_parts.append(f"Email: {patient_email}")  # Adiciona o email
+    if procedure_interest: desc_parts.append(f"Interesse: {procedure_interest}")
+    if indication_source and indication_source.lower() not in ['não indicado', 'nao indicado', 'ninguem', 'ninguém', 'nao']:
+         desc_parts.append(f"Indicação: {indication_source}")
+    # Escapa caracteres especiais para VCALENDAR e mantém quebras de linha como \n
+    description_escaped = "\\n".join(desc_parts).replace(',', '\\,').replace(';', '\\;').replace('\r\n','\\n').replace('\n','\\n')
+
+    event_uid = f"{datetime.datetime.now(pytz.utc).strftime('%Y%m%dT%H%M%SZ')}-{uuid.uuid4()}@clinicabot.margot"
+    dt_format = "%Y%m%dT%H%M%S"
+    tzid_str = "" if tz == pytz.utc else f";TZID={tz.zone}"
+    dtstamp_utc = datetime.datetime.now(pytz.utc).strftime('%Y%m%dT%H%M%SZ')
+
+    # Monta a string VCALENDAR linha a linha, formatando cada uma
+    vcal_string = ""
+    vcal_string += format_vcal_line("BEGIN:VCALENDAR")
+    vcal_string += format_vcal_line("VERSION:2.0")
+    vcal_string += format_vcal_line("PRODID:-//Clinicabot//Margot Agendamento v1.4//PT")
+    vcal_string += format_vcal_line("CALSCALE:GREGORIAN")
+    vcal_string += format_vcal_line("BEGIN:VEVENT")
+    vcal_string += format_vcal_line(f"UID:{event_uid}")
+    vcal_string += format_vcal_line(f"DTSTAMP:{dtstamp_utc}")
+    vcal_string += format_vcal_line(f"DTSTART{tzid_str}:{start_time.strftime(dt_format)}")
+    vcal_string += format_vcal_line(f"DTEND{tzid_str}:{end_time.strftime(dt_format)}")
+    vcal_string += format_vcal_line(f"SUMMARY:{summary}")
+    # Aplica formatação à descrição (pode ser longa)
+    vcal_string += format_vcal_line(f"DESCRIPTION:{description_escaped}")
+    vcal_string += format_vcal_line("STATUS:CONFIRMED")
+    vcal_string += format_vcal_line("TRANSP:OPAQUE")
+    vcal_string += format_vcal_line("SEQUENCE:0")
+    vcal_string += format_vcal_line("END:VEVENT")
+    vcal_string += format_vcal_line("END:VCALENDAR")
+    return vcal_string, event_uid, summary
+
+def format_start_ptbr(start_time: datetime.datetime, pattern: str, fallback: str) -> str:
+    """strftime com locale pt_BR quando disponível (mensagens de agendamento/cancelamento)."""
+    try:
+        import locale; locale.setlocale(locale.LC_TIME, 'pt_BR.UTF-8')
+        return start_time.strftime(pattern)
+    except Exception:
+        return start_time.strftime(fallback)
+
+class GetCtag(BaseElement):
+    """Propriedade getctag (CalendarServer): muda sempre que algum recurso do calendário muda."""
+    tag: ClassVar[str] = "{http://calendarserver.org/ns/}getctag"
+
+class IndexedOccurrence(NamedTuple):
+    start: datetime.datetime
+    end: datetime.datetime
+    summary: Optional[str] # None quando o evento não tem SUMMARY
+    has_end: bool # DTEND presente (exigido pela busca de agendamentos)
+    busy: Optional[Tuple[datetime.datetime, datetime.datetime, str]] # Intervalo para busca de slots
+
+def vevent_occurrence(vevent, tz) -> IndexedOccurrence:
+    """Converte um VEVENT em IndexedOccurrence (mesmas regras de data usadas nas buscas remotas). Sem DTSTART: ValueError."""
+    dtstart_obj = getattr(vevent, 'dtstart', None)
+    if not dtstart_obj or not hasattr(dtstart_obj, 'value'):
+        raise ValueError("Evento sem DTSTART")
+    st_naive = dtstart_obj.value
+    if isinstance(st_naive, datetime.datetime):
+        start_time = st_naive.astimezone(tz) if st_naive.tzinfo else tz.localize(st_naive)
+    else:
+        start_time = tz.localize(datetime.datetime.combine(st_naive, datetime.time.min))
+    end_time = None
+    dtend_obj = getattr(vevent, 'dtend', None)
+    if dtend_obj and hasattr(dtend_obj, 'value'):
+        et_naive = dtend_obj.value
+        if isinstance(et_naive, datetime.datetime):
+            end_time = et_naive.astimezone(tz) if et_naive.tzinfo else tz.localize(et_naive)
+        else:
+            end_time = tz.localize(datetime.datetime.combine(et_naive, datetime.time.max))
+    has_end = end_time is not None
+    if not has_end:
+        duration_obj = getattr(vevent, 'duration', None)
+        end_time = start_time + duration_obj.value if duration_obj else start_time
+    summary_obj = getattr(vevent, 'summary', None)
+    summary = (summary_obj.value or "") if summary_obj else None
+    return IndexedOccurrence(start_time, end_time, summary, has_end, vevent_busy_interval(vevent, tz))
+
+class CalendarBusyIndex:
+    """
+    Índice local de ocupação: ocorrências por recurso (URL canônica), mapa UID -> URL e
+    listas ordenadas para checagem de slots (busy) e de conflito na reserva (extents).
+    Recursos ilegíveis (sem DTSTART ou com erro de parse) ficam à parte, sem ocorrências: enquanto houver algum
+    (unreadable), blocos livres no índice e a checagem final são confirmados no servidor.
+    Quem mantém o índice sincronizado é o CaldavHandler (CTag / sync-token + write-through).
+    """
+    def __init__(self):
+        self.window_start: Optional[datetime.datetime] = None
+        self.window_end: Optional[datetime.datetime] = None
+        self.ctag: Optional[str] = None
+        self.sync_token: Optional[str] = None
+        self.loaded = False
+        self.resources: Dict[str, Dict[str, Any]] = {} # url -> {"href", "uid", "occurrences"}
+        self.uid_map: Dict[str, str] = {} # uid -> url
+        self.busy = BusyIntervals([])
+        self.extents = BusyIntervals([])
+        self.unreadable = 0
+
+    def covers(self, start: datetime.datetime, end: datetime.datetime) -> bool:
+        return self.loaded and self.window_start <= start and end <= self.window_end
+
+    def reset(self, window_start: datetime.datetime, window_end: datetime.datetime):
+        self.window_start = window_start; self.window_end = window_end
+        self.resources = {}; self.uid_map = {}
+        self.ctag = None; self.sync_token = None; self.loaded = False
+
+    def set_resource(self, url: str, href: str, uid: Optional[str], occurrences: List[IndexedOccurrence], unreadable: bool = False):
+        self.remove_resource(url)
+        self.resources[url] = {"href": href, "uid": uid, "occurrences": occurrences, "unreadable": unreadable}
+        if uid: self.uid_map[uid] = url
+
+    def remove_resource(self, url: str):
+        old = self.resources.pop(url, None)
+        if old and old.get("uid") and self.uid_map.get(old["uid"]) == url:
+            del self.uid_map[old["uid"]]
+
+    def rebuild(self):
+        """Reconstrói as listas ordenadas após mudanças nos recursos."""
+        busy, extents = [], []
+        for resource in self.resources.values():
+            for occ in resource["occurrences"]:
+                if occ.busy: busy.append(occ.busy)
+                extents.append((occ.start, occ.end, occ.summary if occ.summary is not None else "N/A"))
+        self.unreadable = sum(1 for resource in self.resources.values() if resource["unreadable"])
+        self.busy = BusyIntervals(busy, self.unreadable)
+        self.extents = BusyIntervals(extents, self.unreadable)
+
+    def occurrences_between(self, start: datetime.datetime, end: datetime.datetime):
+        """Gera (href, ocorrência) que sobrepõem [start, end]."""
+        for resource in self.resources.values():
+            for occ in resource["occurrences"]:
+                if occ.start <= end and occ.end >= start:
+                    yield resource["href"], occ
 
 class CaldavHandler:
     """
-    (v1.4) Gerencia a comunicação CalDAV.
+    (v1.6) Gerencia a comunicação CalDAV.
+    - Índice local de ocupação (CalendarBusyIndex) atualizado via CTag / sync-token; slots,
+      conflito final e busca por nome usam o índice. Escritas continuam indo direto ao servidor.
+    - find_available_slots baixa a janela inteira de ocupação em um REPORT e avalia os blocos localmente
+      (v1.7: bitmap de ocupação + janela deslizante vetorizada, em cache até a agenda mudar; aceita expediente e feriados).
     - Reverte para calendar.save_event(vcal_string).
     - Aplica formatação VCALENDAR mais rigorosa (quebra de linha, line ending).
     - Mantém correção da busca por nome (v1.3) e detecção de conflitos (v1.2).
     """
     # __init__, _connect, _get_tz, _is_connected (sem alterações da v1.3)
-    def __init__(self, url: str, username: str, password: str, calendar_name: str):
+    def __init__(self, url: str, username: str, password: str, calendar_name: str, use_busy_index: bool = True,
+                 timezone: str = DEFAULT_TIMEZONE):
         self.url = url
         self.username = username
         self.password = password
         self.calendar_name = calendar_name
+        self.timezone = timezone
         self.client = None
         self.principal = None
         self.calendar = None
+        self.use_busy_index = use_busy_index
+        self.busy_index = CalendarBusyIndex()
+        self.availability_cache = AvailabilityCache()
+        self._index_lock = threading.RLock()
+        self._booking_lock = threading.Lock() # Serializa checagem de conflito + gravação
+        self.unreadable_resources = 0 # Recursos sem horário legível na última janela de ocupação
+        self.remote_block_checks = 0 # Blocos confirmados no servidor por causa deles
         self._connect()
 
     def _connect(self):
@@ -41,6 +414,7 @@ class CaldavHandler:
             self.principal = self.client.principal()
             calendars = self.principal.calendars()
             self.calendar = next((c for c in calendars if c.name == self.calendar_name), None)
+            self.busy_index.loaded = False # Índice é recarregado após (re)conexão
             if not self.calendar:
                 calendar_names = [c.name for c in calendars]; logger.error(f"Calendário '{self.calendar_name}' não encontrado. Disponíveis: {calendar_names}")
                 raise ValueError(f"Calendário '{self.calendar_name}' não encontrado.")
@@ -50,8 +424,8 @@ class CaldavHandler:
             raise ConnectionError(f"Não foi possível conectar/encontrar calendário CalDAV: {e}")
 
     def _get_tz(self) -> pytz.timezone:
-        try: return pytz.timezone(DEFAULT_TIMEZONE)
-        except pytz.UnknownTimeZoneError: logger.error(f"Timezone '{DEFAULT_TIMEZONE}' desconhecido! Usando UTC."); return pytz.utc
+        try: return pytz.timezone(self.timezone)
+        except pytz.UnknownTimeZoneError: logger.error(f"Timezone '{self.timezone}' desconhecido! Usando UTC."); return pytz.utc
 
     def _is_connected(self) -> bool:
         if self.client and self.principal and self.calendar:
@@ -60,90 +434,238 @@ class CaldavHandler:
         try: self._connect(); return self.calendar is not None
         except ConnectionError: logger.error("Falha ao reconectar ao CalDAV."); return False
 
-    # find_available_slots (sem alterações da v1.3)
+    # find_available_slots (v1.5: busca única da janela inteira + checagem local)
     def find_available_slots(self,
                              start_search_dt: datetime.datetime, num_slots_to_find: int = 5,
                              consultation_duration_minutes: int = 45, block_duration_minutes: int = 60,
-                             preferred_days: List[int] = [0, 1], valid_start_hours: List[int] = [14, 15, 16, 17]
+                             preferred_days: List[int] = [0, 1], valid_start_hours: List[int] = [14, 15, 16, 17],
+                             prefetch_busy: bool = True, working_hours: Optional[WorkingHours] = None,
+                             holidays: Sequence[datetime.date] = (), resume_after: Optional[datetime.datetime] = None,
+                             preferences: Optional[SlotPreferences] = None,
+                             excluded_intervals: Sequence[Tuple[datetime.datetime, datetime.datetime]] = ()
                             ) -> List[datetime.datetime]:
+        """
+        Busca blocos livres. Com prefetch_busy=True (padrão) os eventos de todo o horizonte
+        são baixados em um único REPORT (ou poucos, em blocos de BUSY_FETCH_CHUNK_DAYS) e cada
+        bloco candidato é avaliado localmente. Se essa busca falhar, volta ao modo antigo
+        (um REPORT por bloco). resume_after continua uma busca anterior ("mais opções") a partir do cursor;
+        preferences restringe dias/horários/datas ao que o paciente pediu; excluded_intervals (reservas de outros
+        pacientes) nunca são oferecidos.
+        """
         if not self._is_connected(): logger.error("find_available_slots: Não conectado."); return []
         tz = self._get_tz()
         start_search_dt = start_search_dt.astimezone(tz) if start_search_dt.tzinfo else tz.localize(start_search_dt)
-        available_slots: List[datetime.datetime] = []
-        current_check_date = start_search_dt.date()
-        block_duration = datetime.timedelta(minutes=block_duration_minutes)
-        search_limit_dt = start_search_dt + relativedelta(months=DEFAULT_SEARCH_MONTHS)
         logger.info(f"Iniciando busca por {num_slots_to_find} slots (blocos {block_duration_minutes}min) a partir de {start_search_dt.isoformat()}.")
-        checked_days = 0; max_checked_days = 90
-        while len(available_slots) < num_slots_to_find and current_check_date < search_limit_dt.date() and checked_days < max_checked_days:
-            if current_check_date.weekday() not in preferred_days:
-                current_check_date += datetime.timedelta(days=1); checked_days += 1; continue
-            logger.debug(f"Verificando dia: {current_check_date.strftime('%Y-%m-%d')} (Dia Sem: {current_check_date.weekday()})")
-            for hour in valid_start_hours:
-                block_start_dt = tz.localize(datetime.datetime.combine(current_check_date, datetime.time(hour=hour)))
-                block_end_dt = block_start_dt + block_duration
-                if block_start_dt < start_search_dt: continue
-                logger.debug(f"  - Verificando bloco: {block_start_dt.strftime('%H:%M')} - {block_end_dt.strftime('%H:%M')}")
-                is_busy = False
+
+        busy_intervals: Optional[BusyIntervals] = None
+        if prefetch_busy:
+            busy_intervals = self._get_busy_intervals(*slot_search_range(start_search_dt, block_duration_minutes, tz))
+            if busy_intervals is None:
+                logger.warning("Falha ao buscar janela de ocupação. Usando checagem remota por bloco.")
+        if busy_intervals is not None:
+            self.unreadable_resources = busy_intervals.unreadable
+            search = lambda rejected_starts: find_free_slots(
+                start_search_dt, num_slots_to_find, block_duration_minutes, preferred_days, valid_start_hours, tz, busy_intervals,
+                self.availability_cache, working_hours, holidays, resume_after, preferences, excluded_intervals, rejected_starts)
+            return self._confirm_slots(search, block_duration_minutes, tz) if busy_intervals.unreadable else search(())
+        if working_hours is None:
+            working_hours = working_hours_from_rules(preferred_days, valid_start_hours, block_duration_minutes)
+        return scan_free_slots(max(start_search_dt, resume_after or start_search_dt), num_slots_to_find, block_duration_minutes, tz,
+                               working_hours, holidays, preferences, excluded_intervals,
+                               lambda block_start_dt, block_end_dt: self._is_block_busy_remote(block_start_dt, block_end_dt, tz))
+
+    def _confirm_slots(self, search: Callable[[Set[datetime.datetime]], List[datetime.datetime]],
+                       block_duration_minutes: int, tz) -> List[datetime.datetime]:
+        """
+        Há recursos ilegíveis na janela: cada bloco livre localmente é confirmado no servidor (um REPORT por bloco, a
+        checagem antiga); os recusados saem e a busca local repõe a página. Só blocos candidatos vão ao servidor.
+        """
+        block_duration = datetime.timedelta(minutes=block_duration_minutes)
+        rejected: Set[datetime.datetime] = set(); confirmed: Set[datetime.datetime] = set()
+        while True:
+            slots = search(rejected)
+            pending = [slot for slot in slots if slot not in confirmed]
+            if not pending:
+                return slots
+            for slot in pending:
+                self.remote_block_checks += 1
+                (rejected if self._is_block_busy_remote(slot, slot + block_duration, tz) else confirmed).add(slot)
+
+    def _get_busy_intervals(self, range_start: datetime.datetime, range_end: datetime.datetime) -> Optional[BusyIntervals]:
+        """Usa o índice local quando disponível; senão baixa a janela diretamente do servidor."""
+        if self._refresh_busy_index(range_start, range_end):
+            return self.busy_index.busy
+        return self._fetch_busy_intervals(range_start, range_end)
+
+    # --- Índice local de ocupação (CTag / sync-token) ---
+    def _refresh_busy_index(self, range_start: datetime.datetime, range_end: datetime.datetime) -> bool:
+        """
+        Garante que o índice está atualizado e cobre o intervalo pedido.
+        Calendário inalterado custa um PROPFIND (CTag); mudanças são aplicadas via sync-collection
+        e só os recursos alterados são baixados. Retorna False se o índice não puder ser usado.
+        """
+        if not self.use_busy_index or not self.calendar:
+            return False
+        with self._index_lock:
+            index = self.busy_index
+            try:
+                if not index.covers(range_start, range_end):
+                    self._load_busy_index(range_start, range_end)
+                    return index.covers(range_start, range_end)
+                ctag, sync_token = self._get_collection_tags()
+                if ctag is not None and ctag == index.ctag:
+                    logger.debug("Índice de ocupação: CTag inalterado.")
+                    return True
+                if index.sync_token:
+                    try:
+                        self._sync_busy_index()
+                        index.ctag = ctag
+                        return True
+                    except Exception as e_sync:
+                        logger.warning(f"Sync incremental falhou ({e_sync}). Recarregando índice completo.")
+                self._load_busy_index(range_start, range_end)
+                return index.covers(range_start, range_end)
+            except Exception as e_index:
+                logger.error(f"Erro ao atualizar índice de ocupação: {e_index}", exc_info=True)
+                index.loaded = False
+                return False
+
+    def _get_collection_tags(self) -> Tuple[Optional[str], Optional[str]]:
+        """PROPFIND único com CTag e sync-token da coleção (None se o servidor não suportar)."""
+        props = self.calendar.get_properties([GetCtag(), dav.SyncToken()])
+        return props.get(GetCtag.tag), props.get(dav.SyncToken.tag)
+
+    def _load_busy_index(self, range_start: datetime.datetime, range_end: datetime.datetime):
+        """Carga completa da janela do índice (tags lidas ANTES da busca, para não perder mudanças)."""
+        tz = self._get_tz()
+        today = tz.localize(datetime.datetime.combine(datetime.datetime.now(tz).date(), datetime.time.min))
+        window_start = min(today, range_start) - datetime.timedelta(days=1)
+        window_end = max(today + relativedelta(months=INDEX_HORIZON_MONTHS, days=2), range_end)
+        index = self.busy_index
+        index.reset(window_start, window_end)
+        ctag, sync_token = self._get_collection_tags()
+        grouped: Dict[str, Dict[str, Any]] = {}
+        for event in self._search_events_chunked(window_start, window_end):
+            url = str(event.url.canonical())
+            entry = grouped.setdefault(url, {"href": str(event.url), "uid": None, "occurrences": []})
+            try:
+                vevent = event.instance.vevent
+                uid_obj = getattr(vevent, 'uid', None)
+                if uid_obj and not entry["uid"]: entry["uid"] = uid_obj.value
+                entry["occurrences"].append(vevent_occurrence(vevent, tz))
+            except Exception as e_event: # Ilegível: fica à parte; os blocos livres passam pela checagem remota
+                logger.warning(f"Erro ao indexar evento {url}: {e_event}. Recurso marcado como ilegível.")
+                entry["unreadable"] = True
+        for url, entry in grouped.items():
+            index.set_resource(url, entry["href"], entry["uid"], entry["occurrences"], entry.get("unreadable", False))
+        index.ctag = ctag; index.sync_token = sync_token
+        index.rebuild(); index.loaded = True
+        logger.info(f"Índice de ocupação carregado: {len(index.resources)} recursos, {len(index.busy)} intervalos ({window_start.date()} a {window_end.date()}). Sync-token: {'Sim' if sync_token else 'Não'}.")
+
+    def _sync_busy_index(self):
+        """Aplica as mudanças desde o último sync-token, baixando só os recursos alterados."""
+        index = self.busy_index
+        updates = self.calendar.objects_by_sync_token(sync_token=index.sync_token, load_objects=False)
+        updated = 0; deleted = 0
+        for obj in updates:
+            url = str(obj.url.canonical())
+            try:
+                obj.load()
+            except NotFoundError:
+                index.remove_resource(url); deleted += 1
+                continue
+            try:
+                uid, occurrences = self._resource_occurrences(obj, index.window_start, index.window_end)
+                index.set_resource(url, str(obj.url), uid, occurrences)
+            except Exception as e_event:
+                logger.warning(f"Erro ao indexar evento {url}: {e_event}. Recurso marcado como ilegível.")
+                index.set_resource(url, str(obj.url), None, [], unreadable=True)
+            updated += 1
+        index.sync_token = updates.sync_token
+        index.rebuild()
+        logger.info(f"Índice de ocupação sincronizado: {updated} recurso(s) atualizado(s), {deleted} removido(s).")
+
+    def _resource_occurrences(self, obj, window_start: datetime.datetime, window_end: datetime.datetime) -> Tuple[Optional[str], List[IndexedOccurrence]]:
+        """Extrai UID e ocorrências de um recurso carregado, expandindo recorrências na janela."""
+        tz = self._get_tz()
+        vevents = obj.vobject_instance.contents.get('vevent', [])
+        if not vevents:
+            return None, []
+        uid_obj = getattr(vevents[0], 'uid', None)
+        uid = uid_obj.value if uid_obj else None
+        if any(hasattr(v, 'rrule') or hasattr(v, 'rdate') for v in vevents):
+            obj.expand_rrule(window_start, window_end)
+            vevents = obj.vobject_instance.contents.get('vevent', [])
+        return uid, [vevent_occurrence(v, tz) for v in vevents]
+
+    def _search_events_chunked(self, range_start: datetime.datetime, range_end: datetime.datetime):
+        """calendar.search(expand=True) em blocos de BUSY_FETCH_CHUNK_DAYS."""
+        chunk = datetime.timedelta(days=BUSY_FETCH_CHUNK_DAYS)
+        chunk_start = range_start
+        while chunk_start < range_end:
+            chunk_end = min(chunk_start + chunk, range_end)
+            yield from self.calendar.search(start=chunk_start, end=chunk_end, event=True, expand=True) or []
+            chunk_start = chunk_end
+
+    def _fetch_busy_intervals(self, range_start: datetime.datetime, range_end: datetime.datetime) -> Optional[BusyIntervals]:
+        """Baixa todos os eventos do intervalo (em blocos de BUSY_FETCH_CHUNK_DAYS) e monta a lista ocupada."""
+        tz = self._get_tz()
+        intervals: List[Tuple[datetime.datetime, datetime.datetime, str]] = []
+        unreadable = 0
+        try:
+            for event in self._search_events_chunked(range_start, range_end):
                 try:
-                    # Busca eventos com margem maior (1 min antes/depois)
-                    search_start = block_start_dt - datetime.timedelta(minutes=1)
-                    search_end = block_end_dt + datetime.timedelta(minutes=1)
-                    conflicting_events = self.calendar.search(start=search_start, end=search_end, event=True, expand=True)
-                    event_summaries = []
-                    # Checagem manual de sobreposição real
-                    if conflicting_events:
-                        for event in conflicting_events:
-                            try:
-                                vevent = event.instance.vevent
-                                dtstart_obj = getattr(vevent, 'dtstart', None)
-                                dtend_obj = getattr(vevent, 'dtend', None)
-                                summary = getattr(vevent, 'summary', None)
-                                if dtstart_obj and dtend_obj:
-                                    start_val = dtstart_obj.value
-                                    end_val = dtend_obj.value
-                                    if isinstance(start_val, datetime.datetime) and isinstance(end_val, datetime.datetime):
-                                        start_val = start_val.astimezone(tz) if start_val.tzinfo else tz.localize(start_val)
-                                        end_val = end_val.astimezone(tz) if end_val.tzinfo else tz.localize(end_val)
-                                        # Se houver sobreposição real
-                                        if block_start_dt < end_val and block_end_dt > start_val:
-                                            is_busy = True
-                                            if summary:
-                                                event_summaries.append(summary.value)
-                                            else:
-                                                event_summaries.append("[Sem Título]")
-                                            break
-                                # Se não tem dtstart/dtend, considera como ocupado por segurança
-                                else:
-                                    is_busy = True
-                                    event_summaries.append("[Evento sem horário definido]")
-                                    break
-                            except Exception as e_event:
-                                logger.warning(f"Erro ao verificar conflito com evento existente: {e_event}", exc_info=True)
-                                is_busy = True
-                                event_summaries.append("[Erro Summary]")
-                                break
-                        if is_busy:
-                            logger.info(f"    * Bloco OCUPADO por: {', '.join(event_summaries) if event_summaries else '[Evento desconhecido]'}")
-                        else:
-                            logger.debug("    * Nenhum evento conflitante real.")
-                    else:
-                        logger.debug("    * Nenhum evento conflitante.")
-                except Exception as e_caldav:
-                    logger.error(f"    * Erro buscar conflitos: {e_caldav}", exc_info=True); is_busy = True
-                if is_busy:
-                    logger.debug(f"    * Bloco ocupado. Ignorando: {block_start_dt.isoformat()}")
+                    interval = vevent_busy_interval(event.instance.vevent, tz)
+                except Exception as e_event: # Recurso ilegível: os blocos livres passam pela checagem remota
+                    logger.warning(f"Erro ao ler evento para janela de ocupação: {e_event}. Recurso marcado como ilegível.")
+                    unreadable += 1
                     continue
+                if interval: intervals.append(interval)
+        except Exception as e_caldav:
+            logger.error(f"Erro ao buscar janela de ocupação ({range_start.isoformat()} - {range_end.isoformat()}): {e_caldav}", exc_info=True)
+            return None
+        logger.info(f"Janela de ocupação carregada: {len(intervals)} intervalos, {unreadable} recurso(s) ilegível(is).")
+        return BusyIntervals(intervals, unreadable)
 
-                available_slots.append(block_start_dt)
-                logger.info(f"    * Bloco VAGO. Adicionando slot: {block_start_dt.isoformat()}")
-            # Após verificar todos os horários do dia, verifica se já atingiu o número de slots desejados
-            if len(available_slots) >= num_slots_to_find:
-                break  # Essa verificação só é feita após avaliar todos os horários do dia
-            current_check_date += datetime.timedelta(days=1); checked_days += 1
-        if checked_days >= max_checked_days: logger.warning(f"Busca atingiu limite de {max_checked_days} dias.")
-        logger.info(f"Busca finalizada. Encontrados {len(available_slots)} slots.")
-        return available_slots
+    def _is_block_busy_remote(self, block_start_dt: datetime.datetime, block_end_dt: datetime.datetime, tz) -> bool:
+        """Checagem antiga: um REPORT por bloco (fallback sem janela de ocupação e confirmação com recursos ilegíveis)."""
+        is_busy = False
+        try:
+            # Busca eventos com margem maior (1 min antes/depois)
+            search_start = block_start_dt - BUSY_SEARCH_MARGIN
+            search_end = block_end_dt + BUSY_SEARCH_MARGIN
+            conflicting_events = self.calendar.search(start=search_start, end=search_end, event=True, expand=True)
+            event_summaries = []
+            # Checagem manual de sobreposição real
+            if conflicting_events:
+                for event in conflicting_events:
+                    try:
+                        conflict = vevent_block_conflict(event.instance.vevent, block_start_dt, block_end_dt, tz)
+                        if conflict:
+                            is_busy = True
+                            event_summaries.append(conflict)
+                            break
+                    except Exception as e_event:
+                        logger.warning(f"Erro ao verificar conflito com evento existente: {e_event}", exc_info=True)
+                        is_busy = True
+                        event_summaries.append("[Erro Summary]")
+                        break
+                if is_busy:
+                    logger.info(f"    * Bloco OCUPADO por: {', '.join(event_summaries) if event_summaries else '[Evento desconhecido]'}")
+                else:
+                    logger.debug("    * Nenhum evento conflitante real.")
+            else:
+                logger.debug("    * Nenhum evento conflitante.")
+        except Exception as e_caldav:
+            logger.error(f"    * Erro buscar conflitos: {e_caldav}", exc_info=True); is_busy = True
+        return is_busy
+
+    def metrics(self) -> Dict[str, Any]:
+        return {
+            "unreadable_resources": self.unreadable_resources,
+            "remote_block_checks": self.remote_block_checks,
+            "availability_builds": self.availability_cache.builds,
+        }
 
     # find_appointments_by_details (sem alterações da v1.3)
     def find_appointments_by_details(self,
@@ -157,6 +679,15 @@ class CaldavHandler:
         end_range = end_range.astimezone(tz) if end_range.tzinfo else tz.localize(end_range)
         found_appointments = []
         logger.info(f"Buscando agendamentos para '{patient_name}' entre {start_range.isoformat()} e {end_range.isoformat()}")
+        if self._refresh_busy_index(start_range, end_range):
+            name_lower = patient_name.lower()
+            for href, occ in self.busy_index.occurrences_between(start_range, end_range):
+                if occ.summary is None or not occ.has_end or name_lower not in occ.summary.lower():
+                    continue
+                found_appointments.append({"summary": occ.summary, "start": occ.start, "end": occ.end, "id": href})
+            logger.info(f"Busca por '{patient_name}' (índice local) finalizada. {len(found_appointments)} eventos encontrados.")
+            found_appointments.sort(key=lambda x: x['start'])
+            return found_appointments
         try:
             events = self.calendar.search(start=start_range, end=end_range, event=True, expand=True)
             for event in events:
@@ -205,10 +736,7 @@ class CaldavHandler:
 
     def _format_vcal_line(self, line: str) -> str:
         """Formata uma linha VCALENDAR com quebra e indentação (RFC 5545)."""
-        # Garante que a linha termine com \r\n
-        # Quebra linhas longas (máximo 75 octets recomendado, incluindo CRLF)
-        folded_lines = textwrap.fill(line, width=73, subsequent_indent=' ', break_long_words=False, break_on_hyphens=False)
-        return folded_lines + "\r\n"
+        return format_vcal_line(line)
 
     def book_appointment(self,
                          start_time: datetime.datetime, end_time: datetime.datetime,
@@ -227,74 +755,76 @@ class CaldavHandler:
         start_time = start_time.astimezone(tz) if start_time.tzinfo else tz.localize(start_time)
         end_time = end_time.astimezone(tz) if end_time.tzinfo else tz.localize(end_time)
         logger.debug(f"Verificando conflito final para {start_time.isoformat()} - {end_time.isoformat()}")
-        try: # Checagem de conflito (sem alterações)
+        with self._booking_lock: # Checagem final + gravação atômicas: duas confirmações do mesmo horário não gravam ambas
             conflict_check_start = start_time - datetime.timedelta(seconds=1)
             conflict_check_end = end_time + datetime.timedelta(seconds=1)
-            events_found = self.calendar.search(start=conflict_check_start, end=conflict_check_end, event=True, expand=False)
-            if events_found:
-                summaries = [getattr(e.instance.vevent, 'summary', 'N/A').value for e in events_found if hasattr(e.instance.vevent, 'summary')]
-                conflict_msg = f"Conflito final detectado ({len(events_found)}): {'; '.join(summaries)}."
-                logger.warning(f"Falha agendamento {patient_name}: {conflict_msg}")
-                return False, "Desculpe, este horário foi preenchido enquanto confirmávamos. Tente outro."
-            logger.debug("Nenhum conflito final encontrado.")
-        except Exception as e_conflict:
-            logger.error(f"Erro verificando conflito final: {e_conflict}", exc_info=True); return False, "Erro ao verificar disponibilidade final."
-
-        # Criação VCALENDAR com formatação mais rigorosa
-        summary = f"Consulta - {patient_name}"
-        desc_parts = [f"Paciente: {patient_name}"]
-        if patient_contact: desc_parts.append(f"Contato: {patient_contact}")
-        if patient_email: desc_parts.append(f"Email: {patient_email}")  # Adiciona o email
-        if procedure_interest: desc_parts.append(f"Interesse: {procedure_interest}")
-        if indication_source and indication_source.lower() not in ['não indicado', 'nao indicado', 'ninguem', 'ninguém', 'nao']:
-             desc_parts.append(f"Indicação: {indication_source}")
-        # Escapa caracteres especiais para VCALENDAR e mantém quebras de linha como \n
-        description_escaped = "\\n".join(desc_parts).replace(',', '\\,').replace(';', '\\;').replace('\r\n','\\n').replace('\n','\\n')
-
-        event_uid = f"{datetime.datetime.now(pytz.utc).strftime('%Y%m%dT%H%M%SZ')}-{uuid.uuid4()}@clinicabot.margot"
-        dt_format = "%Y%m%dT%H%M%S"
-        tzid_str = "" if tz == pytz.utc else f";TZID={tz.zone}"
-        dtstamp_utc = datetime.datetime.now(pytz.utc).strftime('%Y%m%dT%H%M%SZ')
-
-        # Monta a string VCALENDAR linha a linha, formatando cada uma
-        vcal_string = ""
-        vcal_string += self._format_vcal_line("BEGIN:VCALENDAR")
-        vcal_string += self._format_vcal_line("VERSION:2.0")
-        vcal_string += self._format_vcal_line("PRODID:-//Clinicabot//Margot Agendamento v1.4//PT")
-        vcal_string += self._format_vcal_line("CALSCALE:GREGORIAN")
-        vcal_string += self._format_vcal_line("BEGIN:VEVENT")
-        vcal_string += self._format_vcal_line(f"UID:{event_uid}")
-        vcal_string += self._format_vcal_line(f"DTSTAMP:{dtstamp_utc}")
-        vcal_string += self._format_vcal_line(f"DTSTART{tzid_str}:{start_time.strftime(dt_format)}")
-        vcal_string += self._format_vcal_line(f"DTEND{tzid_str}:{end_time.strftime(dt_format)}")
-        vcal_string += self._format_vcal_line(f"SUMMARY:{summary}")
-        # Aplica formatação à descrição (pode ser longa)
-        vcal_string += self._format_vcal_line(f"DESCRIPTION:{description_escaped}")
-        vcal_string += self._format_vcal_line("STATUS:CONFIRMED")
-        vcal_string += self._format_vcal_line("TRANSP:OPAQUE")
-        vcal_string += self._format_vcal_line("SEQUENCE:0")
-        vcal_string += self._format_vcal_line("END:VEVENT")
-        vcal_string += self._format_vcal_line("END:VCALENDAR")
+            remote_check = True
+            if self._refresh_busy_index(conflict_check_start, conflict_check_end):
+                conflict = self.busy_index.extents.find_overlap(conflict_check_start, conflict_check_end)
+                if conflict:
+                    logger.warning(f"Falha agendamento {patient_name}: Conflito final detectado (índice local): {conflict[2]}.")
+                    return False, "Desculpe, este horário foi preenchido enquanto confirmávamos. Tente outro."
+                remote_check = self.busy_index.unreadable > 0 # Recursos ilegíveis no índice: confirma no servidor
+                if not remote_check: logger.debug("Nenhum conflito final encontrado (índice local).")
+            if remote_check:
+                try: # Checagem de conflito remota (sem índice ou com recursos ilegíveis)
+                    events_found = self.calendar.search(start=conflict_check_start, end=conflict_check_end, event=True, expand=False)
+                    if events_found:
+                        summaries = [getattr(e.instance.vevent, 'summary', 'N/A').value for e in events_found if hasattr(e.instance.vevent, 'summary')]
+                        conflict_msg = f"Conflito final detectado ({len(events_found)}): {'; '.join(summaries)}."
+                        logger.warning(f"Falha agendamento {patient_name}: {conflict_msg}")
+                        return False, "Desculpe, este horário foi preenchido enquanto confirmávamos. Tente outro."
+                    logger.debug("Nenhum conflito final encontrado.")
+                except Exception as e_conflict:
+                    logger.error(f"Erro verificando conflito final: {e_conflict}", exc_info=True); return False, "Erro ao verificar disponibilidade final."
 
-        try:
-            # **VOLTA A USAR save_event com a string formatada**
-            logger.info(f"Tentando salvar agendamento (Método save_event) para '{patient_name}' UID: {event_uid}")
-            # logger.debug(f"VCALENDAR Content:\n{vcal_string}") # Descomente para debug pesado do VCAL
-            new_event = self.calendar.save_event(vcal_string)
-            event_ref = new_event.url if hasattr(new_event, 'url') else event_uid # Tenta pegar URL
-            logger.info(f"Agendamento (save_event) CRIADO com sucesso. Ref: {event_ref}")
-            try: # Format date for message
-                import locale; locale.setlocale(locale.LC_TIME, 'pt_BR.UTF-8')
-                dt_f = start_time.strftime('%A, %d de %B às %H:%M')
-            except: dt_f = start_time.strftime('%d/%m/%Y %H:%M')
-            return True, f"Agendamento confirmado para {patient_name} em {dt_f}."
-
-        except Exception as e_caldav_save:
-            logger.error(f"Erro CRÍTICO ao salvar evento (save_event) UID {event_uid}: {e_caldav_save}", exc_info=True)
-            # Log específico se o erro antigo reaparecer
-            if "Unexpected value None for self.url" in str(e_caldav_save):
-                 logger.error(">>> O erro 'Unexpected value None for self.url' OCORREU com save_event(string).")
-            return False, "Erro técnico ao registrar agendamento. Equipe notificada."
+            # Criação VCALENDAR com formatação mais rigorosa
+            vcal_string, event_uid, summary = build_appointment_vcal(
+                start_time, end_time, tz, patient_name, patient_contact, patient_email, indication_source, procedure_interest
+            )
+
+            try:
+                # **VOLTA A USAR save_event com a string formatada**
+                logger.info(f"Tentando salvar agendamento (Método save_event) para '{patient_name}' UID: {event_uid}")
+                # logger.debug(f"VCALENDAR Content:\n{vcal_string}") # Descomente para debug pesado do VCAL
+                new_event = self.calendar.save_event(vcal_string)
+                event_ref = new_event.url if hasattr(new_event, 'url') else event_uid # Tenta pegar URL
+                logger.info(f"Agendamento (save_event) CRIADO com sucesso. Ref: {event_ref}")
+                self._index_write_through(new_event, event_uid, start_time, end_time, summary)
+                dt_f = format_start_ptbr(start_time, '%A, %d de %B às %H:%M', '%d/%m/%Y %H:%M')
+                return True, f"Agendamento confirmado para {patient_name} em {dt_f}."
+
+            except Exception as e_caldav_save:
+                logger.error(f"Erro CRÍTICO ao salvar evento (save_event) UID {event_uid}: {e_caldav_save}", exc_info=True)
+                # Log específico se o erro antigo reaparecer
+                if "Unexpected value None for self.url" in str(e_caldav_save):
+                     logger.error(">>> O erro 'Unexpected value None for self.url' OCORREU com save_event(string).")
+                return False, "Erro técnico ao registrar agendamento. Equipe notificada."
+
+    def _index_write_through(self, new_event, event_uid: str, start_time: datetime.datetime, end_time: datetime.datetime, summary: str):
+        """Registra no índice local o evento recém-criado (sem esperar o próximo sync)."""
+        if not self.use_busy_index or not self.busy_index.loaded or not getattr(new_event, 'url', None):
+            return
+        with self._index_lock:
+            try:
+                occurrence = IndexedOccurrence(start_time, end_time, summary, True, (start_time, end_time, summary))
+                self.busy_index.set_resource(str(new_event.url.canonical()), str(new_event.url), event_uid, [occurrence])
+                self.busy_index.rebuild()
+            except Exception as e_index:
+                logger.warning(f"Falha ao atualizar índice local após agendamento: {e_index}. Índice será recarregado.")
+                self.busy_index.loaded = False
+
+    def _index_remove(self, deleted_event):
+        """Remove do índice local um evento apagado no servidor."""
+        if not self.use_busy_index or not self.busy_index.loaded:
+            return
+        with self._index_lock:
+            try:
+                self.busy_index.remove_resource(str(deleted_event.url.canonical()))
+                self.busy_index.rebuild()
+            except Exception as e_index:
+                logger.warning(f"Falha ao atualizar índice local após cancelamento: {e_index}. Índice será recarregado.")
+                self.busy_index.loaded = False
 
     # cancel_appointment (com checagem manual de dtstart/dtend)
     def cancel_appointment(self, event_identifier: str) -> Tuple[bool, str]:
@@ -342,15 +872,11 @@ class CaldavHandler:
                             if isinstance(st_naive, datetime.datetime):
                                 tz = self._get_tz()
                                 start_time = st_naive.astimezone(tz) if st_naive.tzinfo else tz.localize(st_naive)
-                                try:
-                                    import locale
-                                    locale.setlocale(locale.LC_TIME, 'pt_BR.UTF-8')
-                                    start_str = f" de {start_time.strftime('%A, %d/%m às %H:%M')}"
-                                except:
-                                    start_str = f" de {start_time.strftime('%d/%m %H:%M')}"
+                                start_str = f" de {format_start_ptbr(start_time, '%A, %d/%m às %H:%M', '%d/%m %H:%M')}"
                     except Exception as e_details:
                         logger.warning(f"Erro lendo detalhes evento {event_identifier}: {e_details}")
                     event_to_delete.delete()  # DELETA
+                    self._index_remove(event_to_delete)
                     logger.info(f"Evento '{summary}' (ID: {event_identifier}) cancelado.")
                     return True, f"{summary}{start_str} foi cancelado com sucesso."
                 except Exception as e_delete:
@@ -0,0 +1,2 @@
+# conftest.py - Configuração do pytest
+collect_ignore = ["test_caldav.py", "bench_async_caldav.py"] # Scripts manuais contra um servidor CalDAV real (.env)
@@ -0,0 +1,120 @@
+# fast_path.py (v1.1 - Respostas Diretas para Intenções Factuais, sem LLM)
+import re
+import logging
+import unicodedata
+from typing import Any, Dict, Iterable, Optional
+
+logger = logging.getLogger(__name__)
+
+# Intenção (nome usado na configuração) -> chave do bloco pré-renderizado no KnowledgeHandler
+FAST_PATH_INTENTS = {
+    "endereco": "clinic:address",
+    "horarios": "clinic:hours",
+    "links": "clinic:links",
+    "contato": "clinic:contact",
+    "valor_consulta": "consultation:value",
+}
+FAST_PATH_MAX_MESSAGE_CHARS = 120 # Mensagens maiores costumam ter mais de uma pergunta: vão para o LLM
+
+# A mensagem precisa citar a intenção (palavra-chave) e não pode ter outras palavras de conteúdo: "tem estacionamento
+# perto do endereço?" cai no bloco de endereço, mas não é respondida pelo template. Palavras sem acento, minúsculas.
+INTENT_KEYWORDS = {
+    "endereco": {"endereco", "onde", "localizacao", "localizado", "localizada", "rua"},
+    "horarios": {"horario", "horarios", "horas", "abre", "abrem", "fecha", "fecham", "funciona", "funcionam", "funcionamento", "expediente"},
+    "links": {"site", "instagram", "link", "links", "redes", "sociais", "perfil"},
+    "contato": {"telefone", "telefones", "contato", "numero", "whatsapp", "zap", "ligar", "fone"},
+    "valor_consulta": {"valor", "quanto", "custa", "preco", "cobra", "cobram"},
+}
+NEUTRAL_WORDS = { # Saudações, palavras funcionais e o próprio assunto (clínica, consulta): não mudam a pergunta
+    "a", "o", "as", "os", "um", "uma", "de", "do", "da", "dos", "das", "em", "no", "na", "e", "ou", "que", "qual", "quais",
+    "me", "pode", "poderia", "podem", "informar", "passar", "passa", "manda", "saber", "gostaria", "queria", "quero", "por", "favor", "pf",
+    "pfv", "oi", "ola", "bom", "boa", "dia", "tarde", "noite", "tudo", "bem", "obrigado", "obrigada", "voces", "vcs", "vc",
+    "voce", "seu", "sua", "fica", "ficam", "eh", "ai", "ate", "pra", "para", "com", "sobre", "mais",
+    "consultorio", "clinica", "consulta", "avaliacao", "atendimento", "atende", "atendem", "doutor", "dr", "medico",
+}
+
+# Templates no tom da Margot (cordial, direta). Campos (inclusive o nome do médico) preenchidos com dados da base no carregamento.
+FAST_REPLY_TEMPLATES = {
+    "clinic:address": "Nosso consultório fica na {address} 📍\n\nSe quiser, posso verificar os horários disponíveis para uma consulta de avaliação com o {doctor}. 😊",
+    "clinic:hours": "Nossos horários de atendimento são:\n{hours}\n\nPosso ajudar a agendar uma consulta de avaliação?",
+    "clinic:links": "Você pode conhecer mais sobre o trabalho do {doctor} por aqui:\n{links}",
+    "clinic:contact": "Você pode falar com a clínica pelos telefones {phones}{whatsapp_part}. E eu também posso te ajudar por aqui mesmo! 😊",
+    "consultation:value": "O valor da consulta de avaliação com o {doctor} é {value}. Posso verificar os próximos horários disponíveis para você?",
+}
+
+def render_fast_replies(fields: Dict[str, Optional[str]]) -> Dict[str, str]:
+    """Preenche os templates com os dados da base; blocos sem os dados necessários ficam de fora (vão para o LLM)."""
+    replies = {}
+    doctor = fields.get("doctor") or "médico responsável"
+    if fields.get("address"):
+        replies["clinic:address"] = FAST_REPLY_TEMPLATES["clinic:address"].format(address=fields["address"], doctor=doctor)
+    if fields.get("hours"):
+        replies["clinic:hours"] = FAST_REPLY_TEMPLATES["clinic:hours"].format(hours=fields["hours"])
+    if fields.get("links"):
+        replies["clinic:links"] = FAST_REPLY_TEMPLATES["clinic:links"].format(links=fields["links"], doctor=doctor)
+    if fields.get("phones"):
+        whatsapp_part = f" ou pelo WhatsApp {fields['whatsapp']}" if fields.get("whatsapp") else ""
+        replies["clinic:contact"] = FAST_REPLY_TEMPLATES["clinic:contact"].format(phones=fields["phones"], whatsapp_part=whatsapp_part)
+    if fields.get("value"):
+        replies["consultation:value"] = FAST_REPLY_TEMPLATES["consultation:value"].format(value=fields["value"], doctor=doctor)
+    return replies
+
+def message_matches_intent(intent: str, user_message: str) -> bool:
+    """Cita ao menos uma palavra-chave da intenção e nenhuma palavra de conteúdo fora dela (nem números)."""
+    text = unicodedata.normalize("NFKD", user_message.lower())
+    words = re.findall(r"\w+", "".join(char for char in text if not unicodedata.combining(char)))
+    keywords = INTENT_KEYWORDS.get(intent, set())
+    return any(word in keywords for word in words) and all(word in keywords or word in NEUTRAL_WORDS for word in words)
+
+def parse_enabled_intents(raw: Optional[str]) -> frozenset:
+    """'off' (padrão), 'all' ou lista separada por vírgula (ex.: 'endereco,horarios')."""
+    raw = (raw if raw is not None else "off").strip().lower()
+    if raw == "all":
+        return frozenset(FAST_PATH_INTENTS)
+    if raw in ("", "off", "none"):
+        return frozenset()
+    intents = {intent.strip() for intent in raw.split(",") if intent.strip()}
+    unknown = intents - set(FAST_PATH_INTENTS)
+    if unknown:
+        logger.warning(f"Intenções de fast-path desconhecidas ignoradas: {', '.join(sorted(unknown))}")
+    return frozenset(intents & set(FAST_PATH_INTENTS))
+
+class FastPathResponder:
+    """
+    Responde intenções puramente factuais (endereço, horários, links, contato, valor da consulta) direto dos
+    templates pré-renderizados pelo KnowledgeHandler, sem chamar o LLM. Cada intenção pode ser ligada/desligada.
+    Só responde quando a mensagem cita a intenção e nada além dela (message_matches_intent); perguntas abertas,
+    compostas ou sobre outro assunto no mesmo bloco seguem para o LLM.
+    """
+    def __init__(self, knowledge_handler, enabled_intents: Iterable[str], persona_name: str = "Margot",
+                 clinic_name: Optional[str] = None, max_message_chars: int = FAST_PATH_MAX_MESSAGE_CHARS):
+        self.knowledge_handler = knowledge_handler
+        self.enabled_blocks = {FAST_PATH_INTENTS[intent]: intent for intent in enabled_intents if intent in FAST_PATH_INTENTS}
+        self.persona_name = persona_name
+        self.clinic_name = clinic_name # None: nome da clínica na base (knowledge_handler.clinic_name)
+        self.max_message_chars = max_message_chars
+        self.bypassed: Dict[str, int] = {intent: 0 for intent in self.enabled_blocks.values()}
+
+    def respond(self, user_message: str, relevant_knowledge: Optional[str], first_turn: bool) -> Optional[str]:
+        if not self.enabled_blocks or not relevant_knowledge:
+            return None
+        if len(user_message) > self.max_message_chars or user_message.count("?") > 1:
+            return None
+        block_key = self.knowledge_handler.cacheable_block_key(relevant_knowledge)
+        intent = self.enabled_blocks.get(block_key)
+        if intent is None or not message_matches_intent(intent, user_message):
+            return None
+        reply = self.knowledge_handler.fast_replies.get(block_key)
+        if not reply:
+            return None
+        self.bypassed[intent] += 1
+        if first_turn: # Mesma apresentação exigida pela persona na primeira mensagem
+            reply = f"Olá! Sou a {self.persona_name}, da {self.clinic_name or self.knowledge_handler.clinic_name}.\n\n{reply}"
+        return reply
+
+    def metrics(self) -> Dict[str, Any]:
+        return {
+            "enabled_intents": sorted(self.enabled_blocks.values()),
+            "bypassed_llm": sum(self.bypassed.values()),
+            "bypassed_by_intent": dict(self.bypassed),
+        }
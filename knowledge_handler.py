@@ -1,31 +1,168 @@
-# knowledge_handler.py (v8.6 - Context-Aware RAG + Correções)
+# knowledge_handler.py (v9.6 - RAG com Tópico da Sessão + Blocos Pré-Renderizados + Busca Híbrida + Hot Reload + Snapshot Compilado + Multi-Clínica)
+import asyncio
+import datetime
 import json
 import logging
 import os
 import re
-from typing import Optional, Dict, Any, List
+from types import MappingProxyType
+from typing import Optional, Dict, Any, List, Mapping, Tuple
+
+from phrase_matcher import PhraseMatcher
+from bm25_index import BM25Index, KnowledgeChunk, SearchHit, tokenize
+from fast_path import render_fast_replies
+from availability_engine import parse_working_hours
+from knowledge_snapshot import default_snapshot_path, load_snapshot, save_snapshot, source_hash
+from semantic_index import SemanticIndex, HybridHit, fuse_hits, SEMANTIC_MIN_SIMILARITY
 
 logger = logging.getLogger(__name__)
 
 # Lista expandida para detecção de seguro
 KNOWN_INSURANCE_NAMES = ["unimed", "bradesco", "sulamerica", "amil", "porto seguro", "ipsm", "ipê", "saúde caixa", "geap", "cass"]
 
+# --- Tabelas de palavras-chave de find_relevant_info (montadas uma vez, não a cada mensagem) ---
+# Palavras/frases que indicam que a query atual depende do contexto anterior
+CONTEXTUAL_KEYWORDS = frozenset(["disso", "dele", "dela", "nisso", "nele", "nesse", "deste", "desta", "isso"])
+CONTEXTUAL_PHRASES = frozenset(["nesse procedimento", "sobre isso", "e os diferenciais", "mais detalhes", "e quanto a", "como funciona", "fale mais", "detalhes sobre"])
+GREETINGS = frozenset(["oi", "ola", "olá", "bom dia", "boa tarde", "boa noite", "tudo bem", "tudo bom", "tudo certo", "ok", "obrigado", "obrigada", "grato", "grata", "valeu", "de nada", "igualmente",
+                       "td bem", "td bom", "obg", "vlw"]) # Inclui abreviações comuns
+COST_KEYWORDS = frozenset(["quanto custa", "valor", "preço", "custo", "média de valor", "orcamento", "orçamento"])
+EXP_KEYWORDS = frozenset(["experiente", "experiência", "tempo", "anos", "formação", "formou", "currículo", "graduação", "pós-graduação", "especialização", "especialidade", "qualificação", "qualificado", "prêmio", "premios", "livro", "capítulo", "publicou", "sociedade", "membro", "fellowship", "diferenciais", "histórico", "background", "capacitação", "congresso", "científico", "artigo", "pesquisa", "palestra", "destaque", "produção acadêmica"])
+QUANTITY_KEYWORDS = frozenset(["quantos", "quantas", "número de", "volume de"])
+SURGERY_PROC_KEYWORDS = frozenset(["cirurgias", "procedimentos", "operações"])
+GENERIC_DR_KEYWORDS = frozenset(["detalhes sobre ele", "tudo sobre ele", "mais sobre ele", "sobre o dr", "sobre ele", "dele"])
+DOCTOR_KEYWORDS = frozenset(["médico", "dr.", "doutor", "juarez", "missel", "ele"]) # "ele" pode ser ambíguo, mas mantido
+PLASTIC_KEYWORDS = frozenset(["plástico", "plastico", "especialista", "cirurgião plástico"])
+BASE_PROCEDURE_KEYWORDS = frozenset(["procedimento", "cirurgia", "operação", "técnica", "tratamento", "botox", "preenchimento"]) # + variações (por base carregada)
+LIST_KEYWORDS = frozenset(["procedimentos", "cirurgias", "lista", "quais", "tipos", "serviços", "opções"])
+ACTION_KEYWORDS = frozenset(["faz", "realiza", "oferece", "tem", "disponíveis"])
+LINK_KEYWORDS = frozenset(["instagram", "insta", "youtube", "linkedin", "lattes", "site", "link", "rede social", "redes sociais", "perfil", "página"])
+INSURANCE_KEYWORDS = frozenset(["convênio", "convenio", "plano de saúde", "plano medico", "seguro saude", "aceita"] + KNOWN_INSURANCE_NAMES)
+LOCATION_KEYWORDS = frozenset(["endereço", "onde fica", "localização", "rua", "opera", "hospital", "consultório"])
+SURGERY_LOC_KEYWORDS = frozenset(["opera", "cirurgia", "procedimento"])
+WHERE_KEYWORDS = frozenset(["onde", "local", "hospital"])
+ADDRESS_KEYWORDS = frozenset(["endereço", "onde fica", "localização", "rua", "consultório", "clínica"])
+TIME_KEYWORDS = frozenset(["horário", "funcionamento", "aberto", "atende", "que horas", "horarios", "agenda"])
+CONSULT_COST_KEYWORDS = frozenset(["valor", "preço", "custo", "quanto é", "quanto custa"])
+PAYMENT_KEYWORDS = frozenset(["pagamento", "pagar", "forma de pagamento", "parcela", "financia"])
+CONTACT_KEYWORDS = frozenset(["telefone", "contato", "whatsapp", "fone", "liga", "numero", "número"])
+
+# Blocos estáticos -> (tipo, título extra indexado na busca BM25)
+SECTION_BLOCKS = {
+    "clinic:address": ("clinic", "Endereço da clínica consultório localização onde fica"),
+    "clinic:hours": ("clinic", "Horários de funcionamento atendimento"),
+    "clinic:contact": ("clinic", "Telefone contato WhatsApp número"),
+    "clinic:surgery_location": ("clinic", "Local das cirurgias hospital onde opera"),
+    "clinic:links": ("clinic", "Links redes sociais site Instagram YouTube LinkedIn Lattes"),
+    "doctor:experience": ("doctor", "Formação experiência currículo do médico"), # + nome do médico da base
+    "procedure_list": ("procedure", "Lista de procedimentos cirurgias realizados"),
+    "consultation:value": ("consultation", "Valor preço custo da consulta"),
+    "consultation:duration_estimate": ("consultation", "Duração da Consulta consulta"),
+    "consultation:arrival_recommendation": ("consultation", "Chegada consulta"),
+    "consultation:wait_time_estimate": ("consultation", "Espera para Consulta consulta"),
+    "consultation:what_to_bring": ("consultation", "O que Levar na Consulta consulta"),
+    "policy:payment": ("policy", "Formas de pagamento pagar"),
+    "policy:insurance": ("policy", "Convênios plano de saúde convênio"),
+    "policy:surgery_wait": ("policy", "Tempo de espera para cirurgia"),
+    "policy:how_to_schedule": ("policy", "Como Agendar"),
+    "policy:cancellation_policy": ("policy", "Cancelamento e Reagendamento"),
+}
+
+DEFAULT_CLINIC_NAME = "Clínica" # Usados só se a base não trouxer clinic_info.name / doctor_info.full_name
+DEFAULT_DOCTOR_NAME = "médico responsável"
+DEFAULT_WATCH_INTERVAL_SECONDS = 5.0 # Intervalo de verificação do mtime de knowledge_base.json
+
+# Atributos derivados da base que formam um snapshot (trocados juntos no hot reload)
+SNAPSHOT_FIELDS = (
+    "data", "data_mtime", "_procedure_map", "_procedure_search_terms", "_procedure_variation_map", "_procedure_matcher",
+    "_variation_rank", "_procedure_rank", "_term_procedures", "_base_name_rank", "_procedure_or_list_keywords",
+    "_topic_matcher", "_topic_candidates", "_procedure_variations",
+    "blocks", "_cacheable_block_keys", "fast_replies", "clinic_address", "clinic_name", "doctor_name", "doctor_short_name",
+    "_search_index", "semantic_index",
+)
+# Campos gravados no snapshot compilado (o índice semântico tem persistência própria)
+PERSISTED_FIELDS = tuple(name for name in SNAPSHOT_FIELDS if name != "semantic_index")
+# Versão dos índices: mudar sempre que a construção dos índices/blocos mudar (invalida snapshots antigos)
+KNOWLEDGE_INDEX_VERSION = "9.5"
+
+# Blocos que respondem a uma única pergunta (a resposta gerada pode ser reaproveitada pelo cache de respostas)
+CACHEABLE_BLOCK_PREFIXES = ("clinic:", "consultation:", "policy:", "faq:", "procedure_list")
+
+# Busca BM25: mínimo de termos distintos da query presentes no chunk para aceitar o resultado
+SEARCH_MIN_MATCHED_TERMS = 2
+FAQ_MIN_QUERY_COVERAGE = 0.6 # Fração dos termos da query que a pergunta da FAQ precisa cobrir
+
 class KnowledgeHandler:
     """
-    (v8.6) Carrega a base de conhecimento, busca informações COMPLETAS para RAG
+    (v9.6) Carrega a base de conhecimento, busca informações COMPLETAS para RAG
     e utiliza o histórico da conversa para entender o contexto.
+    - data_mtime identifica a versão carregada; reload_if_changed() recarrega só se o arquivo mudou.
+    - Tópico da conversa: detect_turn_topic() roda uma vez por turno e o resultado fica na sessão;
+      find_relevant_info(current_topic=...) resolve follow-ups ("fale mais disso") sem varrer o histórico.
+    - Nomes da clínica e do médico vêm da própria base (clinic_info.name, doctor_info.full_name): um
+      KnowledgeHandler por clínica, sem textos fixos de uma clínica específica nos blocos.
+    - Snapshot compilado (knowledge_base.snapshot.pkl): JSON + índices + blocos gravados após a construção e
+      carregados na partida seguinte se o hash do JSON e a versão dos índices conferirem (reconstrói se não).
+    - Hot reload: start_watching() verifica o mtime em background, monta um snapshot novo (JSON + índices) numa
+      thread e troca tudo de uma vez no event loop; chamadas em andamento nunca veem índices pela metade.
+    - Detecção de procedimento com um único autômato (variações, termos e nomes), uma passada na query.
+    - Índice invertido BM25 (sem acentos) sobre toda a base: search(query, k) devolve os blocos ranqueados.
+    - Opcional: índice semântico (embeddings locais); hybrid_search() funde vetor e BM25 para pegar paráfrases.
+    - Blocos de texto estáticos renderizados uma vez por carga (self.blocks, somente leitura); as buscas viram lookups.
+    - Regras de agendamento (expediente, feriados, duração por procedimento) opcionais na chave 'scheduling_rules'.
     """
-    def __init__(self, json_file_path: str = "knowledge_base.json"):
+    def __init__(self, json_file_path: str = "knowledge_base.json", semantic_index: Optional[SemanticIndex] = None,
+                 watch_interval_seconds: float = DEFAULT_WATCH_INTERVAL_SECONDS, use_snapshot: bool = True,
+                 snapshot_path: Optional[str] = None, rebuild_snapshot: bool = False):
         self.file_path = json_file_path
-        self.data: Optional[Dict[str, Any]] = self._load_knowledge()
+        self.semantic_index = semantic_index
+        self.snapshot_path: Optional[str] = (snapshot_path or default_snapshot_path(json_file_path)) if use_snapshot else None
+        self.watch_interval_seconds = watch_interval_seconds
+        self.reload_count = 0
+        self.reload_failures = 0
+        self.last_reload_at: Optional[datetime.datetime] = None
+        self._seen_mtime: Optional[float] = None # Último mtime tratado (inclusive versões inválidas)
+        self._scheduling_rules: Optional[Tuple[Optional[float], Dict[str, Any]]] = None # (data_mtime, regras) já interpretadas
+        self._watcher: Optional[asyncio.Task] = None
+        self._init_state()
+        snapshot = self._build_snapshot(rebuild=rebuild_snapshot)
+        if snapshot:
+            self.__dict__.update(snapshot)
+        self._seen_mtime = self.data_mtime
+
+        if not self.data:
+            logger.error(f"Base de conhecimento em {self.file_path} não pôde ser carregada. RAG estará inoperante.")
+
+    def _init_state(self):
+        """Estado derivado vazio (antes de carregar a base)."""
+        self.data_mtime: Optional[float] = None
+        self.data: Optional[Dict[str, Any]] = None
+        self.clinic_name = DEFAULT_CLINIC_NAME
+        self.doctor_name = DEFAULT_DOCTOR_NAME
+        self.doctor_short_name = DEFAULT_DOCTOR_NAME # Ex.: "Dr. Juarez" (títulos curtos, como nos links)
+        self._source_hash: Optional[str] = None # sha256 do JSON lido (chave do snapshot compilado)
         self._procedure_map: Dict[str, Dict[str, Any]] = {}
         self._procedure_search_terms: Dict[str, List[str]] = {}
         self._procedure_variation_map: Dict[str, str] = {} # Map: variation_lower -> original_name_lower
-
-        if self.data:
-            self._build_procedure_indexes()
-        else:
-            logger.error(f"Base de conhecimento em {self.file_path} não pôde ser carregada. RAG estará inoperante.")
+        self._procedure_matcher = PhraseMatcher(())
+        self._variation_rank: Dict[str, int] = {} # Ordem de prioridade entre variações
+        self._procedure_rank: Dict[str, int] = {} # Ordem de prioridade no match por termos
+        self._term_procedures: Dict[str, List[str]] = {} # termo -> procedimentos que o exigem
+        self._base_name_rank: Dict[str, Tuple[int, str]] = {} # nome base -> (prioridade, nome original)
+        self._procedure_or_list_keywords: frozenset = BASE_PROCEDURE_KEYWORDS | LIST_KEYWORDS
+        self._topic_matcher = PhraseMatcher(()) # Nomes base (sem parênteses) + variações, para detectar o tópico do turno
+        self._topic_candidates: Dict[str, List[Tuple[int, str]]] = {} # nome base -> [(prioridade, procedimento)]; nome mais longo primeiro
+        self._procedure_variations: Dict[str, frozenset] = {} # procedimento -> variações que o confirmam
+        self.blocks: Mapping[str, str] = MappingProxyType({}) # chave de seção/procedimento -> bloco formatado
+        self._cacheable_block_keys: Dict[str, str] = {} # bloco formatado -> chave (só blocos de pergunta única)
+        self.fast_replies: Mapping[str, str] = MappingProxyType({}) # chave do bloco -> resposta pronta (fast-path sem LLM)
+        self.clinic_address: Optional[str] = None # Endereço em texto simples (mensagem de confirmação)
+        self._search_index = BM25Index()
+
+    def _build_indexes(self):
+        self._build_procedure_indexes()
+        self._render_blocks()
+        self._build_search_index()
 
     def _load_knowledge(self) -> Optional[Dict[str, Any]]:
         """Carrega a base de conhecimento do arquivo JSON."""
@@ -33,8 +170,12 @@ class KnowledgeHandler:
             logger.error(f"Arquivo da base de conhecimento não encontrado: {self.file_path}")
             return None
         try:
-            with open(self.file_path, 'r', encoding='utf-8') as f:
-                knowledge_data = json.load(f)
+            file_mtime = os.path.getmtime(self.file_path)
+            with open(self.file_path, 'rb') as f:
+                raw = f.read()
+            knowledge_data = json.loads(raw.decode('utf-8'))
+            self.data_mtime = file_mtime
+            self._source_hash = source_hash(raw) # Identifica o conteúdo exato usado para montar os índices
             logger.info(f"Base de conhecimento carregada com sucesso de: {self.file_path}")
             # Validação mínima da estrutura esperada
             if not isinstance(knowledge_data.get("procedures"), list) or \
@@ -50,8 +191,118 @@ class KnowledgeHandler:
             logger.error(f"Erro inesperado ao carregar {self.file_path}: {e}", exc_info=True)
             return None
 
+    def _changed_mtime(self) -> Optional[float]:
+        """mtime atual do arquivo se ele mudou desde a última verificação; None caso contrário."""
+        try:
+            current_mtime = os.path.getmtime(self.file_path)
+        except OSError:
+            return None
+        return None if current_mtime == self._seen_mtime else current_mtime
+
+    def _build_snapshot(self, rebuild: bool = False) -> Optional[Dict[str, Any]]:
+        """
+        Monta o estado derivado num objeto à parte (copy-on-write). Seguro para rodar em thread.
+        Usa o snapshot compilado se ele corresponder ao JSON atual; senão carrega o JSON, constrói e grava um novo.
+        """
+        staging = object.__new__(type(self))
+        staging.file_path = self.file_path
+        staging.semantic_index = self.semantic_index.staging_copy() if self.semantic_index is not None else None # Trocado junto com os blocos
+        staging.snapshot_path = self.snapshot_path
+        staging._init_state()
+        if self.snapshot_path and not rebuild and staging._load_compiled():
+            return {name: getattr(staging, name) for name in SNAPSHOT_FIELDS}
+        staging.data = staging._load_knowledge()
+        if not staging.data:
+            return None
+        staging._build_indexes()
+        if self.snapshot_path:
+            persisted = {name: getattr(staging, name) for name in PERSISTED_FIELDS}
+            persisted["blocks"] = dict(staging.blocks); persisted["fast_replies"] = dict(staging.fast_replies) # MappingProxyType não é serializável
+            save_snapshot(self.snapshot_path, staging._source_hash, KNOWLEDGE_INDEX_VERSION, persisted)
+        return {name: getattr(staging, name) for name in SNAPSHOT_FIELDS}
+
+    def _load_compiled(self) -> bool:
+        """Preenche o estado a partir do snapshot compilado, se ele corresponder ao JSON atual. Retorna True se usou."""
+        try:
+            file_mtime = os.path.getmtime(self.file_path)
+            with open(self.file_path, 'rb') as f:
+                raw = f.read()
+        except OSError:
+            return False
+        fields = load_snapshot(self.snapshot_path, source_hash(raw), KNOWLEDGE_INDEX_VERSION)
+        if not fields or not all(name in fields for name in PERSISTED_FIELDS):
+            return False
+        for name in PERSISTED_FIELDS:
+            setattr(self, name, fields[name])
+        self.blocks = MappingProxyType(self.blocks); self.fast_replies = MappingProxyType(self.fast_replies)
+        self.data_mtime = file_mtime # O arquivo pode ter sido copiado/tocado sem mudar o conteúdo
+        self._sync_semantic_index()
+        return True
+
+    def _apply_snapshot(self, snapshot: Optional[Dict[str, Any]], current_mtime: float) -> bool:
+        """Troca o estado derivado de uma vez (chamar no event loop / fora de buscas em andamento)."""
+        self._seen_mtime = current_mtime # Evita nova tentativa até o arquivo mudar de novo
+        if not snapshot:
+            self.reload_failures += 1
+            logger.error(f"Falha ao recarregar {self.file_path}. Mantendo versão anterior da base.")
+            return False
+        self.__dict__.update(snapshot)
+        self.reload_count += 1
+        self.last_reload_at = datetime.datetime.now(datetime.timezone.utc)
+        logger.info(f"Base de conhecimento recarregada (arquivo alterado): {self.file_path}. Recargas: {self.reload_count}.")
+        return True
+
+    def reload_if_changed(self) -> bool:
+        """Recarrega a base (e os índices) se o mtime do arquivo mudou, de forma síncrona. Retorna True se recarregou."""
+        current_mtime = self._changed_mtime()
+        if current_mtime is None:
+            return False
+        return self._apply_snapshot(self._build_snapshot(), current_mtime)
+
+    async def reload_if_changed_async(self) -> bool:
+        """Como reload_if_changed, mas a montagem do snapshot roda em thread (não bloqueia o event loop)."""
+        current_mtime = self._changed_mtime()
+        if current_mtime is None:
+            return False
+        snapshot = await asyncio.to_thread(self._build_snapshot)
+        if self._seen_mtime == current_mtime:
+            return False # Outra recarga já aplicou esta versão enquanto o snapshot era montado
+        return self._apply_snapshot(snapshot, current_mtime)
+
+    async def _watch_loop(self):
+        while True:
+            await asyncio.sleep(self.watch_interval_seconds)
+            try:
+                await self.reload_if_changed_async()
+            except Exception as e_reload:
+                self.reload_failures += 1
+                logger.error(f"Erro no hot reload da base de conhecimento: {e_reload}", exc_info=True)
+
+    def start_watching(self):
+        """Inicia a verificação periódica do arquivo (chamar com o event loop rodando)."""
+        if self._watcher is None or self._watcher.done():
+            self._watcher = asyncio.get_running_loop().create_task(self._watch_loop())
+
+    def metrics(self) -> Dict[str, Any]:
+        return {
+            "reloads": self.reload_count,
+            "reload_failures": self.reload_failures,
+            "last_reload_at": self.last_reload_at.isoformat() if self.last_reload_at else None,
+            "data_mtime": datetime.datetime.fromtimestamp(self.data_mtime, datetime.timezone.utc).isoformat() if self.data_mtime else None,
+            "blocks": len(self.blocks),
+        }
+
+    async def aclose(self):
+        if self._watcher:
+            self._watcher.cancel()
+            try: await self._watcher
+            except asyncio.CancelledError: pass
+            self._watcher = None
+
     def _build_procedure_indexes(self):
         """Constrói os índices para busca rápida de procedimentos e variações."""
+        self._procedure_map = {}; self._procedure_search_terms = {}; self._procedure_variation_map = {}
+        self._procedure_matcher = PhraseMatcher(())
         procedures = self.data.get("procedures", [])
         if not isinstance(procedures, list):
             logger.warning("Chave 'procedures' não encontrada ou não é uma lista no JSON.")
@@ -90,7 +341,150 @@ class KnowledgeHandler:
                  if variation_lower:
                      self._procedure_variation_map[variation_lower] = name_lower # Mapeia variação -> nome original
 
-        logger.info(f"Índices de procedimentos construídos: {len(self._procedure_map)} mapeados, {len(self._procedure_search_terms)} com termos, {len(self._procedure_variation_map)} variações.")
+        # Índice único para _find_specific_procedure: as prioridades reproduzem a ordem das buscas sequenciais
+        self._variation_rank = {variation: rank for rank, variation in enumerate(self._procedure_variation_map)}
+        self._procedure_rank = {name: rank for rank, name in enumerate(self._procedure_search_terms)}
+        self._term_procedures = {}
+        for name_lower, terms in self._procedure_search_terms.items():
+            for term in set(terms):
+                self._term_procedures.setdefault(term, []).append(name_lower)
+        self._base_name_rank = {}
+        for rank, name_lower in enumerate(sorted(self._procedure_map.keys(), key=len, reverse=True)):
+            name_for_match = re.sub(r'\s*\(.*\)\s*', '', name_lower).strip()
+            if len(name_for_match) > 4 and name_for_match not in self._base_name_rank:
+                self._base_name_rank[name_for_match] = (rank, name_lower)
+        self._procedure_matcher = PhraseMatcher(list(self._variation_rank) + list(self._term_procedures) + list(self._base_name_rank))
+        self._procedure_or_list_keywords = BASE_PROCEDURE_KEYWORDS | frozenset(self._procedure_variation_map) | LIST_KEYWORDS # Inclui variações
+
+        # Detecção de tópico por turno (mesma prioridade da antiga varredura: nomes mais longos primeiro)
+        self._topic_candidates = {}
+        for rank, name_lower in enumerate(sorted(self._procedure_map.keys(), key=len, reverse=True)):
+            search_name_processed = re.sub(r'\s*\(.*\)\s*', '', name_lower).strip()
+            if len(search_name_processed) > 3:
+                self._topic_candidates.setdefault(search_name_processed, []).append((rank, name_lower))
+        variations_by_procedure: Dict[str, set] = {}
+        for variation, original in self._procedure_variation_map.items():
+            variations_by_procedure.setdefault(original, set()).add(variation)
+        self._procedure_variations = {name: frozenset(variations) for name, variations in variations_by_procedure.items()}
+        self._topic_matcher = PhraseMatcher(list(self._topic_candidates) + list(self._procedure_variation_map))
+
+        logger.info(f"Índices de procedimentos construídos: {len(self._procedure_map)} mapeados, {len(self._procedure_search_terms)} com termos, {len(self._procedure_variation_map)} variações, {len(self._procedure_matcher)} frases no autômato.")
+
+    def _render_blocks(self):
+        """Renderiza uma vez todos os blocos estáticos da base (procedimentos, FAQ, seções) em um mapa imutável."""
+        self._resolve_names()
+        blocks: Dict[str, str] = {}
+        for name_lower, p_data in self._procedure_map.items():
+            block = self._format_procedure_details(p_data)
+            if block: blocks[f"procedure:{name_lower}"] = block
+        for position, faq in enumerate(self.data.get("faq", []) or []):
+            if not isinstance(faq, dict): continue
+            question, answer = faq.get("question"), faq.get("answer")
+            if not question or not answer or not isinstance(question, str) or not isinstance(answer, str): continue
+            blocks[f"faq:{position}"] = f"- **Respondendo sua pergunta sobre '{question.strip()}':**\n  - {answer.strip()}"
+
+        clinic_info = self.data.get("clinic_info", {}) or {}
+        consultation_info = self.data.get("consultation_info", {}) or {}
+        sections: Dict[str, Optional[str]] = {}
+        self.clinic_address = self._format_address()
+        sections["clinic:address"] = f"- **Endereço da Clínica:** {self.clinic_address}" if self.clinic_address else None
+        hours = self._format_opening_hours()
+        sections["clinic:hours"] = f"- **Horários de Funcionamento da Clínica:**\n{hours}" if hours else None
+        phones = clinic_info.get("phone_number")
+        wp_raw = clinic_info.get("whatsapp_number", "") or ""
+        wp_number = wp_raw.split(':')[-1] if wp_raw.startswith("whatsapp:") else wp_raw # Extrai apenas o número do formato whatsapp:+55...
+        contact_parts = [part for part in (f"- **Telefones:** {phones}" if phones else None, f"- **WhatsApp Principal (Contato):** {wp_number}" if wp_number else None) if part]
+        sections["clinic:contact"] = "\n".join(dict.fromkeys(contact_parts)) or None
+        surgery_location = clinic_info.get("surgery_location")
+        sections["clinic:surgery_location"] = f"- **Local das Cirurgias:** As cirurgias são realizadas no {surgery_location}." if surgery_location else None
+        sections["clinic:links"] = self._get_formatted_links()
+        sections["doctor:experience"] = self._format_doctor_full_experience()
+        sections["procedure_list"] = self._format_procedure_list()
+        value = consultation_info.get("value")
+        sections["consultation:value"] = f"- **Valor da Consulta Inicial:** {value}" if value else None
+        consultation_labels = {"duration_estimate": "Duração da Consulta", "arrival_recommendation": "Chegada", "wait_time_estimate": "Espera para Consulta", "what_to_bring": "O que Levar na Consulta"}
+        for key, label in consultation_labels.items():
+            text = consultation_info.get(key)
+            if text and isinstance(text, str): sections[f"consultation:{key}"] = f"- **{label}:** {text}"
+        payment_methods = self.data.get("payment_methods", [])
+        if isinstance(payment_methods, list) and payment_methods:
+            sections["policy:payment"] = f"- **Formas de Pagamento Aceitas (Consulta):** {', '.join(map(str, payment_methods))}"
+        insurance_info = self.data.get("accepted_insurance", []) # Lista (usa a primeira entrada) ou string única
+        insurance_text = insurance_info[0] if isinstance(insurance_info, list) and insurance_info else insurance_info if isinstance(insurance_info, str) else None
+        sections["policy:insurance"] = f"- **Convênios Médicos:** {insurance_text}" if insurance_text else None
+        surgery_wait = (self.data.get("surgery_info", {}) or {}).get("wait_time_estimate")
+        sections["policy:surgery_wait"] = f"- **Espera para Cirurgia:** {surgery_wait}" if surgery_wait else None
+        scheduling_policy = self.data.get("scheduling_policy", {}) or {}
+        for key, label in {"how_to_schedule": "Como Agendar", "cancellation_policy": "Cancelamento e Reagendamento"}.items():
+            text = scheduling_policy.get(key)
+            if text and isinstance(text, str): sections[f"policy:{key}"] = f"- **{label}:** {text}"
+
+        blocks.update({key: block for key, block in sections.items() if block})
+        self.blocks = MappingProxyType(blocks)
+        links_lines = (sections.get("clinic:links") or "").split("\n")[1:] # Sem o título do bloco
+        self.fast_replies = MappingProxyType(render_fast_replies({
+            "address": self.clinic_address, "hours": hours, "value": value,
+            "links": "\n".join(line.replace("  - ", "• ", 1) for line in links_lines),
+            "phones": phones, "whatsapp": wp_number, "doctor": self.doctor_name,
+        }))
+        self._cacheable_block_keys = {block: key for key, block in blocks.items() if key.startswith(CACHEABLE_BLOCK_PREFIXES)}
+        logger.info(f"Blocos da base pré-renderizados: {len(blocks)}.")
+
+    def _build_search_index(self):
+        """Indexa com BM25 os blocos pré-renderizados (procedimentos, FAQ, clínica, médico, consulta, políticas)."""
+        index = BM25Index()
+        variations_by_procedure: Dict[str, List[str]] = {}
+        for variation, name_lower in self._procedure_variation_map.items():
+            variations_by_procedure.setdefault(name_lower, []).append(variation)
+
+        for name_lower, p_data in self._procedure_map.items():
+            block = self.blocks.get(f"procedure:{name_lower}")
+            if not block: continue
+            # Nome e variações repetidos no texto indexado para pesarem mais que a descrição
+            extra_terms = " ".join([p_data["name"]] * 2 + variations_by_procedure.get(name_lower, []))
+            index.add(KnowledgeChunk(f"procedure:{name_lower}", "procedure", p_data["name"], block), f"{extra_terms}\n{block}")
+
+        for position, faq in enumerate(self.data.get("faq", []) or []):
+            block = self.blocks.get(f"faq:{position}")
+            if not block: continue
+            # Só a pergunta é indexada (mesmo critério da busca antiga na FAQ)
+            index.add(KnowledgeChunk(f"faq:{position}", "faq", faq["question"].strip(), block), faq["question"])
+
+        for key, (kind, title) in SECTION_BLOCKS.items():
+            if key == "procedure_list": continue # A lista só faz sentido quando pedida explicitamente
+            block = self.blocks.get(key)
+            if key == "doctor:experience": title = f"{title} {self.doctor_name}"
+            if block: index.add(KnowledgeChunk(key, kind, title, block))
+
+        index.finalize()
+        self._search_index = index
+        logger.info(f"Índice BM25 construído: {len(index)} blocos.")
+        self._sync_semantic_index()
+
+    def _sync_semantic_index(self):
+        if self.semantic_index is not None:
+            try:
+                self.semantic_index.sync(self._search_index.chunks)
+            except Exception as e:
+                logger.error(f"Falha ao sincronizar índice semântico: {e}. Busca semântica desativada.", exc_info=True)
+                self.semantic_index = None
+
+    def cacheable_block_key(self, knowledge: Optional[str]) -> Optional[str]:
+        """Chave do bloco se o RAG retornou exatamente um bloco de pergunta única (endereço, valor, FAQ...); senão None."""
+        return self._cacheable_block_keys.get(knowledge) if knowledge else None
+
+    def search(self, query: str, k: int = 3, kinds: Optional[Tuple[str, ...]] = None) -> List[SearchHit]:
+        """Busca BM25 na base inteira. Retorna até k SearchHit(score, matched_terms, chunk), do mais relevante ao menos."""
+        return self._search_index.search(query, k, kinds)
+
+    def hybrid_search(self, query: str, k: int = 3, kinds: Optional[Tuple[str, ...]] = None) -> List[HybridHit]:
+        """Funde BM25 e similaridade de embeddings (se o índice semântico estiver ativo)."""
+        keyword_hits = self._search_index.search(query, k * 2, kinds)
+        semantic_hits = []
+        if self.semantic_index is not None:
+            try: semantic_hits = self.semantic_index.search(query, k * 2, kinds)
+            except Exception as e: logger.error(f"Erro na busca semântica: {e}", exc_info=True)
+        return fuse_hits(keyword_hits, semantic_hits, k)
 
     # --- Funções de Formatação (Mantidas como estavam) ---
 
@@ -157,7 +551,7 @@ class KnowledgeHandler:
         else:
              bio_sem_sociedades = bio.strip() if isinstance(bio, str) else ""
 
-        info.append("**Formação e Experiência Completa do Dr. Juarez Missel:**")
+        info.append(f"**Formação e Experiência Completa do {self.doctor_name}:**")
         if bio_sem_sociedades: info.append(f"- **Resumo Profissional:** {bio_sem_sociedades}")
         if isinstance(exp_summary, dict) and exp_summary.get('years'): info.append(f"- **Tempo de Atuação:** {exp_summary['years']}.")
         if isinstance(grad, dict) and grad.get('university'): info.append(f"- **Graduação:** Medicina pela {grad['university']} (Ano: {grad.get('year', 'N/A')}).")
@@ -231,12 +625,22 @@ class KnowledgeHandler:
 
         return "\n".join(info) if len(info) > 1 else None
 
+    def _resolve_names(self):
+        """Nomes da clínica e do médico a partir da base (usados nos blocos, na persona e nas mensagens fixas)."""
+        clinic_info = self.data.get("clinic_info", {}) or {}
+        doctor_info = self.data.get("doctor_info", {}) or {}
+        self.clinic_name = str(clinic_info.get("name") or DEFAULT_CLINIC_NAME).strip()
+        self.doctor_name = str(doctor_info.get("full_name") or clinic_info.get("doctor_name") or DEFAULT_DOCTOR_NAME).strip()
+        name_parts = self.doctor_name.split()
+        has_title = len(name_parts) > 2 and name_parts[0].rstrip(".").lower() in ("dr", "dra")
+        self.doctor_short_name = " ".join(name_parts[:2]) if has_title else self.doctor_name
+
     def _format_details_to_string(self, details_dict: Dict[str, Any]) -> str:
         """Formata um dicionário de detalhes (diferenciais, etc.) em string multi-linha, ignorando 'restricao_importante'."""
         lines = []
         title_map = {
             "diferenciais_clinico": "Clínico/Técnica",
-            "diferenciais_doutor": "Dr. Juarez Missel",
+            "diferenciais_doutor": self.doctor_name,
             "diferenciais_artigos": "Artigos Publicados",
             "diferenciais_capitulos": "Capítulos de Livros",
             "diferenciais_premios": "Prêmios Relacionados"
@@ -259,55 +663,53 @@ class KnowledgeHandler:
         return "\n".join(lines)
 
     def _find_specific_procedure(self, query_lower: str) -> Optional[Dict[str, Any]]:
-        """Tenta encontrar UM procedimento específico na query usando variações e termos."""
-        best_match_proc_data = None
-        highest_score = 0 # 3: Variação, 2: Termos chave, 1: Nome contido
-
-        # 1. Busca por Variações Mapeadas (maior prioridade)
-        # Usa regex para encontrar a palavra/frase exata da variação na query
-        for variation, original_name_lower in self._procedure_variation_map.items():
-             # Usa \b para garantir que é a palavra inteira (evita match parcial como 'lipo' em 'lipofilling')
-             if re.search(r'\b' + re.escape(variation) + r'\b', query_lower):
-                  proc_data = self._procedure_map.get(original_name_lower)
-                  if proc_data: # Se encontrou no mapa
-                       logger.debug(f"Procedimento encontrado por variação mapeada: '{variation}' -> '{original_name_lower}'")
-                       # Se encontrar uma variação, assume que é a intenção principal
-                       return proc_data # Retorna imediatamente
-
-        # 2. Busca por Termos Chave (se não encontrou por variação)
-        # Verifica se TODOS os termos chave de um procedimento estão na query
-        for name_lower, terms in self._procedure_search_terms.items():
-             if terms and all(re.search(r'\b' + re.escape(term) + r'\b', query_lower) for term in terms):
-                  proc_data = self._procedure_map.get(name_lower)
-                  if proc_data and highest_score < 2: # Prioriza o primeiro match completo encontrado
-                       logger.debug(f"Procedimento encontrado por termos chave completos: '{name_lower}' (Termos: {terms})")
-                       best_match_proc_data = proc_data
-                       highest_score = 2
-                       # Não retorna ainda, pode haver um match melhor por nome exato (próximo passo)
-
-        # 3. Busca por Nome Exato (Contido, Menor Prioridade) - Fallback
-        # Verifica se o nome base do procedimento (sem parênteses) está contido na query
-        if highest_score < 2: # Só executa se não achou por termos chave
-            # Ordena por comprimento do nome descrescente para priorizar matches mais específicos
-            sorted_names = sorted(self._procedure_map.keys(), key=len, reverse=True)
-            for name_lower in sorted_names:
-                proc_data = self._procedure_map.get(name_lower)
-                name_for_match = re.sub(r'\s*\(.*\)\s*', '', name_lower).strip()
-                # Verifica se o nome base está na query como palavra completa
-                if len(name_for_match) > 4 and re.search(r'\b' + re.escape(name_for_match) + r'\b', query_lower):
-                     logger.debug(f"Procedimento encontrado por nome contido (fallback): '{name_for_match}' em '{name_lower}'")
-                     best_match_proc_data = proc_data
-                     highest_score = 1
-                     break # Encontrou um fallback, para aqui
-
-        return best_match_proc_data # Retorna o melhor que encontrou (ou None)
+        """
+        Tenta encontrar UM procedimento específico na query usando variações e termos.
+        Uma única passada do autômato encontra todas as frases; as prioridades são as de antes:
+        variação mapeada > todos os termos chave de um procedimento > nome base contido (mais longo primeiro).
+        """
+        hits = self._procedure_matcher.found(query_lower)
+        if not hits:
+            return None
+
+        # 1. Variações Mapeadas (maior prioridade; \b garante palavra inteira, ex: 'lipo' não casa 'lipofilling')
+        variation_hits = [variation for variation in hits if variation in self._variation_rank]
+        if variation_hits:
+            variation = min(variation_hits, key=self._variation_rank.__getitem__)
+            original_name_lower = self._procedure_variation_map[variation]
+            proc_data = self._procedure_map.get(original_name_lower)
+            if proc_data:
+                logger.debug(f"Procedimento encontrado por variação mapeada: '{variation}' -> '{original_name_lower}'")
+                return proc_data
+
+        # 2. Termos Chave: procedimentos com TODOS os termos na query (só os que têm algum termo encontrado)
+        candidates = {name_lower for term in hits for name_lower in self._term_procedures.get(term, ())}
+        complete_matches = [name_lower for name_lower in candidates
+                            if all(term in hits for term in self._procedure_search_terms[name_lower])]
+        if complete_matches:
+            name_lower = min(complete_matches, key=self._procedure_rank.__getitem__) # Prioriza o primeiro na ordem da base
+            logger.debug(f"Procedimento encontrado por termos chave completos: '{name_lower}' (Termos: {self._procedure_search_terms[name_lower]})")
+            return self._procedure_map.get(name_lower)
+
+        # 3. Nome base contido (fallback), priorizando nomes mais longos
+        base_name_hits = [(self._base_name_rank[name], name) for name in hits if name in self._base_name_rank]
+        if base_name_hits:
+            (_, name_lower), name_for_match = min(base_name_hits)
+            logger.debug(f"Procedimento encontrado por nome contido (fallback): '{name_for_match}' em '{name_lower}'")
+            return self._procedure_map.get(name_lower)
+
+        return None
 
 
     def get_procedure_list(self) -> Optional[str]:
-        """ Retorna a lista formatada de nomes de procedimentos principais (excluindo Conceito/Pequenas)."""
+        """ Retorna a lista formatada de procedimentos principais (pré-renderizada no carregamento)."""
         if not self.data: logger.warning("get_procedure_list: Base de conhecimento não carregada."); return None
+        return self.blocks.get("procedure_list")
+
+    def _format_procedure_list(self) -> Optional[str]:
+        """ Formata a lista de nomes de procedimentos principais (excluindo Conceito/Pequenas)."""
         all_procedures = self.data.get("procedures", [])
-        if not isinstance(all_procedures, list): logger.warning("get_procedure_list: 'procedures' não é uma lista ou não existe."); return None
+        if not isinstance(all_procedures, list): logger.warning("_format_procedure_list: 'procedures' não é uma lista ou não existe."); return None
 
         procedure_names = []
         try:
@@ -326,52 +728,31 @@ class KnowledgeHandler:
             return None
 
         if procedure_names:
-            logger.debug(f"get_procedure_list: Encontrados {len(procedure_names)} procedimentos principais.")
+            logger.debug(f"_format_procedure_list: Encontrados {len(procedure_names)} procedimentos principais.")
             # Formato esperado pelo OpenAI Handler
             return "- **Principais Procedimentos Realizados:**\n" + "\n".join([f"  - {name}" for name in procedure_names])
         else:
-            logger.debug("get_procedure_list: Nenhum procedimento principal encontrado para listar.")
+            logger.debug("_format_procedure_list: Nenhum procedimento principal encontrado para listar.")
             return None
 
     def get_faq_answer(self, query_lower: str) -> Optional[str]:
-        """ Tenta encontrar uma resposta direta na FAQ por sobreposição de palavras significativas."""
+        """ Busca a pergunta da FAQ mais próxima no índice BM25 (exige termos em comum e cobertura mínima da query)."""
         if not self.data: logger.warning("get_faq_answer: Base de dados não carregada."); return None
-        faqs = self.data.get("faq", [])
-        if not isinstance(faqs, list): logger.warning("get_faq_answer: 'faq' não é uma lista ou não existe."); return None
-
-        best_match_answer = None
-        max_overlap_score = 0.5 # Threshold mínimo de score para considerar um match
-
-        # Usa regex para palavras com 3+ letras (incluindo acentos)
-        query_words = set(re.findall(r'\b[a-zA-ZÀ-ÿ]{3,}\b', query_lower))
-        if not query_words: logger.debug("get_faq_answer: Query sem palavras significativas."); return None
-
-        for faq in faqs:
-            if not isinstance(faq, dict): continue # Ignora entradas malformadas
-            question = faq.get("question")
-            answer = faq.get("answer")
-            if not question or not answer or not isinstance(question, str): continue # Pula item inválido
-
-            question_lower = question.lower()
-            faq_words = set(re.findall(r'\b[a-zA-ZÀ-ÿ]{3,}\b', question_lower))
-            if not faq_words: continue # Pula pergunta FAQ vazia
-
-            overlap_count = len(faq_words.intersection(query_words))
-            # Calcula score: overlap / tamanho da MAIOR entre query e pergunta FAQ (Jaccard Index simplificado)
-            # Isso penaliza menos se a query for muito longa ou muito curta em relação à pergunta
-            union_size = len(faq_words.union(query_words))
-            if union_size == 0: continue # Evita divisão por zero
-            match_score = overlap_count / union_size
-
-            # Critério: pelo menos 2 palavras em comum E score acima do threshold E melhor que anterior
-            if overlap_count >= 2 and match_score > max_overlap_score:
-                max_overlap_score = match_score
-                # Formata a resposta incluindo a pergunta original para contexto claro
-                best_match_answer = f"- **Respondendo sua pergunta sobre '{question.strip()}':**\n  - {answer.strip()}"
-                logger.debug(f"FAQ Match Encontrado: Score={match_score:.2f}, Overlap={overlap_count}, Pergunta='{question.strip()}'")
-
-        if not best_match_answer: logger.debug("Nenhuma correspondência forte encontrada na FAQ.")
-        return best_match_answer
+
+        query_terms = set(tokenize(query_lower))
+        if not query_terms: logger.debug("get_faq_answer: Query sem palavras significativas."); return None
+
+        hits = self._search_index.search(query_lower, k=1, kinds=("faq",))
+        if hits:
+            hit = hits[0]
+            coverage = hit.matched_terms / len(query_terms)
+            # Critério: pelo menos 2 termos em comum E cobrindo boa parte da query (evita match por palavra solta)
+            if hit.matched_terms >= SEARCH_MIN_MATCHED_TERMS and coverage >= FAQ_MIN_QUERY_COVERAGE:
+                logger.debug(f"FAQ Match Encontrado: Score={hit.score:.2f}, Termos={hit.matched_terms}, Pergunta='{hit.chunk.title}'")
+                return hit.chunk.content
+
+        logger.debug("Nenhuma correspondência forte encontrada na FAQ.")
+        return None
 
     def _get_formatted_links(self) -> Optional[str]:
         """Formata os links disponíveis do médico e da clínica."""
@@ -385,19 +766,50 @@ class KnowledgeHandler:
         if clinic_website and isinstance(clinic_website, str):
             formatted.append(f"  - Site Clínica: {clinic_website}")
         if isinstance(dr_links, dict):
-            if dr_links.get("instagram"): formatted.append(f"  - Instagram Dr. Juarez: {dr_links['instagram']}")
-            if dr_links.get("youtube"): formatted.append(f"  - YouTube Dr. Juarez: {dr_links['youtube']}")
-            if dr_links.get("linkedin"): formatted.append(f"  - LinkedIn Dr. Juarez: {dr_links['linkedin']}")
-            if dr_links.get("lattes"): formatted.append(f"  - Currículo Lattes Dr. Juarez: {dr_links['lattes']}")
+            if dr_links.get("instagram"): formatted.append(f"  - Instagram {self.doctor_short_name}: {dr_links['instagram']}")
+            if dr_links.get("youtube"): formatted.append(f"  - YouTube {self.doctor_short_name}: {dr_links['youtube']}")
+            if dr_links.get("linkedin"): formatted.append(f"  - LinkedIn {self.doctor_short_name}: {dr_links['linkedin']}")
+            if dr_links.get("lattes"): formatted.append(f"  - Currículo Lattes {self.doctor_short_name}: {dr_links['lattes']}")
 
         return "\n".join(formatted) if len(formatted) > 1 else None
 
+    def detect_turn_topic(self, user_message: str, assistant_response: str) -> Optional[str]:
+        """
+        Procedimento discutido no turno: citado na resposta da assistente E confirmado pela pergunta do usuário
+        (nome ou variação). Uma passada do autômato em cada texto; chamado uma vez por turno.
+        """
+        if not assistant_response or not user_message:
+            return None
+        found_in_response = self._topic_matcher.found(assistant_response.lower())
+        if not found_in_response:
+            return None
+        found_in_query = self._topic_matcher.found(user_message.lower())
+        best: Optional[Tuple[int, str]] = None
+        for base_name in found_in_response:
+            for rank, proc_name_lower in self._topic_candidates.get(base_name, ()):
+                if base_name in found_in_query or not self._procedure_variations.get(proc_name_lower, frozenset()).isdisjoint(found_in_query):
+                    if best is None or rank < best[0]:
+                        best = (rank, proc_name_lower)
+        return best[1] if best else None
+
+    def topic_from_history(self, conversation_history: List[Dict[str, str]]) -> Optional[str]:
+        """Tópico mais recente do histórico (para chamadores que não mantêm o tópico na sessão)."""
+        for i in range(len(conversation_history) - 1, 0, -1):
+            message = conversation_history[i]
+            if message.get("role") == "assistant" and conversation_history[i-1].get("role") == "user":
+                topic = self.detect_turn_topic(conversation_history[i-1].get("content", ""), message.get("content", ""))
+                if topic:
+                    return topic
+        return None
+
     # --- FUNÇÃO PRINCIPAL DE BUSCA ---
-    # ---> MODIFICAÇÃO AQUI (Assinatura e Lógica de Contexto) <---
-    def find_relevant_info(self, query: str, conversation_history: Optional[List[Dict[str, str]]] = None) -> Optional[str]:
+    def find_relevant_info(self, query: str, conversation_history: Optional[List[Dict[str, str]]] = None,
+                           current_topic: Optional[str] = None) -> Optional[str]:
         """
-        (v8.6) Identifica intenção (considerando contexto do histórico),
+        (v9.3) Identifica intenção (considerando o tópico da conversa),
         retorna bloco de info relevante e evita RAG para saudações.
+        current_topic: procedimento em discussão (mantido na sessão via detect_turn_topic). Se ausente, é
+        derivado de conversation_history (compatibilidade).
         """
         # 1. Validação inicial
         if not self.data:
@@ -407,49 +819,18 @@ class KnowledgeHandler:
         # 2. Normaliza a query atual
         query_lower = query.lower().strip()
 
-        # 3. --- LÓGICA DE CONTEXTO DO HISTÓRICO ---
-        identified_topic_from_history: Optional[str] = None # Guarda o nome_lower do procedimento identificado
-
-        # Palavras/frases que indicam que a query atual depende do contexto anterior
-        contextual_keywords = ["disso", "dele", "dela", "nisso", "nele", "nesse", "deste", "desta", "isso"]
-        contextual_phrases = ["nesse procedimento", "sobre isso", "e os diferenciais", "mais detalhes", "e quanto a", "como funciona", "fale mais", "detalhes sobre"]
-
+        # 3. --- LÓGICA DE CONTEXTO (tópico mantido na sessão a cada turno) ---
         # Verifica se a query atual parece ser contextual (contém palavra/frase chave)
-        is_contextual_query = any(keyword in query_lower.split() for keyword in contextual_keywords) or \
-                              any(phrase in query_lower for phrase in contextual_phrases)
-
-        # Se for contextual e houver histórico, tenta encontrar o tópico
-        if is_contextual_query and conversation_history and len(conversation_history) >= 1:
-            logger.debug(f"Query '{query}' parece contextual. Analisando histórico ({len(conversation_history)} msgs)...")
-            # Procura de trás para frente no histórico
-            for i in range(len(conversation_history) - 1, -1, -1):
-                message = conversation_history[i]
-                # Foca na última resposta do ASSISTENTE que PODE ter introduzido um tópico
-                if message.get("role") == "assistant":
-                    assistant_response = message.get("content", "").lower()
-                    found_proc_name = None
-                    # Tenta encontrar um nome de procedimento (do nosso mapa) mencionado na resposta
-                    # Prioriza matches mais longos para evitar ambiguidades (ex: "lipo" vs "lipoaspiração")
-                    sorted_proc_names = sorted(self._procedure_map.keys(), key=len, reverse=True)
-                    for proc_name_lower in sorted_proc_names:
-                        search_name_processed = re.sub(r'\s*\(.*\)\s*', '', proc_name_lower).strip()
-                        # Usa \b para matching de palavra inteira
-                        if len(search_name_processed) > 3 and re.search(r'\b' + re.escape(search_name_processed) + r'\b', assistant_response):
-                            # HEURÍSTICA: Verifica se a pergunta DO USUÁRIO ANTERIOR a esta resposta
-                            # também mencionava algo relacionado a este procedimento (nome ou variação)
-                            # Isso ajuda a confirmar que o assistente estava respondendo sobre esse tópico.
-                            if i > 0 and conversation_history[i-1].get("role") == "user":
-                                prev_user_query = conversation_history[i-1].get("content", "").lower()
-                                if re.search(r'\b' + re.escape(search_name_processed) + r'\b', prev_user_query) or \
-                                   any(re.search(r'\b' + re.escape(variation) + r'\b', prev_user_query)
-                                       for variation, original in self._procedure_variation_map.items() if original == proc_name_lower):
-                                    found_proc_name = proc_name_lower
-                                    break # Achou um provável tópico relevante
-
-                    if found_proc_name:
-                        identified_topic_from_history = found_proc_name
-                        logger.info(f"Contexto Histórico: Tópico '{identified_topic_from_history}' identificado baseado na interação anterior.")
-                        break # Para de procurar no histórico assim que encontra um tópico provável
+        is_contextual_query = not CONTEXTUAL_KEYWORDS.isdisjoint(query_lower.split()) or \
+                              any(phrase in query_lower for phrase in CONTEXTUAL_PHRASES)
+
+        identified_topic_from_history: Optional[str] = None # Guarda o nome_lower do procedimento identificado
+        if is_contextual_query:
+            if current_topic is None and conversation_history:
+                current_topic = self.topic_from_history(conversation_history) # Chamadores sem tópico na sessão
+            if current_topic and current_topic in self._procedure_map:
+                identified_topic_from_history = current_topic
+                logger.info(f"Contexto: Tópico '{identified_topic_from_history}' da conversa usado para a query contextual.")
 
         # 4. --- USA O CONTEXTO SE ENCONTRADO ---
         # Se a query é contextual E um tópico foi identificado no histórico
@@ -457,7 +838,7 @@ class KnowledgeHandler:
             logger.debug(f"Tentando RAG com base no contexto histórico: '{identified_topic_from_history}'")
             proc_data = self._procedure_map.get(identified_topic_from_history)
             if proc_data:
-                proc_details_formatted = self._format_procedure_details(proc_data)
+                proc_details_formatted = self.blocks.get(f"procedure:{identified_topic_from_history}")
                 if proc_details_formatted:
                     logger.info(f"Info RAG encontrada (Contexto Histórico - Detalhes Procedimento '{identified_topic_from_history}', Tamanho: {len(proc_details_formatted)})")
                     # RETORNA DIRETAMENTE os detalhes do procedimento identificado no contexto
@@ -470,11 +851,9 @@ class KnowledgeHandler:
             # Se a busca contextual falhar (ex: não conseguiu formatar), a execução continua para a lógica geral abaixo como fallback
 
         # 5. --- TRATAMENTO DE SAUDAÇÕES / RESPOSTAS SIMPLES (APÓS contexto, ANTES de intenção geral) ---
-        greetings = ["oi", "ola", "olá", "bom dia", "boa tarde", "boa noite", "tudo bem", "tudo bom", "tudo certo", "ok", "obrigado", "obrigada", "grato", "grata", "valeu", "de nada", "igualmente"]
-        greetings.extend(["td bem", "td bom", "obg", "vlw"]) # Abreviações comuns
         # Remove pontuação e verifica se a query é apenas uma dessas saudações/respostas
         simple_query = re.sub(r'[^\w\s]', '', query_lower).strip() # Remove pontuação
-        if simple_query in greetings:
+        if simple_query in GREETINGS:
             logger.debug(f"Query '{query}' identificada como saudação/resposta simples. Nenhum RAG necessário.")
             # RETORNA NONE para que a OpenAI lide com a conversa naturalmente
             return None
@@ -483,33 +862,16 @@ class KnowledgeHandler:
         logger.debug(f"Analisando intenção principal para query (sem contexto ou contexto falhou): '{query}'")
         knowledge_blocks: List[str] = []
         intent_found = False
-        is_cost_query = any(cost_kw in query_lower for cost_kw in ["quanto custa", "valor", "preço", "custo", "média de valor", "orcamento", "orçamento"])
-
-        # Palavras-chave (revisadas para clareza)
-        exp_keywords = ["experiente", "experiência", "tempo", "anos", "formação", "formou", "currículo", "graduação", "pós-graduação", "especialização", "especialidade", "qualificação", "qualificado", "prêmio", "premios", "livro", "capítulo", "publicou", "sociedade", "membro", "fellowship", "diferenciais", "histórico", "background", "capacitação", "congresso", "científico", "artigo", "pesquisa", "palestra", "destaque", "produção acadêmica"]
-        quantity_keywords = ["quantos", "quantas", "número de", "volume de"]
-        surgery_proc_keywords = ["cirurgias", "procedimentos", "operações"]
-        generic_dr_keywords = ["detalhes sobre ele", "tudo sobre ele", "mais sobre ele", "sobre o dr", "sobre ele", "dele"]
-        doctor_keywords = ["médico", "dr.", "doutor", "juarez", "missel", "ele"] # "ele" pode ser ambíguo, mas mantido
-        procedure_keywords = ["procedimento", "cirurgia", "operação", "técnica", "tratamento", "botox", "preenchimento"] + list(self._procedure_variation_map.keys()) # Inclui variações
-        list_keywords = ["procedimentos", "cirurgias", "lista", "quais", "tipos", "serviços", "opções"]
-        action_keywords = ["faz", "realiza", "oferece", "tem", "disponíveis"]
-        link_keywords = ["instagram", "insta", "youtube", "linkedin", "lattes", "site", "link", "rede social", "redes sociais", "perfil", "página"]
-        insurance_keywords = ["convênio", "convenio", "plano de saúde", "plano medico", "seguro saude", "aceita"] + KNOWN_INSURANCE_NAMES
-        location_keywords = ["endereço", "onde fica", "localização", "rua", "opera", "hospital", "consultório"]
-        time_keywords = ["horário", "funcionamento", "aberto", "atende", "que horas", "horarios", "agenda"]
-        consult_cost_keywords = ["valor", "preço", "custo", "quanto é", "quanto custa"] # Repetido, mas ok
-        payment_keywords = ["pagamento", "pagar", "forma de pagamento", "parcela", "financia"]
-
+        is_cost_query = any(cost_kw in query_lower for cost_kw in COST_KEYWORDS)
 
         # DETECÇÃO PRIORIZADA:
 
         # 1. Experiência / Detalhes Gerais / Quantidade do Médico
-        is_exp_by_keyword = any(ek in query_lower for ek in exp_keywords) and any(dk in query_lower for dk in doctor_keywords)
-        is_generic_dr_req = any(gdk in query_lower for gdk in generic_dr_keywords) and not any(pk in query_lower for pk in procedure_keywords + list_keywords)
-        is_quantity_req = any(qk in query_lower for qk in quantity_keywords) and any(spk in query_lower for spk in surgery_proc_keywords) and any(dk in query_lower for dk in doctor_keywords)
+        is_exp_by_keyword = any(ek in query_lower for ek in EXP_KEYWORDS) and any(dk in query_lower for dk in DOCTOR_KEYWORDS)
+        is_generic_dr_req = any(gdk in query_lower for gdk in GENERIC_DR_KEYWORDS) and not any(pk in query_lower for pk in self._procedure_or_list_keywords)
+        is_quantity_req = any(qk in query_lower for qk in QUANTITY_KEYWORDS) and any(spk in query_lower for spk in SURGERY_PROC_KEYWORDS) and any(dk in query_lower for dk in DOCTOR_KEYWORDS)
         is_time_as_plastic_req = (("quanto tempo" in query_lower or "desde quando" in query_lower) and \
-                                 any(pk in query_lower for pk in ["plástico", "plastico", "especialista", "cirurgião plástico"])) or \
+                                 any(pk in query_lower for pk in PLASTIC_KEYWORDS)) or \
                                  ("formou em plástica" in query_lower) # Adiciona caso específico
 
         # Condição para buscar experiência: SE (é uma das flags acima) E NÃO é sobre custo
@@ -520,7 +882,7 @@ class KnowledgeHandler:
             # SÓ busca experiência se NÃO mencionar procedimento específico OU se a pergunta for explicitamente genérica/quantitativa
             if not mentions_specific_procedure or is_generic_dr_req or is_quantity_req or is_time_as_plastic_req:
                 logger.debug("Intenção Principal Detectada: Experiência/Detalhes/Qtd/Tempo Específico do Doutor.")
-                experience_info = self._format_doctor_full_experience()
+                experience_info = self.blocks.get("doctor:experience")
                 if experience_info:
                     knowledge_blocks.append(experience_info)
                     intent_found = True
@@ -536,7 +898,7 @@ class KnowledgeHandler:
             if proc_data:
                 proc_name = proc_data.get('name', 'N/A')
                 logger.debug(f"Intenção Principal Detectada: Detalhes do Procedimento '{proc_name}'")
-                proc_details_formatted = self._format_procedure_details(proc_data)
+                proc_details_formatted = self.blocks.get(f"procedure:{proc_data['name'].lower().strip()}")
                 if proc_details_formatted:
                     knowledge_blocks.append(proc_details_formatted)
                     intent_found = True
@@ -547,7 +909,7 @@ class KnowledgeHandler:
 
         # 3. Listar Procedimentos (Se NADA antes e NÃO custo)
         # Verifica se pede lista de procedimentos/cirurgias/serviços que ele faz/realiza/oferece
-        is_list_request = any(lk in query_lower for lk in list_keywords) and any(ak in query_lower for ak in action_keywords)
+        is_list_request = any(lk in query_lower for lk in LIST_KEYWORDS) and any(ak in query_lower for ak in ACTION_KEYWORDS)
 
         if not intent_found and is_list_request and not is_cost_query:
             logger.debug("Intenção Principal Detectada: Listar Procedimentos")
@@ -559,95 +921,35 @@ class KnowledgeHandler:
         # 7. --- BUSCA COMPLEMENTAR ESPECÍFICA (SOMENTE SE NENHUMA INTENÇÃO PRINCIPAL ATENDIDA) ---
         if not intent_found:
             logger.debug("Nenhuma intenção principal encontrada ou RAG já tratado pelo contexto. Verificando buscas complementares...")
-            clinic_info = self.data.get("clinic_info", {})
-            consultation_info = self.data.get("consultation_info", {})
-            payment_methods = self.data.get("payment_methods", []) # Espera lista de strings
-            insurance_info = self.data.get("accepted_insurance", []) # Espera lista de strings ou string única
-            doctor_info = self.data.get("doctor_info", {}) # Para links
-
-            # Ordem de verificação complementar:
+            # Ordem de verificação complementar (blocos pré-renderizados em _render_blocks):
             # Custo Consulta -> Pagamento Consulta -> Convênio -> Links -> Localização -> Horários -> Contato
-
-            # Custo Consulta
-            if any(cck in query_lower for cck in consult_cost_keywords) and "consulta" in query_lower:
-                value = consultation_info.get("value")
-                if value:
-                     info = f"- **Valor da Consulta Inicial:** {value}"
-                     logger.info(f"Info RAG encontrada (Complementar-Valor Consulta, Tamanho: {len(info)})")
-                     knowledge_blocks.append(info) # Adiciona ao bloco
-
-            # Pagamento Consulta
-            elif any(pay_kw in query_lower for pay_kw in payment_keywords) and "consulta" in query_lower:
-                 if payment_methods and isinstance(payment_methods, list):
-                      info = f"- **Formas de Pagamento Aceitas (Consulta):** {', '.join(payment_methods)}"
-                      logger.info(f"Info RAG encontrada (Complementar-Pagamento Consulta, Tamanho: {len(info)})")
-                      knowledge_blocks.append(info)
-
-            # Convênios
-            elif any(ins_kw in query_lower for ins_kw in insurance_keywords):
-                 # Pega a info de convênio (pode ser lista ou string)
-                 insurance_text = None
-                 if isinstance(insurance_info, list) and insurance_info:
-                     insurance_text = insurance_info[0] # Assume a primeira entrada se for lista
-                 elif isinstance(insurance_info, str):
-                     insurance_text = insurance_info
-                 if insurance_text:
-                     info = f"- **Convênios Médicos:** {insurance_text}"
-                     logger.info(f"Info RAG encontrada (Complementar-Convênio, Tamanho: {len(info)})")
-                     knowledge_blocks.append(info)
-
-            # Links
-            elif any(link_kw in query_lower for link_kw in link_keywords):
-                 links_info_formatted = self._get_formatted_links()
-                 if links_info_formatted:
-                      logger.info(f"Info RAG encontrada (Complementar-Links, Tamanho: {len(links_info_formatted)})")
-                      knowledge_blocks.append(links_info_formatted)
-
-            # Localização (Endereço ou Local Cirurgia)
-            elif any(loc_kw in query_lower for loc_kw in location_keywords):
-                 location_info_parts = []
-                 # Verifica se pergunta ONDE opera/faz cirurgia
-                 surgery_loc_keywords = ["opera", "cirurgia", "procedimento"]
-                 where_keywords = ["onde", "local", "hospital"]
-                 if any(slk in query_lower for slk in surgery_loc_keywords) and any(wk in query_lower for wk in where_keywords):
-                     loc = clinic_info.get("surgery_location")
-                     if loc: location_info_parts.append(f"- **Local das Cirurgias:** As cirurgias são realizadas no {loc}.")
-
-                 # Verifica se pergunta endereço da clínica/consultório
-                 address_keywords = ["endereço", "onde fica", "localização", "rua", "consultório", "clínica"]
-                 if any(ak in query_lower for ak in address_keywords):
-                     address = self._format_address()
-                     if address: location_info_parts.append(f"- **Endereço da Clínica:** {address}")
-
-                 if location_info_parts:
-                      # Usa dict.fromkeys para remover duplicatas se ambas perguntas foram feitas
-                      final_loc_info = "\n".join(dict.fromkeys(location_info_parts))
-                      logger.info(f"Info RAG encontrada (Complementar-Localização, Tamanho: {len(final_loc_info)})")
-                      knowledge_blocks.append(final_loc_info)
-
-            # Horários
-            elif any(time_kw in query_lower for time_kw in time_keywords):
-                 hours = self._format_opening_hours()
-                 if hours:
-                     info = f"- **Horários de Funcionamento da Clínica:**\n{hours}"
-                     logger.info(f"Info RAG encontrada (Complementar-Horários, Tamanho: {len(info)})")
-                     knowledge_blocks.append(info)
-
-            # Contato (Telefone/WhatsApp)
-            elif any(con_kw in query_lower for con_kw in ["telefone", "contato", "whatsapp", "fone", "liga", "numero", "número"]):
-                 contact_info_parts = []
-                 phones = clinic_info.get("phone_number")
-                 wp_raw = clinic_info.get("whatsapp_number", "")
-                 # Extrai apenas o número do formato whatsapp:+55...
-                 wp_number = wp_raw.split(':')[-1] if wp_raw.startswith("whatsapp:") else wp_raw
-
-                 if phones: contact_info_parts.append(f"- **Telefones:** {phones}")
-                 if wp_number: contact_info_parts.append(f"- **WhatsApp Principal (Contato):** {wp_number}")
-
-                 if contact_info_parts:
-                      final_contact_info = "\n".join(dict.fromkeys(contact_info_parts))
-                      logger.info(f"Info RAG encontrada (Complementar-Contato, Tamanho: {len(final_contact_info)})")
-                      knowledge_blocks.append(final_contact_info)
+            complementary_block: Optional[str] = None
+            complementary_label = ""
+            if any(cck in query_lower for cck in CONSULT_COST_KEYWORDS) and "consulta" in query_lower:
+                complementary_block, complementary_label = self.blocks.get("consultation:value"), "Valor Consulta"
+            elif any(pay_kw in query_lower for pay_kw in PAYMENT_KEYWORDS) and "consulta" in query_lower:
+                complementary_block, complementary_label = self.blocks.get("policy:payment"), "Pagamento Consulta"
+            elif any(ins_kw in query_lower for ins_kw in INSURANCE_KEYWORDS):
+                complementary_block, complementary_label = self.blocks.get("policy:insurance"), "Convênio"
+            elif any(link_kw in query_lower for link_kw in LINK_KEYWORDS):
+                complementary_block, complementary_label = self.blocks.get("clinic:links"), "Links"
+            elif any(loc_kw in query_lower for loc_kw in LOCATION_KEYWORDS):
+                location_info_parts = []
+                # Verifica se pergunta ONDE opera/faz cirurgia
+                if any(slk in query_lower for slk in SURGERY_LOC_KEYWORDS) and any(wk in query_lower for wk in WHERE_KEYWORDS):
+                    location_info_parts.append(self.blocks.get("clinic:surgery_location"))
+                # Verifica se pergunta endereço da clínica/consultório
+                if any(ak in query_lower for ak in ADDRESS_KEYWORDS):
+                    location_info_parts.append(self.blocks.get("clinic:address"))
+                complementary_block, complementary_label = "\n".join(filter(None, location_info_parts)) or None, "Localização"
+            elif any(time_kw in query_lower for time_kw in TIME_KEYWORDS):
+                complementary_block, complementary_label = self.blocks.get("clinic:hours"), "Horários"
+            elif any(con_kw in query_lower for con_kw in CONTACT_KEYWORDS):
+                complementary_block, complementary_label = self.blocks.get("clinic:contact"), "Contato"
+
+            if complementary_block:
+                logger.info(f"Info RAG encontrada (Complementar-{complementary_label}, Tamanho: {len(complementary_block)})")
+                knowledge_blocks.append(complementary_block)
 
         # 8. --- FALLBACK PARA FAQ (Se NADA foi encontrado até agora) ---
         if not knowledge_blocks: # Verifica se blocos está vazio após todas as buscas
@@ -656,6 +958,13 @@ class KnowledgeHandler:
              if faq_answer:
                   logger.info(f"Info RAG encontrada (FAQ, Tamanho: {len(faq_answer)})")
                   knowledge_blocks.append(faq_answer) # Adiciona resposta da FAQ
+             else:
+                  # Último recurso: melhor bloco da base inteira (BM25 + vetor, se ativo)
+                  hits = [hit for hit in self.hybrid_search(query_lower, k=1)
+                          if hit.matched_terms >= SEARCH_MIN_MATCHED_TERMS or hit.similarity >= SEMANTIC_MIN_SIMILARITY]
+                  if hits:
+                       logger.info(f"Info RAG encontrada (Busca Híbrida '{hits[0].chunk.chunk_id}', Score: {hits[0].score:.2f}, Cosseno: {hits[0].similarity:.2f}, Tamanho: {len(hits[0].chunk.content)})")
+                       knowledge_blocks.append(hits[0].chunk.content)
 
         # 9. --- FINALIZAÇÃO ---
         if knowledge_blocks:
@@ -676,11 +985,47 @@ class KnowledgeHandler:
 # --- Fim da Classe KnowledgeHandler ---
     def get_scheduling_rules(self) -> Dict[str, Any]:
         """
-        Retorna as regras padrão de agendamento usadas para buscar horários disponíveis.
+        (v9.6) Regras de agendamento usadas na busca de horários: padrões abaixo, sobrescritos pela chave opcional
+        'scheduling_rules' da base. Chaves extras opcionais:
+        - working_hours: {"0": [["08:00", "12:00"], ["14:00", "18:00"]]} (dia da semana -> janelas de expediente)
+        - holidays: ["2025-12-25", ...] (datas sem atendimento)
+        - block_minutes: bloco reservado por consulta (padrão 60)
+        - procedure_durations: {"rinoplastia": 60, ...} (palavra-chave do procedimento -> duração em minutos)
+        Interpretadas uma vez por versão da base (data_mtime); o dicionário devolvido é compartilhado, somente leitura.
         """
-        return {
+        if self._scheduling_rules and self._scheduling_rules[0] == self.data_mtime:
+            return self._scheduling_rules[1]
+        rules: Dict[str, Any] = {
             "duration_minutes": 45,
             "preferred_days": [0, 1],  # Segunda-feira (0) e Terça-feira (1)
             "start_hour": 14,
-            "end_hour": 18
-        }
\ No newline at end of file
+            "end_hour": 18,
+            "block_minutes": 60,
+        }
+        configured = (self.data or {}).get("scheduling_rules") or {}
+        for key in ("duration_minutes", "preferred_days", "start_hour", "end_hour", "block_minutes"):
+            if key in configured: rules[key] = configured[key]
+        if configured.get("working_hours"):
+            try: rules["working_hours"] = parse_working_hours(configured["working_hours"])
+            except (ValueError, TypeError, AttributeError) as e: logger.error(f"scheduling_rules.working_hours inválido na base ({e}). Usando dias/horas padrão.")
+        holidays = []
+        for raw_date in configured.get("holidays", []) or []:
+            try: holidays.append(datetime.date.fromisoformat(str(raw_date)))
+            except ValueError: logger.warning(f"Feriado com data inválida ignorado em scheduling_rules: {raw_date}")
+        rules["holidays"] = holidays
+        procedure_durations: Dict[str, int] = {}
+        for keyword, minutes in (configured.get("procedure_durations") or {}).items():
+            try: procedure_durations[str(keyword).lower()] = int(minutes)
+            except (ValueError, TypeError): logger.warning(f"Duração inválida ignorada em scheduling_rules.procedure_durations: {keyword}={minutes!r}")
+        rules["procedure_durations"] = procedure_durations
+        self._scheduling_rules = (self.data_mtime, rules)
+        return rules
+
+    def duration_for_procedure(self, procedure: Optional[str], rules: Optional[Dict[str, Any]] = None) -> int:
+        """Duração da consulta para o procedimento informado pelo paciente (palavra-chave mais longa que aparece no texto)."""
+        rules = rules or self.get_scheduling_rules()
+        text = (procedure or "").lower()
+        matches = [keyword for keyword in rules.get("procedure_durations", {}) if keyword and keyword in text]
+        if matches:
+            return rules["procedure_durations"][max(matches, key=len)]
+        return rules.get("duration_minutes", 45)
\ No newline at end of file
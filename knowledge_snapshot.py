@@ -0,0 +1,75 @@
+# knowledge_snapshot.py (v1.1 - Snapshot Compilado da Base de Conhecimento)
+import os
+import pickle
+import hashlib
+import logging
+import tempfile
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_FORMAT_VERSION = 1
+SNAPSHOT_SUFFIX = ".snapshot.pkl"
+
+def default_snapshot_path(json_file_path: str) -> str:
+    """knowledge_base.json -> knowledge_base.snapshot.pkl (mesmo diretório)."""
+    return os.path.splitext(json_file_path)[0] + SNAPSHOT_SUFFIX
+
+def source_hash(raw: bytes) -> str:
+    return hashlib.sha256(raw).hexdigest()
+
+def load_snapshot(path: str, expected_source_hash: str, build_version: str) -> Optional[Dict[str, Any]]:
+    """
+    Campos do snapshot se ele existir e corresponder ao JSON atual (hash) e ao código atual (build_version).
+    Qualquer divergência ou arquivo corrompido devolve None (o chamador reconstrói a partir do JSON).
+    O arquivo é gerado pela própria aplicação (pickle não deve vir de fontes externas).
+    """
+    try:
+        with open(path, 'rb') as f:
+            header = pickle.load(f)
+            if not isinstance(header, dict) or header.get("format") != SNAPSHOT_FORMAT_VERSION:
+                logger.info(f"Snapshot da base em {path} tem formato antigo. Será reconstruído.")
+                return None
+            if header.get("build_version") != build_version:
+                logger.info(f"Snapshot da base em {path} gerado por outra versão dos índices ({header.get('build_version')}). Será reconstruído.")
+                return None
+            if header.get("source_hash") != expected_source_hash:
+                logger.info(f"knowledge_base.json mudou desde o snapshot {path}. Será reconstruído.")
+                return None
+            fields = pickle.load(f)
+        logger.info(f"Snapshot da base carregado de {path} ({os.path.getsize(path)} bytes).")
+        return fields
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.warning(f"Snapshot da base em {path} inválido ({e}). Será reconstruído.")
+        return None
+
+def save_snapshot(path: str, source_hash_value: str, build_version: str, fields: Dict[str, Any]) -> bool:
+    """
+    Grava cabeçalho + campos (escrita atômica: arquivo temporário + os.replace). O temporário tem nome único no mesmo
+    diretório, então workers/clínicas gravando o mesmo snapshot ao mesmo tempo não escrevem no mesmo arquivo.
+    """
+    tmp_fd, tmp_path = tempfile.mkstemp(prefix=f"{os.path.basename(path)}.", suffix=".tmp", dir=os.path.dirname(path) or ".")
+    try:
+        with os.fdopen(tmp_fd, 'wb') as f:
+            pickle.dump({"format": SNAPSHOT_FORMAT_VERSION, "build_version": build_version, "source_hash": source_hash_value},
+                        f, protocol=pickle.HIGHEST_PROTOCOL)
+            pickle.dump(fields, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+        logger.info(f"Snapshot da base gravado em {path} ({os.path.getsize(path)} bytes).")
+        return True
+    except Exception as e:
+        logger.error(f"Falha ao gravar snapshot da base em {path}: {e}", exc_info=True)
+        try: os.remove(tmp_path)
+        except OSError: pass
+        return False
+
+if __name__ == "__main__":
+    # Etapa de build (ex.: no deploy/imagem): python knowledge_snapshot.py [knowledge_base.json]
+    import sys
+    from knowledge_handler import KnowledgeHandler
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    json_path = sys.argv[1] if len(sys.argv) > 1 else "knowledge_base.json"
+    handler = KnowledgeHandler(json_file_path=json_path, rebuild_snapshot=True)
+    sys.exit(0 if handler.data else 1)
@@ -1,12 +1,12 @@
-# main.py (v1.0.3 - Busca Direta de Slots + Correção GPT Call)
+# main.py (v1.2.0 - Multi-Clínica por Número Twilio + Busca Direta de Slots Paginada)
 import re
 import os
 import logging
-import time
 import datetime
 import pytz
 import locale # Para formatar datas/horas em PT-BR
 import json # Para debug
+import asyncio
 from fastapi import FastAPI, Request, Form, HTTPException
 from fastapi.responses import Response
 from twilio.rest import Client as TwilioClient
@@ -18,9 +18,17 @@ from dateparser import parse as parse_date
 
 # Importa nossos handlers atualizados
 # Certifique-se que caldav_handler.py foi atualizado para aceitar patient_email
-from openai_handler import OpenAIHandler
+from openai_handler import OpenAIHandler, FALLBACK_RESPONSES
 from knowledge_handler import KnowledgeHandler
-from caldav_handler import CaldavHandler # ASSUME QUE FOI CORRIGIDO
+from semantic_index import SemanticIndex, sentence_transformer_encoder, DEFAULT_EMBEDDING_MODEL, DEFAULT_INDEX_DIR
+from async_caldav_handler import AsyncCaldavHandler # Cliente CalDAV assíncrono (não bloqueia o event loop)
+from outbound_queue import OutboundQueue, split_message
+from session_store import SessionStore, SessionLockTimeout, InMemorySessionStore, RedisSessionStore
+from fast_path import FastPathResponder, parse_enabled_intents
+from answer_cache import AnswerCache, InMemoryAnswerCache, RedisAnswerCache, answer_cache_key
+from slot_preferences import SlotPreferences, match_listed_slot, parse_slot_preferences
+from slot_holds import SlotHolds, InMemorySlotHolds, RedisSlotHolds
+from tenant_registry import Tenant, TenantConfig, TenantRegistry, TenantLoadError, DEFAULT_TENANT_ID, DEFAULT_MAX_LOADED_TENANTS, load_tenant_configs
 
 logger = logging.getLogger(__name__)
 
@@ -42,21 +50,44 @@ try:
     twilio_auth_token = os.environ['TWILIO_AUTH_TOKEN']
     twilio_whatsapp_number = os.environ['TWILIO_WHATSAPP_NUMBER']
     openai_api_key = os.environ['OPENAI_API_KEY']
-    caldav_url = os.environ['CALDAV_URL']
-    caldav_username = os.environ['CALDAV_USERNAME']
-    caldav_password = os.environ['CALDAV_PASSWORD']
-    caldav_calendar_name = os.environ['CALDAV_CALENDAR_NAME']
+    caldav_url = os.getenv('CALDAV_URL') # CalDAV da clínica padrão (em TENANTS_FILE, padrão para as clínicas sem 'caldav')
+    caldav_username = os.getenv('CALDAV_USERNAME')
+    caldav_password = os.getenv('CALDAV_PASSWORD')
+    caldav_calendar_name = os.getenv('CALDAV_CALENDAR_NAME')
     margot_persona_name = os.getenv("MARGOT_PERSONA_NAME", "Margot")
-    clinic_name = os.getenv("CLINIC_NAME", "Clínica Missel")
+    clinic_name = os.getenv("CLINIC_NAME") # None: usa clinic_info.name da base
     test_destination_number = os.getenv("TEST_DESTINATION_NUMBER") # Para testes manuais se necessário
     default_timezone = os.getenv("DEFAULT_TIMEZONE", "America/Sao_Paulo")
+    session_store_backend = os.getenv("SESSION_STORE", "memory").lower() # 'memory' (um worker) ou 'redis' (multi-worker; exige Redis acessível)
+    redis_url = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+    session_ttl_seconds = int(os.getenv("SESSION_TTL_SECONDS", str(24 * 60 * 60))) # No backend em memória: tempo máximo ocioso
+    session_max_entries = int(os.getenv("SESSION_MAX_ENTRIES", "5000"))
+    semantic_search_enabled = os.getenv("SEMANTIC_SEARCH", "false").lower() == "true" # Requer numpy + sentence-transformers
+    semantic_model = os.getenv("SEMANTIC_MODEL", DEFAULT_EMBEDDING_MODEL)
+    semantic_index_dir = os.getenv("SEMANTIC_INDEX_DIR", DEFAULT_INDEX_DIR)
+    fast_path_intents = parse_enabled_intents(os.getenv("FAST_PATH_INTENTS", "off")) # Ex.: 'endereco,horarios' ou 'all'
+    answer_cache_backend = os.getenv("ANSWER_CACHE", session_store_backend).lower() # 'memory', 'redis' ou 'off'
+    answer_cache_ttl_seconds = int(os.getenv("ANSWER_CACHE_TTL_SECONDS", "3600"))
+    answer_cache_max_entries = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "1000"))
+    slot_holds_backend = os.getenv("SLOT_HOLDS", session_store_backend).lower() # 'memory', 'redis' ou 'off'
+    slot_hold_ttl_seconds = int(os.getenv("SLOT_HOLD_TTL_SECONDS", "600")) # Reserva provisória dos horários apresentados
+    knowledge_watch_interval = float(os.getenv("KNOWLEDGE_WATCH_INTERVAL_SECONDS", "5")) # Hot reload de knowledge_base.json
+    slot_refresh_interval = float(os.getenv("SLOT_REFRESH_INTERVAL_SECONDS", "30")) # Visão de slots atualizada em background (0: desliga)
+    knowledge_snapshot_enabled = os.getenv("KNOWLEDGE_SNAPSHOT", "true").lower() == "true" # Snapshot compilado para partida rápida
+    knowledge_snapshot_path = os.getenv("KNOWLEDGE_SNAPSHOT_PATH") # Padrão: knowledge_base.snapshot.pkl
+    tenants_file = os.getenv("TENANTS_FILE") # Várias clínicas numa implantação (roteadas pelo número 'To' do Twilio)
+    default_tenant_id = os.getenv("DEFAULT_TENANT") # Clínica para números não configurados (padrão: nenhuma, com TENANTS_FILE)
+    max_loaded_tenants = int(os.getenv("MAX_LOADED_TENANTS", str(DEFAULT_MAX_LOADED_TENANTS)))
 
     required_vars = {
         "TWILIO_ACCOUNT_SID": twilio_account_sid, "TWILIO_AUTH_TOKEN": twilio_auth_token,
         "TWILIO_WHATSAPP_NUMBER": twilio_whatsapp_number, "OPENAI_API_KEY": openai_api_key,
-        "CALDAV_URL": caldav_url, "CALDAV_USERNAME": caldav_username,
-        "CALDAV_PASSWORD": caldav_password, "CALDAV_CALENDAR_NAME": caldav_calendar_name,
     }
+    if not tenants_file: # Sem arquivo de clínicas, o CalDAV da clínica padrão é obrigatório
+        required_vars.update({
+            "CALDAV_URL": caldav_url, "CALDAV_USERNAME": caldav_username,
+            "CALDAV_PASSWORD": caldav_password, "CALDAV_CALENDAR_NAME": caldav_calendar_name,
+        })
     missing_vars = [key for key, value in required_vars.items() if not value]
     if missing_vars:
         raise ValueError(f"Variáveis de ambiente essenciais faltando: {', '.join(missing_vars)}")
@@ -95,25 +126,34 @@ try:
     twilio_client = TwilioClient(twilio_account_sid, twilio_auth_token)
     logger.info("Cliente Twilio inicializado.")
 
+    logger.info("Carregando configuração das clínicas...")
+    default_tenant_config = TenantConfig(
+        tenant_id=DEFAULT_TENANT_ID, whatsapp_number=twilio_whatsapp_number, knowledge_base_path="knowledge_base.json",
+        persona_name=margot_persona_name, clinic_name=clinic_name, doctor_name=os.getenv("DOCTOR_NAME"),
+        timezone=default_timezone, caldav_url=caldav_url, caldav_username=caldav_username,
+        caldav_password=caldav_password, caldav_calendar_name=caldav_calendar_name,
+        relationship_number=os.getenv("RELATIONSHIP_TEAM_WHATSAPP")
+    )
+    if tenants_file:
+        tenant_configs = load_tenant_configs(tenants_file, default_tenant_config)
+    else: # Implantação de uma clínica só: todos os números vão para a clínica das variáveis de ambiente
+        tenant_configs = [default_tenant_config]
+        default_tenant_id = default_tenant_id or DEFAULT_TENANT_ID
+    for tenant_config in tenant_configs: pytz.timezone(tenant_config.timezone) # Falha cedo com timezone inválido
+    logger.info(f"{len(tenant_configs)} clínica(s) configurada(s): {', '.join(config.tenant_id for config in tenant_configs)}.")
+
+    semantic_encoder = None
+    if semantic_search_enabled:
+        try:
+            semantic_encoder = sentence_transformer_encoder(semantic_model) # Modelo carregado uma vez, compartilhado pelas clínicas
+            logger.info(f"Busca semântica ativada (modelo: {semantic_model}, índices em: {semantic_index_dir}).")
+        except Exception as e_sem: # Dependência opcional ausente ou modelo indisponível: segue só com BM25
+            logger.error(f"Busca semântica solicitada mas indisponível: {e_sem}. Seguindo apenas com busca por palavras.")
+
     logger.info("Inicializando Handler OpenAI...")
-    openai_handler = OpenAIHandler(api_key=openai_api_key)
+    openai_handler = OpenAIHandler(api_key=openai_api_key) # Pool compartilhado; cada clínica usa openai_handler.for_tenant()
     logger.info("Handler OpenAI inicializado.")
 
-    logger.info("Inicializando Handler da Base de Conhecimento...")
-    knowledge_handler = KnowledgeHandler(json_file_path="knowledge_base.json")
-    if not knowledge_handler.data:
-        raise RuntimeError("Base de conhecimento (knowledge_base.json) não encontrada ou inválida.")
-    logger.info("Handler da Base de Conhecimento inicializado.")
-
-    logger.info("Inicializando Handler CalDAV...")
-    caldav_handler = CaldavHandler(
-        url=caldav_url,
-        username=caldav_username,
-        password=caldav_password,
-        calendar_name=caldav_calendar_name
-    )
-    logger.info("Handler CalDAV inicializado e conectado.")
-
 except (RuntimeError, ConnectionError, ValueError) as e: # Captura erros específicos de inicialização
     logger.critical(f"Falha CRÍTICA ao inicializar handlers: {e}", exc_info=True)
     exit(1)
@@ -124,45 +164,136 @@ except Exception as e: # Captura qualquer outro erro inesperado
 # --- Criação da Aplicação FastAPI ---
 app = FastAPI(
     title="Margot Clinic Assistant API",
-    description=f"API para gerenciar interações via WhatsApp com a assistente Margot ({clinic_name}).",
-    version="1.0.3" # Versão com busca direta de slots e correção GPT call
+    description=f"API para gerenciar interações via WhatsApp com a assistente {margot_persona_name} (uma ou mais clínicas).",
+    version="1.2.0" # Busca de horários paginada ("mais opções")
 )
 logger.info("Aplicação FastAPI criada.")
 
+@app.on_event("startup")
+async def startup_handlers():
+    try:
+        await session_store.check() # Redis configurado mas inacessível: falha já na subida, não perde sessões em silêncio
+    except Exception as e:
+        logger.critical(f"Falha CRÍTICA: armazenamento de sessões ({type(session_store).__name__}) inacessível: {e}")
+        raise
+    session_store.start()
+    if tenant_registry.default_config: # As demais clínicas são carregadas na primeira mensagem
+        try:
+            await tenant_registry.preload(tenant_registry.default_config.tenant_id)
+            logger.info(f"Clínica padrão '{tenant_registry.default_config.tenant_id}' carregada (base + CalDAV).")
+        except TenantLoadError as e:
+            logger.critical(f"Falha CRÍTICA ao carregar a clínica padrão: {e}", exc_info=True)
+            raise
+
+@app.on_event("shutdown")
+async def shutdown_handlers():
+    await tenant_registry.aclose()
+    logger.info("Clínicas descarregadas (watchers da base e pools HTTP do CalDAV encerrados).")
+    await openai_handler.aclose()
+    logger.info("Pool HTTP da OpenAI encerrado.")
+    await outbound_queue.aclose()
+    logger.info("Fila de saída esvaziada.")
+    await session_store.aclose()
+    logger.info("Armazenamento de sessões encerrado.")
+
 # --- Gerenciamento de Conversa e Estados ---
-conversation_sessions: Dict[str, Dict[str, Any]] = {}
 MAX_HISTORY_LENGTH = 15
 DEFAULT_SESSION_STATE = {
     "history": [],
     "scheduling_status": None, # Controla o fluxo principal
     "patient_data": {}, # Guarda nome, tel, email, proc, indic
     "suggested_slots": [], # Lista de datetimes dos slots sugeridos
+    "slot_cursor": None, # Paginação da busca de slots: {origin, next_start, duration, block, preferences} ("mais opções" continua daqui)
+    "slot_preferences": None, # Preferências de horário do paciente (SlotPreferences.to_dict()), ex.: "quinta de manhã"
     "chosen_slot": None, # Datetime do slot escolhido pelo usuário
     "event_to_modify": None, # Guarda detalhes do evento para cancelar/reagendar {id, summary, start, end}
     "multiple_events_found": [], # Lista de eventos se mais de um for encontrado para cancelar/reagendar
+    "current_topic": None, # Procedimento em discussão (atualizado a cada turno; resolve "fale mais disso")
 }
 
-# --- Funções Helper ---
+# Sessões persistidas fora do processo (Redis) para permitir vários workers sem sticky sessions
+if session_store_backend == "memory":
+    session_store: SessionStore = InMemorySessionStore(
+        DEFAULT_SESSION_STATE, tz=pytz.timezone(default_timezone),
+        max_entries=session_max_entries, idle_timeout_seconds=session_ttl_seconds
+    )
+else:
+    session_store = RedisSessionStore(DEFAULT_SESSION_STATE, redis_url, ttl_seconds=session_ttl_seconds, tz=pytz.timezone(default_timezone))
+logger.info(f"Armazenamento de sessões: {type(session_store).__name__}.")
+
+# --- Clínicas (base, persona, CalDAV e fast-path por clínica; carregadas sob demanda, LRU) ---
+async def load_tenant(config: TenantConfig) -> Tenant:
+    """Carrega uma clínica: base + índices (em thread), CalDAV conectado, persona e fast-path próprios."""
+    is_default = config.tenant_id == DEFAULT_TENANT_ID
+    semantic_index = None
+    if semantic_encoder is not None:
+        index_dir = semantic_index_dir if is_default else os.path.join(semantic_index_dir, config.tenant_id)
+        semantic_index = SemanticIndex(semantic_encoder, semantic_model, index_dir)
+    knowledge_handler = await asyncio.to_thread(
+        KnowledgeHandler, json_file_path=config.knowledge_base_path, semantic_index=semantic_index,
+        watch_interval_seconds=knowledge_watch_interval, use_snapshot=knowledge_snapshot_enabled,
+        snapshot_path=knowledge_snapshot_path if is_default else None
+    )
+    if not knowledge_handler.data:
+        raise RuntimeError(f"Base de conhecimento ({config.knowledge_base_path}) não encontrada ou inválida.")
+    caldav_handler = AsyncCaldavHandler(
+        url=config.caldav_url,
+        username=config.caldav_username,
+        password=config.caldav_password,
+        calendar_name=config.caldav_calendar_name,
+        timezone=config.timezone,
+        busy_max_age_seconds=slot_refresh_interval # Buscas entre duas atualizações usam o índice local, sem ida ao CalDAV
+    )
+    try:
+        await caldav_handler.connect()
+    except Exception:
+        await caldav_handler.aclose()
+        raise
+    knowledge_handler.start_watching()
+    if slot_refresh_interval > 0:
+        caldav_handler.start_slot_refresh(slot_refresh_interval, lambda: default_slot_search_kwargs(knowledge_handler))
+    return Tenant(
+        config, knowledge_handler,
+        openai_handler.for_tenant(knowledge_handler, persona_name=config.persona_name, clinic_name=config.clinic_name, doctor_name=config.doctor_name),
+        caldav_handler,
+        FastPathResponder(knowledge_handler, fast_path_intents, persona_name=config.persona_name, clinic_name=config.clinic_name)
+    )
 
-def get_session(sender_id: str) -> Dict[str, Any]:
-    """ Obtém a sessão do usuário ou inicializa uma nova. """
-    if sender_id not in conversation_sessions:
-        import copy
-        conversation_sessions[sender_id] = copy.deepcopy(DEFAULT_SESSION_STATE)
-        logger.info(f"Nova sessão criada para {sender_id}")
-        # Recupera dados do paciente se existirem
-        try:
-            import redis
-            redis_client = redis.Redis(host='localhost', port=6379, decode_responses=True)
-            redis_key = f"memoria:{sender_id}"
-            if redis_client.exists(redis_key):
-                saved_data = redis_client.hgetall(redis_key)
-                if saved_data:
-                    conversation_sessions[sender_id]["patient_data"].update(saved_data)
-                    logger.info(f"[{sender_id}] Dados anteriores do paciente carregados da memória Redis.")
-        except Exception as e_redis_load:
-            logger.error(f"[{sender_id}] Erro ao carregar memória do Redis: {e_redis_load}", exc_info=True)
-    return conversation_sessions[sender_id]
+tenant_registry = TenantRegistry(tenant_configs, load_tenant, max_loaded=max_loaded_tenants, default_tenant_id=default_tenant_id)
+logger.info(f"Fast-path ativo para: {', '.join(sorted(fast_path_intents)) or 'nenhuma intenção'}.")
+
+# --- Cache de Respostas (perguntas repetidas sobre a base: endereço, valor, convênios...) ---
+answer_cache: Optional[AnswerCache] = None
+if answer_cache_backend == "redis" and isinstance(session_store, RedisSessionStore):
+    answer_cache = RedisAnswerCache(session_store.redis, ttl_seconds=answer_cache_ttl_seconds) # Mesmo pool das sessões
+elif answer_cache_backend in ("memory", "redis"):
+    answer_cache = InMemoryAnswerCache(ttl_seconds=answer_cache_ttl_seconds, max_entries=answer_cache_max_entries)
+logger.info(f"Cache de respostas: {type(answer_cache).__name__ if answer_cache else 'desativado'}.")
+
+# --- Reservas Provisórias de Horários (pacientes simultâneos não recebem os mesmos slots) ---
+slot_holds: Optional[SlotHolds] = None
+if slot_holds_backend == "redis" and isinstance(session_store, RedisSessionStore):
+    slot_holds = RedisSlotHolds(session_store.redis, ttl_seconds=slot_hold_ttl_seconds) # Mesmo pool das sessões
+elif slot_holds_backend in ("memory", "redis"):
+    slot_holds = InMemorySlotHolds(ttl_seconds=slot_hold_ttl_seconds)
+logger.info(f"Reservas de horários: {type(slot_holds).__name__ if slot_holds else 'desativadas'}.")
+
+def mentions_patient_name(text: str, patient_data: Dict[str, Any]) -> bool:
+    """Respostas que citam o nome do paciente não podem ser reaproveitadas para outras pessoas."""
+    name_parts = [part for part in str(patient_data.get("name") or "").lower().split() if len(part) > 2]
+    text_lower = text.lower()
+    return any(re.search(r'\b' + re.escape(part) + r'\b', text_lower) for part in name_parts)
+
+# --- Fila de Saída (mensagens longas divididas em partes) ---
+MAX_MSG_LENGTH = 1550
+OUTBOUND_FOLLOWUP_DELAY_SECONDS = 1.5 # Espera antes da 2ª parte, para a 1ª (TwiML) chegar antes
+
+def send_whatsapp_message(to: str, body: str, from_: Optional[str] = None):
+    twilio_client.messages.create(from_=from_ or twilio_whatsapp_number, body=body, to=to)
+
+outbound_queue = OutboundQueue(send_whatsapp_message)
+
+# --- Funções Helper ---
 
 def reset_session_scheduling(session: Dict[str, Any]):
     """ Reseta os campos relacionados ao agendamento na sessão. """
@@ -171,6 +302,8 @@ def reset_session_scheduling(session: Dict[str, Any]):
     session["scheduling_status"] = None
     session["patient_data"] = {}
     session["suggested_slots"] = []
+    session["slot_cursor"] = None
+    session["slot_preferences"] = None
     session["chosen_slot"] = None
     session["event_to_modify"] = None
     session["multiple_events_found"] = []
@@ -212,28 +345,107 @@ def normalizar_horario_para_dateparser(texto: str) -> str:
     return texto.strip()
 
 # --- Helper para Buscar e Apresentar Slots (Evita Duplicação) ---
-def find_and_present_slots(session: Dict[str, Any], sender_id: str) -> Tuple[str, bool]:
+SLOT_PAGE_SIZE = 5
+MORE_SLOTS_PATTERN = re.compile(
+    r"^\s*mais\s*[.!?]*\s*$|\b(mais|outr[oa]s|pr[oó]xim[oa]s)\s+(op[cç][oõ]es|hor[aá]rios|datas|dias)\b|\bnenhum[a]?\s+(desses|dessas|serve)\b",
+    re.IGNORECASE
+)
+
+def wants_more_slots(user_message: str) -> bool:
+    """'mais', 'mais opções', 'outros horários', 'nenhum desses'... pede a próxima página de horários."""
+    return bool(MORE_SLOTS_PATTERN.search(user_message))
+
+def slot_search_kwargs(rules: Dict[str, Any], duration_minutes: int, block_minutes: int) -> Dict[str, Any]:
+    """Parâmetros de find_available_slots derivados das regras de agendamento da clínica."""
+    return {
+        "num_slots_to_find": SLOT_PAGE_SIZE,
+        "consultation_duration_minutes": duration_minutes,
+        "block_duration_minutes": block_minutes,
+        "preferred_days": rules.get('preferred_days', [0, 1]),
+        "valid_start_hours": list(range(rules.get('start_hour', 14), rules.get('end_hour', 18))),
+        "working_hours": rules.get('working_hours'),
+        "holidays": rules.get('holidays', ()),
+    }
+
+def default_slot_search_kwargs(knowledge_handler: KnowledgeHandler) -> Dict[str, Any]:
+    """Busca padrão (duração sem procedimento específico), aquecida em background pela visão de slots."""
+    rules = knowledge_handler.get_scheduling_rules()
+    duration_minutes = rules.get('duration_minutes', 45)
+    return slot_search_kwargs(rules, duration_minutes, max(rules.get('block_minutes', 60), duration_minutes))
+
+async def find_and_present_slots(tenant: Tenant, session: Dict[str, Any], sender_id: str, more: bool = False,
+                                 preferences: Optional[SlotPreferences] = None) -> Tuple[str, bool]:
     """
     Busca slots no CalDAV, atualiza a sessão e retorna a mensagem formatada
     ou de erro, e um booleano indicando se OpenAI é necessária (sempre False aqui).
+    Com more=True continua do cursor da sessão (slot_cursor): a próxima página começa depois do último horário
+    mostrado, com a mesma origem da busca (o bitmap de ocupação em cache é reaproveitado, sem reler a agenda).
+    preferences (ex.: "quinta de manhã", "depois do dia 20") entram na própria busca; sem elas, vale a preferência
+    guardada na sessão (se o paciente já informou uma).
+    Horários reservados por outros pacientes ficam de fora; os apresentados ficam reservados para este (slot_holds).
     """
-    logger.info(f"[{sender_id}] Executando find_and_present_slots...")
+    if preferences is not None:
+        session["slot_preferences"] = preferences.to_dict()
+    logger.info(f"[{sender_id}] Executando find_and_present_slots (more={more}, preferências={session.get('slot_preferences')})...")
     try:
-        tz = pytz.timezone(default_timezone)
+        tz = pytz.timezone(tenant.config.timezone)
         now = datetime.datetime.now(tz)
-        rules = knowledge_handler.get_scheduling_rules()
-        logger.debug(f"[{sender_id}] Usando regras de agendamento: {rules}")
-        found_slots = caldav_handler.find_available_slots(
-            start_search_dt=now,
-            num_slots_to_find=5,
-            consultation_duration_minutes=rules.get('duration_minutes', 45),
-            block_duration_minutes=60,
-            preferred_days=rules.get('preferred_days', [0, 1]),
-            valid_start_hours=list(range(rules.get('start_hour', 14), rules.get('end_hour', 18)))
+        rules = tenant.knowledge_handler.get_scheduling_rules()
+        cursor = session.get("slot_cursor") if more else None
+        if cursor:
+            duration_minutes, block_minutes = cursor["duration"], cursor["block"]
+            search_origin, resume_after = cursor["origin"], max(cursor["next_start"], now)
+            preferences = SlotPreferences.from_dict(cursor.get("preferences"))
+        else:
+            preferences = SlotPreferences.from_dict(session.get("slot_preferences"))
+            duration_minutes = tenant.knowledge_handler.duration_for_procedure(session.get("patient_data", {}).get("procedure"), rules)
+            block_minutes = max(rules.get('block_minutes', 60), duration_minutes)
+            search_origin, resume_after = now, None
+        logger.debug(f"[{sender_id}] Usando regras de agendamento: {rules} (duração: {duration_minutes} min, cursor: {cursor})")
+        hold_owner = tenant.session_key(sender_id)
+        held_by_others = await slot_holds.held_by_others(tenant.tenant_id, hold_owner) if slot_holds else []
+        found_slots = await tenant.caldav_handler.find_available_slots(
+            start_search_dt=search_origin,
+            **slot_search_kwargs(rules, duration_minutes, block_minutes),
+            resume_after=resume_after,
+            preferences=preferences,
+            excluded_intervals=held_by_others
         )
-        found_slots = found_slots[:5]
+        found_slots = found_slots[:SLOT_PAGE_SIZE]
         logger.debug(f"[{sender_id}] Horários sugeridos pela busca: {[slot.isoformat() for slot in found_slots]}")
 
+        if preferences is not None and not found_slots and not more:
+            logger.info(f"[{sender_id}] Nenhum slot atende às preferências {preferences}.")
+            no_match = f"Não encontrei horários livres {preferences.describe()}."
+            session["slot_preferences"] = None
+            if session.get("suggested_slots"):
+                response_parts = [no_match, "As opções que tenho são:"]
+                for i, slot_dt in enumerate(session["suggested_slots"]): response_parts.append(f"{i+1}. {format_datetime_ptbr(slot_dt)}")
+                response_parts.append("\nQual você prefere? (Ou me diga outro dia/período, ex.: 'terça à tarde'.)")
+                session["scheduling_status"] = "awaiting_choice"
+                return "\n".join(response_parts), False
+            margot_response, openai_needed = await find_and_present_slots(tenant, session, sender_id)
+            return f"{no_match}\n\n{margot_response}", openai_needed
+
+        if more and not found_slots and session.get("suggested_slots"):
+            # Fim da agenda no horizonte: mantém a página atual para o paciente escolher
+            response_parts = ["Não encontrei outros horários disponíveis nas próximas semanas. As opções que tenho são:"]
+            for i, slot_dt in enumerate(session["suggested_slots"]): response_parts.append(f"{i+1}. {format_datetime_ptbr(slot_dt)}")
+            response_parts.append("\nQual você prefere?")
+            session["scheduling_status"] = "awaiting_choice"
+            return "\n".join(response_parts), False
+
+        if found_slots:
+            session["slot_cursor"] = {
+                "origin": search_origin, "next_start": found_slots[-1] + datetime.timedelta(minutes=1),
+                "duration": duration_minutes, "block": block_minutes,
+                "preferences": preferences.to_dict() if preferences else None,
+            }
+        if slot_holds is not None:
+            # Página nova: devolve os horários da anterior e reserva os novos (quem reservar primeiro fica com o horário)
+            await slot_holds.release(tenant.tenant_id, hold_owner, [slot for slot in session.get("suggested_slots") or [] if slot not in found_slots])
+            found_slots = await slot_holds.hold(tenant.tenant_id, hold_owner, found_slots, block_minutes)
+
         # Salva os slots encontrados na sessão ANTES de formatar a mensagem
         session["suggested_slots"] = found_slots
 
@@ -245,10 +457,13 @@ def find_and_present_slots(session: Dict[str, Any], sender_id: str) -> Tuple[str
                 slot_options_list.append({"index": i + 1, "datetime": slot_dt.isoformat(), "formatted": formatted_dt})
 
             # Formata a mensagem de apresentação
-            response_parts = ["Perfeito! Com base nas informações, aqui estão os próximos horários disponíveis:"]
+            if preferences is not None: intro = f"Encontrei estes horários {preferences.describe()}:"
+            elif more: intro = "Claro! Aqui estão os próximos horários disponíveis:"
+            else: intro = "Perfeito! Com base nas informações, aqui estão os próximos horários disponíveis:"
+            response_parts = [intro]
             for slot_info in slot_options_list:
                 response_parts.append(f"{slot_info['index']}. {slot_info['formatted']}")
-            response_parts.append("\nQual horário você prefere? (Responda com o número ou descreva o horário)")
+            response_parts.append("\nQual horário você prefere? (Responda com o número ou descreva o horário. Se nenhum servir, responda *mais* para ver outras opções.)")
             margot_response_final = "\n".join(response_parts)
 
             # Define o próximo estado como 'awaiting_choice'
@@ -272,16 +487,38 @@ def find_and_present_slots(session: Dict[str, Any], sender_id: str) -> Tuple[str
 
 # --- Endpoint Principal /whatsapp ---
 @app.post("/whatsapp", tags=["Twilio"], summary="Recebe e responde mensagens do WhatsApp com fluxo de agendamento completo")
-async def whatsapp_webhook(request: Request, From: str = Form(...), Body: str = Form(...)):
+async def whatsapp_webhook(request: Request, From: str = Form(...), Body: str = Form(...), To: str = Form("")):
     sender_id = From
     user_message = Body.strip()
-    logger.info(f"Msg Recebida | De: {sender_id} | Estado Atual: {conversation_sessions.get(sender_id, {}).get('scheduling_status')} | Mensagem: '{user_message}'")
 
     if not user_message:
          logger.warning(f"Mensagem vazia recebida de {sender_id}. Ignorando.")
          return Response(content=str(MessagingResponse()), media_type="application/xml")
 
-    session = get_session(sender_id)
+    # A clínica é identificada pelo número que recebeu a mensagem ('To'); mensagens do mesmo remetente para a mesma
+    # clínica são processadas em ordem (lock por sessão); remetentes distintos seguem em paralelo
+    try:
+        async with tenant_registry.lease(To) as tenant:
+            if tenant is None:
+                logger.warning(f"Mensagem de {sender_id} para número sem clínica configurada ({To}). Ignorando.")
+                return Response(content=str(MessagingResponse()), media_type="application/xml")
+            async with session_store.lock(tenant.session_key(sender_id)):
+                return await process_whatsapp_message(tenant, sender_id, user_message)
+    except TenantLoadError as e_tenant:
+        logger.error(f"[{sender_id}] {e_tenant}", exc_info=True)
+        error_twiml = MessagingResponse(); error_twiml.message("Desculpe, estamos com uma instabilidade no momento. Por favor, tente novamente em alguns minutos.")
+        return Response(content=str(error_twiml), media_type="application/xml")
+    except SessionLockTimeout as e_lock:
+        logger.error(f"[{sender_id}] {e_lock}. Mensagem não processada: '{user_message}'")
+        busy_twiml = MessagingResponse(); busy_twiml.message("Ainda estou processando sua mensagem anterior. Por favor, envie novamente em instantes.")
+        return Response(content=str(busy_twiml), media_type="application/xml")
+
+async def process_whatsapp_message(tenant: Tenant, sender_id: str, user_message: str) -> Response:
+    """ Processa uma mensagem já validada para a clínica 'tenant'. Chamado com o lock da sessão do remetente adquirido. """
+    knowledge_handler, caldav_handler = tenant.knowledge_handler, tenant.caldav_handler
+    session_key = tenant.session_key(sender_id)
+    session = await session_store.load(session_key)
+    logger.info(f"Msg Recebida | De: {sender_id} | Estado Atual: {session.get('scheduling_status')} | Mensagem: '{user_message}'")
     session_history = session["history"]
     current_status = session["scheduling_status"]
     patient_data = session["patient_data"]
@@ -304,6 +541,8 @@ async def whatsapp_webhook(request: Request, From: str = Form(...), Body: str =
             if intent_schedule:
                 logger.info(f"[{sender_id}] Intenção de AGENDAR detectada.")
                 session["scheduling_status"] = "awaiting_name"
+                preferences = parse_slot_preferences(user_message, datetime.datetime.now(pytz.timezone(tenant.config.timezone)).date())
+                if preferences: session["slot_preferences"] = preferences.to_dict() # Ex.: "quero agendar uma consulta na quinta de manhã"
                 margot_response_final = "Claro! Será um prazer ajudar com o agendamento. Para começar, pode me informar o seu nome completo, por favor?"
                 openai_call_needed = False
             elif intent_reschedule:
@@ -318,14 +557,35 @@ async def whatsapp_webhook(request: Request, From: str = Form(...), Body: str =
                  openai_call_needed = False
             else:
                 logger.debug(f"[{sender_id}] Nenhuma intenção de agendamento explícita. Buscando RAG...")
-                relevant_knowledge = knowledge_handler.find_relevant_info(query=user_message, conversation_history=session_history)
+                relevant_knowledge = knowledge_handler.find_relevant_info(query=user_message, current_topic=session.get("current_topic"))
                 if relevant_knowledge: logger.info(f"[{sender_id}] Conhecimento relevante (RAG) encontrado.")
                 else: logger.info(f"[{sender_id}] Nenhum conhecimento relevante (RAG) encontrado.")
 
-                margot_response_final = openai_handler.get_chat_response(
-                    user_message=user_message, conversation_history=session_history,
-                    relevant_knowledge=relevant_knowledge, current_schedule_state=current_status
-                )
+                # Intenções factuais (endereço, horários, links, contato, valor) respondidas direto do template
+                block_key = knowledge_handler.cacheable_block_key(relevant_knowledge)
+                fast_reply = tenant.fast_path.respond(user_message, relevant_knowledge, first_turn=not session_history)
+                if fast_reply:
+                    logger.info(f"[{sender_id}] Resposta direta (fast-path, bloco '{block_key}'). OpenAI não chamada.")
+                    margot_response_final = fast_reply
+                else:
+                    # Perguntas de bloco único (endereço, valor, convênio, FAQ...) reaproveitam a resposta já gerada
+                    cache_key = None
+                    cached_answer = None
+                    if answer_cache is not None and block_key:
+                        cache_key = answer_cache_key(knowledge_handler.data_mtime, block_key, current_status, first_turn=not session_history,
+                                                     question=user_message, tenant_id=tenant.tenant_id)
+                        cached_answer = await answer_cache.get(cache_key)
+
+                    if cached_answer:
+                        logger.info(f"[{sender_id}] Resposta servida do cache (bloco '{block_key}'). OpenAI não chamada.")
+                        margot_response_final = cached_answer
+                    else:
+                        margot_response_final = await tenant.openai_handler.get_chat_response(
+                            user_message=user_message, conversation_history=session_history,
+                            relevant_knowledge=relevant_knowledge, current_schedule_state=current_status
+                        )
+                        if cache_key and margot_response_final not in FALLBACK_RESPONSES and not mentions_patient_name(margot_response_final, patient_data):
+                            await answer_cache.set(cache_key, margot_response_final)
                 openai_call_needed = False
 
         # --- 2. COLETA DE DADOS SEQUENCIAL (AGENDAMENTO) ---
@@ -380,7 +640,7 @@ async def whatsapp_webhook(request: Request, From: str = Form(...), Body: str =
             logger.info(f"[{sender_id}] Coleta de dados concluída (Indicação: '{patient_data['indication']}'). Iniciando busca de horários diretamente...")
 
             # --- EXECUTA A BUSCA DE SLOTS DIRETAMENTE ---
-            margot_response_final, openai_call_needed = find_and_present_slots(session, sender_id)
+            margot_response_final, openai_call_needed = await find_and_present_slots(tenant, session, sender_id)
             # O estado da sessão (scheduling_status) é atualizado dentro de find_and_present_slots
 
         # --- 4. RECEBER ESCOLHA DO HORÁRIO ---
@@ -388,12 +648,17 @@ async def whatsapp_webhook(request: Request, From: str = Form(...), Body: str =
             logger.debug(f"[{sender_id}] Estado: awaiting_choice. Analisando resposta: '{user_message}'")
             suggested_slots = session.get("suggested_slots", [])
             matched_slot = None
-            tz = pytz.timezone(default_timezone)
+            tz = pytz.timezone(tenant.config.timezone)
+            # "quinta de manhã", "depois do dia 20": só vira nova busca se a mensagem não escolher um horário da lista
+            preferences = parse_slot_preferences(user_message, datetime.datetime.now(tz).date())
 
             if not suggested_slots:
                  logger.warning(f"[{sender_id}] Chegou em awaiting_choice sem suggested_slots na sessão! Tentando buscar novamente...")
-                 margot_response_final, openai_call_needed = find_and_present_slots(session, sender_id)
+                 margot_response_final, openai_call_needed = await find_and_present_slots(tenant, session, sender_id)
                  pass # Pula o resto da lógica deste estado
+            elif wants_more_slots(user_message):
+                logger.info(f"[{sender_id}] Paciente pediu mais opções de horário. Continuando do cursor da busca.")
+                margot_response_final, openai_call_needed = await find_and_present_slots(tenant, session, sender_id, more=True)
             else:
                 logger.debug(f"[{sender_id}] Slots sugeridos na sessão para escolha: {[s.isoformat() for s in suggested_slots]}")
                 # --- ESTRATÉGIA DE MATCHING EM CAMADAS ---
@@ -408,8 +673,16 @@ async def whatsapp_webhook(request: Request, From: str = Form(...), Body: str =
                     except (ValueError, IndexError):
                         logger.debug(f"[{sender_id}] Número '{match_num.group(1)}' inválido ou fora do range.")
 
-                # 2. Tentar Correspondência de Palavras-Chave/Data Parcial
+                # 1b. Ordinal ('a segunda', 'o último') ou data de um horário da lista ('dia 20', '20/10')
                 if not matched_slot:
+                    listed_idx = match_listed_slot(user_message, suggested_slots)
+                    if listed_idx is not None:
+                        matched_slot = suggested_slots[listed_idx]
+                        logger.info(f"[{sender_id}] Slot escolhido por ORDINAL/DATA da lista: {listed_idx+1}")
+
+                # Daqui em diante o matching é aproximado: preferência explícita vira nova busca (passo 5)
+                # 2. Tentar Correspondência de Palavras-Chave/Data Parcial
+                if not matched_slot and preferences is None:
                     logger.debug(f"[{sender_id}] Tentando match por palavras-chave/data parcial...")
                     normalized_msg = user_message.lower()
                     normalized_msg = re.sub(r"[^\w\s\:]", "", normalized_msg)
@@ -439,7 +712,7 @@ async def whatsapp_webhook(request: Request, From: str = Form(...), Body: str =
                             logger.debug(f"[{sender_id}] Match por palavras-chave ambíguo ou score baixo. Melhores scores: {[p['score'] for p in possible_matches]}")
 
                 # 3. Tentar dateparser (NÃO estrito) + Tolerância
-                if not matched_slot:
+                if not matched_slot and preferences is None:
                     logger.debug(f"[{sender_id}] Tentando match com dateparser (não-estrito)...")
                     try:
                         normalized_message_dp = normalizar_horario_para_dateparser(user_message)
@@ -466,7 +739,7 @@ async def whatsapp_webhook(request: Request, From: str = Form(...), Body: str =
                     except Exception as e_dp: logger.warning(f"[{sender_id}] Erro no dateparser: {e_dp}", exc_info=False)
 
                 # 4. Fallback: Tentar GPT (CORRIGIDO)
-                if not matched_slot:
+                if not matched_slot and preferences is None:
                     logger.debug(f"[{sender_id}] Tentando match com GPT (fallback)...")
                     try:
                         horario_lista_texto = "\n".join([f"{i+1}. {format_datetime_ptbr(slot)}" for i, slot in enumerate(suggested_slots)])
@@ -476,12 +749,12 @@ async def whatsapp_webhook(request: Request, From: str = Form(...), Body: str =
                             f"Qual NÚMERO da opção o paciente escolheu? Responda SÓ o número (1, 2, 3...) ou 0 se incerto."
                         )
                         # --- CHAMADA CORRIGIDA COM KEYWORD ARGUMENTS ---
-                        resposta_gpt = openai_handler.get_chat_response(
+                        resposta_gpt = (await tenant.openai_handler.get_chat_response(
                             user_message=pergunta,
                             conversation_history=[], # Histórico vazio para esta análise específica
                             patient_data=patient_data, # Passa o dicionário
                             current_schedule_state="awaiting_choice" # Passa o estado
-                        ).strip()
+                        )).strip()
                         # --- FIM DA CORREÇÃO ---
                         logger.debug(f"[{sender_id}] Resposta bruta do GPT para escolha: '{resposta_gpt}'")
                         match_gpt_num = re.search(r"\b(\d+)\b", resposta_gpt)
@@ -505,6 +778,10 @@ async def whatsapp_webhook(request: Request, From: str = Form(...), Body: str =
                     session["scheduling_status"] = "awaiting_confirmation"
                     openai_call_needed = False
                     logger.info(f"[{sender_id}] Match bem sucedido. Indo para confirmação do slot: {matched_slot.isoformat()}")
+                elif preferences is not None:
+                    # 5. Nenhum horário da lista escolhido: a mensagem é uma preferência nova
+                    logger.info(f"[{sender_id}] Paciente indicou preferência de horário ({preferences.describe()}). Nova busca restrita.")
+                    margot_response_final, openai_call_needed = await find_and_present_slots(tenant, session, sender_id, preferences=preferences)
                 else:
                     # Se NENHUMA estratégia funcionou
                     logger.warning(f"[{sender_id}] Falha em todas as estratégias de matching para: '{user_message}'. Pedindo para reformular.")
@@ -523,30 +800,31 @@ async def whatsapp_webhook(request: Request, From: str = Form(...), Body: str =
             if not chosen_dt or not isinstance(chosen_dt, datetime.datetime):
                 logger.error(f"[{sender_id}] Erro crítico: 'awaiting_confirmation' sem 'chosen_slot'!")
                 margot_response_final = "Desculpe, erro interno. Não lembro o horário. Vamos buscar de novo?"
-                margot_response_final, openai_call_needed = find_and_present_slots(session, sender_id)
+                margot_response_final, openai_call_needed = await find_and_present_slots(tenant, session, sender_id)
             else:
                 confirmation_positive = re.search(r"\b(sim|s|ok|positivo|confirmo|confirmado|pode ser|pode)\b", user_message, re.IGNORECASE)
                 confirmation_negative = re.search(r"\b(n[aã]o|cancela|errado|mudar|outro|nao)\b", user_message, re.IGNORECASE)
+                preferences = parse_slot_preferences(user_message, datetime.datetime.now(chosen_dt.tzinfo).date())
+                if preferences is not None and preferences.accepts(chosen_dt): preferences = None # "sim, quinta" confirma o horário escolhido
 
-                if confirmation_positive:
+                if confirmation_positive and preferences is None:
                     logger.info(f"[{sender_id}] Confirmação recebida para {format_datetime_ptbr(chosen_dt)}. Agendando...")
-                    rules = knowledge_handler.get_scheduling_rules()
-                    duration_minutes = rules.get('duration_minutes', 45)
+                    duration_minutes = (session.get("slot_cursor") or {}).get("duration") or knowledge_handler.duration_for_procedure(patient_data.get("procedure"))
                     end_time_dt = chosen_dt + datetime.timedelta(minutes=duration_minutes)
                     try:
                         # A chamada abaixo assume que caldav_handler.py foi corrigido para aceitar 'patient_email'
                         # Início do bloco try para salvar dados e confirmar agendamento
-                        success, message = caldav_handler.book_appointment(
+                        success, message = await caldav_handler.book_appointment(
                             start_time=chosen_dt, end_time=end_time_dt,
                             patient_name=patient_data.get("name"), patient_contact=patient_data.get("phone"),
                             patient_email=patient_data.get("email"), indication_source=patient_data.get("indication"),
                             procedure_interest=patient_data.get("procedure")
                         )
+                        if slot_holds is not None: # Agendado: libera a página inteira; horário perdido: libera só ele
+                            released_slots = (session.get("suggested_slots") or [chosen_dt]) if success else [chosen_dt]
+                            await slot_holds.release(tenant.tenant_id, session_key, released_slots)
                         if success:
                             try:
-                                import redis
-                                redis_client = redis.Redis(host='localhost', port=6379, decode_responses=True)
-                                redis_key = f"memoria:{sender_id}"
                                 redis_data = {
                                     "name": patient_data.get("name"),
                                     "phone": patient_data.get("phone"),
@@ -555,7 +833,7 @@ async def whatsapp_webhook(request: Request, From: str = Form(...), Body: str =
                                     "indication": patient_data.get("indication"),
                                     "last_datetime": chosen_dt.isoformat()
                                 }
-                                redis_client.hset(redis_key, mapping=redis_data)
+                                await session_store.save_patient_memory(session_key, redis_data)
                                 logger.info(f"[{sender_id}] Dados do paciente salvos na memória Redis.")
                             except Exception as e_redis:
                                 logger.error(f"[{sender_id}] Erro ao salvar dados no Redis: {e_redis}", exc_info=True)
@@ -565,15 +843,15 @@ async def whatsapp_webhook(request: Request, From: str = Form(...), Body: str =
                                 f"{patient_data.get('name', 'Sua consulta')} foi agendada com sucesso para:\n"
                                 f"*{format_datetime_ptbr(chosen_dt)}*\n\n"
                                 f"Procedimento/Interesse: {patient_data.get('procedure', 'Avaliação Geral')}\n"
-                                f"Com o Dr. Juarez Missel.\n\n"
-                                f"📍 *Endereço:* {knowledge_handler._format_address() or 'Rua Coronel Gabriel Bastos, 371 – Passo Fundo/RS'}\n"
+                                f"Com o {tenant.doctor_name}.\n\n"
+                                f"📍 *Endereço:* {knowledge_handler.clinic_address or tenant.clinic_name}\n"
                                 f"⏰ *Lembrete:* Chegue com 15 minutos de antecedência.\n"
                                 f"📋 Se estiver usando medicamentos, leve a lista.\n"
                                 f"🧾 Se tiver exames relacionados, leve-os também.\n\n"
-                                f"Qualquer dúvida, estou à disposição. A {clinic_name} agradece a confiança!"
+                                f"Qualquer dúvida, estou à disposição. A {tenant.clinic_name} agradece a confiança!"
                             )
                             # Envio da confirmação para a equipe de relacionamento
-                            relationship_number = os.getenv("RELATIONSHIP_TEAM_WHATSAPP")
+                            relationship_number = tenant.config.relationship_number
                             if relationship_number:
                                 try:
                                     team_msg = (
@@ -585,12 +863,9 @@ async def whatsapp_webhook(request: Request, From: str = Form(...), Body: str =
                                         f"💬 Procedimento: {patient_data.get('procedure', 'Não informado')}\n"
                                         f"🔁 Indicação: {patient_data.get('indication', 'Não informado')}"
                                     )
-                                    twilio_client.messages.create(
-                                        from_=twilio_whatsapp_number,
-                                        to=relationship_number,
-                                        body=team_msg
-                                    )
-                                    logger.info(f"[{sender_id}] Mensagem enviada para a equipe de relacionamento.")
+                                    # Fila de saída: envio em thread (não bloqueia o event loop), com retry
+                                    outbound_queue.enqueue(relationship_number, [team_msg], initial_delay=0, from_=tenant.config.whatsapp_number)
+                                    logger.info(f"[{sender_id}] Mensagem para a equipe de relacionamento enfileirada.")
                                 except Exception as e_notify:
                                     logger.error(f"[{sender_id}] Erro ao notificar equipe de relacionamento: {e_notify}", exc_info=True)
                             session = reset_session_scheduling(session)
@@ -612,27 +887,31 @@ async def whatsapp_webhook(request: Request, From: str = Form(...), Body: str =
                                     openai_call_needed = False
                                 else: # Se não sobraram, busca novamente
                                      margot_response_final += " Não encontrei mais opções naquela busca. Vou verificar novamente..."
-                                     margot_response_final, openai_call_needed = find_and_present_slots(session, sender_id)
+                                     margot_response_final, openai_call_needed = await find_and_present_slots(tenant, session, sender_id, more=True)
                             else: # Se não tinha lista, busca novamente
                                 margot_response_final += " Vou verificar novamente a disponibilidade..."
-                                margot_response_final, openai_call_needed = find_and_present_slots(session, sender_id)
+                                margot_response_final, openai_call_needed = await find_and_present_slots(tenant, session, sender_id)
                     except Exception as e_book:
                         logger.error(f"[{sender_id}] Erro CRÍTICO em book_appointment: {e_book}", exc_info=True)
                         margot_response_final = "Desculpe, erro técnico grave ao confirmar. Equipe notificada."
                         session = reset_session_scheduling(session)
                         openai_call_needed = False
-                elif confirmation_negative:
+                elif confirmation_negative or preferences is not None or wants_more_slots(user_message):
                     logger.info(f"[{sender_id}] Usuário NÃO confirmou. Voltando para escolha.")
                     session["scheduling_status"] = "awaiting_choice"
                     session["chosen_slot"] = None
-                    if session.get("suggested_slots"):
+                    if preferences is not None:
+                        margot_response_final, openai_call_needed = await find_and_present_slots(tenant, session, sender_id, preferences=preferences)
+                    elif wants_more_slots(user_message):
+                        margot_response_final, openai_call_needed = await find_and_present_slots(tenant, session, sender_id, more=True)
+                    elif session.get("suggested_slots"):
                         response_parts = ["Entendido. Vamos escolher outro.", "\nOpções:"]
                         for i, slot_dt in enumerate(session["suggested_slots"]): response_parts.append(f"{i+1}. {format_datetime_ptbr(slot_dt)}")
-                        response_parts.append("\nQual prefere?")
+                        response_parts.append("\nQual prefere? (Ou responda *mais* para ver outros horários.)")
                         margot_response_final = "\n".join(response_parts)
                     else:
                         margot_response_final = "Entendido. Vou verificar novamente a disponibilidade..."
-                        margot_response_final, openai_call_needed = find_and_present_slots(session, sender_id)
+                        margot_response_final, openai_call_needed = await find_and_present_slots(tenant, session, sender_id)
                     openai_call_needed = False
                 else:
                     logger.warning(f"[{sender_id}] Resposta de confirmação ambígua: '{user_message}'.")
@@ -652,8 +931,8 @@ async def whatsapp_webhook(request: Request, From: str = Form(...), Body: str =
         elif current_status == "cancelling_finding":
              logger.info(f"[{sender_id}] Estado: cancelling_finding. Buscando para {patient_data.get('name_for_cancel')}")
              try:
-                 tz = pytz.timezone(default_timezone); now = datetime.datetime.now(tz); search_end = now + relativedelta(months=6)
-                 found_events = caldav_handler.find_appointments_by_details(
+                 tz = pytz.timezone(tenant.config.timezone); now = datetime.datetime.now(tz); search_end = now + relativedelta(months=6)
+                 found_events = await caldav_handler.find_appointments_by_details(
                      patient_name=patient_data.get('name_for_cancel'), start_range=now, end_range=search_end
                  )
                  if not found_events:
@@ -689,7 +968,7 @@ async def whatsapp_webhook(request: Request, From: str = Form(...), Body: str =
              if not event_to_cancel or not event_to_cancel.get('id'): logger.error(f"Crit Err: cancel confirm sem event!"); margot_response_final = "Erro interno. Recomeçar cancelamento?"; session = reset_session_scheduling(session); session["scheduling_status"] = "cancelling_awaiting_name"; openai_call_needed = False
              elif confirmation_positive:
                  try:
-                      success, message = caldav_handler.cancel_appointment(event_identifier=event_to_cancel['id'])
+                      success, message = await caldav_handler.cancel_appointment(event_identifier=event_to_cancel['id'])
                       if success: margot_response_final = f"✅ Cancelamento Confirmado! Agendamento de {format_datetime_ptbr(event_to_cancel['start'])} cancelado. {message or ''}"
                       else: margot_response_final = f"Problema ao cancelar: {message} Contate a clínica."
                       session = reset_session_scheduling(session); openai_call_needed = False
@@ -703,8 +982,8 @@ async def whatsapp_webhook(request: Request, From: str = Form(...), Body: str =
              else: expected_data_for_openai = "name"; openai_call_needed = True
         elif current_status == "rebooking_finding":
              try:
-                 tz = pytz.timezone(default_timezone); now = datetime.datetime.now(tz); search_end = now + relativedelta(months=6)
-                 found_events = caldav_handler.find_appointments_by_details(patient_name=patient_data.get('name_for_rebook'), start_range=now, end_range=search_end)
+                 tz = pytz.timezone(tenant.config.timezone); now = datetime.datetime.now(tz); search_end = now + relativedelta(months=6)
+                 found_events = await caldav_handler.find_appointments_by_details(patient_name=patient_data.get('name_for_rebook'), start_range=now, end_range=search_end)
                  if not found_events:
                       margot_response_final = f"Não encontrei agendamentos futuros para {patient_data.get('name_for_rebook', 'você')}. Fazer novo agendamento?"
                       session = reset_session_scheduling(session); session["patient_data"]["name"] = patient_data.get("name_for_rebook")
@@ -739,7 +1018,7 @@ async def whatsapp_webhook(request: Request, From: str = Form(...), Body: str =
              if not event_to_rebook or not event_to_rebook.get('id'): logger.error(f"Crit Err: rebook confirm sem event!"); margot_response_final = "Erro interno. Recomeçar remarcação?"; session = reset_session_scheduling(session); session["scheduling_status"] = "rebooking_awaiting_name"; openai_call_needed = False
              elif confirmation_positive:
                  try:
-                      success, message = caldav_handler.cancel_appointment(event_identifier=event_to_rebook['id'])
+                      success, message = await caldav_handler.cancel_appointment(event_identifier=event_to_rebook['id'])
                       if success:
                            logger.info(f"[{sender_id}] Evento antigo cancelado. Coletando/verificando dados para novo.")
                            summary_parts = event_to_rebook.get("summary", "").split(" - "); extracted_name = summary_parts[-1].strip() if len(summary_parts) > 1 else patient_data.get("name_for_rebook")
@@ -752,7 +1031,7 @@ async def whatsapp_webhook(request: Request, From: str = Form(...), Body: str =
                                session["scheduling_status"] = "rebooking_awaiting_email"; margot_response_final = f"Ok! Cancelei o anterior. E seu e-mail para o novo?"; openai_call_needed = False
                            else: # --- EXECUTA A BUSCA DE SLOTS DIRETAMENTE ---
                                 logger.info(f"[{sender_id}] Dados completos para remarcação. Buscando novos slots...")
-                                margot_response_final, openai_call_needed = find_and_present_slots(session, sender_id)
+                                margot_response_final, openai_call_needed = await find_and_present_slots(tenant, session, sender_id)
                       else:
                            logger.warning(f"Falha ao cancelar antigo p/ remarcar: {message}")
                            margot_response_final = f"Problema ao cancelar anterior: {message} Tente de novo ou contate a clínica."; session["scheduling_status"] = "rebooking_awaiting_confirmation"; openai_call_needed = False
@@ -769,14 +1048,14 @@ async def whatsapp_webhook(request: Request, From: str = Form(...), Body: str =
                      session["scheduling_status"] = "rebooking_awaiting_email"; margot_response_final = "Obrigada. E qual seu e-mail?"; openai_call_needed = False
                  else: # --- EXECUTA A BUSCA DE SLOTS DIRETAMENTE ---
                       logger.info(f"[{sender_id}] Dados pós-rebook (tel ok). Buscando slots...")
-                      margot_response_final, openai_call_needed = find_and_present_slots(session, sender_id)
+                      margot_response_final, openai_call_needed = await find_and_present_slots(tenant, session, sender_id)
              else: expected_data_for_openai = "phone"; openai_call_needed = True
         elif current_status == "rebooking_awaiting_email":
              if validate_email(user_message):
                  patient_data["email"] = user_message.lower()
                  # --- EXECUTA A BUSCA DE SLOTS DIRETAMENTE ---
                  logger.info(f"[{sender_id}] Dados pós-rebook (email ok). Buscando slots...")
-                 margot_response_final, openai_call_needed = find_and_present_slots(session, sender_id)
+                 margot_response_final, openai_call_needed = await find_and_present_slots(tenant, session, sender_id)
              else: expected_data_for_openai = "email"; openai_call_needed = True
 
         # --- CASO DEFAULT / ESTADO DESCONHECIDO ---
@@ -799,7 +1078,7 @@ async def whatsapp_webhook(request: Request, From: str = Form(...), Body: str =
                 "cancel_rebook_context": session.pop("_cancel_rebook_context_for_openai", None),
             }
             openai_contexts = {k: v for k, v in openai_contexts.items() if v is not None}
-            margot_response_final = openai_handler.get_chat_response(
+            margot_response_final = await tenant.openai_handler.get_chat_response(
                 user_message=user_message, conversation_history=session_history, **openai_contexts
             )
 
@@ -816,43 +1095,27 @@ async def whatsapp_webhook(request: Request, From: str = Form(...), Body: str =
         cleaned_response = margot_response_final.strip() if margot_response_final else ""
         if cleaned_response:
             session_history.append({"role": "assistant", "content": cleaned_response})
+            turn_topic = knowledge_handler.detect_turn_topic(user_message, cleaned_response)
+            if turn_topic and turn_topic != session.get("current_topic"):
+                session["current_topic"] = turn_topic
+                logger.debug(f"[{sender_id}] Tópico da conversa atualizado: '{turn_topic}'.")
             logger.info(f"Resposta Margot | Para: {sender_id} | Estado Final: {session.get('scheduling_status')} | Resposta: '{cleaned_response[:100]}...'")
         else:
              logger.warning(f"[{sender_id}] Resposta final vazia. Nenhuma resposta enviada.")
+             await session_store.save(session_key, session)
              return Response(content=str(MessagingResponse()), media_type="application/xml")
 
         if len(session_history) > MAX_HISTORY_LENGTH * 2: session["history"] = session_history[-(MAX_HISTORY_LENGTH * 2):]
         else: session["history"] = session_history
-        conversation_sessions[sender_id] = session
-
-        MAX_MSG_LENGTH = 1550
-        response_to_send = cleaned_response
-        final_twiml_response = MessagingResponse(); messages_sent_count = 0
-        while len(response_to_send.encode('utf-8')) > MAX_MSG_LENGTH:
-            split_point = -1; best_newline = response_to_send.rfind('\n', 0, MAX_MSG_LENGTH)
-            if best_newline != -1 and best_newline > MAX_MSG_LENGTH // 2: split_point = best_newline
-            else:
-                best_space = response_to_send.rfind(' ', 0, MAX_MSG_LENGTH)
-                if best_space != -1 and best_space > MAX_MSG_LENGTH // 2: split_point = best_space
-                else: split_point = MAX_MSG_LENGTH
-            message_part = response_to_send[:split_point].strip()
-            response_to_send = response_to_send[split_point:].strip()
-            if message_part:
-                 logger.debug(f"Enviando parte {messages_sent_count + 1} API ({len(message_part)} chars) para {sender_id}")
-                 try:
-                      twilio_client.messages.create(from_=twilio_whatsapp_number, body=message_part, to=sender_id)
-                      messages_sent_count += 1; time.sleep(0.8)
-                 except Exception as e_send_part:
-                      logger.error(f"Erro envio API: {e_send_part}", exc_info=True)
-                      error_twiml = MessagingResponse(); error_twiml.message("Erro ao enviar parte da resposta. Tente novamente?")
-                      return Response(content=str(error_twiml), media_type="application/xml")
-        if response_to_send:
-             logger.debug(f"Enviando parte final TwiML ({len(response_to_send)} chars) para {sender_id}.")
-             final_twiml_response.message(response_to_send); messages_sent_count += 1
-        elif messages_sent_count > 0:
-             logger.info(f"[{sender_id}] Nenhuma parte final TwiML. Retornando TwiML vazio.")
-             return Response(content=str(MessagingResponse()), media_type="application/xml")
-
+        await session_store.save(session_key, session)
+
+        # Primeira parte vai no TwiML (resposta imediata); as demais seguem pela fila de saída em background
+        message_parts = split_message(cleaned_response, MAX_MSG_LENGTH)
+        final_twiml_response = MessagingResponse()
+        final_twiml_response.message(message_parts[0])
+        if len(message_parts) > 1:
+            logger.debug(f"[{sender_id}] Resposta dividida em {len(message_parts)} partes. {len(message_parts) - 1} enfileirada(s) para envio via API.")
+            outbound_queue.enqueue(sender_id, list(message_parts[1:]), initial_delay=OUTBOUND_FOLLOWUP_DELAY_SECONDS, from_=tenant.config.whatsapp_number)
         return Response(content=str(final_twiml_response), media_type="application/xml")
 
     except Exception as e_send_final:
@@ -864,7 +1127,16 @@ async def whatsapp_webhook(request: Request, From: str = Form(...), Body: str =
 @app.get("/", tags=["Status"], summary="Verifica o status da API")
 async def root():
     logger.info("Rota raiz '/' acessada.")
-    return {"message": f"API da {margot_persona_name} ({clinic_name}) está online!", "version": app.version}
+    return {
+        "message": f"API da {margot_persona_name} está online!",
+        "version": app.version,
+        "sessions": session_store.metrics(),
+        "outbound": outbound_queue.metrics(),
+        "llm": openai_handler.metrics(),
+        "tenants": tenant_registry.metrics(), # Base (knowledge) e fast-path de cada clínica carregada
+        "answer_cache": answer_cache.metrics() if answer_cache else None,
+        "slot_holds": slot_holds.metrics() if slot_holds else None,
+    }
 
 # --- Execução Local ---
 if __name__ == "__main__":
@@ -1,57 +1,163 @@
-# openai_handler.py (v6.7 - Contexto para Coleta de Dados)
+# openai_handler.py (v7.1 - Prefixo Estático para Cache de Prompt + Persona em Cache + Persona por Clínica)
 import os
 import logging
 import datetime
 import locale
 import json
-from openai import OpenAI, APIError, RateLimitError
-from typing import Optional, List, Dict, Any
+import random
+import asyncio
+import copy
+import httpx
+from openai import AsyncOpenAI, APIError, APITimeoutError, RateLimitError
+from typing import Optional, List, Dict, Any, Tuple
 
 logger = logging.getLogger(__name__)
 
 # Mantido da versão anterior
 MAX_HISTORY_PAIRS = 5
+DEFAULT_FORMATION_YEAR = 1998
+DEFAULT_PLASTIC_SPEC_YEAR = 2004
+DEFAULT_PERSONA_NAME = "Margot"
+DEFAULT_CLINIC_NAME = "Clínica Missel" # Usados só sem KnowledgeHandler (a base define os nomes de cada clínica)
+DEFAULT_DOCTOR_NAME = "Dr. Juarez Missel"
+
+# (v6.8) Limites da chamada ao LLM (o webhook do Twilio expira em ~15s)
+OPENAI_MAX_CONCURRENT = 8 # Requisições simultâneas à OpenAI por worker
+OPENAI_MAX_CONNECTIONS = 16 # Conexões no pool HTTP compartilhado
+OPENAI_REQUEST_TIMEOUT = 8.0 # Timeout de cada tentativa (s)
+OPENAI_CALL_DEADLINE = 12.0 # Prazo total da chamada: fila do semáforo + tentativas (s)
+OPENAI_RATE_LIMIT_RETRIES = 3
+OPENAI_BACKOFF_BASE = 0.5 # Base do backoff exponencial com jitter (s)
+OPENAI_BACKOFF_MAX = 4.0
+
+# (v7.0) Instruções do RAG no prefixo estático; os dados da base vão na seção volátil, depois do histórico
+RAG_INSTRUCTIONS = (
+    "\n**INSTRUÇÕES PARA A INFORMAÇÃO DA BASE DE DADOS** (valem quando uma mensagem de sistema trouxer 'INFORMAÇÃO DA BASE DE DADOS'; siga estas instruções E as Regras Essenciais):\n"
+    "1.  Responda à ÚLTIMA mensagem do usuário usando a informação da base de dados fornecida.\n"
+    "2.  SE A INFORMAÇÃO DA BASE COMEÇAR COM '**Detalhes sobre...**' (é um procedimento):\n"
+    "    a. Inicie confirmando que o procedimento é realizado.\n"
+    "    b. Integre a '**Descrição:**' completa do procedimento de forma natural e fluida.\n"
+    "    c. **DIFERENCIAIS CONVERSACIONAIS (MUITO IMPORTANTE):** Apresente **TODOS** os pontos listados sob '**Diferenciais e Informações Adicionais:**' (Clínico/Técnica, {doctor_name}, Artigos, Capítulos, Prêmios, etc., SE PRESENTES) **INTEGRANDO-OS NATURALMENTE EM UM OU MAIS PARÁGRAFOS**. **NÃO use listas ou marcadores (-, *) para apresentar os diferenciais**. Em vez disso, conecte as ideias de forma conversacional. Por exemplo: 'Um dos diferenciais importantes é a técnica clínica utilizada, que [explicar]. Além disso, a vasta experiência do {doctor_name} nesse tipo de cirurgia, [explicar], contribui para os resultados. Ele também publicou artigos sobre o tema, como [citar artigo], e contribuiu com o capítulo de livro [citar livro]...'. **Use TODOS os pontos de diferenciais fornecidos, mas em formato de texto corrido e explicativo.**\n"
+    "    d. Se houver uma '**Atenção Importante:**', mencione-a claramente.\n"
+    "    e. **OBJETIVO CRÍTICO:** Sua resposta sobre o procedimento deve ser **EXAUSTIVA e FLUIDA**, utilizando **TODA** a informação relevante fornecida (Descrição, Atenção, e **TODOS** os Diferenciais integrados conversacionalmente). **NÃO RESUMA NADA IMPORTANTE.**\n"
+    "3.  SE A INFORMAÇÃO DA BASE FOR OUTRO TÓPICO (Não um procedimento): Apresente a informação de forma clara, completa e conversacional, mantendo seu tom cordial.\n"
+    "4.  DATAS/ANOS: Lembre-se que o {doctor_name} é formado desde {year_formation} e especialista em plástica desde {year_plastic_spec} (use esses anos diretamente se relevante).\n"
+    "5.  Formatação de Lista de Procedimentos GERAL: Mantenha a regra anterior (usar '-' apenas se a informação começar EXATAMENTE com '**Principais Procedimentos Realizados:**').\n"
+    "6.  Convênios/Custos/etc.: Siga as Regras Essenciais e a informação específica fornecida.\n"
+    "7.  Ignore a informação da base se a pergunta não tiver relação direta com ela."
+)
+
+BUSY_RESPONSE = "Desculpe, estamos com muitas solicitações no momento. Por favor, tente novamente em alguns instantes."
+EMPTY_RESPONSE = "Peço desculpas, não consegui gerar uma resposta adequada neste momento. Poderia repetir, por favor?"
+API_ERROR_RESPONSE = "Desculpe, tivemos um problema técnico com nossa assistente virtual. A equipe já foi notificada. Por favor, tente novamente mais tarde."
+UNEXPECTED_ERROR_RESPONSE = "Desculpe, ocorreu um erro inesperado ao processar sua solicitação. Por favor, tente novamente."
+# Respostas de contingência (nunca devem ir para o cache de respostas)
+FALLBACK_RESPONSES = frozenset([BUSY_RESPONSE, EMPTY_RESPONSE, API_ERROR_RESPONSE, UNEXPECTED_ERROR_RESPONSE])
 
 class OpenAIHandler:
     """
-    (v6.7) Gerencia a interação com a API OpenAI.
+    (v7.1) Gerencia a interação com a API OpenAI.
+    - Cliente AsyncOpenAI sobre um pool httpx compartilhado (keep-alive), sem bloquear o event loop.
+    - Semáforo limita as chamadas simultâneas; cada chamada tem prazo total (OPENAI_CALL_DEADLINE).
+    - RateLimitError é repetido com backoff exponencial + jitter enquanto couber no prazo.
+    - Persona e anos do Dr. calculados uma vez e reaproveitados até o knowledge_base.json mudar
+      (usa os dados já carregados pelo KnowledgeHandler, sem reler o arquivo a cada mensagem).
+    - Ordem das mensagens: prefixo estático (persona + instruções do RAG) -> histórico -> contexto volátil
+      (data/hora, agendamento, dados do RAG) -> usuário. Tokens em cache do provedor são logados/acumulados.
+    - Nome da persona, da clínica e do médico parametrizados (clínica e médico vêm da base); for_tenant() cria
+      uma visão por clínica que compartilha pool HTTP, semáforo e métricas de uso.
     - Persona v6.6 mantida (sem markdown, saudação inicial fixa, RAG conversacional).
     - Adiciona contexto ao prompt para ajudar na coleta sequencial de dados
       e lidar com respostas inesperadas do usuário durante esse processo.
     """
-    def __init__(self, api_key: str):
+    def __init__(self, api_key: str, max_concurrent: int = OPENAI_MAX_CONCURRENT, knowledge_handler=None,
+                 json_path: str = "knowledge_base.json", persona_name: str = DEFAULT_PERSONA_NAME,
+                 clinic_name: Optional[str] = None, doctor_name: Optional[str] = None):
         if not api_key:
             logger.error("API Key da OpenAI não fornecida.")
             raise ValueError("API Key da OpenAI é necessária.")
         try:
-            self.client = OpenAI(api_key=api_key)
+            self.http_client = httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=OPENAI_MAX_CONNECTIONS, max_keepalive_connections=OPENAI_MAX_CONNECTIONS),
+                timeout=httpx.Timeout(OPENAI_REQUEST_TIMEOUT, connect=3.0)
+            )
+            # Retentativas ficam a cargo de _create_completion (respeitando o prazo total)
+            self.client = AsyncOpenAI(api_key=api_key, http_client=self.http_client, max_retries=0, timeout=OPENAI_REQUEST_TIMEOUT)
+            self._semaphore = asyncio.Semaphore(max_concurrent)
+            self.knowledge_handler = knowledge_handler
+            self.json_path = json_path
+            self.persona_name = persona_name
+            self.clinic_name = clinic_name # None: usa o nome da base
+            self.doctor_name = doctor_name
+            self._system_prompt_cache: Optional[Tuple[Optional[float], str]] = None # (mtime da base, prefixo estático)
+            self.usage_totals: Dict[str, int] = {"calls": 0, "prompt_tokens": 0, "cached_prompt_tokens": 0, "completion_tokens": 0}
             self.model = "gpt-3.5-turbo" # Mantendo gpt-3.5-turbo
             logger.info(f"Cliente OpenAI inicializado com sucesso: Modelo {self.model}")
         except Exception as e:
             logger.error(f"Falha ao inicializar cliente OpenAI: {e}", exc_info=True)
             raise
 
+    def for_tenant(self, knowledge_handler, persona_name: str = DEFAULT_PERSONA_NAME,
+                   clinic_name: Optional[str] = None, doctor_name: Optional[str] = None) -> "OpenAIHandler":
+        """Handler de uma clínica: persona/base próprias, mesmo cliente, semáforo e totais de uso (um pool por worker)."""
+        tenant_handler = copy.copy(self)
+        tenant_handler.knowledge_handler = knowledge_handler
+        tenant_handler.persona_name = persona_name
+        tenant_handler.clinic_name = clinic_name
+        tenant_handler.doctor_name = doctor_name
+        tenant_handler._system_prompt_cache = None
+        return tenant_handler
+
+    def _clinic_and_doctor_names(self) -> Tuple[str, str]:
+        """Nomes configurados explicitamente ou, na falta deles, os da base carregada."""
+        knowledge_handler = self.knowledge_handler if self.knowledge_handler is not None and self.knowledge_handler.data else None
+        clinic_name = self.clinic_name or (knowledge_handler.clinic_name if knowledge_handler else DEFAULT_CLINIC_NAME)
+        doctor_name = self.doctor_name or (knowledge_handler.doctor_name if knowledge_handler else DEFAULT_DOCTOR_NAME)
+        return clinic_name, doctor_name
+
+    def _knowledge_version(self) -> Optional[float]:
+        """mtime da versão da base carregada (o hot reload do KnowledgeHandler roda fora do caminho da requisição)."""
+        if self.knowledge_handler is not None:
+            return self.knowledge_handler.data_mtime
+        try: return os.path.getmtime(self.json_path)
+        except OSError: return None
+
+    def _get_system_prompt(self) -> str:
+        """
+        Prefixo estático (persona + instruções do RAG) em cache, reconstruído apenas quando a base muda.
+        Não pode conter nada que varie por chamada (data/hora, estado, dados do paciente).
+        """
+        version = self._knowledge_version()
+        if self._system_prompt_cache is None or self._system_prompt_cache[0] != version:
+            year_formation, year_plastic_spec = self._get_dynamic_years()
+            rag_instructions = RAG_INSTRUCTIONS.format(year_formation=year_formation, year_plastic_spec=year_plastic_spec,
+                                                       doctor_name=self._clinic_and_doctor_names()[1])
+            self._system_prompt_cache = (version, f"{self._define_system_prompt()}\n{rag_instructions}")
+            logger.info("Persona (system prompt) reconstruída a partir da base de conhecimento.")
+        return self._system_prompt_cache[1]
+
     def _define_system_prompt(self) -> str:
-        """Define a persona e as regras de comportamento da Margot (v6.7)."""
+        """Define a persona e as regras de comportamento da assistente (v7.1: nomes parametrizados)."""
         # Obtém anos dinamicamente para usar no prompt
-        year_formation, year_plastic_spec = self._get_dynamic_years_from_json()
+        year_formation, year_plastic_spec = self._get_dynamic_years()
+        persona_name, clinic_name, doctor_name = self.persona_name, *self._clinic_and_doctor_names()
 
         persona = (
-            f"Você é Margot, a concierge e responsável pelo atendimento aos pacientes na Clínica Missel, cujo especialista responsável é o Dr. Juarez Missel (formado em {year_formation}, especialista em plástica desde {year_plastic_spec}), "
+            f"Você é {persona_name}, a concierge e responsável pelo atendimento aos pacientes na {clinic_name}, cujo especialista responsável é o {doctor_name} (formado em {year_formation}, especialista em plástica desde {year_plastic_spec}), "
             "um renomado especialista em Cirurgia Plástica. "
-            "Seu nome é Margot. Sua comunicação deve ser impecável: extremamente educada, cordial, acolhedora, paciente, atenciosa e altamente prestativa. Aja sempre como um membro humano da equipe. "
+            f"Seu nome é {persona_name}. Sua comunicação deve ser impecável: extremamente educada, cordial, acolhedora, paciente, atenciosa e altamente prestativa. Aja sempre como um membro humano da equipe. "
             "Trate todos os pacientes com respeito e empatia."
-            "Seu objetivo principal é fornecer informações precisas sobre a Clínica Missel, os serviços oferecidos, o Dr. Juarez Missel e, crucialmente, gerenciar a agenda de consultas: marcar novos horários, "
+            f"Seu objetivo principal é fornecer informações precisas sobre a {clinic_name}, os serviços oferecidos, o {doctor_name} e, crucialmente, gerenciar a agenda de consultas: marcar novos horários, "
             "ajudar pacientes a remarcar ou cancelar consultas existentes, sempre seguindo o fluxo definido pelo sistema (você será informada do estado atual do agendamento e qual informação pedir)."
             "\n**Instruções Gerais:**\n"
             "- Responda sempre em Português do Brasil.\n"
             "- **NUNCA use formatação Markdown (como asteriscos para negrito ou itálico) em suas respostas finais. Use apenas texto puro.**\n"
             "- Use uma linguagem clara, formal na medida certa, mas acolhedora e nunca robótica.\n"
-            "- Use despedidas cordiais como 'Tenha um excelente dia!', 'Qualquer outra dúvida, estou à disposição!', 'A Clínica Missel agradece seu contato. Até breve!'.\n"
+            f"- Use despedidas cordiais como 'Tenha um excelente dia!', 'Qualquer outra dúvida, estou à disposição!', 'A {clinic_name} agradece seu contato. Até breve!'.\n"
             "\n**Regras Essenciais:**\n"
-            "1.  **APRESENTAÇÃO INICIAL:** Na **PRIMEIRA** mensagem que você envia nesta conversa, **OBRIGATORIAMENTE** apresente-se como 'Olá! Sou a Margot, da Clínica Missel. Em que posso ajudar?'. Em **TODAS** as respostas **SEGUINTES** (a partir da segunda), **NÃO** repita mais essa apresentação completa. Vá direto ao ponto da pergunta do usuário ou use uma saudação curta e apropriada se necessário. Para responder perguntas casuais como 'Tudo bem?', responda naturalmente sem a apresentação completa.\n"
-            "2.  **VOCÊ NÃO É IA:** **NUNCA** revele ser uma inteligência artificial, chatbot, programa ou modelo. Você é Margot, uma pessoa da equipe.\n"
-            "3.  **SEM CONSELHOS MÉDICOS:** **NÃO** dê diagnósticos, opiniões médicas diretas, prognósticos. Redirecione sempre para a consulta individual com o Dr. Juarez.\n"
+            f"1.  **APRESENTAÇÃO INICIAL:** Na **PRIMEIRA** mensagem que você envia nesta conversa, **OBRIGATORIAMENTE** apresente-se como 'Olá! Sou a {persona_name}, da {clinic_name}. Em que posso ajudar?'. Em **TODAS** as respostas **SEGUINTES** (a partir da segunda), **NÃO** repita mais essa apresentação completa. Vá direto ao ponto da pergunta do usuário ou use uma saudação curta e apropriada se necessário. Para responder perguntas casuais como 'Tudo bem?', responda naturalmente sem a apresentação completa.\n"
+            f"2.  **VOCÊ NÃO É IA:** **NUNCA** revele ser uma inteligência artificial, chatbot, programa ou modelo. Você é {persona_name}, uma pessoa da equipe.\n"
+            f"3.  **SEM CONSELHOS MÉDICOS:** **NÃO** dê diagnósticos, opiniões médicas diretas, prognósticos. Redirecione sempre para a consulta individual com o {doctor_name}.\n"
             "4.  **INFORMAÇÕES DA CLÍNICA (RAG):** Use as informações da base de dados (quando fornecidas no contexto 'INFORMAÇÃO DA BASE DE DADOS') sobre endereço, horários, telefone, procedimentos, convênios, links, etc. Siga as instruções do prompt RAG sobre como apresentar esses dados (completude, formato, restrições, custos, etc.). Se a informação não estiver na base, diga que verificará ou que será detalhado na consulta.\n"
             # ---> MODIFICAÇÃO AQUI: Instrução sobre fluxo de agendamento <---
             "5.  **FLUXO DE AGENDAMENTO (IMPORTANTE):**\n"
@@ -64,29 +170,43 @@ class OpenAIHandler:
             # ---> FIM DA MODIFICAÇÃO <---
             "6.  **ERROS/INDISPONIBILIDADE:** Se não puder fazer algo ou se o sistema informar um erro (ex: erro ao buscar slots, erro ao agendar), explique o motivo claramente ao usuário (baseado na mensagem de erro fornecida no contexto, se houver) e ofereça alternativas ou diga que a equipe entrará em contato, se apropriado.\n"
             "7.  **TOM DE VOZ:** Mantenha sempre a positividade, profissionalismo e disposição para ajudar ('Será um prazer!', 'Com certeza!', 'Estou à disposição!').\n"
-            "8.  **FOCO:** Mantenha a conversa nos serviços da Clínica Missel. Se o usuário desviar muito (e não estiver no fluxo de agendamento), redirecione gentilmente: 'Compreendo, mas meu foco aqui é auxiliar com os assuntos da Clínica Missel. Posso ajudar com informações sobre nossos procedimentos ou agendamentos?'.\n"
+            f"8.  **FOCO:** Mantenha a conversa nos serviços da {clinic_name}. Se o usuário desviar muito (e não estiver no fluxo de agendamento), redirecione gentilmente: 'Compreendo, mas meu foco aqui é auxiliar com os assuntos da {clinic_name}. Posso ajudar com informações sobre nossos procedimentos ou agendamentos?'.\n"
             # ---> NOVA REGRA <---
             "9.  **EVITE AÇÕES DIRETAS NO TEXTO:** Não inclua marcadores como `[ACTION:FIND_SLOTS]` ou `[ACTION:BOOK_APPOINTMENT]` em suas respostas finais ao usuário. O sistema interpretará a necessidade dessas ações com base no estado da conversa e nas suas respostas contextuais.\n"
-            "4.  DATAS/ANOS: Lembre-se que o Dr. Juarez Missel é formado desde {year_formation} e especialista em plástica desde {year_plastic_spec} (use esses anos diretamente se relevante).\n"
+            f"4.  DATAS/ANOS: Lembre-se que o {doctor_name} é formado desde {{year_formation}} e especialista em plástica desde {{year_plastic_spec}} (use esses anos diretamente se relevante).\n"
         )
         return persona
 
-    # Função _get_dynamic_years_from_json (Inalterada - já estava na v6.6)
+    def _get_dynamic_years(self) -> tuple[int, int]:
+        """Anos de formação/especialização a partir dos dados do KnowledgeHandler (ou do JSON, sem handler)."""
+        if self.knowledge_handler is not None and self.knowledge_handler.data:
+            return self._extract_dynamic_years(self.knowledge_handler.data, "KnowledgeHandler")
+        return self._get_dynamic_years_from_json()
+
+    # Função _get_dynamic_years_from_json (leitura do arquivo mantida para uso sem KnowledgeHandler)
     def _get_dynamic_years_from_json(self) -> tuple[int, int]:
         """Tenta ler os anos de formação e especialização do JSON, com tratamento de erro."""
-        default_formation_year = 1998
-        default_plastic_spec_year = 2004
-        formation_year = default_formation_year
-        plastic_spec_year = default_plastic_spec_year
-        json_path = "knowledge_base.json"
+        json_path = self.json_path
         try:
             if not os.path.exists(json_path):
                  logger.warning(f"Arquivo {json_path} não encontrado para buscar anos dinâmicos.")
-                 return default_formation_year, default_plastic_spec_year
+                 return DEFAULT_FORMATION_YEAR, DEFAULT_PLASTIC_SPEC_YEAR
 
             with open(json_path, 'r', encoding='utf-8') as f:
                 data = json.load(f)
+            return self._extract_dynamic_years(data, json_path)
+
+        except (FileNotFoundError, json.JSONDecodeError) as e:
+             logger.warning(f"Não foi possível ler {json_path} para anos dinâmicos: {e}")
+             return DEFAULT_FORMATION_YEAR, DEFAULT_PLASTIC_SPEC_YEAR
 
+    def _extract_dynamic_years(self, data: Dict[str, Any], source: str) -> tuple[int, int]:
+        """Extrai os anos de formação e especialização em plástica de 'doctor_info'."""
+        default_formation_year = DEFAULT_FORMATION_YEAR
+        default_plastic_spec_year = DEFAULT_PLASTIC_SPEC_YEAR
+        formation_year = default_formation_year
+        plastic_spec_year = default_plastic_spec_year
+        try:
             doctor_info = data.get("doctor_info", {})
             if not isinstance(doctor_info, dict):
                  logger.warning("'doctor_info' não é um dicionário no JSON.")
@@ -133,15 +253,53 @@ class OpenAIHandler:
             # logger.debug(f"Anos lidos/definidos: Formação={formation_year}, Plástica={plastic_spec_year}")
             return formation_year, plastic_spec_year
 
-        except (FileNotFoundError, json.JSONDecodeError) as e:
-             logger.warning(f"Não foi possível ler {json_path} para anos dinâmicos: {e}")
-             return default_formation_year, default_plastic_spec_year
         except Exception as e:
-             logger.error(f"Erro inesperado ao ler anos do JSON ({json_path}): {e}", exc_info=True)
+             logger.error(f"Erro inesperado ao ler anos do JSON ({source}): {e}", exc_info=True)
              return default_formation_year, default_plastic_spec_year
 
+    def _record_usage(self, usage) -> int:
+        """Acumula tokens de prompt (com e sem cache do provedor). Retorna os tokens em cache desta chamada."""
+        details = getattr(usage, 'prompt_tokens_details', None)
+        cached_tokens = (getattr(details, 'cached_tokens', None) or 0) if details else 0
+        self.usage_totals["calls"] += 1
+        self.usage_totals["prompt_tokens"] += usage.prompt_tokens or 0
+        self.usage_totals["cached_prompt_tokens"] += cached_tokens
+        self.usage_totals["completion_tokens"] += usage.completion_tokens or 0
+        return cached_tokens
+
+    def metrics(self) -> Dict[str, Any]:
+        totals = dict(self.usage_totals)
+        totals["prompt_cache_hit_ratio"] = round(totals["cached_prompt_tokens"] / totals["prompt_tokens"], 3) if totals["prompt_tokens"] else 0.0
+        return totals
+
+    async def aclose(self):
+        """Fecha o pool HTTP compartilhado (chamar no shutdown da aplicação)."""
+        await self.client.close()
+
+    async def _create_completion(self, messages: List[Dict[str, str]]):
+        """Chamada ao LLM limitada pelo semáforo, com retry (backoff + jitter) em RateLimitError."""
+        async with self._semaphore:
+            attempt = 0
+            while True:
+                try:
+                    return await self.client.chat.completions.create(
+                        model=self.model,
+                        messages=messages,
+                        temperature=0.4, # Levemente reduzido para respostas mais focadas no fluxo
+                        max_tokens=1000, # Reduzido um pouco, respostas de fluxo costumam ser menores
+                        presence_penalty=0.1,
+                        frequency_penalty=0.1
+                    )
+                except RateLimitError as e:
+                    attempt += 1
+                    if attempt > OPENAI_RATE_LIMIT_RETRIES:
+                        raise
+                    delay = random.uniform(0, min(OPENAI_BACKOFF_MAX, OPENAI_BACKOFF_BASE * (2 ** attempt)))
+                    logger.warning(f"Rate Limit OpenAI (tentativa {attempt}/{OPENAI_RATE_LIMIT_RETRIES}). Nova tentativa em {delay:.2f}s. Erro: {e}")
+                    await asyncio.sleep(delay)
+
     # ---> ASSINATURA MODIFICADA: Adicionado expected_data e outros contextos <---
-    def get_chat_response(self,
+    async def get_chat_response(self,
                           user_message: str,
                           conversation_history: Optional[List[Dict[str, str]]] = None,
                           # Contextos específicos passados pelo main.py
@@ -162,8 +320,10 @@ class OpenAIHandler:
              logger.warning("Recebida mensagem de usuário vazia.")
              return "Desculpe, não entendi sua mensagem."
 
-        system_prompt = self._define_system_prompt()
-        messages = [{"role": "system", "content": system_prompt}]
+        # (v7.0) Prefixo estático idêntico byte a byte entre chamadas (persona + instruções do RAG),
+        # depois o histórico e, por último, as seções voláteis -> aproveita o cache de prefixo do provedor
+        messages = [{"role": "system", "content": self._get_system_prompt()}]
+        volatile_parts: List[str] = []
 
         # Contexto Temporal (Inalterado)
         try: locale.setlocale(locale.LC_TIME, 'pt_BR.UTF-8')
@@ -173,7 +333,7 @@ class OpenAIHandler:
         now = datetime.datetime.now(); data_hora_formatada = now.strftime("%Y-%m-%d %H:%M");
         try: data_hora_formatada = now.strftime("%A, %d de %B de %Y, %H:%M");
         except Exception: logger.warning(f"Usando formato data/hora fallback.");
-        messages.append({"role": "system", "content": f"Contexto Temporal: A data e hora atuais são {data_hora_formatada}."})
+        volatile_parts.append(f"Contexto Temporal: A data e hora atuais são {data_hora_formatada}.")
 
         # --- Injeção de Contexto de Agendamento ---
         context_parts = []
@@ -216,7 +376,7 @@ class OpenAIHandler:
         # Adiciona o bloco de contexto de agendamento ao prompt
         if len(context_parts) > 1: # Só adiciona se tiver mais que o estado atual
             scheduling_context_prompt = "\n".join(context_parts)
-            messages.append({"role": "system", "content": f"--- Contexto de Agendamento ---\n{scheduling_context_prompt}\n-----------------------------"})
+            volatile_parts.append(f"--- Contexto de Agendamento ---\n{scheduling_context_prompt}\n-----------------------------")
             logger.info("Adicionando Contexto de Agendamento ao prompt.")
         # --- Fim da Injeção de Contexto ---
 
@@ -225,33 +385,16 @@ class OpenAIHandler:
         if conversation_history:
             messages.extend(conversation_history[-(MAX_HISTORY_PAIRS * 2):])
 
-        # Adiciona contexto RAG, se disponível (Inalterado - v6.6 já tinha RAG conversacional)
+        # Seção volátil: contexto temporal, agendamento e dados do RAG (instruções do RAG ficam no prefixo estático)
         if relevant_knowledge:
-            # O prompt RAG da v6.6 já é adequado
-            knowledge_context_prompt = (
-                f"INFORMAÇÃO DA BASE DE DADOS (Use OBRIGATORIAMENTE e COMPLETAMENTE):\n"
+            volatile_parts.append(
+                f"INFORMAÇÃO DA BASE DE DADOS (Use OBRIGATORIAMENTE e COMPLETAMENTE, conforme as INSTRUÇÕES PARA A INFORMAÇÃO DA BASE DE DADOS):\n"
                 f"------------------------------------------------------------------\n"
                 f"{relevant_knowledge}\n"
-                f"------------------------------------------------------------------\n\n"
-                f"SUA TAREFA, MARGOT (Siga estas instruções E as Regras Essenciais):\n"
-                f"1.  Responda à ÚLTIMA mensagem do usuário (abaixo) usando a informação da base de dados fornecida acima.\n"
-                f"2.  SE A INFORMAÇÃO ACIMA COMEÇAR COM '**Detalhes sobre...**' (é um procedimento):\n" # Ajustado para o formato do KH v8.6
-                f"    a. Inicie confirmando que o procedimento é realizado.\n"
-                f"    b. Integre a '**Descrição:**' completa do procedimento de forma natural e fluida.\n"
-                f"    c. **DIFERENCIAIS CONVERSACIONAIS (MUITO IMPORTANTE):** Apresente **TODOS** os pontos listados sob '**Diferenciais e Informações Adicionais:**' (Clínico/Técnica, Dr. Juarez Missel, Artigos, Capítulos, Prêmios, etc., SE PRESENTES) **INTEGRANDO-OS NATURALMENTE EM UM OU MAIS PARÁGRAFOS**. **NÃO use listas ou marcadores (-, *) para apresentar os diferenciais**. Em vez disso, conecte as ideias de forma conversacional. Por exemplo: 'Um dos diferenciais importantes é a técnica clínica utilizada, que [explicar]. Além disso, a vasta experiência do Dr. Juarez Missel nesse tipo de cirurgia, [explicar], contribui para os resultados. Ele também publicou artigos sobre o tema, como [citar artigo], e contribuiu com o capítulo de livro [citar livro]...'. **Use TODOS os pontos de diferenciais fornecidos, mas em formato de texto corrido e explicativo.**\n"
-                f"    d. Se houver uma '**Atenção Importante:**', mencione-a claramente.\n"
-                f"    e. **OBJETIVO CRÍTICO:** Sua resposta sobre o procedimento deve ser **EXAUSTIVA e FLUIDA**, utilizando **TODA** a informação relevante fornecida (Descrição, Atenção, e **TODOS** os Diferenciais integrados conversacionalmente). **NÃO RESUMA NADA IMPORTANTE.**\n"
-                f"3.  SE A INFORMAÇÃO ACIMA FOR OUTRO TÓPICO (Não um procedimento): Apresente a informação de forma clara, completa e conversacional, mantendo seu tom cordial.\n"
-                f"4.  DATAS/ANOS: Lembre-se que o Dr. Juarez Missel é formado desde {1998} e especialista em plástica desde {2004} (use esses anos diretamente se relevante).\n"
-                f"5.  Formatação de Lista de Procedimentos GERAL: Mantenha a regra anterior (usar '-' apenas se a informação começar EXATAMENTE com '**Principais Procedimentos Realizados:**').\n"
-                f"6.  Convênios/Custos/etc.: Siga as Regras Essenciais e a informação específica fornecida.\n"
-                f"7.  Ignore esta seção se a pergunta não tiver relação direta com a informação."
+                f"------------------------------------------------------------------"
             )
-            messages.append({"role": "system", "content": knowledge_context_prompt})
             logger.info("Adicionando contexto RAG ao prompt.")
-        # else: # Removido o log aqui para não poluir tanto
-             # logger.info("Não foi encontrado conhecimento relevante. Usando apenas persona, histórico e contexto de agendamento.")
-
+        messages.append({"role": "system", "content": "\n\n".join(volatile_parts)})
 
         # Adiciona a mensagem atual do usuário
         messages.append({"role": "user", "content": user_message})
@@ -268,17 +411,11 @@ class OpenAIHandler:
 
 
         try:
-            response = self.client.chat.completions.create(
-                model=self.model,
-                messages=messages,
-                temperature=0.4, # Levemente reduzido para respostas mais focadas no fluxo
-                max_tokens=1000, # Reduzido um pouco, respostas de fluxo costumam ser menores
-                presence_penalty=0.1,
-                frequency_penalty=0.1
-            )
+            response = await asyncio.wait_for(self._create_completion(messages), timeout=OPENAI_CALL_DEADLINE)
             assistant_response = response.choices[0].message.content
             if response.usage:
-                 logger.info(f"OpenAI OK. Usage: P={response.usage.prompt_tokens}, C={response.usage.completion_tokens}, T={response.usage.total_tokens}")
+                 cached_tokens = self._record_usage(response.usage)
+                 logger.info(f"OpenAI OK. Usage: P={response.usage.prompt_tokens} (cache={cached_tokens}, sem cache={response.usage.prompt_tokens - cached_tokens}), C={response.usage.completion_tokens}, T={response.usage.total_tokens}")
             else:
                  logger.info("OpenAI OK (usage não reportado).")
 
@@ -290,19 +427,22 @@ class OpenAIHandler:
                 return final_response
             else:
                 logger.warning("OpenAI retornou resposta vazia.")
-                return "Peço desculpas, não consegui gerar uma resposta adequada neste momento. Poderia repetir, por favor?"
+                return EMPTY_RESPONSE
 
-        # Tratamento de erros (Inalterado)
+        # Tratamento de erros
         except RateLimitError as e:
-             logger.error(f"Erro Rate Limit OpenAI: {e}")
+             logger.error(f"Erro Rate Limit OpenAI (retentativas esgotadas): {e}")
              # Mensagem mais útil para o usuário final
-             return "Desculpe, estamos com muitas solicitações no momento. Por favor, tente novamente em alguns instantes."
+             return BUSY_RESPONSE
+        except (asyncio.TimeoutError, APITimeoutError) as e:
+             logger.error(f"Prazo da chamada OpenAI esgotado ({OPENAI_CALL_DEADLINE}s): {e!r}")
+             return BUSY_RESPONSE
         except APIError as e:
              logger.error(f"Erro API OpenAI: {e}", exc_info=True)
-             return "Desculpe, tivemos um problema técnico com nossa assistente virtual. A equipe já foi notificada. Por favor, tente novamente mais tarde."
+             return API_ERROR_RESPONSE
         except Exception as e:
              logger.error(f"Erro inesperado OpenAI: {e}", exc_info=True)
-             return "Desculpe, ocorreu um erro inesperado ao processar sua solicitação. Por favor, tente novamente."
+             return UNEXPECTED_ERROR_RESPONSE
 
 # Bloco de teste local (mantido)
 if __name__ == "__main__":
@@ -313,6 +453,7 @@ if __name__ == "__main__":
     else:
         print("Inicializando OpenAIHandler para teste...")
         handler = OpenAIHandler(api_key=api_key)
+        run = asyncio.new_event_loop().run_until_complete
         print("Handler inicializado.")
 
         # --- Exemplo de Teste: Simular Re-prompt de Telefone ---
@@ -324,13 +465,13 @@ if __name__ == "__main__":
             {"role": "assistant", "content": "Obrigada, Fulano! Agora, por favor, me informe o seu número de telefone com DDD."}
         ]
         user_msg_test = "Ah, esqueci de perguntar, qual o valor da consulta mesmo?"
-        response = handler.get_chat_response(
+        response = run(handler.get_chat_response(
             user_message=user_msg_test,
             conversation_history=history_test,
             current_schedule_state="awaiting_phone",
             patient_data={"name": "Fulano de Tal"},
             expected_data="phone" # <--- Indicando que esperamos o telefone
-        )
+        ))
         print(f"Histórico:\n{json.dumps(history_test, indent=2, ensure_ascii=False)}")
         print(f"Usuário diz: {user_msg_test}")
         print(f"Margot (esperado re-prompt): {response}")
@@ -342,12 +483,12 @@ if __name__ == "__main__":
              {"index": 2, "datetime": "2024-08-05T15:00:00-03:00", "formatted": "Segunda-feira, 05 de Agosto às 15:00"},
              {"index": 3, "datetime": "2024-08-06T14:00:00-03:00", "formatted": "Terça-feira, 06 de Agosto às 14:00"}
         ]
-        response_slots = handler.get_chat_response(
+        response_slots = run(handler.get_chat_response(
             user_message="Ok, pode me mostrar os horários", # Mensagem irrelevante aqui, contexto manda
             conversation_history=[],
             current_schedule_state="awaiting_choice",
             patient_data={"name": "Ciclana", "phone": "11999998888", "email":"c@c.com", "procedure":"Consulta Geral", "indication":"Amiga"},
             available_slots_context=slots_test # <--- Passando os slots formatados
-        )
+        ))
         print(f"Contexto: Apresentar slots {json.dumps(slots_test, indent=2, ensure_ascii=False)}")
         print(f"Margot (esperado apresentar slots e pedir número): {response_slots}")
\ No newline at end of file
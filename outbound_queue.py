@@ -0,0 +1,146 @@
+# outbound_queue.py (v1.1 - Fila Assíncrona de Envio de Mensagens)
+import asyncio
+import logging
+import random
+from typing import Callable, Dict, List, Optional, Any, Tuple
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PACING_SECONDS = 0.8 # Intervalo entre partes para o mesmo destinatário (mantém a ordem no WhatsApp)
+DEFAULT_MAX_RETRIES = 3
+DEFAULT_BACKOFF_BASE = 1.0
+DEFAULT_MAX_CONCURRENT_SENDS = 10 # Envios simultâneos ao Twilio (todos os destinatários)
+DEFAULT_WORKER_IDLE_SECONDS = 30.0 # Worker do destinatário encerra após ficar ocioso
+
+def _is_retryable(error: Exception) -> bool:
+    """Erros 4xx do Twilio (exceto 429) não adiantam repetir (número inválido, corpo inválido etc.)."""
+    status = getattr(error, 'status', None)
+    if isinstance(status, int) and 400 <= status < 500 and status != 429:
+        return False
+    return True
+
+class OutboundQueue:
+    """
+    Fila de saída de mensagens com um worker por destinatário.
+    - Partes do mesmo destinatário são enviadas em ordem, com pacing entre elas.
+    - Destinatários diferentes são atendidos em paralelo (limitados por max_concurrent_sends).
+    - Cada parte guarda o número remetente (from_, ex.: o WhatsApp da clínica); send_func(to, body, from_).
+    - send_func é síncrona (cliente Twilio) e roda em thread (asyncio.to_thread), sem bloquear o event loop.
+    - Falhas transitórias são repetidas com backoff exponencial + jitter.
+    """
+    def __init__(self, send_func: Callable[[str, str, Optional[str]], Any],
+                 pacing_seconds: float = DEFAULT_PACING_SECONDS, max_retries: int = DEFAULT_MAX_RETRIES,
+                 backoff_base: float = DEFAULT_BACKOFF_BASE, max_concurrent_sends: int = DEFAULT_MAX_CONCURRENT_SENDS,
+                 worker_idle_seconds: float = DEFAULT_WORKER_IDLE_SECONDS):
+        self.send_func = send_func
+        self.pacing_seconds = pacing_seconds
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.worker_idle_seconds = worker_idle_seconds
+        self._send_semaphore = asyncio.Semaphore(max_concurrent_sends)
+        self._queues: Dict[str, asyncio.Queue] = {}
+        self._workers: Dict[str, asyncio.Task] = {}
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+
+    def enqueue(self, to: str, parts: List[str], initial_delay: Optional[float] = None, from_: Optional[str] = None):
+        """
+        Agenda o envio das partes para 'to' (chamar com o event loop rodando).
+        initial_delay: espera antes da primeira parte (ex.: dar tempo ao TwiML da resposta chegar antes).
+        from_: número remetente (None: o padrão de send_func).
+        """
+        parts = [part for part in parts if part and part.strip()]
+        if not parts:
+            return
+        queue = self._queues.get(to)
+        if queue is None:
+            queue = self._queues[to] = asyncio.Queue()
+        delay = self.pacing_seconds if initial_delay is None else initial_delay
+        for index, part in enumerate(parts):
+            queue.put_nowait((part, delay if index == 0 else self.pacing_seconds, from_))
+        worker = self._workers.get(to)
+        if worker is None or worker.done():
+            self._workers[to] = asyncio.get_running_loop().create_task(self._worker(to, queue))
+        logger.debug(f"{len(parts)} parte(s) enfileirada(s) para {to}. Pendentes: {queue.qsize()}.")
+
+    async def _worker(self, to: str, queue: asyncio.Queue):
+        try:
+            while True:
+                try:
+                    part, delay, from_ = await asyncio.wait_for(queue.get(), timeout=self.worker_idle_seconds)
+                except asyncio.TimeoutError:
+                    if queue.empty():
+                        break
+                    continue
+                try:
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                    await self._send_with_retry(to, part, from_)
+                finally:
+                    queue.task_done()
+        finally:
+            if self._queues.get(to) is queue and queue.empty():
+                self._queues.pop(to, None)
+            if self._workers.get(to) is asyncio.current_task():
+                self._workers.pop(to, None)
+
+    async def _send_with_retry(self, to: str, body: str, from_: Optional[str] = None):
+        attempt = 0
+        while True:
+            try:
+                async with self._send_semaphore:
+                    await asyncio.to_thread(self.send_func, to, body, from_)
+                self.sent += 1
+                logger.debug(f"Parte enviada para {to} ({len(body)} chars).")
+                return
+            except Exception as e_send:
+                attempt += 1
+                if attempt > self.max_retries or not _is_retryable(e_send):
+                    self.failed += 1
+                    logger.error(f"Falha definitiva ao enviar parte para {to} após {attempt} tentativa(s): {e_send}", exc_info=True)
+                    return
+                self.retried += 1
+                delay = random.uniform(0, self.backoff_base * (2 ** attempt))
+                logger.warning(f"Erro ao enviar parte para {to} (tentativa {attempt}/{self.max_retries}). Nova tentativa em {delay:.2f}s: {e_send}")
+                await asyncio.sleep(delay)
+
+    def metrics(self) -> Dict[str, Any]:
+        return {
+            "sent": self.sent,
+            "failed": self.failed,
+            "retried": self.retried,
+            "pending": sum(queue.qsize() for queue in self._queues.values()),
+            "active_recipients": len(self._workers),
+        }
+
+    async def aclose(self, drain_timeout: float = 10.0):
+        """Espera (até drain_timeout) as filas esvaziarem e encerra os workers."""
+        pending = [queue.join() for queue in list(self._queues.values())]
+        if pending:
+            try:
+                await asyncio.wait_for(asyncio.gather(*pending), timeout=drain_timeout)
+            except asyncio.TimeoutError:
+                logger.warning(f"Fila de saída não esvaziou em {drain_timeout}s. {self.metrics()['pending']} parte(s) descartada(s).")
+        for worker in list(self._workers.values()):
+            worker.cancel()
+        await asyncio.gather(*self._workers.values(), return_exceptions=True)
+        self._workers.clear(); self._queues.clear()
+
+def split_message(text: str, max_bytes: int) -> Tuple[str, ...]:
+    """Divide um texto longo em partes, preferindo quebrar em linha ou espaço após metade do limite."""
+    parts = []
+    remaining = text
+    while len(remaining.encode('utf-8')) > max_bytes:
+        best_newline = remaining.rfind('\n', 0, max_bytes)
+        if best_newline != -1 and best_newline > max_bytes // 2: split_point = best_newline
+        else:
+            best_space = remaining.rfind(' ', 0, max_bytes)
+            if best_space != -1 and best_space > max_bytes // 2: split_point = best_space
+            else: split_point = max_bytes
+        part = remaining[:split_point].strip()
+        remaining = remaining[split_point:].strip()
+        if part: parts.append(part)
+    if remaining:
+        parts.append(remaining)
+    return tuple(parts)
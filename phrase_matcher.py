@@ -0,0 +1,77 @@
+# phrase_matcher.py (v1.0 - Busca de Frases em Uma Passada / Aho-Corasick)
+from collections import deque
+from typing import Dict, Iterable, List, Set, Tuple
+
+def _is_word_char(char: str) -> bool:
+    """Mesma definição de \\w do módulo re para str (letras/dígitos Unicode e '_')."""
+    return char.isalnum() or char == '_'
+
+class PhraseMatcher:
+    """
+    Autômato Aho-Corasick sobre um conjunto fixo de frases (construído uma vez).
+    find_all percorre o texto uma única vez e devolve todas as ocorrências, inclusive sobrepostas,
+    aplicando a mesma regra de fronteira de r'\\b' + re.escape(frase) + r'\\b'.
+    """
+    def __init__(self, phrases: Iterable[str]):
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._output: List[List[str]] = [[]]
+        self.phrases: Set[str] = set()
+        for phrase in phrases:
+            if phrase and phrase not in self.phrases:
+                self.phrases.add(phrase)
+                self._add(phrase)
+        self._build_failure_links()
+
+    def __len__(self) -> int:
+        return len(self.phrases)
+
+    def _add(self, phrase: str):
+        state = 0
+        for char in phrase:
+            next_state = self._goto[state].get(char)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto[state][char] = next_state
+                self._goto.append({}); self._fail.append(0); self._output.append([])
+            state = next_state
+        self._output[state].append(phrase)
+
+    def _build_failure_links(self):
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fallback = self._fail[state]
+                while fallback and char not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                candidate = self._goto[fallback].get(char, 0)
+                self._fail[next_state] = candidate if candidate != next_state else 0
+                self._output[next_state] = self._output[next_state] + self._output[self._fail[next_state]]
+
+    def find_all(self, text: str) -> List[Tuple[int, int, str]]:
+        """Lista de (início, fim, frase) para cada ocorrência com fronteira de palavra nas duas pontas."""
+        matches = []
+        state = 0
+        text_len = len(text)
+        for index, char in enumerate(text):
+            while state and char not in self._goto[state]:
+                state = self._fail[state]
+            state = self._goto[state].get(char, 0)
+            for phrase in self._output[state]:
+                start = index - len(phrase) + 1
+                end = index + 1
+                if self._is_boundary(text, start, text_len) and self._is_boundary(text, end, text_len):
+                    matches.append((start, end, phrase))
+        return matches
+
+    def found(self, text: str) -> Set[str]:
+        """Conjunto das frases presentes no texto (como palavras/expressões inteiras)."""
+        return {phrase for _, _, phrase in self.find_all(text)}
+
+    @staticmethod
+    def _is_boundary(text: str, position: int, text_len: int) -> bool:
+        before = position > 0 and _is_word_char(text[position - 1])
+        after = position < text_len and _is_word_char(text[position])
+        return before != after
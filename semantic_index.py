@@ -0,0 +1,185 @@
+# semantic_index.py (v1.2 - Busca Semântica Local com Índice Vetorial Persistido)
+import hashlib
+import json
+import logging
+import os
+from typing import Callable, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+try:
+    import numpy as np
+except ImportError: # Dependência opcional: sem numpy a busca semântica fica desativada
+    np = None
+
+from bm25_index import KnowledgeChunk, SearchHit
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_EMBEDDING_MODEL = "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2" # Pequeno, multilíngue, roda em CPU
+DEFAULT_INDEX_DIR = "semantic_index"
+EMBEDDINGS_FILENAME = "embeddings.npy"
+MANIFEST_FILENAME = "manifest.json"
+SEMANTIC_MIN_SIMILARITY = 0.45 # Similaridade (cosseno) mínima para aceitar um bloco só pelo vetor
+HYBRID_VECTOR_WEIGHT = 0.6 # Peso do cosseno na fusão; o restante vai para o BM25 normalizado
+
+Encoder = Callable[[List[str]], "np.ndarray"]
+
+class SemanticHit(NamedTuple):
+    similarity: float
+    chunk: KnowledgeChunk
+
+class HybridHit(NamedTuple):
+    score: float # Fusão ponderada (0..1)
+    similarity: float # Cosseno do vetor (0 se o bloco não veio da busca vetorial)
+    keyword_score: float # BM25 bruto (0 se o bloco não veio da busca por palavras)
+    matched_terms: int
+    chunk: KnowledgeChunk
+
+def is_available() -> bool:
+    return np is not None
+
+def sentence_transformer_encoder(model_name: str = DEFAULT_EMBEDDING_MODEL) -> Encoder:
+    """Encoder local (CPU) via sentence-transformers, carregado só quando a busca semântica é ativada."""
+    from sentence_transformers import SentenceTransformer # Import tardio: dependência opcional e pesada
+    model = SentenceTransformer(model_name, device="cpu")
+    def encode(texts: List[str]):
+        return model.encode(texts, batch_size=32, convert_to_numpy=True, normalize_embeddings=True, show_progress_bar=False)
+    return encode
+
+def _content_hash(model_name: str, text: str) -> str:
+    return hashlib.sha1(f"{model_name}\n{text}".encode("utf-8")).hexdigest()
+
+def _chunk_text(chunk: KnowledgeChunk) -> str:
+    return f"{chunk.title}\n{chunk.content}"
+
+class SemanticIndex:
+    """
+    Índice vetorial dos blocos da base, persistido em disco (matriz float32 memory-mapped + manifesto JSON).
+    - sync() recalcula embeddings apenas dos blocos cujo hash de conteúdo mudou; os demais são copiados da matriz anterior.
+    - search() faz o top-k por cosseno de forma vetorizada (vetores já normalizados: produto escalar).
+    - Matriz e blocos ficam numa única tupla, trocada de uma vez.
+    - Hot reload: staging_copy() devolve um índice vazio (mesmo encoder/diretório); o sync roda na cópia, em thread, e
+      ela é trocada junto com os blocos/BM25. O índice em uso nunca vê vetores de uma versão da base que ainda não entrou.
+    """
+    def __init__(self, encoder: Encoder, model_name: str = DEFAULT_EMBEDDING_MODEL, index_dir: str = DEFAULT_INDEX_DIR):
+        if np is None:
+            raise RuntimeError("numpy não está instalado; busca semântica indisponível.")
+        self.encoder = encoder
+        self.model_name = model_name
+        self.index_dir = index_dir
+        self._state: Tuple[Optional["np.ndarray"], List[KnowledgeChunk]] = (None, []) # (np.memmap (n, dim) somente leitura, blocos)
+        self.embedded_last_sync = 0
+
+    @property
+    def embeddings_path(self) -> str:
+        return os.path.join(self.index_dir, EMBEDDINGS_FILENAME)
+
+    @property
+    def manifest_path(self) -> str:
+        return os.path.join(self.index_dir, MANIFEST_FILENAME)
+
+    def __len__(self) -> int:
+        return len(self._state[1])
+
+    def staging_copy(self) -> "SemanticIndex":
+        return SemanticIndex(self.encoder, self.model_name, self.index_dir)
+
+    def _load_previous(self) -> Tuple[Dict[str, int], Optional["np.ndarray"]]:
+        """hash -> linha da matriz persistida anterior (se o modelo for o mesmo)."""
+        try:
+            with open(self.manifest_path, 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+            if manifest.get("model") != self.model_name:
+                logger.info(f"Índice semântico em disco usa outro modelo ({manifest.get('model')}). Recalculando tudo.")
+                return {}, None
+            matrix = np.load(self.embeddings_path, mmap_mode='r')
+            rows = {row["hash"]: position for position, row in enumerate(manifest.get("rows", []))}
+            if len(rows) and matrix.shape[0] < max(rows.values()) + 1:
+                logger.warning("Manifesto do índice semântico não confere com a matriz. Recalculando tudo.")
+                return {}, None
+            return rows, matrix
+        except FileNotFoundError:
+            return {}, None
+        except Exception as e:
+            logger.warning(f"Falha ao ler índice semântico em {self.index_dir}: {e}. Recalculando tudo.")
+            return {}, None
+
+    def sync(self, chunks: Sequence[KnowledgeChunk]):
+        """Alinha o índice em disco com os blocos atuais, reaproveitando embeddings inalterados."""
+        chunks = list(chunks)
+        hashes = [_content_hash(self.model_name, _chunk_text(chunk)) for chunk in chunks]
+        previous_rows, previous_matrix = self._load_previous()
+        missing = [position for position, content_hash in enumerate(hashes) if content_hash not in previous_rows]
+
+        new_vectors = None
+        if missing:
+            new_vectors = np.asarray(self.encoder([_chunk_text(chunks[position]) for position in missing]), dtype=np.float32)
+            norms = np.linalg.norm(new_vectors, axis=1, keepdims=True)
+            new_vectors /= np.where(norms == 0, 1.0, norms)
+        dim = new_vectors.shape[1] if new_vectors is not None else (previous_matrix.shape[1] if previous_matrix is not None else 0)
+
+        unchanged_manifest = previous_matrix is not None and not missing and len(previous_rows) == len(hashes) and \
+            all(previous_rows[content_hash] == position for position, content_hash in enumerate(hashes))
+        if not unchanged_manifest and chunks:
+            os.makedirs(self.index_dir, exist_ok=True)
+            tmp_embeddings = self.embeddings_path + ".tmp.npy"
+            matrix = np.lib.format.open_memmap(tmp_embeddings, mode='w+', dtype=np.float32, shape=(len(chunks), dim))
+            missing_rows = {position: row for row, position in enumerate(missing)}
+            for position, content_hash in enumerate(hashes):
+                if position in missing_rows: matrix[position] = new_vectors[missing_rows[position]]
+                else: matrix[position] = previous_matrix[previous_rows[content_hash]]
+            matrix.flush(); del matrix
+            previous_matrix = None # Libera o mmap antigo antes de substituir o arquivo
+            os.replace(tmp_embeddings, self.embeddings_path)
+            tmp_manifest = self.manifest_path + ".tmp"
+            with open(tmp_manifest, 'w', encoding='utf-8') as f:
+                json.dump({"model": self.model_name, "dim": dim,
+                           "rows": [{"chunk_id": chunk.chunk_id, "hash": content_hash} for chunk, content_hash in zip(chunks, hashes)]}, f)
+            os.replace(tmp_manifest, self.manifest_path)
+
+        self._state = (np.load(self.embeddings_path, mmap_mode='r') if chunks else None, chunks)
+        self.embedded_last_sync = len(missing)
+        logger.info(f"Índice semântico sincronizado: {len(chunks)} blocos, {len(missing)} embedding(s) recalculado(s).")
+
+    def search(self, query: str, k: int = 3, kinds: Optional[Tuple[str, ...]] = None) -> List[SemanticHit]:
+        matrix, chunks = self._state
+        if matrix is None or not query.strip():
+            return []
+        query_vector = np.asarray(self.encoder([query]), dtype=np.float32)[0]
+        norm = np.linalg.norm(query_vector)
+        if norm == 0:
+            return []
+        similarities = matrix @ (query_vector / norm)
+        if kinds:
+            allowed = np.fromiter((chunk.kind in kinds for chunk in chunks), dtype=bool, count=len(chunks))
+            similarities = np.where(allowed, similarities, -np.inf)
+        k = min(k, len(similarities))
+        top = np.argpartition(-similarities, k - 1)[:k]
+        top = top[np.argsort(-similarities[top])]
+        return [SemanticHit(float(similarities[row]), chunks[row]) for row in top if np.isfinite(similarities[row])]
+
+def fuse_hits(keyword_hits: Sequence[SearchHit], semantic_hits: Sequence[SemanticHit], k: int = 3,
+              vector_weight: float = HYBRID_VECTOR_WEIGHT) -> List[HybridHit]:
+    """Fusão ponderada: cosseno (0..1) e BM25 normalizado pelo maior score da consulta."""
+    max_keyword = max((hit.score for hit in keyword_hits), default=0.0)
+    merged: Dict[str, List] = {}
+    for hit in keyword_hits:
+        merged[hit.chunk.chunk_id] = [0.0, hit.score, hit.matched_terms, hit.chunk]
+    for hit in semantic_hits:
+        entry = merged.setdefault(hit.chunk.chunk_id, [0.0, 0.0, 0, hit.chunk])
+        entry[0] = max(hit.similarity, 0.0)
+    fused = []
+    for similarity, keyword_score, matched_terms, chunk in merged.values():
+        keyword_norm = keyword_score / max_keyword if max_keyword else 0.0
+        score = vector_weight * similarity + (1 - vector_weight) * keyword_norm
+        fused.append(HybridHit(score, similarity, keyword_score, matched_terms, chunk))
+    fused.sort(key=lambda hit: hit.score, reverse=True)
+    return fused[:k]
+
+if __name__ == "__main__":
+    # Geração offline do índice: python semantic_index.py [knowledge_base.json]
+    import sys
+    from knowledge_handler import KnowledgeHandler
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    model_name = os.getenv("SEMANTIC_MODEL", DEFAULT_EMBEDDING_MODEL)
+    semantic_index = SemanticIndex(sentence_transformer_encoder(model_name), model_name, os.getenv("SEMANTIC_INDEX_DIR", DEFAULT_INDEX_DIR))
+    KnowledgeHandler(json_file_path=sys.argv[1] if len(sys.argv) > 1 else "knowledge_base.json", semantic_index=semantic_index)
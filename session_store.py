@@ -0,0 +1,326 @@
+# session_store.py (v1.2 - Sessões com Limite de Memória e Lock por Remetente)
+import copy
+import json
+import time
+import asyncio
+import logging
+import datetime
+import contextlib
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Dict, Any, Optional, AsyncIterator
+
+import pytz
+import redis.asyncio as aioredis
+from redis.exceptions import LockError
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SESSION_TTL_SECONDS = 24 * 60 * 60
+DEFAULT_MAX_SESSIONS = 5000 # Limite de sessões residentes no backend em memória (LRU)
+DEFAULT_SWEEP_INTERVAL_SECONDS = 60
+DEFAULT_LOCK_WAIT_SECONDS = 30.0 # Quanto uma mensagem espera a anterior do mesmo remetente terminar
+DEFAULT_LOCK_TTL_SECONDS = 60 # Expiração do lock no Redis (libera se o worker morrer no meio)
+LOCK_KEY_PREFIX = "lock:sessao:"
+SESSION_KEY_PREFIX = "sessao:"
+PATIENT_MEMORY_KEY_PREFIX = "memoria:" # Dados do paciente após agendamento (mesma chave usada antes)
+DATETIME_TAG = "$dt"
+
+def _encode_value(value: Any) -> Any:
+    """datetimes viram {"$dt": ISO-8601}; dicts/listas são percorridos recursivamente."""
+    if isinstance(value, datetime.datetime):
+        return {DATETIME_TAG: value.isoformat()}
+    if isinstance(value, dict):
+        return {k: _encode_value(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_encode_value(v) for v in value]
+    return value
+
+def serialize_session(session: Dict[str, Any]) -> str:
+    return json.dumps(_encode_value(session), ensure_ascii=False)
+
+def deserialize_session(raw: str, tz: Optional[pytz.BaseTzInfo] = None) -> Dict[str, Any]:
+    """Inverso de serialize_session. Com tz, os datetimes voltam convertidos para o fuso da clínica."""
+    def object_hook(obj: Dict[str, Any]) -> Any:
+        if len(obj) == 1 and DATETIME_TAG in obj:
+            dt = datetime.datetime.fromisoformat(obj[DATETIME_TAG])
+            return dt.astimezone(tz) if tz and dt.tzinfo else dt
+        return obj
+    return json.loads(raw, object_hook=object_hook)
+
+class SessionLockTimeout(Exception):
+    """A mensagem anterior do mesmo remetente não terminou dentro do prazo de espera."""
+    pass
+
+class SessionStore(ABC):
+    """
+    Interface de armazenamento das sessões do webhook.
+    - lock(sender_id): serializa o processamento das mensagens de um mesmo remetente (ordem de chegada).
+    - load(sender_id): sessão existente ou nova (a partir do estado padrão + memória do paciente).
+    - save(sender_id, session): persiste a sessão inteira (histórico, estado, slots, evento em edição).
+    - save_patient_memory(sender_id, data): guarda os dados do paciente após um agendamento.
+    """
+    def __init__(self, default_state: Dict[str, Any], tz: Optional[pytz.BaseTzInfo] = None,
+                 lock_wait_seconds: float = DEFAULT_LOCK_WAIT_SECONDS):
+        self.default_state = default_state
+        self.tz = tz
+        self.lock_wait_seconds = lock_wait_seconds
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._lock_users: Dict[str, int] = {} # Locks sem ninguém esperando são descartados
+
+    @contextlib.asynccontextmanager
+    async def _local_lock(self, sender_id: str, timeout: float) -> AsyncIterator[None]:
+        """asyncio.Lock por remetente (FIFO dentro do worker); diferentes remetentes não se bloqueiam."""
+        lock = self._locks.setdefault(sender_id, asyncio.Lock())
+        self._lock_users[sender_id] = self._lock_users.get(sender_id, 0) + 1
+        try:
+            try:
+                await asyncio.wait_for(lock.acquire(), timeout)
+            except asyncio.TimeoutError:
+                raise SessionLockTimeout(f"Lock da sessão {sender_id} não obtido em {timeout:g}s")
+            try:
+                yield
+            finally:
+                lock.release()
+        finally:
+            self._lock_users[sender_id] -= 1
+            if not self._lock_users[sender_id]:
+                del self._lock_users[sender_id]
+                self._locks.pop(sender_id, None)
+
+    @contextlib.asynccontextmanager
+    async def lock(self, sender_id: str) -> AsyncIterator[None]:
+        async with self._local_lock(sender_id, self.lock_wait_seconds):
+            yield
+
+    def new_session(self, patient_memory: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        session = copy.deepcopy(self.default_state)
+        if patient_memory:
+            session["patient_data"].update(patient_memory)
+        return session
+
+    @abstractmethod
+    async def load(self, sender_id: str) -> Dict[str, Any]: ...
+
+    @abstractmethod
+    async def save(self, sender_id: str, session: Dict[str, Any]): ...
+
+    @abstractmethod
+    async def delete(self, sender_id: str): ...
+
+    @abstractmethod
+    async def save_patient_memory(self, sender_id: str, data: Dict[str, Any]): ...
+
+    async def check(self):
+        """Verifica se o backend está acessível (levanta exceção se não estiver). Chamado na subida da aplicação."""
+        pass
+
+    def start(self):
+        """Inicia tarefas de manutenção em background (chamar com o event loop rodando)."""
+        pass
+
+    def metrics(self) -> Dict[str, Any]:
+        return {"backend": type(self).__name__}
+
+    async def aclose(self):
+        pass
+
+class InMemorySessionStore(SessionStore):
+    """
+    Sessões em memória do processo (um único worker; perdidas ao reiniciar), com limite de memória:
+    - LRU com no máximo max_entries sessões (a menos usada é descartada ao inserir uma nova).
+    - Sessões sem atividade há mais de idle_timeout_seconds são removidas pela varredura em background.
+    - Métricas: sessões residentes, evicções (LRU/ociosidade) e bytes estimados (JSON da sessão).
+    """
+    def __init__(self, default_state: Dict[str, Any], tz: Optional[pytz.BaseTzInfo] = None,
+                 max_entries: int = DEFAULT_MAX_SESSIONS, idle_timeout_seconds: int = DEFAULT_SESSION_TTL_SECONDS,
+                 sweep_interval_seconds: int = DEFAULT_SWEEP_INTERVAL_SECONDS,
+                 lock_wait_seconds: float = DEFAULT_LOCK_WAIT_SECONDS):
+        super().__init__(default_state, tz, lock_wait_seconds)
+        self.max_entries = max_entries
+        self.idle_timeout_seconds = idle_timeout_seconds
+        self.sweep_interval_seconds = sweep_interval_seconds
+        self.sessions: "OrderedDict[str, Dict[str, Any]]" = OrderedDict() # Ordem = recência de uso
+        self.last_seen: Dict[str, float] = {}
+        self.session_bytes: Dict[str, int] = {}
+        self.patient_memory: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self.evictions_lru = 0
+        self.evictions_idle = 0
+        self._sweeper: Optional[asyncio.Task] = None
+
+    def _touch(self, sender_id: str):
+        self.sessions.move_to_end(sender_id)
+        self.last_seen[sender_id] = time.monotonic()
+
+    def _drop(self, sender_id: str):
+        self.sessions.pop(sender_id, None)
+        self.last_seen.pop(sender_id, None)
+        self.session_bytes.pop(sender_id, None)
+
+    def _enforce_capacity(self):
+        while len(self.sessions) > self.max_entries:
+            oldest_id = next(iter(self.sessions))
+            self._drop(oldest_id)
+            self.evictions_lru += 1
+            logger.debug(f"Sessão {oldest_id} descartada (LRU, limite {self.max_entries}).")
+        while len(self.patient_memory) > self.max_entries:
+            self.patient_memory.popitem(last=False)
+
+    async def load(self, sender_id: str) -> Dict[str, Any]:
+        if sender_id not in self.sessions:
+            self.sessions[sender_id] = self.new_session(self.patient_memory.get(sender_id))
+            logger.info(f"Nova sessão criada para {sender_id}")
+        self._touch(sender_id)
+        self._enforce_capacity()
+        return self.sessions[sender_id]
+
+    async def save(self, sender_id: str, session: Dict[str, Any]):
+        self.sessions[sender_id] = session
+        self._touch(sender_id)
+        try:
+            self.session_bytes[sender_id] = len(serialize_session(session).encode('utf-8'))
+        except (TypeError, ValueError) as e_size:
+            logger.debug(f"Não foi possível medir sessão {sender_id}: {e_size}")
+        self._enforce_capacity()
+
+    async def delete(self, sender_id: str):
+        self._drop(sender_id)
+
+    async def save_patient_memory(self, sender_id: str, data: Dict[str, Any]):
+        self.patient_memory.setdefault(sender_id, {}).update({k: v for k, v in data.items() if v is not None})
+        self.patient_memory.move_to_end(sender_id)
+        self._enforce_capacity()
+
+    def sweep(self) -> int:
+        """Remove sessões ociosas. Como o dict está em ordem de uso, para na primeira sessão ainda ativa."""
+        cutoff = time.monotonic() - self.idle_timeout_seconds
+        removed = 0
+        while self.sessions:
+            oldest_id = next(iter(self.sessions))
+            if self.last_seen.get(oldest_id, 0) > cutoff:
+                break
+            self._drop(oldest_id)
+            removed += 1
+        if removed:
+            self.evictions_idle += removed
+            logger.info(f"Varredura de sessões: {removed} sessão(ões) ociosa(s) removida(s). Residentes: {len(self.sessions)}.")
+        return removed
+
+    async def _sweep_loop(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval_seconds)
+            try:
+                self.sweep()
+            except Exception as e_sweep:
+                logger.error(f"Erro na varredura de sessões: {e_sweep}", exc_info=True)
+
+    def start(self):
+        if self._sweeper is None or self._sweeper.done():
+            self._sweeper = asyncio.get_running_loop().create_task(self._sweep_loop())
+
+    def metrics(self) -> Dict[str, Any]:
+        return {
+            "backend": type(self).__name__,
+            "sessions": len(self.sessions),
+            "max_sessions": self.max_entries,
+            "idle_timeout_seconds": self.idle_timeout_seconds,
+            "evictions_lru": self.evictions_lru,
+            "evictions_idle": self.evictions_idle,
+            "resident_bytes": sum(self.session_bytes.values()),
+            "patient_memory_entries": len(self.patient_memory),
+        }
+
+    async def aclose(self):
+        if self._sweeper:
+            self._sweeper.cancel()
+            try: await self._sweeper
+            except asyncio.CancelledError: pass
+            self._sweeper = None
+
+class RedisSessionStore(SessionStore):
+    """
+    Sessões no Redis (compartilhadas entre workers/hosts, sem sticky sessions).
+    - Pool de conexões único (redis.asyncio) para todo o processo.
+    - Sessão inteira serializada em JSON em 'sessao:{sender}', com TTL renovado a cada save.
+    - load lê sessão e memória do paciente em um único pipeline (uma ida ao Redis).
+    - lock combina o lock local (ordem FIFO no worker) com um lock no Redis (exclusão entre workers).
+    Falhas do Redis são logadas e o atendimento segue com uma sessão nova, como antes.
+    """
+    def __init__(self, default_state: Dict[str, Any], redis_url: str,
+                 ttl_seconds: int = DEFAULT_SESSION_TTL_SECONDS, tz: Optional[pytz.BaseTzInfo] = None,
+                 max_connections: int = 50, lock_wait_seconds: float = DEFAULT_LOCK_WAIT_SECONDS,
+                 lock_ttl_seconds: int = DEFAULT_LOCK_TTL_SECONDS):
+        super().__init__(default_state, tz, lock_wait_seconds)
+        self.ttl_seconds = ttl_seconds
+        self.lock_ttl_seconds = lock_ttl_seconds
+        self.pool = aioredis.ConnectionPool.from_url(redis_url, decode_responses=True, max_connections=max_connections)
+        self.redis = aioredis.Redis(connection_pool=self.pool)
+
+    @contextlib.asynccontextmanager
+    async def lock(self, sender_id: str) -> AsyncIterator[None]:
+        deadline = time.monotonic() + self.lock_wait_seconds
+        async with self._local_lock(sender_id, self.lock_wait_seconds):
+            redis_lock = self.redis.lock(
+                f"{LOCK_KEY_PREFIX}{sender_id}", timeout=self.lock_ttl_seconds,
+                blocking_timeout=max(0.1, deadline - time.monotonic())
+            )
+            try:
+                acquired = await redis_lock.acquire()
+            except Exception as e_redis_lock:
+                logger.error(f"[{sender_id}] Erro ao obter lock no Redis (seguindo só com o lock local): {e_redis_lock}")
+                acquired = None
+            if acquired is False:
+                raise SessionLockTimeout(f"Lock Redis da sessão {sender_id} não obtido em {self.lock_wait_seconds:g}s")
+            try:
+                yield
+            finally:
+                if acquired:
+                    try:
+                        await redis_lock.release()
+                    except LockError:
+                        logger.warning(f"[{sender_id}] Lock Redis expirou antes do fim do processamento ({self.lock_ttl_seconds}s).")
+                    except Exception as e_release:
+                        logger.error(f"[{sender_id}] Erro ao liberar lock no Redis: {e_release}")
+
+    async def load(self, sender_id: str) -> Dict[str, Any]:
+        try:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                pipe.get(f"{SESSION_KEY_PREFIX}{sender_id}")
+                pipe.hgetall(f"{PATIENT_MEMORY_KEY_PREFIX}{sender_id}")
+                raw_session, patient_memory = await pipe.execute()
+        except Exception as e_redis_load:
+            logger.error(f"[{sender_id}] Erro ao carregar sessão do Redis: {e_redis_load}", exc_info=True)
+            return self.new_session()
+        if raw_session:
+            try:
+                return deserialize_session(raw_session, self.tz)
+            except (ValueError, TypeError) as e_decode:
+                logger.error(f"[{sender_id}] Sessão inválida no Redis, criando nova: {e_decode}")
+        logger.info(f"Nova sessão criada para {sender_id}")
+        if patient_memory:
+            logger.info(f"[{sender_id}] Dados anteriores do paciente carregados da memória Redis.")
+        return self.new_session(patient_memory)
+
+    async def save(self, sender_id: str, session: Dict[str, Any]):
+        try:
+            await self.redis.set(f"{SESSION_KEY_PREFIX}{sender_id}", serialize_session(session), ex=self.ttl_seconds)
+        except Exception as e_redis_save:
+            logger.error(f"[{sender_id}] Erro ao salvar sessão no Redis: {e_redis_save}", exc_info=True)
+
+    async def delete(self, sender_id: str):
+        await self.redis.delete(f"{SESSION_KEY_PREFIX}{sender_id}")
+
+    async def save_patient_memory(self, sender_id: str, data: Dict[str, Any]):
+        mapping = {k: v for k, v in data.items() if v is not None}
+        if mapping:
+            await self.redis.hset(f"{PATIENT_MEMORY_KEY_PREFIX}{sender_id}", mapping=mapping)
+
+    async def check(self):
+        await self.redis.ping()
+
+    def metrics(self) -> Dict[str, Any]:
+        return {"backend": type(self).__name__, "ttl_seconds": self.ttl_seconds}
+
+    async def aclose(self):
+        await self.redis.aclose()
+        await self.pool.disconnect()
@@ -0,0 +1,203 @@
+# slot_holds.py (v1.1 - Reservas Provisórias de Horários com TTL e Conflito por Sobreposição)
+import time
+import datetime
+import logging
+from abc import ABC, abstractmethod
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_HOLD_TTL_SECONDS = 10 * 60 # Tempo para o paciente escolher/confirmar antes do horário voltar para os outros
+HOLD_KEY_PREFIX = "reserva:"
+HOLD_INDEX_PREFIX = "reservas:" # Sorted set por clínica (score = início em epoch) para listar as reservas ativas
+HOLD_LOOKBACK_SECONDS = 24 * 3600 # Reservas que começaram antes disso não são mais consideradas (nem listadas)
+
+HeldInterval = Tuple[datetime.datetime, datetime.datetime]
+
+# Reserva só se nenhum outro paciente tiver um intervalo que se sobreponha (não apenas o mesmo início): com durações
+# diferentes, 14:00-14:45 e 14:30-15:15 são horários distintos mas não podem ser oferecidos a dois pacientes.
+# Verificação e escrita no mesmo script (atômico entre workers). Valor da reserva: '{dono}|{fim em epoch}'.
+_HOLD_SCRIPT = """
+local start_ts, end_ts = tonumber(ARGV[4]), tonumber(ARGV[5])
+local slot_ids = redis.call('ZRANGEBYSCORE', KEYS[2], start_ts - tonumber(ARGV[7]), '(' .. ARGV[5])
+for _, slot_id in ipairs(slot_ids) do
+    local value = redis.call('GET', ARGV[6] .. slot_id)
+    if value then
+        local separator = string.find(value, '|', 1, true)
+        local held_end = separator and tonumber(string.sub(value, separator + 1))
+        if string.sub(value, 1, (separator or 0) - 1) ~= ARGV[1] and (held_end == nil or held_end > start_ts) then
+            return 0
+        end
+    end
+end
+redis.call('SET', KEYS[1], ARGV[1] .. '|' .. ARGV[5], 'PX', ARGV[2])
+redis.call('ZADD', KEYS[2], start_ts, ARGV[3])
+return 1
+"""
+
+# Apaga a reserva só se ainda pertencer ao remetente (não remove a reserva que outro paciente fez depois do TTL)
+_RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    redis.call('DEL', KEYS[1])
+    redis.call('ZREM', KEYS[2], ARGV[2])
+    return 1
+end
+return 0
+"""
+
+def _slot_id(start: datetime.datetime) -> str:
+    """Identificador estável do horário (UTC), igual entre workers e fusos."""
+    return start.astimezone(datetime.timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+
+def overlaps_any(start: datetime.datetime, end: datetime.datetime, intervals: Sequence[HeldInterval]) -> bool:
+    return any(held_start < end and start < held_end for held_start, held_end in intervals)
+
+class SlotHolds(ABC):
+    """
+    Interface comum: reserva provisória (TTL) dos horários apresentados a um paciente, para que a busca de outros
+    pacientes da mesma clínica não os ofereça ao mesmo tempo. Reserva é por (clínica, início); o dono é a chave da sessão.
+    - hold(): reserva os horários que não se sobrepõem a reserva alheia e devolve só os que ficaram com o remetente.
+    - release(): devolve horários (nova página, recusa, agendamento concluído ou falho).
+    - held_by_others(): intervalos reservados por outros pacientes (excluídos da busca).
+    """
+    def __init__(self, ttl_seconds: int = DEFAULT_HOLD_TTL_SECONDS):
+        self.ttl_seconds = ttl_seconds
+        self.holds = 0
+        self.conflicts = 0
+        self.releases = 0
+
+    async def hold(self, tenant_id: str, owner: str, slots: Sequence[datetime.datetime], duration_minutes: int) -> List[datetime.datetime]:
+        held = []
+        for slot in slots:
+            if await self._hold(tenant_id, owner, slot, slot + datetime.timedelta(minutes=duration_minutes)):
+                held.append(slot); self.holds += 1
+            else:
+                self.conflicts += 1
+                logger.info(f"[{owner}] Horário {slot.isoformat()} já reservado por outro paciente. Removido da lista.")
+        return held
+
+    async def release(self, tenant_id: str, owner: str, slots: Sequence[datetime.datetime]):
+        for slot in slots:
+            if await self._release(tenant_id, owner, slot): self.releases += 1
+
+    @abstractmethod
+    async def held_by_others(self, tenant_id: str, owner: str) -> List[HeldInterval]: ...
+
+    @abstractmethod
+    async def _hold(self, tenant_id: str, owner: str, start: datetime.datetime, end: datetime.datetime) -> bool: ...
+
+    @abstractmethod
+    async def _release(self, tenant_id: str, owner: str, start: datetime.datetime) -> bool: ...
+
+    def metrics(self) -> Dict[str, Any]:
+        return {
+            "backend": type(self).__name__,
+            "holds": self.holds,
+            "conflicts": self.conflicts,
+            "releases": self.releases,
+            "ttl_seconds": self.ttl_seconds,
+        }
+
+class InMemorySlotHolds(SlotHolds):
+    """Reservas no processo (um worker). Expiração verificada na leitura."""
+    def __init__(self, ttl_seconds: int = DEFAULT_HOLD_TTL_SECONDS):
+        super().__init__(ttl_seconds)
+        self.entries: Dict[Tuple[str, str], Tuple[str, datetime.datetime, datetime.datetime, float]] = {} # (clínica, slot) -> (dono, início, fim, expira_em)
+
+    def _active(self, key: Tuple[str, str]) -> Optional[Tuple[str, datetime.datetime, datetime.datetime, float]]:
+        entry = self.entries.get(key)
+        if entry is not None and entry[3] <= time.monotonic():
+            del self.entries[key]
+            return None
+        return entry
+
+    async def _hold(self, tenant_id: str, owner: str, start: datetime.datetime, end: datetime.datetime) -> bool:
+        if overlaps_any(start, end, await self.held_by_others(tenant_id, owner)): # Sem await real: verificação e escrita atômicas no loop
+            return False
+        self.entries[(tenant_id, _slot_id(start))] = (owner, start, end, time.monotonic() + self.ttl_seconds)
+        return True
+
+    async def _release(self, tenant_id: str, owner: str, start: datetime.datetime) -> bool:
+        key = (tenant_id, _slot_id(start))
+        entry = self._active(key)
+        if entry is None or entry[0] != owner:
+            return False
+        del self.entries[key]
+        return True
+
+    async def held_by_others(self, tenant_id: str, owner: str) -> List[HeldInterval]:
+        now = time.monotonic()
+        expired = [key for key, entry in self.entries.items() if entry[3] <= now]
+        for key in expired: del self.entries[key]
+        return [(start, end) for (entry_tenant, _), (entry_owner, start, end, _) in self.entries.items()
+                if entry_tenant == tenant_id and entry_owner != owner]
+
+    def metrics(self) -> Dict[str, Any]:
+        metrics = super().metrics()
+        metrics["entries"] = len(self.entries)
+        return metrics
+
+class RedisSlotHolds(SlotHolds):
+    """
+    Reservas compartilhadas entre workers: 'reserva:{clínica}:{slot}' = '{dono}|{fim}' (TTL) e um sorted set por clínica
+    para listar as reservas (entradas vencidas são limpas na leitura). Um script Lua verifica a sobreposição com reservas
+    alheias e grava a reserva de forma atômica (só um paciente fica com cada trecho da agenda). Usa o cliente/pool das sessões. Falhas do Redis não bloqueiam o agendamento (sem reserva, como antes).
+    """
+    def __init__(self, redis_client, ttl_seconds: int = DEFAULT_HOLD_TTL_SECONDS):
+        super().__init__(ttl_seconds)
+        self.redis = redis_client
+        self.errors = 0
+
+    async def _hold(self, tenant_id: str, owner: str, start: datetime.datetime, end: datetime.datetime) -> bool:
+        slot_id = _slot_id(start)
+        try:
+            return bool(await self.redis.eval(
+                _HOLD_SCRIPT, 2, f"{HOLD_KEY_PREFIX}{tenant_id}:{slot_id}", f"{HOLD_INDEX_PREFIX}{tenant_id}",
+                owner, self.ttl_seconds * 1000, slot_id, start.timestamp(), end.timestamp(), f"{HOLD_KEY_PREFIX}{tenant_id}:",
+                HOLD_LOOKBACK_SECONDS
+            )) # Já era do remetente: regrava e renova o TTL
+        except Exception as e_redis_hold:
+            self.errors += 1
+            logger.error(f"Erro ao reservar horário no Redis: {e_redis_hold}")
+            return True
+
+    async def _release(self, tenant_id: str, owner: str, start: datetime.datetime) -> bool:
+        slot_id = _slot_id(start)
+        key = f"{HOLD_KEY_PREFIX}{tenant_id}:{slot_id}"
+        try:
+            current = await self.redis.get(key)
+            if current is None or current.split("|", 1)[0] != owner:
+                return False
+            return bool(await self.redis.eval(_RELEASE_SCRIPT, 2, key, f"{HOLD_INDEX_PREFIX}{tenant_id}", current, slot_id))
+        except Exception as e_redis_release:
+            self.errors += 1
+            logger.error(f"Erro ao liberar reserva de horário no Redis: {e_redis_release}")
+            return False
+
+    async def held_by_others(self, tenant_id: str, owner: str) -> List[HeldInterval]:
+        index_key = f"{HOLD_INDEX_PREFIX}{tenant_id}"
+        try:
+            slot_ids = await self.redis.zrangebyscore(index_key, time.time() - HOLD_LOOKBACK_SECONDS, "+inf")
+            if not slot_ids:
+                return []
+            values = await self.redis.mget([f"{HOLD_KEY_PREFIX}{tenant_id}:{slot_id}" for slot_id in slot_ids])
+            expired = [slot_id for slot_id, value in zip(slot_ids, values) if value is None]
+            if expired: await self.redis.zrem(index_key, *expired)
+            await self.redis.zremrangebyscore(index_key, "-inf", time.time() - HOLD_LOOKBACK_SECONDS)
+        except Exception as e_redis_list:
+            self.errors += 1
+            logger.error(f"Erro ao listar reservas de horário no Redis: {e_redis_list}")
+            return []
+        intervals = []
+        for slot_id, value in zip(slot_ids, values):
+            if value is None: continue
+            value_owner, end_ts = value.split("|", 1)
+            if value_owner == owner: continue
+            start = datetime.datetime.strptime(slot_id, '%Y%m%dT%H%M%SZ').replace(tzinfo=datetime.timezone.utc)
+            intervals.append((start, datetime.datetime.fromtimestamp(float(end_ts), datetime.timezone.utc)))
+        return intervals
+
+    def metrics(self) -> Dict[str, Any]:
+        metrics = super().metrics()
+        metrics["errors"] = self.errors
+        return metrics
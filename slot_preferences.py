@@ -0,0 +1,227 @@
+# slot_preferences.py (v1.1 - Preferências de Horário em Texto Livre -> Restrições da Busca de Slots)
+import re
+import datetime
+import logging
+import unicodedata
+from typing import Any, Dict, NamedTuple, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+WEEKDAY_NAMES = ("segunda", "terca", "quarta", "quinta", "sexta", "sabado", "domingo") # Índice = weekday() (0=segunda)
+WEEKDAY_LABELS = ("segunda", "terça", "quarta", "quinta", "sexta", "sábado", "domingo")
+DAY_PERIODS = { # Período do dia -> janela de INÍCIO da consulta, em minutos desde a meia-noite [de, até)
+    "manha": (6 * 60, 12 * 60),
+    "tarde": (12 * 60, 18 * 60),
+    "noite": (18 * 60, 24 * 60),
+}
+PERIOD_LABELS = {"manha": "de manhã", "tarde": "à tarde", "noite": "à noite"}
+
+_WEEKDAY_RE = re.compile(r"\b(" + "|".join(WEEKDAY_NAMES) + r")s?(?:[\s-]*(feiras?))?\b")
+_ORDINAL_RE = re.compile(r"\s*(opcao|alternativa|horario|da lista)\b") # 'a segunda opção' é escolha da lista
+_PERIOD_RE = re.compile(r"\b(?:de|a|na|pela|da|durante a|no periodo da)\s+(manha|tarde|noite)\b") # 'boa tarde' não conta
+_HOUR = r"(\d{1,2})(?:\s*(?:h|:)\s*(\d{2})?|\s*horas?)"
+_AFTER_HOUR_RE = re.compile(r"\b(?:depois|apos|a partir)\s+(?:d?as|da|de)\s+" + _HOUR)
+_BEFORE_HOUR_RE = re.compile(r"\b(?:antes|ate)\s+(?:d?as|da)\s+" + _HOUR)
+_EXACT_HOUR_RE = re.compile(r"\b\d{1,2}\s*(?:h\b|:\d{2}|horas?\b)")
+_DATE = r"(?:o\s+)?(?:dia\s+)?(\d{1,2})(?:\s*/\s*(\d{1,2}))?"
+_AFTER_DATE_RE = re.compile(r"\b(depois|apos|a partir)\s+(?:d[oe]\s+)?" + _DATE + r"\b")
+_BEFORE_DATE_RE = re.compile(r"\b(antes|ate)\s+(?:d[oe]\s+|o\s+)?" + _DATE + r"\b")
+_ON_DATE_RE = re.compile(r"\b(?:no\s+)?dia\s+(\d{1,2})(?:\s*/\s*(\d{1,2}))?\b|\b(\d{1,2})\s*/\s*(\d{1,2})\b")
+_NAME_LEAD_WORDS = {"a", "o", "as", "os", "na", "no", "nas", "nos", "e", "ou", "de", "so", "ate", "depois", "antes", "toda", "todas",
+                    "pode", "ser", "prefiro", "melhor", "quero"} # 'Pode Ser Quinta' é preferência; 'Maria da Silva Segunda' é nome
+# Escolha por ordinal na lista: 'a segunda', 'o primeiro horário', 'a última'. Ordinais que também são dias da semana
+# só contam com artigo ('a segunda') ou com 'opção/horário' depois; 'na segunda' e 'segunda-feira' são dia da semana.
+ORDINALS = {"primeir": 1, "segund": 2, "terceir": 3, "quart": 4, "quint": 5, "sext": 6, "setim": 7, "oitav": 8, "decim": 10, "ultim": -1}
+_WEEKDAY_ORDINALS = {"segund", "quart", "quint", "sext"}
+_LISTED_ORDINAL_RE = re.compile(r"(?:\b(a|o)\s+)?\b(" + "|".join(ORDINALS) + r")[ao]\b(?!\s*-?\s*feira)(\s*(?:opcao|alternativa|horario|da lista))?")
+_LISTED_HOUR_RE = re.compile(r"\b(\d{1,2})\s*(?:h\b|:\d{2}|horas?\b)")
+
+class SlotPreferences(NamedTuple):
+    """Restrições extraídas da mensagem do paciente (None = sem restrição naquele eixo)."""
+    weekdays: Optional[Tuple[int, ...]] = None # 0=segunda ... 6=domingo
+    start_after_minute: Optional[int] = None # Início da consulta >= este minuto do dia
+    start_before_minute: Optional[int] = None # Início da consulta < este minuto do dia
+    earliest: Optional[datetime.date] = None
+    latest: Optional[datetime.date] = None # Inclusivo
+
+    def is_empty(self) -> bool:
+        return not any(value is not None for value in self)
+
+    def accepts(self, start: datetime.datetime) -> bool:
+        minute = start.hour * 60 + start.minute
+        if self.weekdays is not None and start.weekday() not in self.weekdays: return False
+        if self.start_after_minute is not None and minute < self.start_after_minute: return False
+        if self.start_before_minute is not None and minute >= self.start_before_minute: return False
+        if self.earliest is not None and start.date() < self.earliest: return False
+        if self.latest is not None and start.date() > self.latest: return False
+        return True
+
+    def start_window(self) -> Optional[Tuple[int, int]]:
+        if self.start_after_minute is None and self.start_before_minute is None:
+            return None
+        return (self.start_after_minute or 0, self.start_before_minute if self.start_before_minute is not None else 24 * 60)
+
+    def describe(self) -> str:
+        """Texto para a mensagem ao paciente (ex.: 'às quintas, de manhã, a partir de 20/10')."""
+        parts = []
+        if self.weekdays is not None:
+            labels = [WEEKDAY_LABELS[day] + "s" for day in self.weekdays]
+            parts.append("às " + (" ou ".join(labels) if len(labels) <= 2 else ", ".join(labels[:-1]) + " ou " + labels[-1]))
+        period = next((name for name, window in DAY_PERIODS.items() if window == self.start_window()), None)
+        if period:
+            parts.append(PERIOD_LABELS[period])
+        else:
+            if self.start_after_minute is not None: parts.append(f"a partir das {self.start_after_minute // 60}:{self.start_after_minute % 60:02d}")
+            if self.start_before_minute is not None: parts.append(f"antes das {self.start_before_minute // 60}:{self.start_before_minute % 60:02d}")
+        if self.earliest is not None and self.earliest == self.latest:
+            parts.append(f"no dia {self.earliest.strftime('%d/%m')}")
+        else:
+            if self.earliest is not None: parts.append(f"a partir de {self.earliest.strftime('%d/%m')}")
+            if self.latest is not None: parts.append(f"até {self.latest.strftime('%d/%m')}")
+        return ", ".join(parts)
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Forma serializável em JSON (sessão no Redis)."""
+        return {
+            "weekdays": list(self.weekdays) if self.weekdays is not None else None,
+            "start_after_minute": self.start_after_minute, "start_before_minute": self.start_before_minute,
+            "earliest": self.earliest.isoformat() if self.earliest else None,
+            "latest": self.latest.isoformat() if self.latest else None,
+        }
+
+    @classmethod
+    def from_dict(cls, raw: Optional[Dict[str, Any]]) -> Optional["SlotPreferences"]:
+        if not raw:
+            return None
+        return cls(
+            weekdays=tuple(raw["weekdays"]) if raw.get("weekdays") is not None else None,
+            start_after_minute=raw.get("start_after_minute"), start_before_minute=raw.get("start_before_minute"),
+            earliest=datetime.date.fromisoformat(raw["earliest"]) if raw.get("earliest") else None,
+            latest=datetime.date.fromisoformat(raw["latest"]) if raw.get("latest") else None,
+        )
+
+def _normalize(text: str) -> str:
+    text = unicodedata.normalize("NFKD", text.lower())
+    return "".join(char for char in text if not unicodedata.combining(char))
+
+def _strip_name_weekdays(message: str) -> str:
+    """Remove dia da semana que faz parte de um nome próprio ('Maria da Silva Segunda'): maiúsculo e após outra palavra maiúscula."""
+    words = message.split()
+    kept = []
+    for position, word in enumerate(words):
+        previous = words[position - 1] if position else ""
+        bare = _normalize(word).strip(".,;:!?")
+        if (position and word[:1].isupper() and previous[:1].isupper() and bare.split("-")[0].rstrip("s") in WEEKDAY_NAMES
+                and _normalize(previous).strip(".,;:!?") not in _NAME_LEAD_WORDS):
+            continue
+        kept.append(word)
+    return " ".join(kept)
+
+def match_listed_slot(message: str, slots: Sequence[datetime.datetime]) -> Optional[int]:
+    """
+    Índice do horário da lista que a mensagem escolhe por ordinal ('a segunda', 'o último') ou pela data
+    ('dia 20', '20/10', 'dia 20 às 15h'). None se a mensagem não aponta um único horário da lista.
+    """
+    text = _normalize(message)
+    for match in _LISTED_ORDINAL_RE.finditer(text):
+        stem = match.group(2)
+        if stem in _WEEKDAY_ORDINALS and not match.group(1) and not match.group(3):
+            continue # 'segunda' sozinha é dia da semana
+        position = ORDINALS[stem]
+        if position == -1: return len(slots) - 1 if slots else None
+        return position - 1 if position <= len(slots) else None
+    date_match = _ON_DATE_RE.search(text)
+    if not date_match:
+        return None
+    day_text, month_text = (date_match.group(1), date_match.group(2)) if date_match.group(1) else (date_match.group(3), date_match.group(4))
+    candidates = [index for index, slot in enumerate(slots)
+                  if slot.day == int(day_text) and (not month_text or slot.month == int(month_text))]
+    if len(candidates) > 1:
+        hour_match = _LISTED_HOUR_RE.search(text[:date_match.start()] + " " + text[date_match.end():])
+        if hour_match: candidates = [index for index in candidates if slots[index].hour == int(hour_match.group(1))]
+    return candidates[0] if len(candidates) == 1 else None
+
+def _resolve_date(day_text: str, month_text: Optional[str], today: datetime.date) -> Optional[datetime.date]:
+    """'20' -> próximo dia 20 (este mês ou o seguinte); '20/11' -> 20/11 deste ano ou do próximo."""
+    try:
+        day = int(day_text)
+        if month_text:
+            candidate = datetime.date(today.year, int(month_text), day)
+            return candidate if candidate >= today else candidate.replace(year=today.year + 1)
+        candidate_month, candidate_year = today.month, today.year
+        for _ in range(3): # Pula meses sem esse dia (ex.: 31)
+            try:
+                candidate = datetime.date(candidate_year, candidate_month, day)
+                if candidate >= today: return candidate
+            except ValueError:
+                pass
+            candidate_month, candidate_year = (1, candidate_year + 1) if candidate_month == 12 else (candidate_month + 1, candidate_year)
+    except ValueError:
+        return None
+    return None
+
+def _minute(hour_text: str, minute_text: Optional[str]) -> Optional[int]:
+    hour, minute = int(hour_text), int(minute_text or 0)
+    return hour * 60 + minute if 0 <= hour <= 23 and 0 <= minute <= 59 else None
+
+def parse_slot_preferences(message: str, today: datetime.date) -> Optional[SlotPreferences]:
+    """
+    Extrai dia da semana ('quinta', 'segunda ou terça'), período ('de manhã', 'à tarde'), faixa de hora
+    ('depois das 15h', 'antes das 16h') e faixa de datas ('depois do dia 20', 'até 05/11', 'semana que vem', 'amanhã').
+    None quando não há restrição ou quando a mensagem escolhe um horário exato ('quinta às 15h' é escolha, não filtro).
+    """
+    text = _normalize(_strip_name_weekdays(message))
+    weekdays: Optional[Tuple[int, ...]] = None
+    start_after = start_before = None
+    earliest = latest = None
+
+    for pattern, is_after in ((_AFTER_HOUR_RE, True), (_BEFORE_HOUR_RE, False)):
+        match = pattern.search(text)
+        if match:
+            minute = _minute(match.group(1), match.group(2))
+            if minute is not None:
+                if is_after: start_after = minute
+                else: start_before = minute
+            text = text[:match.start()] + " " + text[match.end():]
+    if _EXACT_HOUR_RE.search(text):
+        return None # Hora exata: o paciente está escolhendo um horário, não filtrando
+
+    found_days = [WEEKDAY_NAMES.index(match.group(1)) for match in _WEEKDAY_RE.finditer(text)
+                  if match.group(2) or not _ORDINAL_RE.match(text, match.end())]
+    if found_days:
+        weekdays = tuple(sorted(set(found_days)))
+    period = _PERIOD_RE.search(text)
+    if period:
+        period_start, period_end = DAY_PERIODS[period.group(1)]
+        start_after = max(start_after or 0, period_start)
+        start_before = min(start_before if start_before is not None else 24 * 60, period_end)
+
+    for pattern, is_after in ((_AFTER_DATE_RE, True), (_BEFORE_DATE_RE, False)):
+        match = pattern.search(text)
+        if not match: continue
+        date = _resolve_date(match.group(2), match.group(3), today)
+        if date is not None:
+            exclusive = match.group(1) in ("depois", "apos", "antes")
+            if is_after: earliest = date + datetime.timedelta(days=1) if exclusive else date
+            else: latest = date - datetime.timedelta(days=1) if exclusive else date
+        text = text[:match.start()] + " " + text[match.end():]
+    on_date = _ON_DATE_RE.search(text)
+    if on_date and earliest is None and latest is None:
+        day_text, month_text = (on_date.group(1), on_date.group(2)) if on_date.group(1) else (on_date.group(3), on_date.group(4))
+        earliest = latest = _resolve_date(day_text, month_text, today)
+
+    if re.search(r"\b(semana que vem|proxima semana)\b", text):
+        next_monday = today + datetime.timedelta(days=7 - today.weekday())
+        earliest, latest = max(earliest or next_monday, next_monday), min(latest or next_monday + datetime.timedelta(days=6), next_monday + datetime.timedelta(days=6))
+    elif re.search(r"\b(esta|essa) semana\b", text):
+        latest = min(latest or datetime.date.max, today + datetime.timedelta(days=6 - today.weekday()))
+    if re.search(r"\bdepois de amanha\b", text):
+        earliest = latest = today + datetime.timedelta(days=2)
+    elif re.search(r"\bamanha\b", text):
+        earliest = latest = today + datetime.timedelta(days=1)
+
+    preferences = SlotPreferences(weekdays, start_after, start_before, earliest, latest)
+    if preferences.is_empty():
+        return None
+    logger.debug(f"Preferências de horário extraídas de '{message}': {preferences}")
+    return preferences
@@ -0,0 +1,236 @@
+# tenant_registry.py (v1.0 - Registro de Clínicas: Roteamento pelo Número Twilio + Carga Sob Demanda com LRU)
+import asyncio
+import json
+import logging
+import os
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, NamedTuple, Optional, Sequence
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TENANT_ID = "default" # Clínica configurada pelas variáveis de ambiente (implantação de uma clínica só)
+DEFAULT_MAX_LOADED_TENANTS = 8 # Clínicas com base/índices/conexão CalDAV em memória ao mesmo tempo
+
+class TenantConfig(NamedTuple):
+    tenant_id: str
+    whatsapp_number: str # Número Twilio (campo 'To' do webhook) que identifica a clínica; também é o remetente das mensagens
+    knowledge_base_path: str
+    persona_name: str
+    clinic_name: Optional[str] # None: usa clinic_info.name da base
+    doctor_name: Optional[str] # None: usa doctor_info.full_name da base
+    timezone: str
+    caldav_url: Optional[str]
+    caldav_username: Optional[str]
+    caldav_password: Optional[str]
+    caldav_calendar_name: Optional[str]
+    relationship_number: Optional[str] # WhatsApp da equipe de relacionamento (aviso de nova consulta)
+
+class TenantLoadError(Exception):
+    """A clínica não pôde ser carregada (base inválida, CalDAV indisponível...)."""
+
+def normalize_number(number: Optional[str]) -> str:
+    """'whatsapp:+55 54 99118-1305' -> '+5554991181305' (mesma chave para o 'To' do Twilio e a configuração)."""
+    number = (number or "").strip()
+    if number.lower().startswith("whatsapp:"):
+        number = number[len("whatsapp:"):]
+    return "".join(char for char in number if char.isdigit() or char == "+")
+
+def load_tenant_configs(path: str, defaults: TenantConfig) -> List[TenantConfig]:
+    """
+    Lê o arquivo de clínicas: {"tenants": [{"id", "whatsapp_number", "knowledge_base", "persona_name", "clinic_name",
+    "doctor_name", "timezone", "relationship_number", "caldav": {"url", "username", "password_env", "calendar_name"}}]}.
+    Campos ausentes herdam de 'defaults' (variáveis de ambiente). A senha do CalDAV vem de uma variável de ambiente
+    (caldav.password_env), nunca do arquivo. Configuração inválida gera ValueError.
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        raw = json.load(f)
+    entries = raw.get("tenants") if isinstance(raw, dict) else raw
+    if not isinstance(entries, list) or not entries:
+        raise ValueError(f"Arquivo de clínicas {path} sem a lista 'tenants'.")
+
+    configs: List[TenantConfig] = []
+    for entry in entries:
+        if not isinstance(entry, dict) or not entry.get("id") or not entry.get("whatsapp_number"):
+            raise ValueError(f"Clínica inválida em {path} (obrigatórios: 'id' e 'whatsapp_number'): {entry}")
+        caldav = entry.get("caldav", {}) or {}
+        password_env = caldav.get("password_env")
+        config = defaults._replace(
+            tenant_id=str(entry["id"]),
+            whatsapp_number=str(entry["whatsapp_number"]),
+            knowledge_base_path=entry.get("knowledge_base", defaults.knowledge_base_path),
+            persona_name=entry.get("persona_name", defaults.persona_name),
+            clinic_name=entry.get("clinic_name", defaults.clinic_name),
+            doctor_name=entry.get("doctor_name", defaults.doctor_name),
+            timezone=entry.get("timezone", defaults.timezone),
+            relationship_number=entry.get("relationship_number", defaults.relationship_number),
+            caldav_url=caldav.get("url", defaults.caldav_url),
+            caldav_username=caldav.get("username", defaults.caldav_username),
+            caldav_password=os.getenv(password_env) if password_env else defaults.caldav_password,
+            caldav_calendar_name=caldav.get("calendar_name", defaults.caldav_calendar_name),
+        )
+        missing = [field for field in ("caldav_url", "caldav_username", "caldav_password", "caldav_calendar_name") if not getattr(config, field)]
+        if missing:
+            raise ValueError(f"Clínica '{config.tenant_id}' sem configuração CalDAV: {', '.join(missing)}.")
+        configs.append(config)
+    return configs
+
+class Tenant:
+    """Recursos carregados de uma clínica (base + índices, persona/LLM, CalDAV, fast-path)."""
+    def __init__(self, config: TenantConfig, knowledge_handler, openai_handler, caldav_handler, fast_path):
+        self.config = config
+        self.knowledge_handler = knowledge_handler
+        self.openai_handler = openai_handler
+        self.caldav_handler = caldav_handler
+        self.fast_path = fast_path
+        self.active_requests = 0
+
+    @property
+    def tenant_id(self) -> str:
+        return self.config.tenant_id
+
+    @property
+    def clinic_name(self) -> str:
+        return self.config.clinic_name or self.knowledge_handler.clinic_name
+
+    @property
+    def doctor_name(self) -> str:
+        return self.config.doctor_name or self.knowledge_handler.doctor_name
+
+    def session_key(self, sender_id: str) -> str:
+        """Sessão por clínica + remetente (a clínica padrão mantém a chave antiga: sessões existentes continuam válidas)."""
+        return sender_id if self.tenant_id == DEFAULT_TENANT_ID else f"{self.tenant_id}:{sender_id}"
+
+    def metrics(self) -> Dict[str, Any]:
+        return {
+            "clinic_name": self.clinic_name,
+            "active_requests": self.active_requests,
+            "knowledge": self.knowledge_handler.metrics(),
+            "fast_path": self.fast_path.metrics(),
+            "calendar": self.caldav_handler.metrics(),
+        }
+
+    async def aclose(self):
+        await self.knowledge_handler.aclose()
+        await self.caldav_handler.aclose()
+
+TenantFactory = Callable[[TenantConfig], Awaitable[Tenant]]
+
+class TenantRegistry:
+    """
+    Roteia cada mensagem para a clínica dona do número Twilio ('To') e mantém as clínicas carregadas em LRU.
+    - Carga sob demanda (na primeira mensagem para o número), uma única vez mesmo com mensagens simultâneas.
+    - Acima de max_loaded, a clínica usada há mais tempo é descarregada; se ainda houver requisições usando-a,
+      o fechamento (watcher da base, pool do CalDAV) espera a última terminar.
+    - Números desconhecidos vão para default_tenant_id (se configurado) ou são recusados.
+    """
+    def __init__(self, configs: Sequence[TenantConfig], factory: TenantFactory,
+                 max_loaded: int = DEFAULT_MAX_LOADED_TENANTS, default_tenant_id: Optional[str] = None):
+        self.factory = factory
+        self.max_loaded = max(1, max_loaded)
+        self.configs_by_id: Dict[str, TenantConfig] = {config.tenant_id: config for config in configs}
+        self.configs_by_number: Dict[str, TenantConfig] = {normalize_number(config.whatsapp_number): config for config in configs}
+        self.default_config = self.configs_by_id.get(default_tenant_id) if default_tenant_id else None
+        self._loaded: "OrderedDict[str, Tenant]" = OrderedDict()
+        self._load_locks: Dict[str, asyncio.Lock] = {}
+        self._retired: List[Tenant] = [] # Descarregadas, aguardando requisições em andamento
+        self.loads = 0
+        self.load_failures = 0
+        self.evictions = 0
+        self.unknown_numbers = 0
+
+    def resolve(self, to_number: Optional[str]) -> Optional[TenantConfig]:
+        config = self.configs_by_number.get(normalize_number(to_number))
+        if config is None:
+            self.unknown_numbers += 1
+            return self.default_config
+        return config
+
+    async def get(self, config: TenantConfig) -> Tenant:
+        tenant = await self._acquire(config)
+        await self._release(tenant)
+        return tenant
+
+    async def _acquire(self, config: TenantConfig) -> Tenant:
+        """
+        Clínica carregada já marcada como em uso (active_requests incrementado antes de qualquer await): uma carga
+        simultânea de outra clínica pode descarregá-la, mas não fechá-la enquanto esta requisição a usa.
+        """
+        tenant = self._loaded.get(config.tenant_id)
+        if tenant is not None:
+            self._loaded.move_to_end(config.tenant_id)
+            tenant.active_requests += 1
+            return tenant
+        lock = self._load_locks.setdefault(config.tenant_id, asyncio.Lock())
+        async with lock:
+            tenant = self._loaded.get(config.tenant_id)
+            if tenant is not None:
+                tenant.active_requests += 1
+                return tenant
+            try:
+                tenant = await self.factory(config)
+            except Exception as e_load:
+                self.load_failures += 1
+                raise TenantLoadError(f"Falha ao carregar a clínica '{config.tenant_id}': {e_load}") from e_load
+            self._loaded[config.tenant_id] = tenant
+            tenant.active_requests += 1
+            self.loads += 1
+            logger.info(f"Clínica '{config.tenant_id}' carregada ({len(self._loaded)}/{self.max_loaded} em memória).")
+        await self._evict_excess()
+        return tenant
+
+    async def _release(self, tenant: Tenant):
+        tenant.active_requests -= 1
+        if tenant.active_requests == 0 and tenant in self._retired:
+            self._retired.remove(tenant)
+            await self._close(tenant)
+
+    @asynccontextmanager
+    async def lease(self, to_number: Optional[str]) -> AsyncIterator[Optional[Tenant]]:
+        """Clínica do número durante uma requisição (None se o número não pertence a nenhuma clínica)."""
+        config = self.resolve(to_number)
+        if config is None:
+            yield None
+            return
+        tenant = await self._acquire(config)
+        try:
+            yield tenant
+        finally:
+            await self._release(tenant)
+
+    async def preload(self, tenant_id: str) -> Optional[Tenant]:
+        config = self.configs_by_id.get(tenant_id)
+        return await self.get(config) if config else None
+
+    async def _evict_excess(self):
+        while len(self._loaded) > self.max_loaded:
+            tenant_id, tenant = self._loaded.popitem(last=False)
+            self.evictions += 1
+            logger.info(f"Clínica '{tenant_id}' descarregada (LRU, limite de {self.max_loaded}).")
+            if tenant.active_requests: self._retired.append(tenant)
+            else: await self._close(tenant)
+
+    async def _close(self, tenant: Tenant):
+        try: await tenant.aclose()
+        except Exception as e_close: logger.error(f"Erro ao fechar recursos da clínica '{tenant.tenant_id}': {e_close}", exc_info=True)
+
+    def loaded(self) -> List[Tenant]:
+        return list(self._loaded.values())
+
+    def metrics(self) -> Dict[str, Any]:
+        return {
+            "configured": len(self.configs_by_id),
+            "loaded": len(self._loaded),
+            "max_loaded": self.max_loaded,
+            "loads": self.loads,
+            "load_failures": self.load_failures,
+            "evictions": self.evictions,
+            "unknown_numbers": self.unknown_numbers,
+            "tenants": {tenant_id: tenant.metrics() for tenant_id, tenant in self._loaded.items()},
+        }
+
+    async def aclose(self):
+        """Fecha todas as clínicas carregadas (chamar no shutdown da aplicação)."""
+        for tenant in list(self._loaded.values()) + self._retired:
+            await self._close(tenant)
+        self._loaded.clear(); self._retired.clear()
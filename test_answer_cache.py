@@ -0,0 +1,69 @@
+# test_answer_cache.py - Chave e backends do cache de respostas
+import asyncio
+
+import fakeredis
+
+from answer_cache import InMemoryAnswerCache, RedisAnswerCache, answer_cache_key, normalize_question
+
+def key(question: str, **overrides) -> str:
+    params = {"knowledge_version": 1700000000.5, "block_key": "policy:insurance", "scheduling_state": None,
+              "first_turn": False, "question": question, "tenant_id": "default"}
+    params.update(overrides)
+    return answer_cache_key(**params)
+
+def test_different_questions_on_same_block_do_not_share_answers():
+    assert key("vocês aceitam unimed?") != key("aceitam bradesco?")
+    assert key("vocês aceitam unimed?") != key("aceita cartão de crédito parcelado?")
+
+def test_same_question_with_different_case_accents_and_punctuation_shares_answer():
+    assert normalize_question("  Vocês aceitam  UNIMED?! ") == "voces aceitam unimed"
+    assert key("Vocês aceitam Unimed?") == key("voces aceitam unimed")
+
+def test_key_changes_with_version_tenant_state_and_turn():
+    base = key("qual o endereço?")
+    assert key("qual o endereço?", knowledge_version=1700000001.0) != base
+    assert key("qual o endereço?", tenant_id="aurora") != base
+    assert key("qual o endereço?", scheduling_state="awaiting_choice") != base
+    assert key("qual o endereço?", first_turn=True) != base
+
+def test_in_memory_cache_hits_misses_and_lru():
+    async def scenario():
+        cache = InMemoryAnswerCache(ttl_seconds=60, max_entries=2)
+        assert await cache.get("a") is None
+        await cache.set("a", "resposta A"); await cache.set("b", "resposta B")
+        assert await cache.get("a") == "resposta A" # 'a' passa a ser o mais recente
+        await cache.set("c", "resposta C") # Descarta 'b'
+        return cache, await cache.get("b"), await cache.get("c")
+    cache, evicted, kept = asyncio.run(scenario())
+    assert evicted is None and kept == "resposta C"
+    assert cache.metrics()["hits"] == 2 and cache.metrics()["evictions"] == 1
+
+def test_in_memory_cache_expires_entries():
+    async def scenario():
+        cache = InMemoryAnswerCache(ttl_seconds=0)
+        await cache.set("a", "resposta A")
+        return await cache.get("a")
+    assert asyncio.run(scenario()) is None
+
+def test_redis_cache_is_shared_between_workers_with_ttl():
+    async def scenario():
+        server = fakeredis.FakeServer()
+        worker_a = RedisAnswerCache(fakeredis.FakeAsyncRedis(server=server, decode_responses=True), ttl_seconds=300)
+        worker_b = RedisAnswerCache(fakeredis.FakeAsyncRedis(server=server, decode_responses=True), ttl_seconds=300)
+        assert await worker_b.get("a") is None
+        await worker_a.set("a", "resposta A")
+        return worker_b, await worker_b.get("a"), await worker_a.redis.ttl("resposta:a")
+    worker_b, answer, ttl = asyncio.run(scenario())
+    assert answer == "resposta A" and 0 < ttl <= 300
+    assert worker_b.metrics()["hits"] == 1 and worker_b.metrics()["misses"] == 1
+
+def test_redis_failures_become_misses():
+    async def scenario():
+        server = fakeredis.FakeServer()
+        server.connected = False # Redis fora do ar
+        cache = RedisAnswerCache(fakeredis.FakeAsyncRedis(server=server, decode_responses=True))
+        await cache.set("a", "resposta A")
+        return cache, await cache.get("a")
+    cache, answer = asyncio.run(scenario())
+    assert answer is None
+    assert cache.metrics()["errors"] == 2 and cache.metrics()["misses"] == 1
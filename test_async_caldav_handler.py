@@ -0,0 +1,109 @@
+# test_async_caldav_handler.py - AsyncCaldavHandler sem servidor (índice local preenchido à mão)
+import asyncio
+import datetime
+
+import pytest
+import pytz
+
+from async_caldav_handler import AsyncCaldavHandler, AsyncCalendarObject
+from caldav_handler import select_free_slots
+
+TZ = pytz.timezone("America/Sao_Paulo")
+
+def make_handler(timezone: str = "America/Sao_Paulo") -> AsyncCaldavHandler:
+    handler = AsyncCaldavHandler("http://caldav.teste/", "u", "p", "Consultas", timezone=timezone)
+    handler.calendar_url = "http://caldav.teste/consultas/"
+    now = datetime.datetime.now(TZ)
+    handler.busy_index.reset(now - datetime.timedelta(days=1), now + datetime.timedelta(days=90))
+    handler.busy_index.loaded = True
+    saved = []
+
+    async def connected(): return True
+    async def index_fresh(range_start, range_end): return True # Índice já sincronizado (CTag inalterado)
+    async def save_event(vcal_string, uid):
+        await asyncio.sleep(0.01) # PUT lento: a outra confirmação chega no meio
+        saved.append(uid)
+        return AsyncCalendarObject(f"{handler.calendar_url}{uid}.ics", '"etag"', vcal_string)
+    handler._is_connected = connected
+    handler._refresh_busy_index = index_fresh
+    handler.save_event = save_event
+    handler.saved = saved
+    return handler
+
+def test_concurrent_bookings_of_same_slot_write_once():
+    async def scenario():
+        handler = make_handler()
+        start = TZ.localize(datetime.datetime.combine(datetime.date.today() + datetime.timedelta(days=7), datetime.time(15)))
+        end = start + datetime.timedelta(minutes=45)
+        results = await asyncio.gather(
+            handler.book_appointment(start, end, "Paciente Um", "5400000001"),
+            handler.book_appointment(start, end, "Paciente Dois", "5400000002"),
+        )
+        await handler.aclose()
+        return results, handler.saved
+    results, saved = asyncio.run(scenario())
+    assert sorted(ok for ok, _ in results) == [False, True]
+    assert len(saved) == 1
+
+NO_DTSTART_ICS = "BEGIN:VCALENDAR\r\nVERSION:2.0\r\nBEGIN:VEVENT\r\nUID:sem-inicio\r\nSUMMARY:Bloqueio\r\nEND:VEVENT\r\nEND:VCALENDAR\r\n"
+BROKEN_ICS = "BEGIN:VCALENDAR\r\nBEGIN:VEVENT\r\nDTSTART:amanhã cedo\r\nEND:VEVENT\r\nEND:VCALENDAR\r\n"
+
+@pytest.mark.parametrize("ics", [NO_DTSTART_ICS, BROKEN_ICS])
+def test_unreadable_event_is_checked_remotely_per_block(ics):
+    search_start = TZ.localize(datetime.datetime.combine(datetime.date.today(), datetime.time.min))
+    free = select_free_slots(search_start, 6, 60, [0, 1, 2, 3, 4], [14, 15, 16], TZ, lambda start, end: False)
+    blocked = (free[1] + datetime.timedelta(minutes=5), free[1] + datetime.timedelta(minutes=55)) # Onde o servidor põe o recurso ilegível
+    async def scenario():
+        handler = AsyncCaldavHandler("http://caldav.teste/", "u", "p", "Consultas")
+        handler.calendar_url = "http://caldav.teste/consultas/"
+        unreadable = AsyncCalendarObject(f"{handler.calendar_url}ilegivel.ics", '"e"', ics)
+        saved = []
+        async def connected(): return True
+        async def tags(): return '"ctag-1"', None
+        async def search_chunked(range_start, range_end): return [unreadable]
+        async def search(start, end, expand=True): return [unreadable] if start < blocked[1] and blocked[0] < end else []
+        async def save_event(vcal_string, uid): saved.append(uid)
+        handler._is_connected = connected
+        handler._get_collection_tags = tags
+        handler._search_events_chunked = search_chunked
+        handler.search = search
+        handler.save_event = save_event
+        result = await handler.book_appointment(free[1], free[1] + datetime.timedelta(minutes=45), "Paciente", "5400000001")
+        slots = await handler.find_available_slots(search_start, 5, 45, 60, [0, 1, 2, 3, 4], [14, 15, 16])
+        await handler.aclose()
+        return result, saved, slots, handler.metrics()
+    (ok, _), saved, slots, metrics = asyncio.run(scenario())
+    assert not ok and saved == [] # Checagem final recusa sobre o recurso ilegível
+    assert slots == [free[0]] + free[2:6] # Só o bloco ocupado no servidor sai; a agenda não fica vazia
+    assert metrics["unreadable_resources"] == 1 and metrics["remote_block_checks"] == 6
+
+def test_slots_and_bookings_use_clinic_timezone():
+    lisbon = pytz.timezone("Europe/Lisbon")
+    async def scenario():
+        handler = make_handler(timezone="Europe/Lisbon")
+        slots = await handler.find_available_slots(datetime.datetime.now(lisbon), 3, 45, 60, [0, 1, 2, 3, 4], [14, 15])
+        ok, _ = await handler.book_appointment(slots[0].replace(tzinfo=None), slots[0].replace(tzinfo=None) + datetime.timedelta(minutes=45), "Paciente", "5400000001")
+        await handler.aclose()
+        return slots, ok, handler.busy_index.extents.find_overlap(slots[0], slots[0] + datetime.timedelta(minutes=45))
+    slots, ok, booked = asyncio.run(scenario())
+    assert [slot.tzinfo.zone for slot in slots] == ["Europe/Lisbon"] * 3
+    assert all(slot.hour in (14, 15) for slot in slots)
+    assert ok and booked[0] == slots[0] # Horário sem fuso é interpretado no fuso da clínica
+
+def test_recently_verified_index_serves_searches_without_revalidating():
+    async def scenario():
+        handler = make_handler()
+        handler.busy_max_age_seconds = 60
+        now = datetime.datetime.now(TZ)
+        handler.busy_index.reset(now - datetime.timedelta(days=1), now + datetime.timedelta(days=120)); handler.busy_index.loaded = True
+        refreshes = []
+        async def index_fresh(range_start, range_end): refreshes.append(range_start); return True
+        handler._refresh_busy_index = index_fresh
+        first = await handler.find_available_slots(now, 3, 45, 60, [0, 1, 2, 3, 4], [14, 15])
+        second = await handler.find_available_slots(now, 3, 45, 60, [0, 1, 2, 3, 4], [14, 15])
+        await handler.aclose()
+        return first, second, len(refreshes), handler.metrics()
+    first, second, refreshes, metrics = asyncio.run(scenario())
+    assert first == second and len(first) == 3
+    assert refreshes == 1 # A segunda busca usa o índice verificado há menos de busy_max_age_seconds
+    assert metrics["busy_fresh_hits"] == 1 and metrics["availability_builds"] == 1
@@ -0,0 +1,128 @@
+# test_availability_engine.py - Bitmap de ocupação comparado com a varredura dia a dia (select_free_slots)
+import random
+import datetime
+
+import pytest
+import pytz
+
+import availability_engine
+from availability_engine import OccupancyGrid, working_hours_from_rules
+from caldav_handler import BusyIntervals, find_free_slots, select_free_slots, slot_horizon_days
+from slot_preferences import SlotPreferences
+
+TIMEZONES = ["America/Sao_Paulo", "Europe/Lisbon", "America/New_York"]
+
+def random_scenario(seed: int):
+    rng = random.Random(seed)
+    tz = pytz.timezone(rng.choice(TIMEZONES))
+    start = tz.localize(datetime.datetime(2026, 1, 1) + datetime.timedelta(days=rng.randrange(365), minutes=rng.randrange(0, 24 * 60, 5)))
+    preferred_days = sorted(rng.sample(range(7), rng.randint(1, 7)))
+    hours = sorted(rng.sample(range(7, 20), rng.randint(1, 6)))
+    duration = rng.choice([30, 45, 60, 90])
+    busy = []
+    for _ in range(rng.randint(0, 80)):
+        busy_start = start + datetime.timedelta(minutes=rng.randrange(-24 * 60, 70 * 24 * 60))
+        busy_end = busy_start + datetime.timedelta(minutes=rng.randint(1, 240))
+        busy.append((busy_start.astimezone(pytz.utc), busy_end.astimezone(pytz.utc), "Ocupado")) # Vindos do CalDAV em UTC
+    return rng, tz, start, preferred_days, hours, duration, BusyIntervals(busy)
+
+def reference_slots(start, duration, preferred_days, hours, tz, busy: BusyIntervals, accepts=lambda slot: True):
+    """Todos os blocos livres do horizonte pela varredura antiga (a referência da equivalência)."""
+    horizon_end = tz.localize(datetime.datetime.combine(start.date() + datetime.timedelta(days=slot_horizon_days(start)), datetime.time.min))
+    slots = select_free_slots(start, 10 ** 6, duration, preferred_days, hours, tz, lambda block_start, block_end: busy.is_busy(block_start, block_end))
+    return [slot for slot in slots if slot < horizon_end and accepts(slot)]
+
+@pytest.fixture(params=["bitmap", "varredura"])
+def engine(request, monkeypatch):
+    if request.param == "varredura":
+        monkeypatch.setattr(availability_engine, "is_available", lambda: False)
+    return request.param
+
+@pytest.mark.parametrize("seed", range(40))
+def test_find_free_slots_matches_day_by_day_scan(seed, engine):
+    rng, tz, start, preferred_days, hours, duration, busy = random_scenario(seed)
+    expected = reference_slots(start, duration, preferred_days, hours, tz, busy)
+    count = rng.randint(1, 15)
+    assert find_free_slots(start, count, duration, preferred_days, hours, tz, busy)[:count] == expected[:count]
+
+@pytest.mark.parametrize("seed", range(40))
+def test_resume_after_continues_from_cursor(seed, engine):
+    rng, tz, start, preferred_days, hours, duration, busy = random_scenario(seed)
+    expected = reference_slots(start, duration, preferred_days, hours, tz, busy)
+    count = rng.randint(1, 8)
+    first_page = find_free_slots(start, count, duration, preferred_days, hours, tz, busy)[:count]
+    if not first_page:
+        return
+    cursor = first_page[-1] + datetime.timedelta(minutes=1)
+    second_page = find_free_slots(start, count, duration, preferred_days, hours, tz, busy, resume_after=cursor)[:count]
+    assert first_page + second_page == expected[:len(first_page) + count]
+
+@pytest.mark.parametrize("seed", range(40))
+def test_next_slots_with_preferences_matches_filtered_scan(seed):
+    rng, tz, start, preferred_days, hours, duration, busy = random_scenario(seed)
+    after_minute = rng.choice([None, rng.randrange(7, 20) * 60])
+    preferences = SlotPreferences(weekdays=tuple(sorted(rng.sample(range(7), rng.randint(1, 4)))), start_after_minute=after_minute,
+                                  start_before_minute=after_minute + rng.randint(1, 6) * 60 if after_minute is not None else None)
+    expected = reference_slots(start, duration, preferred_days, hours, tz, busy, accepts=preferences.accepts)
+    grid = OccupancyGrid.build(start.date(), slot_horizon_days(start), tz, working_hours_from_rules(preferred_days, hours, duration),
+                               ((busy_start, busy_end) for busy_start, busy_end, _ in busy.intervals))
+    page = grid.next_slots(start, 10, duration, weekdays=preferences.weekdays, start_window=preferences.start_window())
+    assert page == expected[:10]
+    assert grid.next_slots(start, 10, duration, weekdays=preferences.weekdays, start_window=preferences.start_window()) == page # Página materializada
+
+@pytest.mark.parametrize("tz_name, day", [
+    ("Europe/Lisbon", datetime.date(2026, 3, 29)), # Adianta o relógio (+1h à 01:00)
+    ("Europe/Lisbon", datetime.date(2026, 10, 25)), # Atrasa o relógio (02:00 volta para 01:00)
+    ("America/New_York", datetime.date(2026, 3, 8)),
+    ("America/New_York", datetime.date(2026, 11, 1)),
+])
+def test_dst_day_keeps_wall_clock_slots_and_blocks_by_instant(tz_name, day, engine):
+    tz = pytz.timezone(tz_name)
+    start = tz.localize(datetime.datetime.combine(day - datetime.timedelta(days=1), datetime.time.min))
+    booked = tz.localize(datetime.datetime.combine(day, datetime.time(9)))
+    busy = BusyIntervals([(booked.astimezone(pytz.utc), (booked + datetime.timedelta(minutes=45)).astimezone(pytz.utc), "Consulta")])
+    slots = find_free_slots(start, 6, 45, list(range(7)), [9, 14], tz, busy)[:6]
+    assert slots == reference_slots(start, 45, list(range(7)), [9, 14], tz, busy)[:6]
+    on_dst_day = [slot for slot in slots if slot.date() == day]
+    assert [slot.hour for slot in on_dst_day] == [14] # 09:00 ocupado (evento gravado em UTC)
+    assert on_dst_day[0].utcoffset() == tz.localize(datetime.datetime.combine(day, datetime.time(14))).utcoffset()
+    assert slots[0].utcoffset() != on_dst_day[0].utcoffset() # Véspera ainda no outro horário
+    assert all(slot.minute == 0 and slot.hour in (9, 14) for slot in slots)
+
+def test_holidays_are_skipped(engine):
+    tz = pytz.timezone("America/Sao_Paulo")
+    start = tz.localize(datetime.datetime(2026, 11, 2, 0, 0)) # Segunda-feira; 02/11 é feriado (Finados)
+    holidays = [datetime.date(2026, 11, 2), datetime.date(2026, 11, 20)]
+    slots = find_free_slots(start, 40, 45, [0, 4], [10], tz, BusyIntervals([]), holidays=holidays)[:40]
+    expected = [slot for slot in reference_slots(start, 45, [0, 4], [10], tz, BusyIntervals([])) if slot.date() not in holidays][:40]
+    assert slots == expected
+    assert not {slot.date() for slot in slots} & set(holidays)
+    assert slots[0].date() == datetime.date(2026, 11, 6)
+
+def test_rejected_starts_drop_slots_and_fill_the_page(engine):
+    tz = pytz.timezone("America/Sao_Paulo")
+    start = tz.localize(datetime.datetime(2026, 11, 2, 0, 0))
+    all_slots = find_free_slots(start, 6, 45, [1, 2], [14, 15, 16], tz, BusyIntervals([]))[:6]
+    rejected = {all_slots[0], all_slots[2]} # Recusados pela checagem remota
+    slots = find_free_slots(start, 4, 45, [1, 2], [14, 15, 16], tz, BusyIntervals([]), rejected_starts=rejected)[:4]
+    assert slots == [all_slots[1]] + all_slots[3:6]
+
+def test_excluded_intervals_drop_overlapping_slots_and_fill_the_page(engine):
+    tz = pytz.timezone("America/Sao_Paulo")
+    start = tz.localize(datetime.datetime(2026, 11, 2, 0, 0))
+    all_slots = find_free_slots(start, 6, 45, [1, 2], [14, 15, 16], tz, BusyIntervals([]))[:6]
+    held = [(all_slots[0] + datetime.timedelta(minutes=30), all_slots[0] + datetime.timedelta(minutes=75))] # Outro paciente: 14:30-15:15
+    slots = find_free_slots(start, 4, 45, [1, 2], [14, 15, 16], tz, BusyIntervals([]), excluded_intervals=held)[:4]
+    assert slots == [all_slots[2]] + all_slots[3:6]
+
+@pytest.mark.skipif(not availability_engine.is_available(), reason="bitmap requer numpy")
+def test_cache_keeps_one_grid_per_duration():
+    tz = pytz.timezone("America/Sao_Paulo")
+    start = tz.localize(datetime.datetime(2026, 11, 2, 0, 0))
+    busy, cache = BusyIntervals([]), availability_engine.AvailabilityCache()
+    for _ in range(3):
+        for duration in (30, 45, 60, 90):
+            find_free_slots(start, 5, duration, [0, 1], [14, 15, 16], tz, busy, cache)
+    assert cache.builds == 4 # Um bitmap por duração, reaproveitados nas rodadas seguintes
+    find_free_slots(start, 5, 45, [0, 1], [14, 15, 16], tz, BusyIntervals([]), cache) # Agenda mudou: novo objeto de ocupação
+    assert cache.builds == 5
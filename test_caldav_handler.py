@@ -0,0 +1,105 @@
+# test_caldav_handler.py - Funções puras do caldav_handler (sem servidor CalDAV)
+import datetime
+from types import SimpleNamespace
+
+import pytest
+import pytz
+import vobject
+
+from caldav_handler import (
+    BUSY_SEARCH_MARGIN, BusyIntervals, CaldavHandler, CalendarBusyIndex, find_free_slots, vevent_block_conflict, vevent_busy_interval, vevent_occurrence,
+)
+
+TZ = pytz.timezone("America/Sao_Paulo")
+
+def make_vevent(**fields):
+    calendar = vobject.iCalendar()
+    vevent = calendar.add("vevent")
+    for name, value in fields.items():
+        vevent.add(name).value = value
+    return vevent
+
+def test_timed_event_busy_interval():
+    start = TZ.localize(datetime.datetime(2026, 11, 9, 15, 0))
+    interval = vevent_busy_interval(make_vevent(dtstart=start, dtend=start + datetime.timedelta(hours=1), summary="Consulta"), TZ)
+    assert interval == (start, start + datetime.timedelta(hours=1), "Consulta")
+
+def test_event_without_dtend_blocks_with_margin():
+    start = TZ.localize(datetime.datetime(2026, 11, 9, 15, 0))
+    interval = vevent_busy_interval(make_vevent(dtstart=start), TZ)
+    assert interval[:2] == (start - BUSY_SEARCH_MARGIN, start + BUSY_SEARCH_MARGIN)
+
+def test_all_day_event_does_not_block():
+    assert vevent_busy_interval(make_vevent(dtstart=datetime.date(2026, 11, 9), dtend=datetime.date(2026, 11, 10)), TZ) is None
+
+def test_event_without_dtstart_is_unreadable():
+    with pytest.raises(ValueError):
+        vevent_busy_interval(make_vevent(summary="Sem horário"), TZ)
+
+def test_block_conflict_keeps_per_block_rules():
+    start = TZ.localize(datetime.datetime(2026, 11, 9, 15, 0))
+    block = (start, start + datetime.timedelta(minutes=45))
+    assert vevent_block_conflict(make_vevent(summary="Sem horário"), *block, TZ) == "[Evento sem horário definido]"
+    assert vevent_block_conflict(make_vevent(dtstart=start, dtend=block[1], summary="Consulta"), *block, TZ) == "Consulta"
+    assert vevent_block_conflict(make_vevent(dtstart=block[1], dtend=block[1] + datetime.timedelta(hours=1)), *block, TZ) is None
+
+def make_handler(monkeypatch, is_block_busy_remote, busy_intervals=None) -> CaldavHandler:
+    """CaldavHandler sem servidor: a janela de ocupação e a checagem por bloco são simuladas."""
+    monkeypatch.setattr(CaldavHandler, "_connect", lambda self: None)
+    handler = CaldavHandler("http://caldav.teste/", "u", "p", "Consultas")
+    handler._is_connected = lambda: True
+    handler._fetch_busy_intervals = lambda range_start, range_end: busy_intervals
+    handler._is_block_busy_remote = is_block_busy_remote
+    return handler
+
+def block(day: int, hour: int) -> datetime.datetime:
+    return TZ.localize(datetime.datetime(2026, 11, day, hour, 0))
+
+def test_unreadable_resources_send_free_blocks_to_remote_check(monkeypatch):
+    checked = []
+    def is_block_busy_remote(block_start, block_end, tz):
+        checked.append(block_start)
+        return block_start == block(2, 15) # Onde o servidor põe o recurso ilegível
+    handler = make_handler(monkeypatch, is_block_busy_remote, BusyIntervals([], unreadable=1))
+    slots = handler.find_available_slots(block(2, 0), 5, 45, 60, [0, 1], [14, 15, 16])
+    assert slots == [block(2, 14), block(2, 16), block(3, 14), block(3, 15), block(3, 16)]
+    assert checked == [block(2, 14), block(2, 15), block(2, 16), block(3, 14), block(3, 15), block(3, 16)] # Só blocos candidatos
+    assert handler.metrics()["unreadable_resources"] == 1 and handler.metrics()["remote_block_checks"] == 6
+
+def test_remote_fallback_keeps_working_hours_and_holidays(monkeypatch):
+    start = block(2, 0) # Segunda-feira (feriado abaixo)
+    handler = make_handler(monkeypatch, lambda block_start, block_end, tz: False)
+    working_hours = {0: [(9 * 60, 12 * 60)], 2: [(14 * 60, 16 * 60)]}
+    slots = handler.find_available_slots(start, 4, 45, 60, [0, 1], [14, 15, 16], prefetch_busy=False,
+                                         working_hours=working_hours, holidays=[datetime.date(2026, 11, 2)])
+    expected = find_free_slots(start, 4, 60, [0, 1], [14, 15, 16], TZ, BusyIntervals([]), working_hours=working_hours,
+                               holidays=[datetime.date(2026, 11, 2)])
+    assert slots[:4] == expected # A varredura completa o último dia, como a busca antiga
+    assert slots[0] == block(4, 14)
+
+def test_index_keeps_unreadable_resources_apart():
+    index = CalendarBusyIndex()
+    index.reset(block(1, 0), block(30, 0))
+    index.set_resource("consulta.ics", "consulta.ics", "uid-consulta", [vevent_occurrence(make_vevent(dtstart=block(3, 14), dtend=block(3, 15), summary="Consulta"), TZ)])
+    index.set_resource("ilegivel.ics", "ilegivel.ics", None, [], unreadable=True)
+    index.rebuild()
+    assert index.unreadable == 1 and index.busy.unreadable == 1
+    assert index.busy.find_overlap(block(3, 14), block(3, 15)) and not index.busy.find_overlap(block(3, 16), block(3, 17)) # Agenda não fica bloqueada
+    index.remove_resource("ilegivel.ics"); index.rebuild()
+    assert index.unreadable == 0
+
+def test_final_check_confirms_remotely_while_index_has_unreadable_resources(monkeypatch):
+    blocked = (block(3, 14), block(3, 15)) # Onde o servidor põe o recurso ilegível
+    unreadable_event = SimpleNamespace(instance=SimpleNamespace(vevent=make_vevent(summary="Bloqueio")))
+    saved = []
+    handler = make_handler(monkeypatch, lambda block_start, block_end, tz: False)
+    handler.calendar = SimpleNamespace(
+        search=lambda start, end, event, expand: [unreadable_event] if start < blocked[1] and blocked[0] < end else [],
+        save_event=lambda vcal_string: saved.append(vcal_string) or SimpleNamespace(url=None))
+    handler.busy_index.reset(block(1, 0), block(30, 0))
+    handler.busy_index.set_resource("ilegivel.ics", "ilegivel.ics", None, [], unreadable=True)
+    handler.busy_index.rebuild(); handler.busy_index.loaded = True
+    handler._refresh_busy_index = lambda range_start, range_end: True
+    refused, _ = handler.book_appointment(blocked[0], blocked[0] + datetime.timedelta(minutes=45), "Paciente", "5400000001")
+    booked, _ = handler.book_appointment(block(3, 16), block(3, 16) + datetime.timedelta(minutes=45), "Paciente", "5400000001")
+    assert not refused and booked and len(saved) == 1
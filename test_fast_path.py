@@ -0,0 +1,47 @@
+# test_fast_path.py - Respostas diretas (sem LLM) só para perguntas que citam a intenção e nada além dela
+import pytest
+
+from fast_path import FastPathResponder, message_matches_intent, parse_enabled_intents
+
+class FakeKnowledge:
+    fast_replies = {"clinic:address": "Nosso consultório fica na Rua A, 10", "clinic:hours": "Seg a sex, 8h às 18h",
+                    "consultation:value": "O valor é R$ 500"}
+
+    def cacheable_block_key(self, relevant_knowledge):
+        return relevant_knowledge # Nos testes, o 'conhecimento relevante' já é a chave do bloco
+
+@pytest.mark.parametrize("intent, message", [
+    ("endereco", "qual o endereço?"),
+    ("endereco", "Onde fica o consultório?"),
+    ("horarios", "qual o horário de atendimento?"),
+    ("horarios", "que horas vocês abrem?"),
+    ("valor_consulta", "quanto custa a consulta?"),
+    ("contato", "me passa o telefone da clínica por favor"),
+])
+def test_direct_questions_match_intent(intent, message):
+    assert message_matches_intent(intent, message)
+
+@pytest.mark.parametrize("intent, message", [
+    ("endereco", "tem estacionamento perto do endereço?"),
+    ("horarios", "atende pelo ipe?"),
+    ("horarios", "atende sábado?"),
+    ("valor_consulta", "aceita cartão de crédito parcelado?"),
+    ("valor_consulta", "quanto custa a rinoplastia?"),
+    ("endereco", "bom dia"),
+])
+def test_other_questions_go_to_llm(intent, message):
+    assert not message_matches_intent(intent, message)
+
+def test_responder_only_answers_enabled_matching_intents():
+    responder = FastPathResponder(FakeKnowledge(), {"endereco", "horarios"}, clinic_name="Clínica Teste")
+    assert responder.respond("qual o endereço?", "clinic:address", first_turn=False) == "Nosso consultório fica na Rua A, 10"
+    assert responder.respond("tem estacionamento perto do endereço?", "clinic:address", first_turn=False) is None
+    assert responder.respond("atende pelo ipe?", "clinic:hours", first_turn=False) is None
+    assert responder.respond("quanto custa a consulta?", "consultation:value", first_turn=False) is None # Intenção desligada
+    assert responder.respond("qual o endereço?", "clinic:address", first_turn=True).startswith("Olá! Sou a Margot, da Clínica Teste.")
+    assert responder.metrics()["bypassed_by_intent"] == {"endereco": 2, "horarios": 0}
+
+def test_fast_path_is_off_by_default():
+    assert parse_enabled_intents(None) == frozenset()
+    assert parse_enabled_intents("all") == frozenset({"endereco", "horarios", "links", "contato", "valor_consulta"})
+    assert parse_enabled_intents("endereco, desconhecida") == frozenset({"endereco"})
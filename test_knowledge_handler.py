@@ -0,0 +1,53 @@
+# test_knowledge_handler.py - Hot reload da base de conhecimento (índice semântico com encoder simulado)
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+
+from knowledge_handler import KnowledgeHandler
+from semantic_index import SemanticIndex
+
+def fake_encoder(texts):
+    """Vetores determinísticos por texto (sem modelo): suficiente para verificar troca e reaproveitamento."""
+    return np.array([np.frombuffer(hashlib.sha256(text.encode("utf-8")).digest(), dtype=np.uint8)[:16] for text in texts], dtype=np.float32) + 1.0
+
+def test_reload_builds_semantic_index_aside_and_swaps_with_blocks(tmp_path):
+    json_path = str(tmp_path / "knowledge_base.json")
+    shutil.copy("knowledge_base.json", json_path)
+    handler = KnowledgeHandler(json_file_path=json_path, semantic_index=SemanticIndex(fake_encoder, "fake", str(tmp_path / "semantic")),
+                               use_snapshot=False)
+    live_index, live_state = handler.semantic_index, handler.semantic_index._state
+    assert [chunk.chunk_id for chunk in live_state[1]] == [chunk.chunk_id for chunk in handler._search_index.chunks]
+
+    with open(json_path, encoding="utf-8") as f:
+        data = json.load(f)
+    data["faq"][0]["answer"] = "O valor da consulta de avaliação é R$ 600,00."
+    with open(json_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.utime(json_path, (1, 1))
+
+    snapshot = handler._build_snapshot()
+    assert live_index._state is live_state # A montagem em thread não toca no índice em uso
+    assert snapshot["semantic_index"] is not live_index
+
+    assert handler._apply_snapshot(snapshot, os.path.getmtime(json_path))
+    assert handler.semantic_index is snapshot["semantic_index"]
+    assert handler.semantic_index._state[1] == handler._search_index.chunks
+    assert 0 < handler.semantic_index.embedded_last_sync < len(handler.semantic_index) # Só os blocos alterados
+
+def test_scheduling_rules_skip_bad_durations_and_are_parsed_once_per_version(tmp_path):
+    json_path = str(tmp_path / "knowledge_base.json")
+    with open("knowledge_base.json", encoding="utf-8") as f:
+        data = json.load(f)
+    data["scheduling_rules"] = {"procedure_durations": {"Rinoplastia": 90, "Otoplastia": "uma hora", "Lipo": None}}
+    with open(json_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    handler = KnowledgeHandler(json_file_path=json_path, use_snapshot=False)
+    rules = handler.get_scheduling_rules()
+    assert rules["procedure_durations"] == {"rinoplastia": 90}
+    assert handler.duration_for_procedure("quero fazer rinoplastia") == 90
+    assert handler.get_scheduling_rules() is rules
+    handler.data_mtime = (handler.data_mtime or 0) + 1 # Nova versão da base
+    assert handler.get_scheduling_rules() is not rules
@@ -0,0 +1,23 @@
+# test_knowledge_snapshot.py - Gravação e leitura do snapshot compilado
+import os
+import threading
+
+from knowledge_snapshot import load_snapshot, save_snapshot
+
+def test_concurrent_saves_leave_one_complete_snapshot(tmp_path):
+    path = str(tmp_path / "knowledge_base.snapshot.pkl")
+    payloads = [{"blocks": {f"bloco:{writer}": "x" * 200_000}, "writer": writer} for writer in range(8)]
+    results = []
+    threads = [threading.Thread(target=lambda fields=fields: results.append(save_snapshot(path, "hash", "9.5", fields))) for fields in payloads]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    assert results == [True] * 8
+    fields = load_snapshot(path, "hash", "9.5")
+    assert fields in payloads
+    assert os.listdir(tmp_path) == ["knowledge_base.snapshot.pkl"] # Nenhum temporário sobrando
+
+def test_snapshot_of_other_source_is_ignored(tmp_path):
+    path = str(tmp_path / "knowledge_base.snapshot.pkl")
+    assert save_snapshot(path, "hash-antigo", "9.5", {"data": {}})
+    assert load_snapshot(path, "hash-novo", "9.5") is None
+    assert load_snapshot(path, "hash-antigo", "9.4") is None
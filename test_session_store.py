@@ -0,0 +1,108 @@
+# test_session_store.py - Backends de sessão (memória e Redis)
+import asyncio
+import datetime
+
+import fakeredis
+import pytest
+import pytz
+
+from session_store import InMemorySessionStore, RedisSessionStore, SessionLockTimeout
+from slot_preferences import SlotPreferences
+
+DEFAULT_STATE = {"history": [], "scheduling_status": None, "patient_data": {}}
+TZ = pytz.timezone("America/Sao_Paulo")
+SENDER = "whatsapp:+5500000000001"
+
+def redis_store(server: fakeredis.FakeServer, **kwargs) -> RedisSessionStore:
+    """RedisSessionStore com o cliente trocado por um Redis simulado (mesmo server = workers compartilhando o Redis)."""
+    store = RedisSessionStore(DEFAULT_STATE, "redis://redis.teste:6379/0", tz=TZ, **kwargs)
+    store.redis = fakeredis.FakeAsyncRedis(server=server, decode_responses=True)
+    return store
+
+def test_in_memory_store_round_trip():
+    async def scenario():
+        store = InMemorySessionStore(DEFAULT_STATE)
+        await store.check()
+        session = await store.load("whatsapp:+5500000000001")
+        session["scheduling_status"] = "awaiting_name"
+        await store.save("whatsapp:+5500000000001", session)
+        return await store.load("whatsapp:+5500000000001")
+    assert asyncio.run(scenario())["scheduling_status"] == "awaiting_name"
+
+def test_unreachable_redis_fails_check():
+    async def scenario():
+        store = RedisSessionStore(DEFAULT_STATE, "redis://127.0.0.1:1/0")
+        try:
+            await store.check()
+        finally:
+            await store.aclose()
+    with pytest.raises(Exception):
+        asyncio.run(scenario())
+
+def test_redis_store_round_trip_keeps_datetimes_cursor_and_preferences():
+    slot = TZ.localize(datetime.datetime(2026, 11, 2, 14, 0))
+    preferences = SlotPreferences(weekdays=(3,), start_before_minute=12 * 60, earliest=datetime.date(2026, 11, 20))
+    async def scenario():
+        store = redis_store(fakeredis.FakeServer(), ttl_seconds=120)
+        await store.check()
+        session = await store.load(SENDER)
+        session["scheduling_status"] = "awaiting_choice"
+        session["suggested_slots"] = [slot, slot + datetime.timedelta(days=1)]
+        session["chosen_slot"] = slot
+        session["slot_cursor"] = {"origin": slot, "next_start": slot + datetime.timedelta(minutes=1), "duration": 45, "block": 60,
+                                  "preferences": preferences.to_dict()}
+        session["slot_preferences"] = preferences.to_dict()
+        await store.save(SENDER, session)
+        loaded = await store.load(SENDER)
+        ttl = await store.redis.ttl(f"sessao:{SENDER}")
+        await store.aclose()
+        return loaded, ttl
+    loaded, ttl = asyncio.run(scenario())
+    assert loaded["scheduling_status"] == "awaiting_choice"
+    assert loaded["suggested_slots"] == [slot, slot + datetime.timedelta(days=1)]
+    assert loaded["chosen_slot"].tzinfo.zone == "America/Sao_Paulo" # Volta no fuso da clínica
+    cursor = loaded["slot_cursor"]
+    assert (cursor["origin"], cursor["duration"], cursor["block"]) == (slot, 45, 60)
+    assert cursor["next_start"] - cursor["origin"] == datetime.timedelta(minutes=1)
+    assert SlotPreferences.from_dict(cursor["preferences"]) == preferences
+    assert SlotPreferences.from_dict(loaded["slot_preferences"]) == preferences
+    assert 0 < ttl <= 120
+
+def test_redis_store_new_session_uses_patient_memory():
+    async def scenario():
+        store = redis_store(fakeredis.FakeServer())
+        await store.save_patient_memory(SENDER, {"name": "Maria", "email": None})
+        session = await store.load(SENDER)
+        await store.delete(SENDER)
+        await store.aclose()
+        return session
+    assert asyncio.run(scenario())["patient_data"] == {"name": "Maria"}
+
+def test_redis_lock_serializes_messages_of_same_sender():
+    async def scenario():
+        store = redis_store(fakeredis.FakeServer())
+        order = []
+        async def handle(message: str):
+            async with store.lock(SENDER):
+                order.append(f"{message}:início")
+                await asyncio.sleep(0.02)
+                order.append(f"{message}:fim")
+        await asyncio.gather(handle("primeira"), handle("segunda"))
+        await store.aclose()
+        return order
+    assert asyncio.run(scenario()) == ["primeira:início", "primeira:fim", "segunda:início", "segunda:fim"]
+
+def test_redis_lock_is_shared_between_workers():
+    async def scenario():
+        server = fakeredis.FakeServer()
+        worker_a, worker_b = redis_store(server), redis_store(server, lock_wait_seconds=0.2)
+        try:
+            async with worker_a.lock(SENDER):
+                with pytest.raises(SessionLockTimeout):
+                    async with worker_b.lock(SENDER):
+                        pass
+            async with worker_b.lock(SENDER): # Liberado pelo outro worker
+                return True
+        finally:
+            await worker_a.aclose(); await worker_b.aclose()
+    assert asyncio.run(scenario())
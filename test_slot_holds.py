@@ -0,0 +1,69 @@
+# test_slot_holds.py - Reservas provisórias de horários (memória e Redis simulado com fakeredis)
+import asyncio
+import datetime
+
+import fakeredis
+import pytest
+import pytz
+
+from slot_holds import InMemorySlotHolds, RedisSlotHolds
+
+TZ = pytz.timezone("America/Sao_Paulo")
+DAY = datetime.date.today() + datetime.timedelta(days=7)
+
+def at(hour: int, minute: int = 0) -> datetime.datetime:
+    return TZ.localize(datetime.datetime.combine(DAY, datetime.time(hour, minute)))
+
+def make_holds(backend: str):
+    if backend == "memory":
+        return InMemorySlotHolds(ttl_seconds=60)
+    return RedisSlotHolds(fakeredis.FakeAsyncRedis(decode_responses=True), ttl_seconds=60)
+
+BACKENDS = ["memory", "redis"]
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_slot_held_by_one_patient_is_refused_to_another(backend):
+    async def scenario():
+        holds = make_holds(backend)
+        first = await holds.hold("clinica", "paciente-a", [at(14), at(15)], 45)
+        second = await holds.hold("clinica", "paciente-b", [at(14), at(16)], 45)
+        again = await holds.hold("clinica", "paciente-a", [at(14)], 45) # O próprio dono renova
+        return first, second, again, await holds.held_by_others("clinica", "paciente-b"), holds
+    first, second, again, others, holds = asyncio.run(scenario())
+    assert first == [at(14), at(15)] and second == [at(16)] and again == [at(14)]
+    assert sorted(others) == [(at(14), at(14, 45)), (at(15), at(15, 45))]
+    assert holds.conflicts == 1
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_overlapping_slot_with_different_start_is_refused(backend):
+    async def scenario():
+        holds = make_holds(backend)
+        await holds.hold("clinica", "paciente-a", [at(14)], 45) # 14:00-14:45
+        overlapping = await holds.hold("clinica", "paciente-b", [at(14, 30), at(13, 30)], 45) # 14:30-15:15 e 13:30-14:15
+        adjacent = await holds.hold("clinica", "paciente-b", [at(14, 45), at(13, 15)], 45) # Encostam, não sobrepõem
+        other_clinic = await holds.hold("outra", "paciente-b", [at(14, 30)], 45)
+        return overlapping, adjacent, other_clinic
+    overlapping, adjacent, other_clinic = asyncio.run(scenario())
+    assert overlapping == []
+    assert adjacent == [at(14, 45), at(13, 15)]
+    assert other_clinic == [at(14, 30)]
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_release_only_frees_own_holds(backend):
+    async def scenario():
+        holds = make_holds(backend)
+        await holds.hold("clinica", "paciente-a", [at(14)], 45)
+        await holds.release("clinica", "paciente-b", [at(14)]) # Não é dono: nada muda
+        refused = await holds.hold("clinica", "paciente-b", [at(14, 15)], 45)
+        await holds.release("clinica", "paciente-a", [at(14)])
+        accepted = await holds.hold("clinica", "paciente-b", [at(14, 15)], 45)
+        return refused, accepted, holds.releases
+    refused, accepted, releases = asyncio.run(scenario())
+    assert refused == [] and accepted == [at(14, 15)] and releases == 1
+
+def test_expired_hold_no_longer_blocks():
+    async def scenario():
+        holds = InMemorySlotHolds(ttl_seconds=0)
+        await holds.hold("clinica", "paciente-a", [at(14)], 45)
+        return await holds.hold("clinica", "paciente-b", [at(14, 30)], 45)
+    assert asyncio.run(scenario()) == [at(14, 30)]
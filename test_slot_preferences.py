@@ -0,0 +1,64 @@
+# test_slot_preferences.py - Preferências de horário em texto livre e escolha na lista de horários
+import datetime
+
+import pytest
+import pytz
+
+from slot_preferences import SlotPreferences, match_listed_slot, parse_slot_preferences
+
+TZ = pytz.timezone("America/Sao_Paulo")
+TODAY = datetime.date(2026, 10, 18) # Domingo
+SLOTS = [TZ.localize(datetime.datetime(2026, 10, day, hour)) for day, hour in [(19, 14), (20, 15), (20, 16), (26, 14), (27, 9)]]
+
+@pytest.mark.parametrize("message, expected", [
+    ("pode ser quinta", SlotPreferences(weekdays=(3,))),
+    ("segunda ou terça", SlotPreferences(weekdays=(0, 1))),
+    ("quintas-feiras de manhã", SlotPreferences(weekdays=(3,), start_after_minute=6 * 60, start_before_minute=12 * 60)),
+    ("à tarde", SlotPreferences(start_after_minute=12 * 60, start_before_minute=18 * 60)),
+    ("depois das 15h", SlotPreferences(start_after_minute=15 * 60)),
+    ("antes das 16:30", SlotPreferences(start_before_minute=16 * 60 + 30)),
+    ("depois do dia 20", SlotPreferences(earliest=datetime.date(2026, 10, 21))),
+    ("a partir do dia 20", SlotPreferences(earliest=datetime.date(2026, 10, 20))),
+    ("até 05/11", SlotPreferences(latest=datetime.date(2026, 11, 5))),
+    ("semana que vem", SlotPreferences(earliest=datetime.date(2026, 10, 19), latest=datetime.date(2026, 10, 25))),
+    ("amanhã", SlotPreferences(earliest=datetime.date(2026, 10, 19), latest=datetime.date(2026, 10, 19))),
+    ("dia 2", SlotPreferences(earliest=datetime.date(2026, 11, 2), latest=datetime.date(2026, 11, 2))),
+])
+def test_parse_preferences(message, expected):
+    assert parse_slot_preferences(message, TODAY) == expected
+
+@pytest.mark.parametrize("message", [
+    "quinta às 15h", # Horário exato: escolha, não filtro
+    "a segunda opção",
+    "boa tarde!",
+    "Maria da Silva Segunda", # Sobrenome, não dia da semana
+    "sim, pode confirmar",
+])
+def test_messages_without_preferences(message):
+    assert parse_slot_preferences(message, TODAY) is None
+
+def test_preferences_accept_and_round_trip():
+    preferences = parse_slot_preferences("quinta de manhã depois do dia 20", TODAY)
+    assert preferences.accepts(TZ.localize(datetime.datetime(2026, 10, 22, 9)))
+    assert not preferences.accepts(TZ.localize(datetime.datetime(2026, 10, 22, 14)))
+    assert not preferences.accepts(TZ.localize(datetime.datetime(2026, 10, 23, 9)))
+    assert SlotPreferences.from_dict(preferences.to_dict()) == preferences
+    assert preferences.describe() == "às quintas, de manhã, a partir de 21/10"
+
+@pytest.mark.parametrize("message, expected", [
+    ("a segunda", 1),
+    ("pode ser a segunda", 1),
+    ("o primeiro horário", 0),
+    ("quinta opção", 4),
+    ("a última", 4),
+    ("19/10", 0),
+    ("dia 26", 3),
+    ("dia 20 às 16h", 2),
+    ("dia 20", None), # Dois horários no dia 20
+    ("na segunda", None), # Dia da semana
+    ("segunda-feira", None),
+    ("26/11", None), # Mês diferente
+    ("Maria da Silva Segunda", None),
+])
+def test_match_listed_slot(message, expected):
+    assert match_listed_slot(message, SLOTS) == expected
@@ -0,0 +1,51 @@
+# test_tenant_registry.py - Roteamento e LRU de clínicas (recursos simulados)
+import asyncio
+
+from tenant_registry import Tenant, TenantConfig, TenantRegistry, normalize_number
+
+def make_config(tenant_id: str, number: str) -> TenantConfig:
+    return TenantConfig(tenant_id, f"whatsapp:{number}", "knowledge_base.json", "Margot", None, None, "America/Sao_Paulo",
+                        "http://caldav.teste/", "u", "p", "Consultas", None)
+
+class FakeResource:
+    """Fecha devagar (como o pool do CalDAV), abrindo espaço para outra requisição no meio."""
+    def __init__(self):
+        self.closed = False
+
+    async def aclose(self):
+        await asyncio.sleep(0.01)
+        self.closed = True
+
+async def factory(config: TenantConfig) -> Tenant:
+    await asyncio.sleep(0)
+    return Tenant(config, FakeResource(), None, FakeResource(), None)
+
+CONFIGS = [make_config("a", "+5554000000001"), make_config("b", "+5554000000002"), make_config("c", "+5554000000003")]
+
+def test_normalize_number():
+    assert normalize_number("whatsapp:+55 54 99118-1305") == "+5554991181305"
+
+def test_unknown_number_without_default_is_refused():
+    async def scenario():
+        registry = TenantRegistry(CONFIGS, factory)
+        async with registry.lease("whatsapp:+1999") as tenant:
+            return tenant
+    assert asyncio.run(scenario()) is None
+
+def test_tenant_handed_out_is_not_closed_by_concurrent_eviction():
+    async def scenario():
+        registry = TenantRegistry(CONFIGS, factory, max_loaded=1)
+        await registry.get(CONFIGS[0])
+        seen = []
+        async def request(config: TenantConfig):
+            async with registry.lease(config.whatsapp_number) as tenant:
+                await asyncio.sleep(0.02) # Atendimento em andamento
+                seen.append((tenant.tenant_id, tenant.caldav_handler.closed))
+            return tenant
+        tenants = await asyncio.gather(request(CONFIGS[1]), request(CONFIGS[2]))
+        await registry.aclose()
+        return seen, tenants, registry
+    seen, tenants, registry = asyncio.run(scenario())
+    assert sorted(seen) == [("b", False), ("c", False)]
+    assert all(tenant.caldav_handler.closed for tenant in tenants) # Fechadas depois da última requisição / no shutdown
+    assert registry.evictions == 2
@@ -0,0 +1,128 @@
+# test_webhook.py - Fluxo de agendamento pelo webhook (CalDAV e OpenAI simulados, sem rede)
+import os
+import time
+import threading
+
+import pytest
+import pytz
+
+os.environ.update({
+    "TWILIO_ACCOUNT_SID": "AC_teste", "TWILIO_AUTH_TOKEN": "teste", "TWILIO_WHATSAPP_NUMBER": "whatsapp:+5554991181305",
+    "OPENAI_API_KEY": "sk-teste", "CALDAV_URL": "http://caldav.teste/", "CALDAV_USERNAME": "u", "CALDAV_PASSWORD": "p",
+    "CALDAV_CALENDAR_NAME": "Consultas", "SESSION_STORE": "memory", "KNOWLEDGE_SNAPSHOT": "false",
+    "SLOT_REFRESH_INTERVAL_SECONDS": "0", "RELATIONSHIP_TEAM_WHATSAPP": "whatsapp:+5554999990000", "LOG_LEVEL": "WARNING",
+})
+os.environ.pop("TENANTS_FILE", None)
+
+import async_caldav_handler
+import openai_handler
+from caldav_handler import BusyIntervals
+
+TZ = pytz.timezone("America/Sao_Paulo")
+gpt_prompts = [] # Mensagens enviadas ao GPT (para conferir qual ramo chamou)
+gpt_answers = {"Qual NÚMERO": " 2\n"} # Trecho do prompt -> resposta simulada
+
+async def _noop(self, *args, **kwargs): return None
+async def _connected(self): return True
+async def _busy(self, range_start, range_end): return BusyIntervals([])
+async def _search(self, start, end, expand=True): return []
+async def _save_event(self, vcal_string, uid): return async_caldav_handler.AsyncCalendarObject(f"http://caldav.teste/{uid}.ics", None, vcal_string)
+async def _chat(self, user_message, **kwargs):
+    gpt_prompts.append(user_message)
+    return next((answer for marker, answer in gpt_answers.items() if marker in user_message), "Resposta do GPT")
+
+@pytest.fixture(scope="module")
+def client():
+    patches = [
+        (async_caldav_handler.AsyncCaldavHandler, "connect", _noop), (async_caldav_handler.AsyncCaldavHandler, "aclose", _noop),
+        (async_caldav_handler.AsyncCaldavHandler, "_is_connected", _connected),
+        (async_caldav_handler.AsyncCaldavHandler, "_get_busy_intervals", _busy),
+        (async_caldav_handler.AsyncCaldavHandler, "search", _search), (async_caldav_handler.AsyncCaldavHandler, "save_event", _save_event),
+        (openai_handler.OpenAIHandler, "get_chat_response", _chat), (openai_handler.OpenAIHandler, "aclose", _noop),
+    ]
+    originals = [(owner, name, getattr(owner, name)) for owner, name, _ in patches]
+    for owner, name, replacement in patches: setattr(owner, name, replacement)
+    import main
+    from fastapi.testclient import TestClient
+    with TestClient(main.app) as test_client:
+        yield test_client
+    for owner, name, original in originals: setattr(owner, name, original)
+
+class FakeTwilioMessages:
+    """Registra os envios e a thread em que aconteceram (o event loop não pode esperar a rede)."""
+    def __init__(self):
+        self.sent = []
+
+    def create(self, from_, body, to):
+        self.sent.append({"from_": from_, "to": to, "body": body, "thread": threading.current_thread()})
+
+def send(client, sender: str, body: str) -> str:
+    response = client.post("/whatsapp", data={"From": sender, "To": "whatsapp:+5554991181305", "Body": body})
+    assert response.status_code == 200
+    return response.text.split("<Message>")[-1].split("</Message>")[0] if "<Message>" in response.text else response.text
+
+def session_of(sender: str):
+    import main
+    return main.session_store.sessions[sender]
+
+def reach_awaiting_choice(client, sender: str) -> list:
+    for message in ("quero agendar uma consulta", "Maria Silva", "54999998888", "maria@exemplo.com", "rinoplastia", "não"):
+        send(client, sender, message)
+    session = session_of(sender)
+    assert session["scheduling_status"] == "awaiting_choice"
+    return list(session["suggested_slots"])
+
+def test_gpt_fallback_recognizes_option(client):
+    sender = "whatsapp:+5500000000401"
+    slots = reach_awaiting_choice(client, sender)
+    gpt_prompts.clear()
+    reply = send(client, sender, "aquele que você comentou, pode ser esse")
+    assert any("Qual NÚMERO" in prompt for prompt in gpt_prompts)
+    session = session_of(sender)
+    assert session["scheduling_status"] == "awaiting_confirmation"
+    assert session["chosen_slot"] == slots[1]
+    assert "Podemos confirmar" in reply
+
+def test_relationship_team_notice_is_sent_off_the_event_loop(client, monkeypatch):
+    import main
+    fake_messages = FakeTwilioMessages()
+    monkeypatch.setattr(main, "twilio_client", type("FakeTwilio", (), {"messages": fake_messages})())
+    sender = "whatsapp:+5500000000405"
+    reach_awaiting_choice(client, sender)
+    send(client, sender, "1")
+    reply = send(client, sender, "sim")
+    assert "confirmad" in reply.lower()
+    deadline = time.monotonic() + 3
+    while not fake_messages.sent and time.monotonic() < deadline: time.sleep(0.02)
+    assert [message["to"] for message in fake_messages.sent] == ["whatsapp:+5554999990000"]
+    assert "Nova consulta agendada" in fake_messages.sent[0]["body"]
+    assert fake_messages.sent[0]["thread"].name.startswith(("asyncio_", "ThreadPoolExecutor")) # asyncio.to_thread
+
+def test_ordinal_picks_listed_option_instead_of_weekday(client):
+    sender = "whatsapp:+5500000000402"
+    slots = reach_awaiting_choice(client, sender)
+    send(client, sender, "pode ser a segunda")
+    session = session_of(sender)
+    assert session["scheduling_status"] == "awaiting_confirmation"
+    assert session["chosen_slot"] == slots[1]
+
+def test_date_of_listed_slot_picks_it(client):
+    sender = "whatsapp:+5500000000403"
+    slots = reach_awaiting_choice(client, sender)
+    chosen = slots[-1]
+    same_day = sum(slot.date() == chosen.date() for slot in slots)
+    send(client, sender, f"{chosen.day:02d}/{chosen.month:02d}" + (f" às {chosen.hour}h" if same_day > 1 else ""))
+    session = session_of(sender)
+    assert session["scheduling_status"] == "awaiting_confirmation"
+    assert session["chosen_slot"] == chosen
+
+def test_new_preference_starts_restricted_search(client):
+    sender = "whatsapp:+5500000000404"
+    reach_awaiting_choice(client, sender)
+    gpt_prompts.clear()
+    send(client, sender, "prefiro na terça")
+    session = session_of(sender)
+    assert session["scheduling_status"] == "awaiting_choice"
+    assert session["slot_preferences"]["weekdays"] == [1]
+    assert all(slot.weekday() == 1 for slot in session["suggested_slots"])
+    assert not gpt_prompts # Preferência não gasta chamada ao GPT